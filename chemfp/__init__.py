@@ -127,9 +127,14 @@ def open(source, format=None):
     The supported format strings are:
 
        fps, fps.gz  - fingerprints are in FPS format
-    
-    The result is an FPSReader. Here's an example of printing the
-    contents of the file::
+       fpb          - fingerprints are in the binary FPB format
+
+    For FPS files the result is an FPSReader. If an uncompressed FPS
+    file has a current ".fpsidx" index, made by the fpsindex program,
+    then the reader uses it for random access. An FPB file is
+    memory-mapped and the result is a FingerprintArena which can be
+    searched directly. Here's an example of printing the contents of
+    the file::
     
         reader = open("example.fps.gz")
         for id, fp in reader:
@@ -140,7 +145,7 @@ def open(source, format=None):
     :param format: The file format and optional compression.
     :type format: string, or None
 
-    :returns: an FPSReader
+    :returns: an FPSReader or, for FPB files, a FingerprintArena
     """
     from . import io
     format_name, compression = io.normalize_format(source, format)
@@ -150,7 +155,10 @@ def open(source, format=None):
         return readers.open_fps(source, format_name+compression)
 
     if format_name == "fpb":
-        raise NotImplementedError("fpb format support not implemented")
+        if compression:
+            raise ValueError("The fpb format does not support compression")
+        from . import fpb
+        return fpb.open_fpb(source)
 
     raise TypeError("Unable to determine fingerprint format type from %r" % (source,))
 
@@ -170,6 +178,10 @@ def load_fingerprints(reader, metadata=None, reorder=True, alignment=None):
     The loader may reorder the fingerprints for better search performance.
     To prevent ordering, use reorder=False.
 
+    An FPB file is already stored as an arena. It is memory-mapped and
+    returned as-is, unless a different alignment is requested or the
+    arena must be reordered.
+
     The 'alignment' option specifies the alignment data alignment and
     padding size for each fingerprint. A value of 8 means that each
     fingerprint will start on a 8 byte alignment, and use storage
@@ -194,6 +206,13 @@ def load_fingerprints(reader, metadata=None, reorder=True, alignment=None):
         metadata = reader.metadata
 
     from . import arena
+    if (isinstance(reader, arena.FingerprintArena) and
+        metadata is reader.metadata and
+        (alignment is None or alignment == reader.alignment) and
+        (reader.popcount_indices or not reorder)):
+        # Already in the right form (eg, a memory-mapped FPB file)
+        return reader
+
     return arena.fps_to_arena(reader, metadata=metadata, reorder=reorder,
                               alignment=alignment)
 
@@ -0,0 +1,256 @@
+"""Run searches in the background and get the results as futures
+
+The chemfp searches release the GIL, so they can run in worker threads
+while the calling thread does something else, like serve other
+requests. A SearchExecutor has a fixed number of worker threads. Each
+search method queues the search and immediately returns a Future with
+the same API as the standard concurrent.futures (here from the bundled
+chemfp.futures package):
+
+  executor = aio.SearchExecutor(max_workers=4)
+  future = executor.knearest_tanimoto_search_fp(query_fp, targets, k=5, threshold=0.0)
+  future.add_done_callback(send_response)
+  ...
+  executor.shutdown()
+
+The targets may be a FingerprintArena or an FPSReader, and the result
+is what the corresponding function in chemfp.search or
+chemfp.fps_search returns. Since the searches are queued, a process
+can have many more requests in flight than there are workers.
+
+A queued search can be cancelled with future.cancel(). An arena
+search which has already started can't be stopped, but an FPSReader
+scan can. It checks for a cancel request between blocks, and the
+future is cancelled once the current block is finished.
+
+Use read_blocks() to read the blocks of an FPSReader in a worker
+thread, one future per block.
+
+If you use more than one worker then you probably want
+chemfp.set_num_threads(1), so the OpenMP threads of one search don't
+compete with the other searches.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import collections
+import threading
+
+from . import search, fps_search
+from .futures import _base
+from .futures import ThreadPoolExecutor, Future, CancelledError
+from .readers import FPSReader
+
+__all__ = ["SearchExecutor", "SearchFuture", "BlockStream", "CancelledError"]
+
+
+class SearchFuture(Future):
+    """A Future for a search, which may be cancelled while it runs
+
+    This is a concurrent.futures Future. The difference is that cancel()
+    of a running search which supports cancellation (an FPSReader
+    scan) tells the search to stop and returns True. The future is
+    cancelled when the search stops, which is at the end of the
+    current block. (If that was the last block then the search
+    finishes normally and the future has the result.)
+    """
+    def __init__(self):
+        super(SearchFuture, self).__init__()
+        self._cancel_event = threading.Event()
+        self._can_cancel_while_running = False
+
+    def cancel(self):
+        if super(SearchFuture, self).cancel():
+            return True
+        with self._condition:
+            if self._state != _base.RUNNING or not self._can_cancel_while_running:
+                return False
+            self._cancel_event.set()
+            return True
+
+    def _set_cancelled(self):
+        # The running search stopped because of a cancel() request
+        with self._condition:
+            self._state = _base.CANCELLED_AND_NOTIFIED
+            for waiter in self._waiters:
+                waiter.add_cancelled(self)
+            self._condition.notify_all()
+        self._invoke_callbacks()
+
+
+class _CancellableReader(object):
+    # Pass everything through to the FPSReader, except that
+    # iter_blocks() and _iter_search_blocks() stop with a
+    # CancelledError if there's a cancel request. The FPS scans only
+    # use those and the metadata, index and error reporting attributes.
+    def __init__(self, reader, cancel_event):
+        self._reader = reader
+        self._cancel_event = cancel_event
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
+    def iter_blocks(self):
+        cancel_event = self._cancel_event
+        for block in self._reader.iter_blocks():
+            if cancel_event.isSet():
+                raise CancelledError()
+            yield block
+    def _iter_search_blocks(self, min_popcount=None, max_popcount=None):
+        cancel_event = self._cancel_event
+        for lineno, block in self._reader._iter_search_blocks(min_popcount, max_popcount):
+            if cancel_event.isSet():
+                raise CancelledError()
+            yield lineno, block
+
+
+def _run(future, f, args):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        result = f(*args)
+    except CancelledError:
+        if future._cancel_event.isSet():
+            future._set_cancelled()
+        else:
+            future.set_exception(CancelledError())
+    except BaseException, err:
+        future.set_exception(err)
+    else:
+        future.set_result(result)
+
+
+class SearchExecutor(object):
+    """Run chemfp searches in a pool of worker threads
+
+    'max_workers' is the number of searches which can run at the same
+    time. The default is chemfp.get_max_threads(). The other searches
+    wait in a queue until a worker is free.
+
+    The search methods have the same parameters as the chemfp.search
+    functions, except that the targets may also be an FPSReader, and
+    they return a SearchFuture for the result.
+    """
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            from . import get_max_threads
+            max_workers = get_max_threads()
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers)
+
+    def submit(self, f, *args):
+        """Call f(*args) in a worker thread and return a SearchFuture for the result"""
+        future = SearchFuture()
+        self._executor.submit(_run, future, f, args)
+        return future
+
+    def _submit_search(self, targets, arena_f, fps_f, *args):
+        if isinstance(targets, FPSReader):
+            future = SearchFuture()
+            future._can_cancel_while_running = True
+            reader = _CancellableReader(targets, future._cancel_event)
+            self._executor.submit(_run, future, fps_f, args[:1] + (reader,) + args[1:])
+            return future
+        return self.submit(arena_f, *(args[:1] + (targets,) + args[1:]))
+
+    def count_tanimoto_hits_fp(self, query_fp, targets, threshold=0.7):
+        """Count the targets which are at least 'threshold' similar to 'query_fp'"""
+        return self._submit_search(targets, search.count_tanimoto_hits_fp,
+                                   fps_search.count_tanimoto_hits_fp, query_fp, threshold)
+
+    def count_tanimoto_hits(self, queries, targets, threshold=0.7):
+        """Count the targets which are at least 'threshold' similar to each query"""
+        return self._submit_search(targets, search.count_tanimoto_hits,
+                                   fps_search.count_tanimoto_hits_arena, queries, threshold)
+
+    def threshold_tanimoto_search_fp(self, query_fp, targets, threshold=0.7):
+        """Find the targets which are at least 'threshold' similar to 'query_fp'
+
+        For an FPSReader the result is a list of (id, score) pairs.
+        """
+        return self._submit_search(targets, search.threshold_tanimoto_search_fp,
+                                   fps_search.id_threshold_tanimoto_search_fp,
+                                   query_fp, threshold)
+
+    def threshold_tanimoto_search(self, queries, targets, threshold=0.7):
+        """Find the targets which are at least 'threshold' similar to each query"""
+        return self._submit_search(targets, search.threshold_tanimoto_search,
+                                   fps_search.threshold_tanimoto_search_arena,
+                                   queries, threshold)
+
+    def knearest_tanimoto_search_fp(self, query_fp, targets, k=3, threshold=0.7):
+        """Find the 'k' targets most similar to 'query_fp' with at least 'threshold' similarity
+
+        For an FPSReader the result is a list of (id, score) pairs.
+        """
+        return self._submit_search(targets, search.knearest_tanimoto_search_fp,
+                                   fps_search.id_knearest_tanimoto_search_fp,
+                                   query_fp, k, threshold)
+
+    def knearest_tanimoto_search(self, queries, targets, k=3, threshold=0.7):
+        """Find the 'k' targets most similar to each query with at least 'threshold' similarity"""
+        return self._submit_search(targets, search.knearest_tanimoto_search,
+                                   fps_search.knearest_tanimoto_search,
+                                   queries, k, threshold)
+
+    def read_blocks(self, reader):
+        """Return a BlockStream to read the blocks of an FPSReader in the worker threads"""
+        return BlockStream(self, reader)
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads once the queued searches are done"""
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True)
+        return False
+
+
+class BlockStream(object):
+    """Read the blocks of an FPSReader without blocking the caller
+
+    Each call to read() returns a SearchFuture for the next block of
+    the file, or for None at the end of the file. The file is read by
+    the executor's worker threads. The futures get the blocks in the
+    order that read() was called, even if several reads are pending.
+    A cancelled read doesn't consume a block.
+    """
+    def __init__(self, executor, reader):
+        self._executor = executor
+        self._blocks = reader.iter_blocks()
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._at_end = False
+
+    def read(self):
+        future = SearchFuture()
+        with self._lock:
+            self._pending.append(future)
+        self._executor._executor.submit(self._read_next)
+        return future
+
+    def _read_next(self):
+        # Each call handles the oldest pending future. The lock keeps
+        # the file reads in the same order as the futures. The result
+        # is set after the lock is released, in case a done callback
+        # calls read().
+        with self._lock:
+            future = self._pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                return
+            block = error = None
+            if not self._at_end:
+                try:
+                    block = next(self._blocks)
+                except StopIteration:
+                    self._at_end = True
+                except BaseException, err:
+                    self._at_end = True
+                    error = err
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(block)
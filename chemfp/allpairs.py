@@ -0,0 +1,364 @@
+"""All-pairs similarity search with the hits stored on disk
+
+search.threshold_tanimoto_search_symmetric() keeps every hit in an
+in-memory SearchResults. For a large data set and a low threshold
+that can be much more than the available memory. This module does the
+same search one tile at a time and appends each tile's hits to a
+file, so the memory use only depends on the tile size.
+
+  arena = chemfp.load_fingerprints("pubchem.fps.gz")
+  hits = allpairs.threshold_tanimoto_search_symmetric(
+               arena, 0.7, "pubchem_0.7.hits")
+  for index, score in hits[1234]:
+      print arena.ids[index], score
+
+The arena must be ordered by popcount, which is the default for
+load_fingerprints(). It is split into blocks of 'block_size'
+fingerprints. Tile (R, C) is the search of the fingerprints in block R
+against those in block C. Only the tiles on and above the diagonal are
+searched, with the same symmetric search as
+search.partial_threshold_tanimoto_search_symmetric(). The lower
+triangle, if requested, is the transpose of the tile's hits, so each
+tile is written as one or two row chunks. At most one tile's hits, and
+their transpose, are in memory at a time; that's at most
+2*block_size**2 hits. The search also uses 32 bytes per fingerprint
+for the row bookkeeping.
+
+A marker record is written after each finished tile. If the search is
+interrupted, call the function again with the same parameters and it
+will discard any partially written tile then continue with the next
+unfinished tile.
+
+The file layout, with all integers in native byte order, is:
+
+  header (64 bytes)
+     8 bytes  magic: "FPHITS1\\0"
+     uint32   byte order marker (0x01020304)
+     uint32   num_bits
+     uint64   number of fingerprints
+     double   threshold
+     uint32   block_size
+     uint32   flags (bit 0 is set if the lower triangle is included)
+     NUL padding
+
+  records, each starting with
+     4 bytes  "ROWS" or "DONE"
+     uint32   row_start, row_end, col_start, col_end
+     uint64   number of hits
+
+  A ROWS record is followed by the hits for rows [row_start, row_end)
+  with target indices in [col_start, col_end):
+     (row_end-row_start+1) uint64 offsets to the start of each row
+     number of hits C ints with the target indices
+     number of hits doubles with the scores
+  Within each row the hits are ordered by increasing index.
+
+  A DONE record, with no data, marks the tile (row_start, col_start)
+  as finished.
+"""
+
+from __future__ import absolute_import
+
+import os
+import mmap
+import array
+import struct
+
+import _chemfp
+
+__all__ = ["threshold_tanimoto_search_symmetric", "open_hits", "HitsReader"]
+
+MAGIC = "FPHITS1\0"
+BYTE_ORDER_MARKER = 0x01020304
+HEADER_SIZE = 64
+
+FLAG_LOWER_TRIANGLE = 1
+
+_header_struct = struct.Struct("=8sIIQdII")
+assert _header_struct.size <= HEADER_SIZE
+
+_record_struct = struct.Struct("=4sIIIIQ")
+_uint64_struct = struct.Struct("=Q")
+
+_INT_SIZE = array.array("i").itemsize
+_DOUBLE_SIZE = array.array("d").itemsize
+
+class HitsFormatError(ValueError):
+    pass
+
+
+def _pack_header(num_bits, num_fingerprints, threshold, block_size, flags):
+    header = _header_struct.pack(MAGIC, BYTE_ORDER_MARKER, num_bits, num_fingerprints,
+                                 threshold, block_size, flags)
+    return header + "\0" * (HEADER_SIZE - len(header))
+
+def _unpack_header(data, filename):
+    if len(data) < HEADER_SIZE:
+        raise HitsFormatError("File %r is too small to be an all-pairs hits file" % (filename,))
+    (magic, byte_order, num_bits, num_fingerprints, threshold, block_size,
+     flags) = _header_struct.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise HitsFormatError("File %r is not an all-pairs hits file" % (filename,))
+    if byte_order != BYTE_ORDER_MARKER:
+        raise HitsFormatError("File %r was written on a machine with a different byte order"
+                              % (filename,))
+    return num_bits, num_fingerprints, threshold, block_size, flags
+
+
+def _scan_records(data, filename):
+    # Return the ROWS records of the finished tiles, the finished tiles,
+    # and the file offset just past the last finished tile.
+    size = len(data)
+    offset = HEADER_SIZE
+    pending = []
+    chunks = []
+    done_tiles = set()
+    end_of_done = offset
+    while offset + _record_struct.size <= size:
+        (tag, row_start, row_end, col_start, col_end,
+         num_hits) = _record_struct.unpack_from(data, offset)
+        data_offset = offset + _record_struct.size
+        if tag == "ROWS":
+            num_rows = row_end - row_start
+            next_offset = (data_offset + (num_rows+1) * _uint64_struct.size +
+                           num_hits * (_INT_SIZE + _DOUBLE_SIZE))
+            if next_offset > size:
+                break
+            pending.append((row_start, row_end, col_start, col_end, num_hits, data_offset))
+        elif tag == "DONE":
+            next_offset = data_offset
+            chunks.extend(pending)
+            pending = []
+            done_tiles.add((row_start, col_start))
+            end_of_done = next_offset
+        else:
+            break
+        offset = next_offset
+    return chunks, done_tiles, end_of_done
+
+
+def _get_rows(results, row_start, row_end, index_offset):
+    # Return the row offsets, indices and scores for the given rows,
+    # with the hits ordered by increasing index
+    offsets = [0]
+    indices = array.array("i")
+    scores = array.array("d")
+    num_hits = 0
+    for row in xrange(row_start, row_end):
+        results._reorder_row(row, "increasing-index")
+        row_indices = results._get_indices(row)
+        if index_offset:
+            row_indices = array.array("i", [i - index_offset for i in row_indices])
+        indices.extend(row_indices)
+        scores.extend(results._get_scores(row))
+        num_hits += len(row_indices)
+        offsets.append(num_hits)
+    return offsets, indices, scores
+
+def _write_rows(outfile, row_start, row_end, col_start, col_end, rows):
+    offsets, indices, scores = rows
+    if not indices:
+        return
+    outfile.write(_record_struct.pack("ROWS", row_start, row_end, col_start, col_end,
+                                      len(indices)))
+    outfile.write(struct.pack("=%dQ" % len(offsets), *offsets))
+    indices.tofile(outfile)
+    scores.tofile(outfile)
+
+
+def threshold_tanimoto_search_symmetric(arena, threshold, filename, block_size=10000,
+                                        include_lower_triangle=True):
+    """Find all pairs in the arena with at least 'threshold' similarity
+
+    The hits are written to 'filename' in blocks of 'block_size' rows
+    and columns. If the file already exists and was created by an
+    interrupted search with the same parameters then the search
+    restarts after the last finished tile. A file created by a
+    different search raises a ValueError.
+
+    :param arena: the fingerprints
+    :type arena: FingerprintArena
+    :param threshold: the minimum Tanimoto similarity
+    :type threshold: float between 0.0 and 1.0
+    :param filename: where to write the hits
+    :type filename: string
+    :param block_size: the number of fingerprints in each tile side
+    :type block_size: positive integer
+    :param include_lower_triangle: also store (j, i) for each hit (i, j)
+    :type include_lower_triangle: boolean
+    :returns: a HitsReader for the finished file
+    """
+    if not (0.0 <= threshold <= 1.0):
+        raise ValueError("threshold must be between 0.0 and 1.0")
+    if block_size < 1:
+        raise ValueError("block_size must be positive")
+
+    if not arena.popcount_indices:
+        raise ValueError("The arena must be ordered by popcount")
+
+    N = len(arena)
+    flags = 0
+    if include_lower_triangle:
+        flags |= FLAG_LOWER_TRIANGLE
+    header = _pack_header(arena.num_bits, N, threshold, block_size, flags)
+
+    done_tiles = set()
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        outfile = open(filename, "r+b")
+        # Only the record headers are read, so this doesn't need to
+        # fit in memory
+        data = mmap.mmap(outfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if data[:HEADER_SIZE] != header:
+                _unpack_header(data, filename)
+                raise ValueError("File %r contains the hits from a different search" % (filename,))
+            _, done_tiles, end_of_done = _scan_records(data, filename)
+        except:
+            data.close()
+            outfile.close()
+            raise
+        data.close()
+        # Discard a partially written tile
+        outfile.seek(end_of_done)
+        outfile.truncate()
+    else:
+        outfile = open(filename, "wb")
+        outfile.write(header)
+
+    # The symmetric search uses the indices in the underlying arena,
+    # and puts the hits for query i in row i. Only the rows for the
+    # current tile have hits.
+    offset = arena.start
+    results = _chemfp.SearchResults(arena.end, None, "double")
+    try:
+        for row_start in xrange(0, N, block_size):
+            row_end = min(row_start + block_size, N)
+            for col_start in xrange(row_start, N, block_size):
+                if (row_start, col_start) in done_tiles:
+                    continue
+                col_end = min(col_start + block_size, N)
+                _chemfp.threshold_tanimoto_arena_symmetric(
+                    threshold, arena.num_bits,
+                    arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+                    offset+row_start, offset+row_end, offset+col_start, offset+col_end,
+                    arena.popcount_indices,
+                    results)
+                if include_lower_triangle:
+                    _chemfp.fill_lower_triangle_tile(
+                        results, offset+row_start, offset+row_end,
+                        offset+col_start, offset+col_end)
+                rows = _get_rows(results, offset+row_start, offset+row_end, offset)
+                _write_rows(outfile, row_start, row_end, col_start, col_end, rows)
+                if include_lower_triangle and col_start != row_start:
+                    rows = _get_rows(results, offset+col_start, offset+col_end, offset)
+                    _write_rows(outfile, col_start, col_end, row_start, row_end, rows)
+                for row in xrange(offset+row_start, offset+row_end):
+                    results._clear_row(row)
+                for row in xrange(offset+col_start, offset+col_end):
+                    results._clear_row(row)
+                outfile.write(_record_struct.pack("DONE", row_start, row_end,
+                                                  col_start, col_end, 0))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+
+    return open_hits(filename)
+
+
+class HitsReader(object):
+    """Read rows from an all-pairs hits file
+
+    The file is memory-mapped and the rows are read on demand. Each
+    row is a list of (target index, score) pairs ordered by index.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER_SIZE:
+                raise HitsFormatError("File %r is too small to be an all-pairs hits file"
+                                      % (filename,))
+            self._data = data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (self.num_bits, self._num_fingerprints, self.threshold, self.block_size,
+         flags) = _unpack_header(data, filename)
+        self.include_lower_triangle = bool(flags & FLAG_LOWER_TRIANGLE)
+
+        chunks, done_tiles, _ = _scan_records(data, filename)
+        num_blocks = (self._num_fingerprints + self.block_size - 1) // self.block_size
+        self.is_complete = (len(done_tiles) == num_blocks * (num_blocks+1) // 2)
+
+        # For each block of rows, the chunks ordered by column
+        self._block_chunks = {}
+        for chunk in sorted(chunks, key=lambda chunk: (chunk[0], chunk[2])):
+            self._block_chunks.setdefault(chunk[0], []).append(chunk)
+
+    def close(self):
+        self._data.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __len__(self):
+        return self._num_fingerprints
+
+    def _get_row_chunks(self, row):
+        if not (0 <= row < self._num_fingerprints):
+            raise IndexError("row index is out of range")
+        row_start = row - row % self.block_size
+        return self._block_chunks.get(row_start, ())
+
+    def _iter_row_slices(self, row):
+        # Yield the (file offset, count) for the row's hits in each chunk
+        unpack_from = _uint64_struct.unpack_from
+        for (row_start, row_end, col_start, col_end,
+             num_hits, data_offset) in self._get_row_chunks(row):
+            offsets_offset = data_offset + (row - row_start) * _uint64_struct.size
+            start = unpack_from(self._data, offsets_offset)[0]
+            end = unpack_from(self._data, offsets_offset + _uint64_struct.size)[0]
+            if start == end:
+                continue
+            indices_offset = data_offset + (row_end - row_start + 1) * _uint64_struct.size
+            yield (indices_offset + start * _INT_SIZE,
+                   indices_offset + num_hits * _INT_SIZE + start * _DOUBLE_SIZE,
+                   end - start)
+
+    def get_num_hits(self, row):
+        "Return the number of hits for the given row"
+        return sum(count for (_, _, count) in self._iter_row_slices(row))
+
+    def get_indices(self, row):
+        "Return an array of the target indices for the given row"
+        indices = array.array("i")
+        data = self._data
+        for (indices_offset, _, count) in self._iter_row_slices(row):
+            indices.fromstring(data[indices_offset:indices_offset + count*_INT_SIZE])
+        return indices
+
+    def get_scores(self, row):
+        "Return an array of the scores for the given row"
+        scores = array.array("d")
+        data = self._data
+        for (_, scores_offset, count) in self._iter_row_slices(row):
+            scores.fromstring(data[scores_offset:scores_offset + count*_DOUBLE_SIZE])
+        return scores
+
+    def get_indices_and_scores(self, row):
+        "Return a list of (target index, score) pairs for the given row"
+        return zip(self.get_indices(row), self.get_scores(row))
+
+    def __getitem__(self, row):
+        return self.get_indices_and_scores(row)
+
+    def __iter__(self):
+        for row in xrange(self._num_fingerprints):
+            yield self.get_indices_and_scores(row)
+
+def open_hits(filename):
+    """Open an all-pairs hits file created by threshold_tanimoto_search_symmetric()"""
+    return HitsReader(filename)
@@ -29,7 +29,128 @@ import _chemfp
 from chemfp import bitops, search
 
 __all__ = []
-    
+
+
+class IdStore(object):
+    """A read-only sequence of identifiers stored in one contiguous string
+
+    A Python list of strings needs roughly 40 bytes of object overhead
+    for every identifier. An IdStore instead keeps all of the ids in
+    a single string, each one followed by a newline, plus an array of
+    the offsets to the start of each id. Id i is
+      data[offsets[i]:offsets[i+1]-1]
+
+    The id strings are only created when requested. Slicing returns a
+    new IdStore which shares the same data.
+    """
+    def __init__(self, data, offsets, start=0, end=None):
+        self._data = data
+        self._offsets = offsets
+        if end is None:
+            end = len(offsets) - 1
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, end, step = i.indices(self._end - self._start)
+            if step != 1:
+                return [self[j] for j in xrange(start, end, step)]
+            if start >= end:
+                return IdStore(self._data, self._offsets, self._start, self._start)
+            return IdStore(self._data, self._offsets, self._start+start, self._start+end)
+        n = self._end - self._start
+        if i < 0:
+            i += n
+        if not (0 <= i < n):
+            raise IndexError("id index out of range")
+        i += self._start
+        offsets = self._offsets
+        return self._data[offsets[i]:offsets[i+1]-1]
+
+    def __iter__(self):
+        # Split the ids a block at a time, which is much faster than
+        # one slice per id but doesn't make a list of every id.
+        data = self._data
+        offsets = self._offsets
+        for block_start in xrange(self._start, self._end, 1000):
+            block_end = min(block_start + 1000, self._end)
+            for id in data[offsets[block_start]:offsets[block_end]-1].split("\n"):
+                yield id
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return NotImplemented
+        for id1, id2 in zip(self, other):
+            if id1 != id2:
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "IdStore(%r)" % (list(self),)
+
+    def _get_table(self):
+        # Return the id data, the offsets as a buffer of native 4 or
+        # 8 byte integers starting with id 0 of this store, and the
+        # integer size, for the C code. Return None if the offsets
+        # can't be used directly.
+        offsets = self._offsets
+        start = self._start
+        n = self._end - start + 1
+        if isinstance(offsets, array.array):
+            itemsize = offsets.itemsize
+            if itemsize not in (4, 8):
+                return None
+            return self._data, buffer(offsets, start*itemsize, n*itemsize), itemsize
+        get_buffer = getattr(offsets, "_get_buffer", None)
+        if get_buffer is None:
+            return None
+        offsets_buffer = get_buffer(start, n)
+        if offsets_buffer is None:
+            return None
+        return self._data, offsets_buffer, 8
+
+class _IdStoreBuilder(object):
+    def __init__(self):
+        self._data = StringIO()
+        self._offsets = array.array("L", [0])
+        self._size = 0
+
+    def append(self, id):
+        self._data.write(id)
+        self._data.write("\n")
+        self._size += len(id) + 1
+        self._offsets.append(self._size)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def get_id_store(self):
+        data = self._data.getvalue()
+        self._data.close()
+        return IdStore(data, self._offsets)
+
+def _reorder_id_store(id_store, ordering):
+    data = id_store._data
+    offsets = id_store._offsets
+    builder = _IdStoreBuilder()
+    for item in ordering:
+        i = item.index
+        builder.append(data[offsets[i]:offsets[i+1]-1])
+    return builder.get_id_store()
+
 
 class FingerprintArena(FingerprintReader):
     """Stores fingerprints in a contiguous block of memory
@@ -38,7 +159,8 @@ class FingerprintArena(FingerprintReader):
        metadata
            `Metadata` about the fingerprints
        ids
-           list of identifiers, ordered by position
+           sequence of identifiers, ordered by position. This is an
+           IdStore for arenas made by load_fingerprints()
     """
     def __init__(self, metadata, alignment,
                  start_padding, end_padding, storage_size, arena,
@@ -65,6 +187,7 @@ class FingerprintArena(FingerprintReader):
         self.end = end
         assert end >= start
         self._range_check = xrange(end-start)
+        self.knearest_index = None
 
     def __len__(self):
         """Number of fingerprint records in the FingerprintArena"""
@@ -84,11 +207,13 @@ class FingerprintArena(FingerprintReader):
                                         "", [], 0, 0)
             if step != 1:
                 raise IndexError("arena slice step size must be 1")
-            return FingerprintArena(self.metadata, self.alignment,
-                                    self.start_padding, self.end_padding,
-                                    self.storage_size, self.arena,
-                                    self.popcount_indices, self.ids,
-                                    self.start+start, self.start+end)
+            arena = FingerprintArena(self.metadata, self.alignment,
+                                     self.start_padding, self.end_padding,
+                                     self.storage_size, self.arena,
+                                     self.popcount_indices, self.ids,
+                                     self.start+start, self.start+end)
+            arena.knearest_index = self.knearest_index
+            return arena
         try:
             i = self._range_check[i]
         except IndexError:
@@ -99,9 +224,23 @@ class FingerprintArena(FingerprintReader):
         return self.ids[arena_i], self.arena[start_offset:end_offset]
 
 
-    def save(self, destination):
-        """Save the arena contents to the given filename or file object"""
+    def save(self, destination, format=None):
+        """Save the arena contents to the given filename or file object
+
+        If 'format' is None then the format is determined from the
+        destination filename, defaulting to "fps". Use "fpb" to save
+        the arena in the binary FPB format, which chemfp.open() can
+        memory-map and search without parsing.
+        """
         from . import io
+        format_name, compression = io.normalize_format(destination, format)
+        if format_name == "fpb":
+            if compression:
+                raise ValueError("The fpb format does not support compression")
+            from . import fpb
+            fpb.write_fpb(self, destination)
+            return
+
         need_close = False
         if isinstance(destination, basestring):
             need_close = True
@@ -122,6 +261,68 @@ class FingerprintArena(FingerprintReader):
         """This method is not documented"""
         pass
 
+    def as_numpy(self, dtype="uint8"):
+        """Return the fingerprints as a read-only NumPy array, without a copy
+
+        The array has shape (len(arena), storage_size/itemsize) and is
+        a view of the arena's memory. The storage_size may be larger
+        than the number of bytes in a fingerprint; the extra bytes are
+        zero. Use "uint64" to get the fingerprints as 64-bit words,
+        which requires that the storage_size be a multiple of 8.
+
+        :param dtype: "uint8" or "uint64"
+        :returns: a numpy.ndarray
+        """
+        import numpy
+        if dtype not in ("uint8", "uint64"):
+            raise ValueError("dtype must be 'uint8' or 'uint64', not %r" % (dtype,))
+        dtype = numpy.dtype(dtype)
+        if self.storage_size % dtype.itemsize:
+            raise ValueError("storage size of %d bytes is not a multiple of %d"
+                             % (self.storage_size, dtype.itemsize))
+        num_columns = self.storage_size // dtype.itemsize
+        n = self.end - self.start
+        if n == 0:
+            return numpy.zeros((0, num_columns), dtype=dtype)
+        fps = numpy.frombuffer(self.arena, dtype=dtype, count=n*num_columns,
+                               offset=self.start_padding + self.start*self.storage_size)
+        return fps.reshape(n, num_columns)
+
+    def popcount_indices_as_numpy(self):
+        """Return the popcount indices as a read-only NumPy int array, without a copy
+
+        Fingerprints with popcount p are at arena positions
+        indices[p] <= i < indices[p+1]. The positions are for the full
+        arena, even if this is a subarena. Returns None if the arena
+        isn't ordered by popcount.
+        """
+        import numpy
+        if not self.popcount_indices:
+            return None
+        return numpy.frombuffer(self.popcount_indices, dtype=numpy.intc)
+
+    def build_knearest_index(self, block_size=8):
+        """Build an index which makes k-nearest searches of this arena faster
+
+        The fingerprints in each popcount range are grouped into blocks
+        of `block_size` fingerprints, and the index stores the union of
+        the bits in each block. This gives an upper bound on the score
+        for every fingerprint in the block, so the k-nearest search can
+        skip blocks which cannot improve the current k-nearest hits.
+
+        The index takes about 1/`block_size` of the arena's memory. It
+        is used by this arena and by any subarenas made from it after
+        the index was built. The arena must be ordered by popcount.
+        
+        :param block_size: the number of fingerprints in a block (default: 8)
+        :type block_size: positive integer
+        :returns: the index, which is also stored as `knearest_index`
+        """
+        if not self.popcount_indices:
+            raise ValueError("the arena must be ordered by popcount")
+        self.knearest_index = KNearestIndex(self, block_size)
+        return self.knearest_index
+
     def __iter__(self):
         """Iterate over the (id, fingerprint) contents of the arena"""
         storage_size = self.storage_size
@@ -160,10 +361,12 @@ class FingerprintArena(FingerprintReader):
             end = start+arena_size
             if end > self.end:
                 end = self.end
-            yield FingerprintArena(self.metadata, self.alignment,
-                                   self.start_padding, self.end_padding,
-                                   self.storage_size, self.arena,
-                                   self.popcount_indices, self.ids, start, end)
+            arena = FingerprintArena(self.metadata, self.alignment,
+                                     self.start_padding, self.end_padding,
+                                     self.storage_size, self.arena,
+                                     self.popcount_indices, self.ids, start, end)
+            arena.knearest_index = self.knearest_index
+            yield arena
             start = end
 
     def count_tanimoto_hits_fp(self, query_fp, threshold=0.7):
@@ -243,10 +446,8 @@ class FingerprintArena(FingerprintReader):
         :type threshold: float between 0.0 and 1.0, inclusive
         :returns: SearchResults
         """
-        for query_arena in queries.iter_arenas(arena_size):
-            result = search.threshold_tanimoto_search(query_arena, self, threshold)
-            for (query_id, hits) in zip(query_arena.arena_ids, result.iter_ids_and_scores()):
-                yield query_id, hits
+        return self._iter_query_arenas(queries, arena_size,
+                                       search.iter_threshold_tanimoto_search, threshold)
 
     def id_knearest_tanimoto_search_fp(self, query_fp, k=3, threshold=0.7):
         """Find the k-nearest fingerprints which are similar to the query fingerprint
@@ -290,11 +491,75 @@ class FingerprintArena(FingerprintReader):
         :type threshold: float between 0.0 and 1.0, inclusive
         :returns: SearchResult
         """
+        return self._iter_query_arenas(queries, arena_size,
+                                       search.iter_knearest_tanimoto_search, k, threshold)
+
+
+    def id_count_hits(self, queries, threshold=0.7, metric=None, arena_size=100):
+        """Count the fingerprints which are similar enough to each query fingerprint
+
+        Like id_count_tanimoto_hits() but using the given similarity
+        `metric`, which is a chemfp.metrics.Metric or a metric name.
+        The default of None means Tanimoto.
+        """
         for query_arena in queries.iter_arenas(arena_size):
-            result = search.knearest_tanimoto_search(query_arena, self, k, threshold)
-            for (query_id, hits) in zip(query_arena.arena_ids, result.iter_ids_and_scores()):
-                yield query_id, hits
+            result = search.count_hits(query_arena, self, threshold, metric)
+            for (query_id, count) in zip(query_arena.arena_ids, result):
+                yield query_id, count
+
+    def id_threshold_search(self, queries, threshold=0.7, metric=None, arena_size=100):
+        """Find the fingerprints which are similar to each of the query fingerprints
 
+        Like id_threshold_tanimoto_search() but using the given
+        similarity `metric`.
+        """
+        return self._iter_query_arenas(queries, arena_size,
+                                       search.iter_threshold_search, threshold, metric)
+
+    def id_knearest_search(self, queries, k=3, threshold=0.7, metric=None, arena_size=100):
+        """Find the k-nearest fingerprint which are similar to each of the query fingerprints
+
+        Like id_knearest_tanimoto_search() but using the given
+        similarity `metric`.
+        """
+        return self._iter_query_arenas(queries, arena_size,
+                                       search.iter_knearest_search, k, threshold, metric)
+
+    def _iter_query_arenas(self, queries, arena_size, iter_search, *args):
+        # Stream the hits for 'arena_size' queries at a time. An arena
+        # of queries is searched in place, without making subarenas.
+        if isinstance(queries, FingerprintArena):
+            query_arenas = [queries]
+        else:
+            query_arenas = queries.iter_arenas(arena_size)
+        for query_arena in query_arenas:
+            for item in iter_search(query_arena, self, *args + (arena_size,)):
+                yield item
+
+class KNearestIndex(object):
+    """The per-block union index used for faster k-nearest searches
+
+    Use FingerprintArena.build_knearest_index() to make one.
+    """
+    def __init__(self, arena, block_size):
+        if block_size < 1:
+            raise ValueError("block_size must be positive")
+        num_bits = arena.num_bits
+        num_blocks = _chemfp.get_num_knearest_blocks(
+            num_bits, arena.popcount_indices, block_size)
+        block_indices = array.array("i", (0,)*(num_bits+2))
+        block_unions = ctypes.create_string_buffer(max(num_blocks, 1) * arena.storage_size)
+        _chemfp.make_knearest_block_index(
+            num_bits, arena.start_padding, arena.end_padding, arena.storage_size,
+            arena.arena, arena.popcount_indices, block_size,
+            block_indices, block_unions)
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.block_indices = block_indices.tostring()
+        # Align the unions the same way as the arena so the faster
+        # popcount methods can be used.
+        self.start_padding, self.end_padding, self.block_unions = (
+            _chemfp.make_unsorted_aligned_arena(block_unions.raw, arena.alignment))
 
 # TODO: push more of this malloc-management down into C
 class ChemFPOrderedPopcount(ctypes.Structure):
@@ -305,6 +570,7 @@ class ChemFPOrderedPopcount(ctypes.Structure):
 _methods = bitops.get_methods()
 _has_popcnt = "POPCNT" in _methods
 _has_ssse3 = "ssse3" in _methods
+_vector_methods = ("avx2", "avx512-vpopcnt")
 
 def get_optimal_alignment(num_bits):
     if num_bits <= 32:
@@ -320,15 +586,20 @@ def get_optimal_alignment(num_bits):
     if num_bits <= 224:
         return 8
 
+    if num_bits >= 768:
+        method = bitops.get_alignment_method("align8-large")
+    else:
+        method = bitops.get_alignment_method("align8-small")
+
+    # The AVX2 and AVX-512 methods only need 8 byte alignment, but
+    # they are faster if each vector load is inside one cache line.
+    if method in _vector_methods:
+        return 64
+
     # If you have POPCNT (and you're using it) then there's no reason
     # to use a larger alignment
-    if _has_popcnt:
-        if num_bits >= 768:
-            if bitops.get_alignment_method("align8-large") == "POPCNT":
-                return 8
-        else:
-            if bitops.get_alignment_method("align8-small") == "POPCNT":
-                return 8
+    if _has_popcnt and method == "POPCNT":
+        return 8
 
     # If you don't have SSSE3 or you aren't using it, then use 8
     if not _has_ssse3 or bitops.get_alignment_method("align-ssse3") != "ssse3":
@@ -364,13 +635,15 @@ def fps_to_arena(fps_reader, metadata=None, reorder=True, alignment=None):
     else:
         end_padding = None
 
-    ids = []
+    ids = _IdStoreBuilder()
     unsorted_fps = StringIO()
     for (id, fp) in fps_reader:
         unsorted_fps.write(fp)
         if end_padding:
             unsorted_fps.write(end_padding)
         ids.append(id)
+    num_fingerprints = len(ids)
+    ids = ids.get_id_store()
 
     unsorted_arena = unsorted_fps.getvalue()
     unsorted_fps.close()
@@ -385,14 +658,14 @@ def fps_to_arena(fps_reader, metadata=None, reorder=True, alignment=None):
 
     # Reorder
         
-    ordering = (ChemFPOrderedPopcount*len(ids))()
+    ordering = (ChemFPOrderedPopcount*num_fingerprints)()
     popcounts = array.array("i", (0,)*(metadata.num_bits+2))
 
     start_padding, end_padding, unsorted_arena = _chemfp.make_sorted_aligned_arena(
-        num_bits, storage_size, unsorted_arena, len(ids),
+        num_bits, storage_size, unsorted_arena, num_fingerprints,
         ordering, popcounts, alignment)
 
-    new_ids = [ids[item.index] for item in ordering]
+    ids = _reorder_id_store(ids, ordering)
     return FingerprintArena(metadata, alignment,
                             start_padding, end_padding, storage_size,
-                            unsorted_arena, popcounts.tostring(), new_ids)
+                            unsorted_arena, popcounts.tostring(), ids)
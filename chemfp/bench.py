@@ -0,0 +1,308 @@
+"""Benchmark the chemfp load and search functions
+
+The benchmarks use synthetic fingerprints so the results are
+reproducible and don't depend on a toolkit. generate_fingerprints()
+makes random fingerprints with a given bit density and spread of
+popcounts, and run_benchmarks() times each search phase over a sweep
+of fingerprint sizes, thread counts, thresholds, k values and arena
+alignments:
+
+  report = bench.run_benchmarks(num_targets=10000, num_bits_list=[166, 1024],
+                                num_threads_list=[1, 4])
+  json.dump(report, sys.stdout, indent=2)
+
+Each result has the best time over the repeats and the throughput in
+fingerprints per second. For the load phase that's the number of
+fingerprints loaded per second. For the searches it's the number of
+query/target comparisons per second, which for the symmetric searches
+is N*(N-1)/2 for N fingerprints.
+
+The arena searches can also be run by several Python threads at once,
+each doing the same search of the same arena, to see how well the
+searches scale when the GIL is released. Use 'python_threads_list'
+for that, and set num_threads_list to [1] so the OpenMP threads don't
+compete with the Python threads. The throughput is for all of the
+threads together.
+
+The "load" phase reads an FPS file. The "fps-*" phases scan that same
+file without loading it into an arena, so they don't depend on the
+alignment.
+
+The "chemfp-bench" command-line tool is a wrapper for this module.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import chemfp
+from . import bitops, io, search, fps_search
+
+__all__ = ["PHASES", "generate_fingerprints", "run_benchmarks"]
+
+ARENA_PHASES = ("count", "threshold", "knearest")
+SYMMETRIC_PHASES = ("count-symmetric", "threshold-symmetric", "knearest-symmetric")
+FPS_PHASES = ("fps-count", "fps-threshold", "fps-knearest")
+PHASES = ("load",) + ARENA_PHASES + SYMMETRIC_PHASES + FPS_PHASES
+
+
+def generate_fingerprints(num_fingerprints, num_bits, density=0.2, density_spread=0.3,
+                          seed=None, id_prefix="FP"):
+    """Generate random (id, fingerprint) pairs
+
+    The popcount of each fingerprint comes from a normal distribution
+    with a mean of density*num_bits and a standard deviation of
+    density_spread times the mean, limited to the range 0 to num_bits.
+    The bits are then picked uniformly at random. Use a spread of 0.0
+    to give every fingerprint the same popcount.
+
+    The ids are id_prefix followed by the fingerprint index. Use the
+    same 'seed' to get the same fingerprints.
+    """
+    if num_bits <= 0:
+        raise ValueError("num_bits must be positive")
+    if not (0.0 <= density <= 1.0):
+        raise ValueError("density must be between 0.0 and 1.0, inclusive")
+    if density_spread < 0.0:
+        raise ValueError("density_spread must not be negative")
+
+    rng = random.Random(seed)
+    num_bytes = (num_bits + 7) // 8
+    mean = density * num_bits
+    stddev = density_spread * mean
+    all_bits = range(num_bits)
+    for i in xrange(num_fingerprints):
+        popcount = int(round(rng.gauss(mean, stddev)))
+        popcount = min(max(popcount, 0), num_bits)
+        fp = bytearray(num_bytes)
+        for bit in rng.sample(all_bits, popcount):
+            fp[bit >> 3] |= 1 << (bit & 7)
+        yield "%s%d" % (id_prefix, i), str(fp)
+
+
+def _time_it(repeat, f, *args):
+    # Return the result of the last call and the list of times
+    times = []
+    for i in range(repeat):
+        t1 = time.time()
+        result = f(*args)
+        times.append(time.time() - t1)
+    return result, times
+
+def _run_in_threads(num_python_threads, f, *args):
+    # Call f(*args) in each of 'num_python_threads' threads at the
+    # same time and return the first result.
+    if num_python_threads == 1:
+        return f(*args)
+    results = [None] * num_python_threads
+    errors = []
+    def run(i):
+        try:
+            results[i] = f(*args)
+        except Exception, err:
+            errors.append(err)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_python_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results[0]
+
+def _count_hits(phase, result):
+    # The count phases return a list of counts; the others return rows of hits
+    if phase in ("count", "count-symmetric", "fps-count"):
+        return sum(result)
+    return sum(len(row) for row in result)
+
+def _run_phase(phase, targets, queries, fps_filename, threshold, k):
+    if phase == "count":
+        return search.count_tanimoto_hits(queries, targets, threshold)
+    if phase == "threshold":
+        return search.threshold_tanimoto_search(queries, targets, threshold)
+    if phase == "knearest":
+        return search.knearest_tanimoto_search(queries, targets, k, threshold)
+    if phase == "count-symmetric":
+        return search.count_tanimoto_hits_symmetric(targets, threshold)
+    if phase == "threshold-symmetric":
+        return search.threshold_tanimoto_search_symmetric(targets, threshold)
+    if phase == "knearest-symmetric":
+        return search.knearest_tanimoto_search_symmetric(targets, k, threshold)
+    if phase == "fps-count":
+        return fps_search.count_tanimoto_hits_arena(queries, chemfp.open(fps_filename), threshold)
+    if phase == "fps-threshold":
+        return fps_search.threshold_tanimoto_search_arena(
+            queries, chemfp.open(fps_filename), threshold)
+    if phase == "fps-knearest":
+        return fps_search.knearest_tanimoto_search(
+            queries, chemfp.open(fps_filename), k, threshold)
+    raise ValueError("Unknown phase %r" % (phase,))
+
+def _get_environment():
+    return {
+        "software": chemfp.SOFTWARE,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "methods": bitops.get_methods(),
+        "alignment_methods": bitops.get_alignment_methods(),
+        "max_threads": chemfp.get_max_threads(),
+        "date": io.utcnow(),
+        }
+
+def run_benchmarks(num_targets=10000, num_queries=100,
+                   num_bits_list=(166, 1024), num_threads_list=None,
+                   thresholds=(0.7,), ks=(3,), alignments=(None,),
+                   phases=PHASES, density=0.2, density_spread=0.3,
+                   repeat=1, seed=0, progress=None, python_threads_list=(1,)):
+    """Time the chemfp searches over a sweep of parameters
+
+    Every combination of num_bits, number of threads, threshold, k and
+    alignment is timed for each of the 'phases', which must be names
+    from PHASES. An alignment of None uses the default for the
+    fingerprint size. The thresholds are used by the count and
+    threshold phases, and k by the k-nearest phases, which use a
+    threshold of 0.0. The default num_threads_list is the current
+    value of chemfp.get_num_threads().
+
+    The arena and symmetric phases are also timed for each number of
+    Python threads in 'python_threads_list'. Each thread does the
+    same search at the same time, and the number of fingerprints is
+    the total over all of the threads.
+
+    If 'progress' is not None then it's called with each result as it
+    is finished.
+
+    Returns a dictionary, suitable for JSON, with the "environment",
+    the "parameters" and a list of "results".
+    """
+    for phase in phases:
+        if phase not in PHASES:
+            raise ValueError("Unknown phase %r; must be one of %s" % (phase, ", ".join(PHASES)))
+    if repeat < 1:
+        raise ValueError("repeat must be at least 1")
+    for num_python_threads in python_threads_list:
+        if num_python_threads < 1:
+            raise ValueError("the number of Python threads must be at least 1")
+    # A seed of None gives different fingerprints each time
+    if seed is None:
+        query_seed = None
+    else:
+        query_seed = seed + 1
+    if num_threads_list is None:
+        num_threads_list = [chemfp.get_num_threads()]
+
+    parameters = {
+        "num_targets": num_targets,
+        "num_queries": num_queries,
+        "num_bits": list(num_bits_list),
+        "num_threads": list(num_threads_list),
+        "python_threads": list(python_threads_list),
+        "thresholds": list(thresholds),
+        "k": list(ks),
+        "alignments": list(alignments),
+        "phases": list(phases),
+        "density": density,
+        "density_spread": density_spread,
+        "repeat": repeat,
+        "seed": seed,
+        }
+    results = []
+
+    def add_result(phase, num_bits, num_threads, alignment, threshold, k,
+                   num_fingerprints, hits, times, python_threads=None):
+        best = min(times)
+        result = {
+            "phase": phase,
+            "num_bits": num_bits,
+            "num_threads": num_threads,
+            "python_threads": python_threads,
+            "alignment": alignment,
+            "threshold": threshold,
+            "k": k,
+            "num_fingerprints": num_fingerprints,
+            "num_hits": hits,
+            "times": times,
+            "time": best,
+            "fingerprints_per_second": (num_fingerprints / best) if best > 0.0 else None,
+            }
+        results.append(result)
+        if progress is not None:
+            progress(result)
+
+    dirname = tempfile.mkdtemp(prefix="chemfp_bench")
+    original_num_threads = chemfp.get_num_threads()
+    try:
+        for num_bits in num_bits_list:
+            metadata = chemfp.Metadata(num_bits=num_bits, type="chemfp-bench/1")
+            fps_filename = os.path.join(dirname, "targets_%d.fps" % (num_bits,))
+            io.write_fps1_output(
+                generate_fingerprints(num_targets, num_bits, density, density_spread, seed),
+                fps_filename, metadata)
+            query_fps = list(generate_fingerprints(num_queries, num_bits, density, density_spread,
+                                                   query_seed, id_prefix="Q"))
+            queries = chemfp.load_fingerprints(query_fps, metadata)
+            num_pairs = num_targets * (num_targets-1) // 2
+
+            for alignment in alignments:
+                targets, times = _time_it(repeat, chemfp.load_fingerprints,
+                                          fps_filename, None, True, alignment)
+                if "load" in phases:
+                    add_result("load", num_bits, None, targets.alignment, None, None,
+                               num_targets, len(targets), times)
+                aligned_queries = chemfp.load_fingerprints(query_fps, metadata,
+                                                           alignment=alignment)
+                for num_threads in num_threads_list:
+                    chemfp.set_num_threads(num_threads)
+                    for phase in ARENA_PHASES + SYMMETRIC_PHASES:
+                        if phase not in phases:
+                            continue
+                        if phase in SYMMETRIC_PHASES:
+                            num_fingerprints = num_pairs
+                        else:
+                            num_fingerprints = num_queries * num_targets
+                        if phase.startswith("knearest"):
+                            settings = [(0.0, k) for k in ks]
+                        else:
+                            settings = [(threshold, None) for threshold in thresholds]
+                        for (threshold, k) in settings:
+                            for num_python_threads in python_threads_list:
+                                result, times = _time_it(
+                                    repeat, _run_in_threads, num_python_threads, _run_phase,
+                                    phase, targets, aligned_queries, None, threshold, k)
+                                add_result(phase, num_bits, num_threads, targets.alignment,
+                                           threshold, k, num_python_threads * num_fingerprints,
+                                           _count_hits(phase, result), times,
+                                           num_python_threads)
+                targets = aligned_queries = None
+
+            for num_threads in num_threads_list:
+                chemfp.set_num_threads(num_threads)
+                for phase in FPS_PHASES:
+                    if phase not in phases:
+                        continue
+                    if phase == "fps-knearest":
+                        settings = [(0.0, k) for k in ks]
+                    else:
+                        settings = [(threshold, None) for threshold in thresholds]
+                    for (threshold, k) in settings:
+                        result, times = _time_it(repeat, _run_phase, phase, None, queries,
+                                                 fps_filename, threshold, k)
+                        add_result(phase, num_bits, num_threads, None, threshold, k,
+                                   num_queries * num_targets, _count_hits(phase, result), times)
+    finally:
+        chemfp.set_num_threads(original_num_threads)
+        shutil.rmtree(dirname, ignore_errors=True)
+
+    return {
+        "environment": _get_environment(),
+        "parameters": parameters,
+        "results": results,
+        }
@@ -0,0 +1,453 @@
+"""Read and write BGZF, the blocked gzip format
+
+NOTE: This module should not be used directly. Use ".bgz" as the
+compression (for example, the format "fps.bgz" or an output filename
+ending in ".fps.bgz") to write a BGZF file. chemfp.open() and
+load_fingerprints() detect BGZF input, including a BGZF file with a
+".gz" extension.
+
+A gzip file is one compressed stream, so it can only be decompressed
+from the start to the end, by a single thread. BGZF, from the SAMtools
+project, is a series of small gzip members ("blocks"), each with at
+most 64 KB of data. Any gzip reader can read it. Each block header
+has an extra "BC" field with the size of the compressed block, so a
+reader can find the next block without decompressing the current one.
+That makes it possible to decompress several blocks at the same time
+and to start reading at any block. The file ends with an empty block.
+
+When it can, the writer ends each block on a newline, so each block of
+an FPS file holds whole records.
+
+The block index ("name.gzi") uses the bgzip ".gzi" layout: the number
+of entries as a little-endian uint64, then a (compressed offset,
+uncompressed offset) pair of uint64s for each block after the first.
+It's only needed to seek. Without it the reader finds the blocks by
+reading each block header and size.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import bisect
+import collections
+import os
+import struct
+import sys
+import zlib
+from __builtin__ import open as _builtin_open
+
+__all__ = []
+
+INDEX_EXTENSION = ".gzi"
+
+# The gzip header with the FEXTRA flag and the 6 byte "BC" subfield,
+# which is followed by the uint16 total block size minus 1.
+_HEADER = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+_HEADER_SIZE = len(_HEADER) + 2
+_TRAILER_SIZE = 8
+
+EOF_BLOCK = (_HEADER + "\x1b\x00" +  # block size is 28
+             "\x03\x00" +            # an empty deflate stream
+             "\x00\x00\x00\x00\x00\x00\x00\x00")  # CRC-32 and size are 0
+
+# Same as SAMtools. The compressed block must fit in 64 KB, even for
+# data which doesn't compress.
+MAX_BLOCK_DATA = 0xff00
+
+def _get_num_threads():
+    import _chemfp
+    return _chemfp.get_num_threads()
+
+
+def _is_block_header(header):
+    # Other writers may use a different modification time or OS field
+    return header[:4] == _HEADER[:4] and header[10:16] == _HEADER[10:16]
+
+def is_bgzf_file(source):
+    """Return True if the file named 'source' starts with a BGZF block header"""
+    with _builtin_open(source, "rb") as infile:
+        return _is_block_header(infile.read(len(_HEADER)))
+
+
+def _compress_block(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER_SIZE + len(compressed) + _TRAILER_SIZE
+    return "".join([_HEADER, struct.pack("<H", block_size - 1), compressed,
+                    struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))])
+
+def _decompress_block(block):
+    # This runs in the worker threads. zlib releases the GIL while it
+    # decompresses.
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = decompressor.decompress(block[_HEADER_SIZE:-_TRAILER_SIZE])
+    crc, size = struct.unpack("<II", block[-_TRAILER_SIZE:])
+    if len(data) != size:
+        raise IOError("Incorrect length of data produced")
+    if zlib.crc32(data) & 0xffffffff != crc:
+        raise IOError("CRC check failed")
+    return data
+
+def _get_block_size(header, filename, offset):
+    if not _is_block_header(header):
+        raise IOError("Not a BGZF block at byte %d of %r" % (offset, filename))
+    if len(header) < _HEADER_SIZE:
+        raise IOError("Truncated BGZF block at byte %d of %r" % (offset, filename))
+    return struct.unpack("<H", header[len(_HEADER):_HEADER_SIZE])[0] + 1
+
+
+def read_block_index(filename):
+    """Read a ".gzi" block index and return the list of (compressed offset, uncompressed offset) pairs
+
+    The list starts with (0, 0), for the first block.
+    """
+    with _builtin_open(filename, "rb") as infile:
+        data = infile.read()
+    if len(data) < 8:
+        raise IOError("Truncated BGZF index file %r" % (filename,))
+    num_entries = struct.unpack("<Q", data[:8])[0]
+    if len(data) != 8 + 16*num_entries:
+        raise IOError("Incorrect size for the BGZF index file %r" % (filename,))
+    values = struct.unpack("<%dQ" % (2*num_entries,), data[8:])
+    return [(0, 0)] + zip(values[::2], values[1::2])
+
+def write_block_index(filename, block_offsets):
+    """Write the (compressed offset, uncompressed offset) pairs to a ".gzi" index
+
+    The first pair must be (0, 0), which isn't stored.
+    """
+    assert block_offsets[:1] == [(0, 0)], block_offsets[:1]
+    values = [value for pair in block_offsets[1:] for value in pair]
+    with _builtin_open(filename, "wb") as outfile:
+        outfile.write(struct.pack("<Q%dQ" % (len(values),), len(values)//2, *values))
+
+
+class BGZFWriter(object):
+    """A write-only file object which compresses to BGZF
+
+    If 'destination' is a filename then close() also writes the ".gzi"
+    block index, unless 'index' is false.
+    """
+    def __init__(self, destination, compresslevel=6, index=True):
+        if isinstance(destination, basestring):
+            self._file = _builtin_open(destination, "wb")
+            self._close_file = True
+            self.name = destination
+            if index:
+                self._index_filename = destination + INDEX_EXTENSION
+            else:
+                self._index_filename = None
+        else:
+            self._file = destination
+            self._close_file = False
+            self.name = getattr(destination, "name", None)
+            self._index_filename = None
+        self._compresslevel = compresslevel
+        self._chunks = []
+        self._num_bytes = 0
+        self._block_offsets = []
+        self._compressed_offset = 0
+        self._uncompressed_offset = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self._chunks.append(data)
+        self._num_bytes += len(data)
+        if self._num_bytes >= MAX_BLOCK_DATA:
+            self._write_blocks(False)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _write_blocks(self, write_all):
+        data = "".join(self._chunks)
+        start = 0
+        while len(data) - start >= MAX_BLOCK_DATA:
+            end = data.rfind("\n", start, start + MAX_BLOCK_DATA) + 1
+            if end == 0:
+                # A very long line
+                end = start + MAX_BLOCK_DATA
+            self._write_block(data[start:end])
+            start = end
+        if write_all and start < len(data):
+            self._write_block(data[start:])
+            start = len(data)
+        data = data[start:]
+        self._chunks = [data]
+        self._num_bytes = len(data)
+
+    def _write_block(self, data):
+        self._block_offsets.append( (self._compressed_offset, self._uncompressed_offset) )
+        block = _compress_block(data, self._compresslevel)
+        self._file.write(block)
+        self._compressed_offset += len(block)
+        self._uncompressed_offset += len(data)
+
+    def flush(self):
+        # This ends the current block
+        self._write_blocks(True)
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self._write_blocks(True)
+        self._file.write(EOF_BLOCK)
+        self.closed = True
+        if self._close_file:
+            self._file.close()
+        if self._index_filename is not None and self._block_offsets:
+            write_block_index(self._index_filename, self._block_offsets)
+
+
+class BGZFReader(object):
+    """A read-only file object for BGZF data which decompresses blocks in parallel
+
+    'source' is a filename or a seekable binary file object.
+    'num_threads' is the number of decompression threads. The default
+    is chemfp.get_num_threads(). With one thread the blocks are
+    decompressed as they are read, with no extra threads.
+
+    seek() uses the ".gzi" block index if there is one, otherwise the
+    first seek reads the size of each block.
+
+    The decompression threads are stopped once the last block has been
+    queued, and started again if there is a seek, so a reader which
+    isn't closed doesn't keep its threads.
+    """
+    def __init__(self, source, num_threads=None):
+        if isinstance(source, basestring):
+            self._file = _builtin_open(source, "rb")
+            self._close_file = True
+            self.name = source
+        else:
+            self._file = source
+            self._close_file = False
+            self.name = getattr(source, "name", None)
+        if num_threads is None:
+            num_threads = _get_num_threads()
+        if num_threads < 1:
+            raise ValueError("num_threads must be positive")
+        self._num_threads = num_threads
+        # Started when there are blocks to decompress
+        self._executor = None
+        if num_threads == 1:
+            self._max_pending = 1
+        else:
+            self._max_pending = 4 * num_threads
+
+        # The compressed blocks which are queued to decompress. For a
+        # single thread these are the compressed blocks themselves.
+        self._pending = collections.deque()
+        self._next_block_offset = 0
+        self._at_last_block = False
+        # The current decompressed block
+        self._data = ""
+        self._pos = 0
+        self._data_offset = 0
+        self._block_offsets = None
+        self._uncompressed_offsets = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._cancel_pending()
+        self._stop_executor(wait=True)
+        if self._close_file:
+            self._file.close()
+
+    def __del__(self):
+        # The worker threads don't reference the reader, so this is
+        # called even if the reader wasn't closed
+        self._stop_executor(wait=False)
+
+    def _stop_executor(self, wait):
+        # Work which is already queued is still done
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            self._executor = None
+            executor.shutdown(wait=wait)
+
+    def _cancel_pending(self):
+        if self._num_threads > 1:
+            for future in self._pending:
+                future.cancel()
+        self._pending.clear()
+
+    def _read_block(self):
+        # Return the next compressed block, or None at the end of the file
+        infile = self._file
+        header = infile.read(_HEADER_SIZE)
+        if not header:
+            return None
+        block_size = _get_block_size(header, self.name, self._next_block_offset)
+        rest = infile.read(block_size - _HEADER_SIZE)
+        if len(rest) != block_size - _HEADER_SIZE:
+            raise IOError("Truncated BGZF block at byte %d of %r" % (
+                self._next_block_offset, self.name))
+        self._next_block_offset += block_size
+        return header + rest
+
+    def _queue_blocks(self):
+        while not self._at_last_block and len(self._pending) < self._max_pending:
+            block = self._read_block()
+            if block is None:
+                self._at_last_block = True
+                # Nothing else to decompress unless there's a seek
+                self._stop_executor(wait=False)
+                break
+            if self._num_threads == 1:
+                self._pending.append(block)
+            else:
+                if self._executor is None:
+                    from .futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(self._num_threads)
+                self._pending.append(self._executor.submit(_decompress_block, block))
+
+    def _next_block(self):
+        # Move on to the next decompressed block. Returns False at the end of the file.
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self._queue_blocks()
+        if not self._pending:
+            return False
+        item = self._pending.popleft()
+        if self._num_threads == 1:
+            data = _decompress_block(item)
+        else:
+            data = item.result()
+        self._data_offset += len(self._data)
+        self._data = data
+        self._pos = 0
+        # Keep the workers busy while the caller uses this block
+        self._queue_blocks()
+        return True
+
+    def read(self, size=-1):
+        chunks = []
+        if size < 0:
+            size = sys.maxint
+        while size > 0:
+            if self._pos == len(self._data):
+                if not self._next_block():
+                    break
+                continue
+            chunk = self._data[self._pos:self._pos+size]
+            self._pos += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def readline(self, size=-1):
+        chunks = []
+        if size < 0:
+            size = sys.maxint
+        while size > 0:
+            end = self._data.find("\n", self._pos, self._pos + size)
+            if end != -1:
+                chunk = self._data[self._pos:end+1]
+                self._pos = end+1
+                chunks.append(chunk)
+                break
+            chunk = self._data[self._pos:self._pos+size]
+            self._pos += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+            if self._pos == len(self._data) and not self._next_block():
+                break
+        return "".join(chunks)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def tell(self):
+        return self._data_offset + self._pos
+
+    def get_block_offsets(self):
+        """Return the list of (compressed offset, uncompressed offset) for each block"""
+        if self._block_offsets is None:
+            index_filename = None
+            if self.name is not None:
+                index_filename = self.name + INDEX_EXTENSION
+            if index_filename is not None and os.path.exists(index_filename):
+                self._block_offsets = read_block_index(index_filename)
+            else:
+                self._block_offsets = self._scan_block_offsets()
+        return self._block_offsets
+
+    def _scan_block_offsets(self):
+        # Use the block size in each header and the data size in each
+        # trailer. This uses its own file position, so put it back.
+        infile = self._file
+        current_position = infile.tell()
+        block_offsets = []
+        compressed_offset = uncompressed_offset = 0
+        try:
+            infile.seek(0)
+            while 1:
+                header = infile.read(_HEADER_SIZE)
+                if not header:
+                    break
+                block_size = _get_block_size(header, self.name, compressed_offset)
+                infile.seek(compressed_offset + block_size - 4)
+                size = infile.read(4)
+                if len(size) != 4:
+                    raise IOError("Truncated BGZF block at byte %d of %r" % (
+                        compressed_offset, self.name))
+                block_offsets.append( (compressed_offset, uncompressed_offset) )
+                compressed_offset += block_size
+                uncompressed_offset += struct.unpack("<I", size)[0]
+        finally:
+            infile.seek(current_position)
+        return block_offsets
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence != 0:
+            raise ValueError("Seek from end not supported")
+        if offset < 0:
+            raise IOError("Negative seek in read mode")
+        if self._data_offset <= offset <= self._data_offset + len(self._data):
+            self._pos = offset - self._data_offset
+            return
+
+        block_offsets = self.get_block_offsets()
+        if not block_offsets:
+            return
+        if self._uncompressed_offsets is None:
+            self._uncompressed_offsets = [u for (c, u) in block_offsets]
+        # Use the last block which starts at or before the offset
+        i = max(bisect.bisect_right(self._uncompressed_offsets, offset) - 1, 0)
+        compressed_offset, uncompressed_offset = block_offsets[i]
+        self._cancel_pending()
+        self._file.seek(compressed_offset)
+        self._next_block_offset = compressed_offset
+        self._at_last_block = False
+        self._data = ""
+        self._pos = 0
+        self._data_offset = uncompressed_offset
+        self._next_block()
+        self._pos = min(offset - self._data_offset, len(self._data))
@@ -63,7 +63,7 @@ def get_options():
     return [_chemfp.get_option_name(i) for i in range(_chemfp.get_num_options())]
 
 def get_option(option):
-    _chemfp.get_option(option)
+    return _chemfp.get_option(option)
 
 def set_option(option, value):
     _chemfp.set_option(option, value)
@@ -0,0 +1,224 @@
+"""Cluster the fingerprints in an arena
+
+Both methods start from the symmetric threshold search, which finds
+the neighbors of every fingerprint, then pick cluster centroids one
+at a time. An unassigned fingerprint becomes a centroid and all of
+its unassigned neighbors join its cluster.
+
+  arena = chemfp.load_fingerprints("pubchem.fps.gz")
+  clusters = cluster.butina(arena, 0.8)
+  for i in range(len(clusters)):
+      print clusters.get_centroid_id(i), clusters.get_size(i)
+
+butina() is Taylor-Butina clustering. It picks the centroids in order
+of decreasing number of neighbors. See
+  Butina, "Unsupervised Data Base Clustering Based on Daylight's
+  Fingerprint and Tanimoto Similarity", JCICS 39 (1999) 747-750.
+
+sphere_exclusion() picks the centroids in a given order, which is the
+arena order unless you say otherwise.
+
+The neighbor lists are in memory as a SearchResults, and the
+assignment loop is in C. The other data structures are arrays with
+one integer per fingerprint.
+"""
+
+from __future__ import absolute_import
+
+import array
+import random
+
+from . import search
+import _chemfp
+
+__all__ = ["butina", "sphere_exclusion", "ClusterResults"]
+
+# _chemfp.butina_order() tie-break methods
+_TIE_RANK = 0
+_TIE_DENSITY = 1
+
+BUTINA_TIE_BREAKS = ("index", "reverse-index", "density", "random")
+SPHERE_EXCLUSION_ORDERS = ("index", "reverse-index", "random")
+
+
+class ClusterResults(object):
+    """The clusters from butina() or sphere_exclusion()
+
+    The clusters are numbered 0, 1, 2, ... in the order the centroids
+    were picked. Each cluster has a centroid and zero or more other
+    members. Fingerprints are referred to by their arena index.
+
+    'centroids' is an array of the centroid index for each cluster,
+    and 'assignments' is an array of the centroid index for each
+    fingerprint. A centroid is assigned to itself.
+    """
+    def __init__(self, method, threshold, ids, results, centroids, assignments):
+        self.method = method
+        self.threshold = threshold
+        self.ids = ids
+        self.results = results
+        self.centroids = centroids
+        self.assignments = assignments
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def get_centroid(self, i):
+        "Return the arena index of the centroid of cluster i"
+        return self.centroids[i]
+
+    def get_centroid_id(self, i):
+        "Return the id of the centroid of cluster i"
+        return self.ids[self.centroids[i]]
+
+    def get_num_neighbors(self, i):
+        """Return the number of neighbors of the centroid of cluster i
+
+        This includes the neighbors which were already assigned to
+        another cluster. A singleton cluster with neighbors is a
+        "false singleton".
+        """
+        return self.results._size(self.centroids[i])
+
+    def get_members_and_scores(self, i):
+        """Return the (index, score) pairs for the other members of cluster i
+
+        The score is the similarity to the centroid. The list is
+        ordered by decreasing score.
+        """
+        centroid = self.centroids[i]
+        assignments = self.assignments
+        hits = [(index, score) for (index, score) in self.results[centroid]
+                    if assignments[index] == centroid]
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        return hits
+
+    def get_members(self, i):
+        "Return the arena indices for cluster i, starting with the centroid"
+        return [self.centroids[i]] + [index for (index, score) in self.get_members_and_scores(i)]
+
+    def get_size(self, i):
+        "Return the number of fingerprints in cluster i, including the centroid"
+        centroid = self.centroids[i]
+        assignments = self.assignments
+        return 1 + sum(1 for index in self.results._get_indices(centroid)
+                           if assignments[index] == centroid)
+
+    def get_cluster(self, index):
+        "Return the cluster number for the fingerprint at the given arena index"
+        if not hasattr(self, "_cluster_numbers"):
+            self._cluster_numbers = dict((centroid, i) for (i, centroid) in enumerate(self.centroids))
+        return self._cluster_numbers[self.assignments[index]]
+
+
+def _get_neighbors(arena, threshold, results):
+    if results is None:
+        if not len(arena):
+            return search.SearchResults(0, arena.ids)
+        if not arena.popcount_indices:
+            raise ValueError("the arena must be ordered by popcount")
+        if arena.start != 0:
+            raise ValueError("cannot cluster a subarena which does not start at 0")
+        return search.threshold_tanimoto_search_symmetric(arena, threshold)
+    if len(results) != len(arena):
+        raise ValueError("results must have one row for each fingerprint in the arena")
+    return results
+
+def _assign(method, threshold, arena, results, order):
+    n = len(arena)
+    assignments = array.array("i", [0]) * n
+    if n:
+        num_centroids = _chemfp.cluster_assign(results, order, assignments)
+    else:
+        num_centroids = 0
+    if -1 in assignments:
+        raise ValueError("order must contain every arena index")
+    # The centroids are the fingerprints assigned to themselves, in
+    # the order they were picked.
+    centroids = array.array("i", (index for index in order if assignments[index] == index))
+    assert len(centroids) == num_centroids
+    return ClusterResults(method, threshold, arena.ids, results, centroids, assignments)
+
+def _get_ranks(n, ordering, seed):
+    if ordering == "index":
+        return None
+    if ordering == "reverse-index":
+        return array.array("i", xrange(n-1, -1, -1))
+    if ordering == "random":
+        ranks = array.array("i", xrange(n))
+        random.Random(seed).shuffle(ranks)
+        return ranks
+    raise AssertionError(ordering)
+
+
+def butina(arena, threshold, tie_break="index", seed=None, results=None):
+    """Taylor-Butina clustering of the arena fingerprints
+
+    The centroids are picked in order of decreasing number of
+    neighbors. 'tie_break' decides between fingerprints with the same
+    number of neighbors:
+      "index" - the smaller arena index goes first
+      "reverse-index" - the larger arena index goes first
+      "density" - the larger sum of neighbor scores goes first
+      "random" - random order, using the given 'seed'
+
+    :param arena: the fingerprints to cluster (must be ordered by popcount)
+    :type arena: FingerprintArena
+    :param threshold: the minimum similarity for two fingerprints to be neighbors
+    :type threshold: float between 0.0 and 1.0
+    :param tie_break: the tie-breaking method
+    :type tie_break: string
+    :param seed: the random number seed for the "random" tie-break
+    :param results: the threshold_tanimoto_search_symmetric() results, if already computed
+    :type results: SearchResults
+    :returns: a ClusterResults
+    """
+    if tie_break not in BUTINA_TIE_BREAKS:
+        raise ValueError("Unknown tie_break %r; must be one of %s" %
+                         (tie_break, ", ".join(BUTINA_TIE_BREAKS)))
+    results = _get_neighbors(arena, threshold, results)
+    n = len(arena)
+    order = array.array("i", [0]) * n
+    if n:
+        if tie_break == "density":
+            _chemfp.butina_order(results, _TIE_DENSITY, None, order)
+        else:
+            _chemfp.butina_order(results, _TIE_RANK, _get_ranks(n, tie_break, seed), order)
+    return _assign("Butina", threshold, arena, results, order)
+
+
+def sphere_exclusion(arena, threshold, order="index", seed=None, results=None):
+    """Sphere exclusion clustering of the arena fingerprints
+
+    The centroids are picked in the given 'order', which is one of:
+      "index" - arena order
+      "reverse-index" - reverse arena order
+      "random" - random order, using the given 'seed'
+    or a sequence of the arena indices in the order to visit them.
+
+    :param arena: the fingerprints to cluster (must be ordered by popcount)
+    :type arena: FingerprintArena
+    :param threshold: the minimum similarity for two fingerprints to be neighbors
+    :type threshold: float between 0.0 and 1.0
+    :param order: the order to pick centroids
+    :type order: string or sequence of integers
+    :param seed: the random number seed for the "random" order
+    :param results: the threshold_tanimoto_search_symmetric() results, if already computed
+    :type results: SearchResults
+    :returns: a ClusterResults
+    """
+    n = len(arena)
+    if isinstance(order, basestring):
+        if order not in SPHERE_EXCLUSION_ORDERS:
+            raise ValueError("Unknown order %r; must be one of %s" %
+                             (order, ", ".join(SPHERE_EXCLUSION_ORDERS)))
+        ranks = _get_ranks(n, order, seed)
+        if ranks is None:
+            ranks = array.array("i", xrange(n))
+        order = ranks
+    else:
+        order = array.array("i", order)
+        if len(order) != n:
+            raise ValueError("order must have one index for each fingerprint in the arena")
+    results = _get_neighbors(arena, threshold, results)
+    return _assign("sphere-exclusion", threshold, arena, results, order)
@@ -0,0 +1,124 @@
+from __future__ import with_statement
+import sys
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import chemfp
+from chemfp import argparse, io, bitops, bench
+
+
+def _list_of(type, name):
+    # argparse reports a ValueError as "invalid <name> value"
+    def parse_list(s):
+        return [type(term) for term in s.split(",")]
+    parse_list.__name__ = name
+    return parse_list
+
+def _alignment(s):
+    if s == "auto":
+        return None
+    alignment = int(s)
+    if alignment < 1 or (alignment & (alignment-1)):
+        raise ValueError(s)
+    return alignment
+
+def _phase(s):
+    if s not in bench.PHASES:
+        raise ValueError(s)
+    return s
+
+
+parser = argparse.ArgumentParser(
+    description="Benchmark chemfp loading and searching with random fingerprints",
+    epilog="Phases: " + ", ".join(bench.PHASES))
+parser.add_argument("--num-targets", type=int, default=10000, metavar="N",
+                    help="number of target fingerprints (default: 10000)")
+parser.add_argument("--num-queries", type=int, default=100, metavar="N",
+                    help="number of query fingerprints (default: 100)")
+parser.add_argument("--num-bits", type=_list_of(int, "integer list"), default=[166, 1024],
+                    metavar="LIST", help="fingerprint sizes (default: 166,1024)")
+parser.add_argument("--threads", type=_list_of(int, "integer list"), default=None,
+                    metavar="LIST", help="number of threads (default: the OpenMP default)")
+parser.add_argument("--python-threads", type=_list_of(int, "integer list"), default=[1],
+                    metavar="LIST", help="number of Python threads doing the same arena search at once (default: 1)")
+parser.add_argument("-t", "--threshold", type=_list_of(float, "float list"), default=[0.7],
+                    metavar="LIST", help="count and threshold search thresholds (default: 0.7)")
+parser.add_argument("-k", type=_list_of(int, "integer list"), default=[3],
+                    metavar="LIST", help="k-nearest values (default: 3)")
+parser.add_argument("--alignment", type=_list_of(_alignment, "alignment list"), default=[None],
+                    metavar="LIST", help="arena alignments, as a power of two or 'auto' (default: auto)")
+parser.add_argument("--phases", type=_list_of(_phase, "phase list"), default=list(bench.PHASES),
+                    metavar="LIST", help="phases to time (default: all)")
+parser.add_argument("--density", type=float, default=0.2,
+                    help="average fraction of bits set in a fingerprint (default: 0.2)")
+parser.add_argument("--density-spread", type=float, default=0.3,
+                    help="standard deviation of the popcount, as a fraction of the average (default: 0.3)")
+parser.add_argument("--repeat", type=int, default=1,
+                    help="number of times to run each phase; report the best (default: 1)")
+parser.add_argument("--seed", type=int, default=0,
+                    help="random number seed for the fingerprints (default: 0)")
+parser.add_argument("-o", "--output", metavar="FILENAME",
+                    help="JSON output filename (default is stdout)")
+parser.add_argument("-q", "--quiet", action="store_true",
+                    help="don't report each result to stderr")
+
+
+def _report_progress(result):
+    sys.stderr.write("%-20s num_bits=%s threads=%s python_threads=%s alignment=%s threshold=%s k=%s  %.3f s  %.4g fps/s\n" % (
+        result["phase"], result["num_bits"], result["num_threads"], result["python_threads"],
+        result["alignment"],
+        result["threshold"], result["k"], result["time"],
+        result["fingerprints_per_second"] or 0.0))
+
+def main(args=None):
+    args = parser.parse_args(args)
+    if args.num_targets < 1 or args.num_queries < 1:
+        parser.error("--num-targets and --num-queries must be positive")
+    for threshold in args.threshold:
+        if not (0.0 <= threshold <= 1.0):
+            parser.error("--threshold must be between 0.0 and 1.0, inclusive")
+    for k in args.k:
+        if k < 1:
+            parser.error("-k must be positive")
+    if args.threads is not None:
+        max_threads = chemfp.get_max_threads()
+        for num_threads in args.threads:
+            if not (1 <= num_threads <= max_threads):
+                parser.error("--threads must be between 1 and %d" % (max_threads,))
+    for num_python_threads in args.python_threads:
+        if num_python_threads < 1:
+            parser.error("--python-threads must be positive")
+    if not (0.0 <= args.density <= 1.0):
+        parser.error("--density must be between 0.0 and 1.0, inclusive")
+    if args.density_spread < 0.0:
+        parser.error("--density-spread must not be negative")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    bitops.use_environment_variables()
+
+    if args.quiet:
+        progress = None
+    else:
+        progress = _report_progress
+
+    report = bench.run_benchmarks(
+        num_targets=args.num_targets, num_queries=args.num_queries,
+        num_bits_list=args.num_bits, num_threads_list=args.threads,
+        thresholds=args.threshold, ks=args.k, alignments=args.alignment,
+        phases=args.phases, density=args.density, density_spread=args.density_spread,
+        repeat=args.repeat, seed=args.seed, progress=progress,
+        python_threads_list=args.python_threads)
+
+    outfile = io.open_output(args.output)
+    with io.ignore_pipe_errors:
+        json.dump(report, outfile, indent=2, sort_keys=True)
+        outfile.write("\n")
+    if outfile is not sys.stdout:
+        outfile.close()
+
+if __name__ == "__main__":
+    main()
@@ -31,7 +31,12 @@ def iter_all_sources(opener, metadata, filenames, format, id_tag, errors):
         for x in reader:
             yield x
 
-def read_multifile_structure_fingerprints(opener, filenames, format, id_tag, aromaticity, errors):
+def read_multifile_structure_fingerprints(opener, filenames, format, id_tag, aromaticity, errors,
+                                          jobs=1):
+    if jobs > 1:
+        from . import parallel
+        return parallel.read_multifile_structure_fingerprints(
+            opener, filenames, format, id_tag, aromaticity, errors, jobs)
     metadata = Metadata(aromaticity=aromaticity)
     if not filenames:
         reader = sys_exit_opener(opener, metadata, None, format, id_tag, errors)
@@ -46,6 +51,15 @@ def read_multifile_structure_fingerprints(opener, filenames, format, id_tag, aro
     multi_reader = itertools.chain(reader, iter_all_sources(opener, metadata, filenames[1:], format, id_tag, errors))
     return reader.metadata, multi_reader
 
+def add_jobs_option(parser):
+    parser.add_argument(
+        "--jobs", "-j", metavar="N", type=int, default=1,
+        help="fingerprint SMILES or SD files with N worker processes (default=1)")
+
+def check_jobs(parser, args):
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
 def is_valid_tag(tag):
     if tag is None:
         return True
@@ -0,0 +1,98 @@
+from __future__ import with_statement
+import math
+import sys
+import time
+
+import chemfp
+from chemfp import argparse, io, SOFTWARE, bitops, cluster
+
+def write_cluster_magic(outfile):
+    outfile.write("#Clusters/1\n")
+
+def write_cluster_header(outfile, d):
+    lines = []
+    for name in ("num_bits", "type", "software", "targets"):
+        value = d.get(name, None)
+        if value is not None:
+            lines.append("#%s=%s\n" % (name, value))
+    for value in d.get("target_sources", []):
+        lines.append("#target_sources=%s\n" % (value,))
+    outfile.writelines(lines)
+
+def report_clusters(outfile, float_formatter, clusters):
+    ids = clusters.ids
+    hit_formatter = "\t%s\t" + float_formatter
+    for i in xrange(len(clusters)):
+        members = clusters.get_members_and_scores(i)
+        outfile.write("%d\t%s" % (len(members)+1, clusters.get_centroid_id(i)))
+        for (index, score) in members:
+            outfile.write(hit_formatter % (ids[index], score))
+        outfile.write("\n")
+
+
+parser = argparse.ArgumentParser(
+    description="Cluster the fingerprints in an FPS file")
+parser.add_argument("-t", "--threshold", help="minimum similarity for two fingerprints to be neighbors",
+                    default=0.8, type=float)
+parser.add_argument("--method", choices=("butina", "sphere-exclusion"), default="butina",
+                    help="clustering method (default: butina)")
+parser.add_argument("--tie-break", choices=cluster.BUTINA_TIE_BREAKS, default="index",
+                    help="for Butina, how to order fingerprints with the same number of neighbors; "
+                    "for sphere exclusion, the order to pick centroids (default: index)")
+parser.add_argument("--seed", type=int, default=None,
+                    help="random number seed for '--tie-break random'")
+parser.add_argument("-o", "--output", metavar="FILENAME",
+                    help="output filename (default is stdout)")
+parser.add_argument("--times", help="report load and execution times to stderr",
+                    action="store_true")
+parser.add_argument("target_filename", nargs=1, help="target filename", default=None)
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    target_filename = args.target_filename[0]
+
+    threshold = args.threshold
+    if not (0.0 <= threshold <= 1.0):
+        parser.error("--threshold must be between 0.0 and 1.0, inclusive")
+    if args.method == "sphere-exclusion" and args.tie_break not in cluster.SPHERE_EXCLUSION_ORDERS:
+        parser.error("--tie-break %s is not supported for sphere-exclusion" % (args.tie_break,))
+
+    bitops.use_environment_variables()
+
+    t1 = time.time()
+    targets = chemfp.load_fingerprints(target_filename)
+    t2 = time.time()
+    if args.method == "butina":
+        clusters = cluster.butina(targets, threshold, tie_break=args.tie_break, seed=args.seed)
+        type = "Butina threshold=%s tie-break=%s" % (threshold, args.tie_break)
+    else:
+        clusters = cluster.sphere_exclusion(targets, threshold, order=args.tie_break,
+                                            seed=args.seed)
+        type = "sphere-exclusion threshold=%s tie-break=%s" % (threshold, args.tie_break)
+    if args.tie_break == "random" and args.seed is not None:
+        type += " seed=%d" % (args.seed,)
+    t3 = time.time()
+
+    # See simsearch for why this many digits
+    num_digits = int(math.log10(targets.metadata.num_bytes*8)) + 2
+    float_formatter = "%." + str(num_digits) + "f"
+
+    outfile = io.open_output(args.output)
+    with io.ignore_pipe_errors:
+        write_cluster_magic(outfile)
+        write_cluster_header(outfile, {
+            "num_bits": targets.metadata.num_bits,
+            "software": SOFTWARE,
+            "type": type,
+            "targets": target_filename,
+            "target_sources": targets.metadata.sources})
+        report_clusters(outfile, float_formatter, clusters)
+    t4 = time.time()
+
+    if args.times:
+        sys.stderr.write("load %.2f cluster %.2f output %.2f total %.2f\n" %
+                         (t2-t1, t3-t2, t4-t3, t4-t1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+import sys
+
+from .. import argparse, io, fpsidx, readers
+
+parser = argparse.ArgumentParser(
+    description="Make the '.fpsidx' random-access index for FPS files",
+    epilog="The index for 'name.fps' is saved as 'name.fps.fpsidx'. Only "
+    "uncompressed FPS files can be indexed.")
+parser.add_argument(
+    "--records-per-block", metavar="N", type=int, default=fpsidx.RECORDS_PER_BLOCK,
+    help="number of fingerprint records in each index block (default=%d)" % (
+        fpsidx.RECORDS_PER_BLOCK,))
+parser.add_argument(
+    "--check", action="store_true",
+    help="check that the existing index files are current, instead of writing new ones")
+parser.add_argument("filenames", nargs="+", help="list of FPS files", default=[])
+
+def main(args=None):
+    args = parser.parse_args(args)
+    if args.records_per_block < 1:
+        parser.error("--records-per-block must be a positive integer")
+
+    for filename in args.filenames:
+        if io.normalize_format(filename, None)[1]:
+            parser.error("Cannot index the compressed file %r" % (filename,))
+
+    num_failures = 0
+    for filename in args.filenames:
+        index_filename = fpsidx.get_index_filename(filename)
+        try:
+            if args.check:
+                old_index = fpsidx.read_index(index_filename)
+                index = fpsidx.build_index(filename, old_index.records_per_block)
+            else:
+                index = fpsidx.build_index(filename, args.records_per_block)
+        except (IOError, readers.FPSParseError, fpsidx.FPSIndexFormatError), err:
+            sys.stderr.write("ERROR: %s\n" % (err,))
+            num_failures += 1
+            continue
+        if not args.check:
+            index.save(index_filename)
+        elif index != old_index:
+            sys.stderr.write("ERROR: %r is out of date\n" % (index_filename,))
+            num_failures += 1
+
+    if num_failures:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -53,6 +53,7 @@ parser.add_argument(
 parser.add_argument(
     "-o", "--output", metavar="FILENAME",
     help="save the fingerprints to FILENAME (default=stdout)")
+cmdsupport.add_jobs_option(parser)
 parser.add_argument(
     "filename", nargs="?", help="input structure file (default is stdin)", default=None)
 
@@ -84,6 +85,17 @@ def main(args=None):
     else:
         parser.error("should not get here")
 
+    cmdsupport.check_jobs(parser, args)
+    if args.jobs > 1:
+        if args.filename is None:
+            filenames = []
+        else:
+            filenames = [args.filename]
+        metadata, reader = cmdsupport.read_multifile_structure_fingerprints(
+            opener, filenames, args.format, None, None, "strict", args.jobs)
+        io.write_fps1_output(reader, args.output, metadata)
+        return
+
     # Ready the input reader/iterator
     try:
         reader = opener.read_structure_fingerprints(args.filename, args.format)
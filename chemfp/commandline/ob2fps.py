@@ -73,6 +73,7 @@ parser.add_argument(
 parser.add_argument(
     "--errors", choices=["strict", "report", "ignore"], default="strict",
     help="how should structure parse errors be handled? (default=strict)")
+cmdsupport.add_jobs_option(parser)
 parser.add_argument(
     "filenames", nargs="*", help="input structure files (default is stdin)")
 
@@ -115,10 +116,12 @@ def main(args=None):
     if missing:
         parser.error("Structure file %r does not exist" % (missing,))
 
+    cmdsupport.check_jobs(parser, args)
+
     # Ready the input reader/iterator
     metadata, reader = cmdsupport.read_multifile_structure_fingerprints(
         opener, args.filenames, format = args.format,
-        id_tag = args.id_tag, aromaticity = None, errors = args.errors)
+        id_tag = args.id_tag, aromaticity = None, errors = args.errors, jobs = args.jobs)
 
     try:
         io.write_fps1_output(reader, args.output, metadata)
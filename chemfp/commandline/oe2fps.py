@@ -95,6 +95,7 @@ parser.add_argument(
     "--errors", choices=["strict", "report", "ignore"], default="strict",
     help="how should structure parse errors be handled? (default=strict)")
 
+cmdsupport.add_jobs_option(parser)
 parser.add_argument(
     "filenames", nargs="*", help="input structure files (default is stdin)")
 
@@ -151,9 +152,12 @@ def main(args=None):
     if missing:
         parser.error("Structure file %r does not exist" % (missing,))
 
+    cmdsupport.check_jobs(parser, args)
+
     # Ready the input reader/iterator
     metadata, reader = cmdsupport.read_multifile_structure_fingerprints(
-        opener, args.filenames, args.format, args.id_tag, args.aromaticity, args.errors)
+        opener, args.filenames, args.format, args.id_tag, args.aromaticity, args.errors,
+        args.jobs)
     
     try:
         io.write_fps1_output(reader, args.output, metadata)
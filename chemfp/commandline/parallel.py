@@ -0,0 +1,205 @@
+"""Generate structure fingerprints with several worker processes
+
+This is the '--jobs' support for the *2fps programs. The main process
+reads the input and splits it into blocks of whole records: lines for
+the SMILES formats and "$$$$"-terminated records for SD files. Each
+worker writes its block to a temporary file, reads it with the usual
+toolkit fingerprint reader, and returns the (id, fingerprint) pairs
+and any error messages. The main process passes the results on in
+input order and writes the messages to stderr, with the line and
+record numbers counted from the start of the input.
+"""
+from __future__ import absolute_import, with_statement
+import os
+import re
+import sys
+import tempfile
+import collections
+from cStringIO import StringIO
+
+from .. import ParseError, Metadata
+from .. import io, types
+from ..futures import ProcessPoolExecutor
+
+LINE_FORMATS = ("smi", "can", "ism", "usm")
+RECORD_FORMATS = ("sdf", "sd", "mol", "mdl")
+
+# The number of records in a block
+CHUNK_SIZE = 1000
+
+
+def get_chunk_format(source, format):
+    """Return the (format name, compression) for 'source', or raise a ValueError
+
+    Only the line-based SMILES formats and SD files can be split into blocks.
+    """
+    format_name, compression = io.normalize_format(source, format, default=("smi", ""))
+    if format_name not in LINE_FORMATS and format_name not in RECORD_FORMATS:
+        raise ValueError("--jobs only supports SMILES and SD files, not %r" % (format_name,))
+    return format_name, compression
+
+
+def iter_line_chunks(infile, chunk_size=CHUNK_SIZE):
+    """Yield (number of records, text) for blocks of 'chunk_size' lines"""
+    lines = []
+    for line in infile:
+        lines.append(line)
+        if len(lines) == chunk_size:
+            yield len(lines), "".join(lines)
+            lines = []
+    if lines:
+        yield len(lines), "".join(lines)
+
+
+def iter_sdf_chunks(infile, chunk_size=CHUNK_SIZE):
+    """Yield (number of records, text) for blocks of 'chunk_size' SD records
+
+    A record ends with a line starting with "$$$$". Any text after the
+    last one is passed along in the final block, so the toolkit can
+    report the problem.
+    """
+    lines = []
+    num_records = 0
+    has_text = False  # Is there text after the last "$$$$"?
+    for line in infile:
+        lines.append(line)
+        if line[:4] == "$$$$":
+            num_records += 1
+            has_text = False
+            if num_records == chunk_size:
+                yield num_records, "".join(lines)
+                lines = []
+                num_records = 0
+        elif not has_text and line.strip():
+            has_text = True
+    if has_text:
+        num_records += 1
+    if num_records:
+        yield num_records, "".join(lines)
+
+
+# The readers report locations as "at line N" and "record #N". In a
+# worker these count from the start of its block.
+_line_pat = re.compile(r"\bat line (\d+)")
+_record_pat = re.compile(r"\brecord #(\d+)")
+
+def _fix_locations(text, tmp_filename, source_name, first_lineno, first_record):
+    # Report the source filename, and lines and records counted from
+    # the start of the source instead of the start of the block
+    text = text.replace(tmp_filename, source_name)
+    text = _line_pat.sub(
+        lambda m: "at line %d" % (int(m.group(1)) + first_lineno - 1,), text)
+    return _record_pat.sub(
+        lambda m: "record #%d" % (int(m.group(1)) + first_record - 1,), text)
+
+
+def _fingerprint_chunk(type, format_name, id_tag, errors, aromaticity,
+                       text, source_name, first_lineno, first_record):
+    # This runs in the worker process. Returns the list of (id, fp)
+    # pairs and the text of the "report" error messages.
+    fingerprinter = types.parse_type(type)
+    fd, tmp_filename = tempfile.mkstemp(suffix="." + format_name, prefix="chemfp_")
+    real_stderr = sys.stderr
+    sys.stderr = messages = StringIO()
+    try:
+        with os.fdopen(fd, "w") as outfile:
+            outfile.write(text)
+        try:
+            reader = fingerprinter.read_structure_fingerprints(
+                tmp_filename, format_name, id_tag, errors,
+                metadata=Metadata(aromaticity=aromaticity))
+            id_fps = list(reader)
+        except ParseError, err:
+            raise ParseError(_fix_locations(str(err), tmp_filename, source_name,
+                                            first_lineno, first_record))
+    finally:
+        sys.stderr = real_stderr
+        os.unlink(tmp_filename)
+    return id_fps, "".join(
+        _fix_locations(line.rstrip("\n"), tmp_filename, source_name,
+                       first_lineno, first_record) + "\n"
+            for line in messages.getvalue().splitlines())
+
+
+def _iter_chunk_tasks(filenames, format, chunk_size):
+    for filename in (filenames or [None]):
+        format_name, compression = get_chunk_format(filename, format)
+        if format_name in LINE_FORMATS:
+            iter_chunks = iter_line_chunks
+        else:
+            iter_chunks = iter_sdf_chunks
+        try:
+            infile = io.open_compressed_input_universal(filename, compression)
+        except (IOError, NotImplementedError), err:
+            sys.stderr.write("Problem reading structure fingerprints: %s. Exiting.\n" % err)
+            raise SystemExit(1)
+        if filename is None:
+            source_name = "<stdin>"
+        else:
+            source_name = filename
+        first_lineno = 1
+        first_record = 1
+        for num_records, text in iter_chunks(infile, chunk_size):
+            yield format_name, text, source_name, first_lineno, first_record
+            first_lineno += text.count("\n")
+            first_record += num_records
+
+
+def _get_chunk_result(future):
+    id_fps, messages = future.result()
+    if messages:
+        sys.stderr.write(messages)
+    return id_fps
+
+
+def _iter_ordered_fingerprints(fingerprinter, filenames, format, id_tag, errors,
+                               aromaticity, jobs, chunk_size):
+    type = fingerprinter.get_type()
+    # Keep a couple of blocks per worker in the queue, so the workers
+    # don't wait on the reader, and the memory use stays bounded.
+    max_pending = 2 * jobs
+    pending = collections.deque()
+    executor = ProcessPoolExecutor(jobs)
+    try:
+        for (format_name, text, source_name, first_lineno, first_record) in _iter_chunk_tasks(
+                filenames, format, chunk_size):
+            pending.append(executor.submit(_fingerprint_chunk, type, format_name, id_tag,
+                                           errors, aromaticity, text, source_name,
+                                           first_lineno, first_record))
+            if len(pending) >= max_pending:
+                for id_fp in _get_chunk_result(pending.popleft()):
+                    yield id_fp
+        while pending:
+            for id_fp in _get_chunk_result(pending.popleft()):
+                yield id_fp
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def read_multifile_structure_fingerprints(fingerprinter, filenames, format, id_tag,
+                                          aromaticity, errors, jobs, chunk_size=None):
+    """Return the (metadata, reader) for fingerprinting 'filenames' with 'jobs' processes
+
+    This is the parallel version of cmdsupport.read_multifile_structure_fingerprints().
+    Each worker gets 'chunk_size' records at a time (default: CHUNK_SIZE).
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    for filename in (filenames or [None]):
+        try:
+            get_chunk_format(filename, format)
+        except ValueError, err:
+            sys.stderr.write("%s. Exiting.\n" % (err,))
+            raise SystemExit(1)
+
+    metadata = Metadata(num_bits=fingerprinter.num_bits,
+                        sources=list(filenames),
+                        software=fingerprinter.config.software,
+                        type=fingerprinter.get_type(),
+                        date=io.utcnow(),
+                        aromaticity=aromaticity)
+    reader = _iter_ordered_fingerprints(fingerprinter, filenames, format, id_tag, errors,
+                                        aromaticity, jobs, chunk_size)
+    return metadata, reader
@@ -134,6 +134,9 @@ shortcuts_group.add_argument("--pubchem", nargs=0, action=AddSubsKeys,
 
 _illegal_value_pat = re.compile(r"[\000-\037]")
 
+# The number of records to decode with each decoders.decode_fingerprints() call
+_DECODE_BLOCK_SIZE = 1000
+
 def main(args=None):
     args = parser.parse_args(args)
 
@@ -163,7 +166,8 @@ def main(args=None):
     # What follows is a bit tricky. I set up a chain of iterators:
     #   - iterate through the SDF iterators
     #   -   iterate through the (id, encoded_fp) pairs in each SDF iterator
-    #   -     convert to (id, fp, num_bits) 3-element tuples
+    #   -     gather those into blocks of records
+    #   -       decode each block at once, and yield (id, fp, num_bits) 3-element tuples
     #   -       use the first element to figure out the right metadata
     #   -       send to (id, fp) information to the io.write_fps1_output function
 
@@ -214,64 +218,115 @@ def main(args=None):
     outfile = None       # Don't open it until I'm ready to write the first record
     num_bytes = None     # Will need to get (or at least check) the fingerprint byte length
 
+    # Gather the (id, encoded_fp) pairs into blocks for the batch
+    # decoder. Decoding reads ahead of 'location', so also save where
+    # each record starts, to report errors by the record's index in
+    # the block.
+    def iter_encoded_blocks(encoded_fp_reader):
+        while 1:
+            ids = []
+            encoded_fps = []
+            positions = []
+            for id, encoded_fp in itertools.islice(encoded_fp_reader, _DECODE_BLOCK_SIZE):
+                ids.append(id)
+                encoded_fps.append(encoded_fp or None)
+                positions.append( (location.name, location.lineno, location._record) )
+            if not ids:
+                break
+            yield ids, encoded_fps, positions
+
+    record_location = sdf_reader.FileLocation()
+    def where(position):
+        record_location.name, record_location.lineno, record_location._record = position
+        return record_location.where()
+
     # Decoded encoded fingerprints, yielding (id, fp, num_bits)
     
-    def decode_fingerprints(encoded_fp_reader, error_handler):
+    def decode_fingerprints(encoded_blocks, error_handler):
         expected_num_bits = -1
         expected_fp_size = None
         
-        for id, encoded_fp in encoded_fp_reader:
-            if not id:
-                msg = MISSING_ID % dict(id=id, where=location.where(),
-                                        tag=args.id_tag)
-                error_handler(msg)
-                continue
-            
-            if not encoded_fp:
-                msg = MISSING_FP % dict(id=id, where=location.where(),
-                                        tag=args.fp_tag)
-                error_handler(msg)
-                continue
-
-            # Decode the fingerprint, and complain if it isn't decodeable.
-            try:
-                num_bits, fp = fp_decoder(encoded_fp)
-            except TypeError, err:
-                msg = ("Could not %(decoder_name)s decode %(tag)r value %(encoded_fp)r: %(err)s %(where)s" %
-                       dict(decoder_name=fp_decoder_name, tag=args.fp_tag,
-                            where=location.where(), err=err, encoded_fp=encoded_fp))
-                error_handler(msg)
-                continue
-
-            if num_bits != expected_num_bits:
-                if expected_num_bits == -1:
-                    expected_num_bits = num_bits
-                else:
-                    msg = ("Tag %(tag)r value %(encoded_fp)r has %(got)d bits but expected %(expected)d %(where)s" %
-                           dict(tag=args.fp_tag, encoded_fp=encoded_fp,
-                                got=num_bits, expected=expected_num_bits,
-                                where=location.where()))
+        for ids, encoded_fps, positions in encoded_blocks:
+            if expected_fp_size is None:
+                # Only a guess. The built-in decoders need at least
+                # one character per byte. The block is decoded again
+                # if the first fingerprint is larger.
+                storage_size = max([len(encoded_fp) for encoded_fp in encoded_fps
+                                        if encoded_fp is not None] or [0])
+            else:
+                storage_size = expected_fp_size
+            data, fp_sizes, fp_num_bits = decoders.decode_fingerprints(
+                encoded_fps, fp_decoder, storage_size)
+
+            for i, id in enumerate(ids):
+                encoded_fp = encoded_fps[i]
+                if not id:
+                    msg = MISSING_ID % dict(id=id, where=where(positions[i]),
+                                            tag=args.id_tag)
                     error_handler(msg)
                     continue
 
-            if len(fp) != expected_fp_size:
-                if expected_fp_size is None:
-                    expected_fp_size = len(fp)
-                else:
-                    msg = ("Tag %(tag)r value %(encoded_fp)r has %(got)d bytes but expected %(expected)d %(where)s" %
-                           dict(tag=args.fp_tag, encoded_fp=encoded_fp,
-                                got=len(fp), expected=expected_fp_size,
-                                where=location.where()))
+                if not encoded_fp:
+                    msg = MISSING_FP % dict(id=id, where=where(positions[i]),
+                                            tag=args.fp_tag)
                     error_handler(msg)
                     continue
 
-            yield id, fp, num_bits
+                # Complain if the fingerprint isn't decodeable. The
+                # batch decoder doesn't keep the error, so decode it
+                # again to get the message.
+                fp_size = fp_sizes[i]
+                if fp_size == -1:
+                    try:
+                        fp_decoder(encoded_fp)
+                    except TypeError, err:
+                        msg = ("Could not %(decoder_name)s decode %(tag)r value %(encoded_fp)r: %(err)s %(where)s" %
+                               dict(decoder_name=fp_decoder_name, tag=args.fp_tag,
+                                    where=where(positions[i]), err=err, encoded_fp=encoded_fp))
+                        error_handler(msg)
+                        continue
+                    raise AssertionError("%r decoded %r on the second try" %
+                                         (fp_decoder_name, encoded_fp))
+
+                num_bits = fp_num_bits[i]
+                if num_bits == -1:
+                    num_bits = None
+                if num_bits != expected_num_bits:
+                    if expected_num_bits == -1:
+                        expected_num_bits = num_bits
+                    else:
+                        msg = ("Tag %(tag)r value %(encoded_fp)r has %(got)d bits but expected %(expected)d %(where)s" %
+                               dict(tag=args.fp_tag, encoded_fp=encoded_fp,
+                                    got=num_bits, expected=expected_num_bits,
+                                    where=where(positions[i])))
+                        error_handler(msg)
+                        continue
+
+                if fp_size != expected_fp_size:
+                    if expected_fp_size is None:
+                        expected_fp_size = fp_size
+                        if fp_size > storage_size:
+                            # The guess was too small to store it
+                            storage_size = fp_size
+                            data, fp_sizes, fp_num_bits = decoders.decode_fingerprints(
+                                encoded_fps, fp_decoder, storage_size)
+                    else:
+                        msg = ("Tag %(tag)r value %(encoded_fp)r has %(got)d bytes but expected %(expected)d %(where)s" %
+                               dict(tag=args.fp_tag, encoded_fp=encoded_fp,
+                                    got=fp_size, expected=expected_fp_size,
+                                    where=where(positions[i])))
+                        error_handler(msg)
+                        continue
+
+                offset = i * storage_size
+                yield id, str(data[offset:offset+fp_size]), num_bits
 
 
 
     sdf_iters = get_sdf_iters()
     encoded_fps = iter_encoded_fingerprints(sdf_iters)
-    decoded_fps = decode_fingerprints(encoded_fps, error_handler)
+    encoded_blocks = iter_encoded_blocks(encoded_fps)
+    decoded_fps = decode_fingerprints(encoded_blocks, error_handler)
 
     try:
         id, fp, num_bits = next(decoded_fps)
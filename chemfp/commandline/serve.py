@@ -0,0 +1,96 @@
+from __future__ import with_statement
+import os
+import sys
+import time
+
+import chemfp
+from chemfp import argparse, bitops, server
+
+
+def _target_spec(s):
+    # Either "name=filename" or "filename", which uses the base name
+    if "=" in s:
+        name, filename = s.split("=", 1)
+        if not name:
+            raise ValueError(s)
+    else:
+        filename = s
+        name = os.path.basename(s)
+        for ext in (".gz", ".fps", ".fpb"):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+    if not filename:
+        raise ValueError(s)
+    return name, filename
+
+_target_spec.__name__ = "target"
+
+
+parser = argparse.ArgumentParser(
+    description="Load fingerprint files into memory and serve similarity searches over HTTP",
+    epilog="Each target is a filename or NAME=FILENAME. The default name is the "
+           "filename without the directory and the .fps, .fpb and .gz extensions. "
+           "Use 'simsearch --server' to search it.")
+parser.add_argument("targets", metavar="TARGET", nargs="+", type=_target_spec,
+                    help="target fingerprint file")
+parser.add_argument("--host", default="127.0.0.1",
+                    help="host address to listen on (default: 127.0.0.1)")
+parser.add_argument("--port", type=int, default=8080,
+                    help="port to listen on; 0 picks a free port (default: 8080)")
+parser.add_argument("--max-batch-size", type=int, default=1000, metavar="N",
+                    help="most queries to merge into one search (default: 1000)")
+parser.add_argument("--max-wait", type=float, default=1.0, metavar="MS",
+                    help="milliseconds to wait for more requests to merge into a search (default: 1.0)")
+parser.add_argument("--threads", type=int, default=None,
+                    help="number of OpenMP threads for each search (default: the OpenMP default)")
+parser.add_argument("--knearest-index", action="store_true",
+                    help="build the k-nearest block index for each target")
+parser.add_argument("-q", "--quiet", action="store_true",
+                    help="don't log the requests to stderr")
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    if not (0 <= args.port < 65536):
+        parser.error("--port must be between 0 and 65535")
+    if args.max_batch_size < 1:
+        parser.error("--max-batch-size must be positive")
+    if args.max_wait < 0.0:
+        parser.error("--max-wait must not be negative")
+    if args.threads is not None:
+        max_threads = chemfp.get_max_threads()
+        if not (1 <= args.threads <= max_threads):
+            parser.error("--threads must be between 1 and %d" % (max_threads,))
+    names = [name for (name, filename) in args.targets]
+    for name in names:
+        if names.count(name) > 1:
+            parser.error("More than one target is named %r; use NAME=FILENAME" % (name,))
+
+    bitops.use_environment_variables()
+    if args.threads is not None:
+        chemfp.set_num_threads(args.threads)
+
+    targets = []
+    for name, filename in args.targets:
+        t1 = time.time()
+        arena = chemfp.load_fingerprints(filename)
+        if args.knearest_index:
+            arena.build_knearest_index()
+        if not args.quiet:
+            sys.stderr.write("Loaded %r as %r: %d fingerprints in %.2f s\n" % (
+                filename, name, len(arena), time.time()-t1))
+        targets.append((name, arena))
+
+    search_server = server.SearchServer(targets, (args.host, args.port),
+                                        max_batch_size=args.max_batch_size,
+                                        max_wait=args.max_wait / 1000.0,
+                                        verbose=not args.quiet)
+    if not args.quiet:
+        sys.stderr.write("Serving on %s\n" % (search_server.url,))
+    try:
+        search_server.serve_forever()
+    finally:
+        search_server.shutdown()
+
+if __name__ == "__main__":
+    main()
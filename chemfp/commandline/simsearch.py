@@ -4,7 +4,8 @@ import sys
 import itertools
 
 import chemfp
-from chemfp import argparse, readers, io, SOFTWARE, bitops
+from chemfp import argparse, readers, io, SOFTWARE, bitops, metrics, search
+from chemfp.arena import FingerprintArena
 
 def write_simsearch_magic(outfile):
     outfile.write("#Simsearch/1\n")
@@ -24,33 +25,61 @@ def write_simsearch_header(outfile, d):
     outfile.writelines(lines)
 
 
-def report_threshold(outfile, float_formatter, query_arenas, targets, threshold):
+def report_threshold(outfile, num_digits, query_arenas, targets, threshold,
+                     metric=metrics.TANIMOTO):
+    if isinstance(targets, FingerprintArena):
+        def search_arena(query_arena):
+            return search.threshold_search(query_arena, targets, threshold, metric)
+        _report_arena_search(outfile, num_digits, query_arenas, search_arena)
+        return
     def search_function(query_arena):
-        return targets.id_threshold_tanimoto_search(query_arena, threshold=threshold)
-    _report_search(outfile, float_formatter, query_arenas, search_function)
-
-def report_knearest(outfile, float_formatter, query_arenas, targets, k, threshold):
+        if metric.is_tanimoto:
+            return targets.id_threshold_tanimoto_search(query_arena, threshold=threshold)
+        return targets.id_threshold_search(query_arena, threshold=threshold, metric=metric)
+    _report_search(outfile, num_digits, query_arenas, search_function)
+
+def report_knearest(outfile, num_digits, query_arenas, targets, k, threshold,
+                    metric=metrics.TANIMOTO):
+    if isinstance(targets, FingerprintArena):
+        def search_arena(query_arena):
+            return search.knearest_search(query_arena, targets, k, threshold, metric)
+        _report_arena_search(outfile, num_digits, query_arenas, search_arena)
+        return
     def search_function(query_arena):
-        return targets.id_knearest_tanimoto_search(query_arena, k=k, threshold=threshold)
+        if metric.is_tanimoto:
+            return targets.id_knearest_tanimoto_search(query_arena, k=k, threshold=threshold)
+        return targets.id_knearest_search(query_arena, k=k, threshold=threshold, metric=metric)
                                                
-    _report_search(outfile, float_formatter, query_arenas, search_function)
+    _report_search(outfile, num_digits, query_arenas, search_function)
+
+# Search and format this many queries at a time, which limits the
+# number of hits in memory
+_ARENA_CHUNK_SIZE = 100
+
+def _report_arena_search(outfile, num_digits, query_arenas, search_arena):
+    # The hits are formatted in C and written with one write() per chunk
+    for query_arena in query_arenas:
+        for chunk in query_arena.iter_arenas(_ARENA_CHUNK_SIZE):
+            results = search_arena(chunk)
+            outfile.write(search.format_hits(results, chunk.arena_ids, num_digits))
 
-def _report_search(outfile, float_formatter, query_arenas, search_function):
-    hit_formatter = "\t%s\t" + float_formatter
+def _report_search(outfile, num_digits, query_arenas, search_function):
+    hit_formatter = "\t%s\t%." + str(num_digits) + "f"
     for query_arena in query_arenas:
         for query_id, hits in search_function(query_arena):
-            outfile.write("%d\t%s" % (len(hits), query_id))
-            for hit in hits:
-                outfile.write(hit_formatter % hit)
-            outfile.write("\n") # XXX flush?
+            outfile.write("%d\t%s%s\n" % (len(hits), query_id,
+                                           "".join([hit_formatter % hit for hit in hits])))
     
 
 
-def report_counts(outfile, query_arenas, targets, threshold):
+def report_counts(outfile, query_arenas, targets, threshold, metric=metrics.TANIMOTO):
     for query_arena in query_arenas:
-        results = targets.id_count_tanimoto_hits(query_arena, threshold)
-        for query_id, hit_count in results:
-            outfile.write("%d\t%s\n" % (hit_count, query_id))
+        if metric.is_tanimoto:
+            results = targets.id_count_tanimoto_hits(query_arena, threshold)
+        else:
+            results = targets.id_count_hits(query_arena, threshold, metric)
+        outfile.write("".join(["%d\t%s\n" % (hit_count, query_id)
+                                   for (query_id, hit_count) in results]))
         
 def int_or_all(s):
     if s == "all":
@@ -67,6 +96,12 @@ parser.add_argument("-k" ,"--k-nearest", help="select the k nearest neighbors (u
                     default=None, type=int_or_all)
 parser.add_argument("-t" ,"--threshold", help="minimum similarity score threshold",
                     default=None, type=float)
+parser.add_argument("--metric", choices=metrics.METRIC_NAMES, default="tanimoto",
+                    help="similarity measure (default: tanimoto)")
+parser.add_argument("--alpha", type=float, default=1.0,
+                    help="Tversky weight for the query bits (default: 1.0)")
+parser.add_argument("--beta", type=float, default=1.0,
+                    help="Tversky weight for the target bits (default: 1.0)")
 parser.add_argument("-q", "--queries", help="filename containing the query fingerprints")
 parser.add_argument("--hex-query", help="query in hex")
 parser.add_argument("--query-id", default="Query1",
@@ -89,7 +124,11 @@ parser.add_argument("--memory", help="build and search an in-memory data structu
 parser.add_argument("--times", help="report load and execution times to stderr",
                     action="store_true")
 
-parser.add_argument("target_filename", nargs=1, help="target filename", default=None)
+parser.add_argument("--server", metavar="URL",
+                    help="search the targets of a chemfp-serve server, like http://127.0.0.1:8080. "
+                         "The target filename is the server's name for the targets.")
+
+parser.add_argument("target_filename", nargs="?", help="target filename", default=None)
 
 ## Something to enable multi-threading
 #parser.add_argument("-j", "--jobs", help="number of jobs ",
@@ -98,7 +137,9 @@ parser.add_argument("target_filename", nargs=1, help="target filename", default=
 
 def main(args=None):
     args = parser.parse_args(args)
-    target_filename = args.target_filename[0]
+    target_filename = args.target_filename
+    if target_filename is None and args.server is None:
+        parser.error("too few arguments")
 
     threshold = args.threshold
     k = args.k_nearest
@@ -125,6 +166,8 @@ def main(args=None):
     
     if args.scan and args.memory:
         parser.error("Cannot specify both --scan and --memory")
+    if args.server and (args.scan or args.memory):
+        parser.error("Cannot specify --scan or --memory with --server")
     
     if args.hex_query and args.queries:
         parser.error("Cannot specify both --hex-query and --queries")
@@ -150,13 +193,28 @@ def main(args=None):
     if args.batch_size < 1:
         parser.error("--batch-size must be positive")
 
+    if args.metric != "tversky" and (args.alpha != 1.0 or args.beta != 1.0):
+        parser.error("--alpha and --beta are only used with --metric tversky")
+    try:
+        metric = metrics.get_metric(args.metric, args.alpha, args.beta)
+    except ValueError, err:
+        parser.error(str(err))
+
     batch_size = args.batch_size
 
     bitops.use_environment_variables()
 
     # Open the target file. This reads just enough to get the header.
 
-    targets = chemfp.open(target_filename)
+    if args.server is not None:
+        from chemfp import server
+        try:
+            targets = server.SearchClient(args.server).open_targets(target_filename)
+        except server.ServerError, err:
+            parser.error(str(err))
+        target_filename = targets.name
+    else:
+        targets = chemfp.open(target_filename)
             
     if args.hex_query is not None:
         try:
@@ -188,12 +246,11 @@ def main(args=None):
     # disambiguate the scores. I don't like seeing only
     # the minimum resolution, so I also show at least
     # the next bit.
-    #   For 4096 the float_formatter is %.5f and the
+    #   For 4096 the scores are written with %.5f and the
     # above values are 0.00024 and 0.00049.
     # This also prevents the results from being shown
     # in scientific notation.
     num_digits = int(math.log10(targets.metadata.num_bytes*8)) + 2
-    float_formatter = "%." + str(num_digits) + "f"
 
     import time
     t1 = time.time()
@@ -207,7 +264,10 @@ def main(args=None):
         pass
     elif args.memory:
         targets = chemfp.load_fingerprints(targets)
-    if not first_query_arena:
+    if args.server is not None:
+        # The server has the targets in memory
+        pass
+    elif not first_query_arena:
         # No input. Leave as-is
         pass
     elif len(first_query_arena) < min(10, batch_size):
@@ -229,12 +289,16 @@ def main(args=None):
     t2 = time.time()
     outfile = io.open_output(args.output)
     with io.ignore_pipe_errors:
-        type = "Tanimoto k=%(k)s threshold=%(threshold)s" % dict(
-            k=k, threshold=threshold, max_score=1.0)
+        type = "%(metric)s k=%(k)s threshold=%(threshold)s" % dict(
+            metric=metric, k=k, threshold=threshold, max_score=1.0)
 
         if args.count:
-            type = "Count threshold=%(threshold)s" % dict(
-                threshold=threshold)
+            if metric.is_tanimoto:
+                type = "Count threshold=%(threshold)s" % dict(
+                    threshold=threshold)
+            else:
+                type = "Count %(metric)s threshold=%(threshold)s" % dict(
+                    metric=metric, threshold=threshold)
             write_count_magic(outfile)
         else:
             write_simsearch_magic(outfile)
@@ -254,13 +318,13 @@ def main(args=None):
 
             if args.count:
                 report_counts(outfile, query_arenas, targets,
-                              threshold = threshold)
+                              threshold = threshold, metric = metric)
             elif k == "all":
-                report_threshold(outfile, float_formatter, query_arenas, targets,
-                                 threshold = threshold)
+                report_threshold(outfile, num_digits, query_arenas, targets,
+                                 threshold = threshold, metric = metric)
             else:
-                report_knearest(outfile, float_formatter, query_arenas, targets,
-                                k = k, threshold = threshold)
+                report_knearest(outfile, num_digits, query_arenas, targets,
+                                k = k, threshold = threshold, metric = metric)
                                 
                 
                     
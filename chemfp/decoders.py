@@ -20,9 +20,26 @@ is known exactly, which currently is only the case for the binary and
 CACTVS fingerprints. (The hex and other encoders must round the
 fingerprints up to a multiple of 8 bits.)
 
+The built-in decoders are implemented in C. Use decode_fingerprints()
+to decode a list of fingerprints at once into a block of fixed-size
+rows, which is the layout used by a fingerprint arena.
+
 """
 import string
 import binascii
+import array
+
+import _chemfp
+
+# These must match the CHEMFP_ENCODING_* values in chemfp.h
+_BINARY_LSB = 0
+_BINARY_MSB = 1
+_HEX = 2
+_HEX_LSB = 3
+_HEX_MSB = 4
+_BASE64 = 5
+_CACTVS = 6
+_DAYLIGHT = 7
 
 _lsb_bit_table = {} # "10000000" -> 1
 _msb_bit_table = {} # "00000001" -> 1
@@ -102,6 +119,9 @@ def from_binary_lsb(text):
     (29, '\\x00\\x80\\x00\\x00')
     >>>
     """
+    result = _chemfp.decode_fingerprint(_BINARY_LSB, text)
+    if result is not None:
+        return result
     table = _lsb_bit_table
     N = len(text)
     try:
@@ -125,6 +145,9 @@ def from_binary_msb(text):
     (29, '\\x00\\x80\\x00\\x00')
     >>>
     """
+    result = _chemfp.decode_fingerprint(_BINARY_MSB, text)
+    if result is not None:
+        return result
     # It feels like there should be a faster, more elegant way to do this.
     # While close,
     #   hex(int('00010101', 2))[2:].decode("hex")
@@ -156,6 +179,9 @@ def from_base64(text):
     '4869'
     >>> 
     """
+    result = _chemfp.decode_fingerprint(_BASE64, text)
+    if result is not None:
+        return result
     try:
         # This is the same as doing text.decode("base64") but since I
         # need to catch the exception, I might as well work with the
@@ -183,6 +209,9 @@ def from_hex(text):
     Raises a TypeError if the hex string is not a multiple of 2 bytes long
     or if it contains a non-hex character.
     """
+    result = _chemfp.decode_fingerprint(_HEX, text)
+    if result is not None:
+        return result
     return (None, text.decode("hex"))
 
 def from_hex_msb(text):
@@ -195,6 +224,9 @@ def from_hex_msb(text):
     Raises a TypeError if the hex string is not a multiple of 2 bytes long
     or if it contains a non-hex character.
     """
+    result = _chemfp.decode_fingerprint(_HEX_MSB, text)
+    if result is not None:
+        return result
     return (None, text.decode("hex")[::-1])
 
 def from_hex_lsb(text):
@@ -207,6 +239,9 @@ def from_hex_lsb(text):
     Raises a TypeError if the hex string is not a multiple of 2 bytes long
     or if it contains a non-hex character.
     """
+    result = _chemfp.decode_fingerprint(_HEX_LSB, text)
+    if result is not None:
+        return result
     return (None, text.decode("hex").translate(_reverse_bits_in_a_byte_transtable))
 
 
@@ -237,6 +272,9 @@ def from_cactvs(text):
     For format details, see
       ftp://ftp.ncbi.nlm.nih.gov/pubchem/specifications/pubchem_fingerprints.txt
     """
+    result = _chemfp.decode_fingerprint(_CACTVS, text)
+    if result is not None:
+        return result
     fp = text.decode("base64")
     # first 4 bytes are the length (struct.unpack(">I"))
     if fp[:4] != '\x00\x00\x03q':
@@ -312,12 +350,15 @@ def from_daylight(text):
 
   See the implementation for format details.
   """
+  result = _chemfp.decode_fingerprint(_DAYLIGHT, text)
+  if result is not None:
+    return result
   if len(text) % 4 != 1:
     raise ValueError("Daylight binary encoding is of the wrong length")
 
   if text == "3":
     # This is the encoding of an empty string (perverse, I know)
-    return ""
+    return (None, "")
   
   count = text[-1]
   if count not in ("1", "2", "3"):
@@ -354,6 +395,18 @@ def from_daylight(text):
 
 assert from_daylight("I5Z2MLZgOKRcR...1") == (None, "PyDaylight")
 
+# The C decoder for each of the built-in decoder functions
+_encodings = {
+    from_binary_lsb: _BINARY_LSB,
+    from_binary_msb: _BINARY_MSB,
+    from_hex: _HEX,
+    from_hex_lsb: _HEX_LSB,
+    from_hex_msb: _HEX_MSB,
+    from_base64: _BASE64,
+    from_cactvs: _CACTVS,
+    from_daylight: _DAYLIGHT,
+    }
+
 def from_on_bit_positions(text, num_bits=1024, separator=" "):
     """Decode from a list of integers describing the location of the on bits
 
@@ -384,6 +437,74 @@ def from_on_bit_positions(text, num_bits=1024, separator=" "):
     return num_bits, "".join(map(chr, bytes))
 
 
+def decode_fingerprints(encoded_fps, decoder, storage_size):
+    """Decode a list of encoded fingerprints into one block of fixed-size rows
+
+    encoded_fps - a list of encoded fingerprints. None means a missing fingerprint.
+    decoder - a decoder name from the command-line options (like "cactvs" or
+        "binary_msb") or a decoder function
+    storage_size - the number of bytes for each fingerprint
+
+    Returns a 3-ple of (data, num_bytes, num_bits). 'data' is a
+    bytearray where fingerprint i is data[i*storage_size:(i+1)*storage_size],
+    padded with 0 bytes. This is the layout of a fingerprint arena,
+    if storage_size is a multiple of the arena alignment. num_bytes
+    and num_bits are arrays of integers: num_bytes[i] is the decoded
+    size of fingerprint i, or -1 if it could not be decoded, and
+    num_bits[i] is its exact number of bits, or -1 if that isn't known.
+    A fingerprint larger than storage_size is not stored.
+
+    >>> data, num_bytes, num_bits = decode_fingerprints(["0110", "1", "01x"], "binary", 2)
+    >>> str(data)
+    '\\x06\\x00\\x01\\x00\\x00\\x00'
+    >>> num_bytes.tolist(), num_bits.tolist()
+    ([1, 1, -1], [4, 1, -1])
+
+    The built-in decoders decode the whole list in C. Other decoder
+    functions are called once for each fingerprint.
+    """
+    if isinstance(decoder, basestring):
+        try:
+            decoder = _decoder_table[decoder]
+        except KeyError:
+            decoder = None
+        if decoder is None:
+            raise ValueError("Unknown decoder name")
+    if storage_size < 0:
+        raise ValueError("storage_size must not be negative")
+    if not isinstance(encoded_fps, list):
+        encoded_fps = list(encoded_fps)
+    n = len(encoded_fps)
+    data = bytearray(n * storage_size)
+    num_bytes = array.array("i", [-1]) * n
+    num_bits = array.array("i", [-1]) * n
+
+    encoding = _encodings.get(decoder, None)
+    if encoding is not None:
+        num_failures = _chemfp.decode_fingerprints(encoding, encoded_fps, storage_size,
+                                                   data, num_bytes, num_bits)
+        # The C code only accepts well-formed input. Let the Python
+        # decoder try the rest, in case it's more forgiving.
+        if num_failures:
+            todo = [i for i in xrange(n) if num_bytes[i] == -1 and encoded_fps[i] is not None]
+        else:
+            todo = []
+    else:
+        todo = [i for i in xrange(n) if encoded_fps[i] is not None]
+
+    for i in todo:
+        try:
+            fp_num_bits, fp = decoder(encoded_fps[i])
+        except (TypeError, ValueError, KeyError):
+            continue
+        num_bytes[i] = len(fp)
+        if fp_num_bits is not None:
+            num_bits[i] = fp_num_bits
+        if len(fp) <= storage_size:
+            start = i * storage_size
+            data[start:start+len(fp)] = fp
+    return data, num_bytes, num_bits
+
 ##############
 
 def import_decoder(path):
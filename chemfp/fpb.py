@@ -0,0 +1,262 @@
+"""Read and write the binary "fpb" fingerprint arena format
+
+NOTE: This module should not be used directly. Use
+FingerprintArena.save() to write an FPB file and chemfp.open() or
+chemfp.load_fingerprints() to read one.
+
+The FPS format is easy to read and write, but loading it into a
+FingerprintArena means parsing every hex fingerprint, then sorting and
+copying the result into an aligned block of memory. The FPB format
+stores the arena exactly as it is laid out in memory, so it can be
+memory-mapped and searched directly, with no parsing and no copy.
+
+The file layout, with all integers in native byte order, is:
+
+  header (128 bytes)
+     8 bytes  magic: "FPB1\\r\\n\\0\\0"
+     uint32   byte order marker (0x01020304)
+     uint32   num_bits
+     uint32   storage_size
+     uint32   alignment
+     uint64   number of fingerprints
+     uint32   flags (bit 0 is set if the fingerprints are sorted by popcount)
+     5 x (uint64 offset, uint64 length) for the sections below
+     NUL padding
+
+  sections, in order
+     metadata - the FPS header lines except num_bits, as text
+     popcount indices - num_bits+2 C ints, or empty for unsorted arenas
+     id offsets - num_fingerprints+1 uint64 offsets into the id data
+     id data - each id followed by a newline
+     arena - num_fingerprints * storage_size bytes, aligned to
+             at least 64 bytes from the start of the file
+
+Id i is id_data[id_offsets[i]:id_offsets[i+1]-1].
+"""
+
+from __future__ import absolute_import
+
+import array
+import struct
+from cStringIO import StringIO
+
+from . import io
+
+__all__ = []
+
+MAGIC = "FPB1\r\n\0\0"
+BYTE_ORDER_MARKER = 0x01020304
+HEADER_SIZE = 128
+# The largest alignment used by any popcount method
+MIN_ARENA_ALIGNMENT = 64
+
+FLAG_POPCOUNT_SORTED = 1
+
+_header_format = "=8sIIIIQI" + "QQ"*5
+_header_struct = struct.Struct(_header_format)
+assert _header_struct.size <= HEADER_SIZE
+
+_uint64_struct = struct.Struct("=Q")
+
+
+class FPBFormatError(ValueError):
+    pass
+
+
+def _get_subarena_popcount_indices(arena):
+    # The popcount indices are for the full arena. A subarena
+    # (from slicing or iter_arenas) has a different range.
+    popcount_indices = arena.popcount_indices
+    if not popcount_indices:
+        return ""
+    if arena.start == 0 and arena.end == (
+        (len(arena.arena) - arena.start_padding - arena.end_padding) // arena.storage_size):
+        return str(popcount_indices)
+    indices = array.array("i")
+    indices.fromstring(str(popcount_indices))
+    start = arena.start
+    end = arena.end
+    for i, index in enumerate(indices):
+        if index < start:
+            index = start
+        elif index > end:
+            index = end
+        indices[i] = index - start
+    return indices.tostring()
+
+def _align(offset, alignment):
+    extra = offset % alignment
+    if extra:
+        offset += alignment - extra
+    return offset
+
+def write_fpb(arena, destination):
+    """Write the FingerprintArena to the destination filename or file object"""
+    metadata_f = StringIO()
+    io.write_fps1_magic(metadata_f)
+    io.write_fps1_header(metadata_f, arena.metadata)
+    # num_bits is already in the FPB header
+    metadata_text = "".join(line for line in metadata_f.getvalue().splitlines(True)
+                                if not line.startswith("#num_bits="))
+
+    popcount_indices = _get_subarena_popcount_indices(arena)
+
+    ids = arena.arena_ids
+    for id in ids:
+        if "\n" in id:
+            raise ValueError("fingerprint ids must not contain a newline: %r" % (id,))
+
+    num_fingerprints = len(ids)
+    id_offsets = StringIO()
+    id_data_size = 0
+    pack_uint64 = _uint64_struct.pack
+    for id in ids:
+        id_offsets.write(pack_uint64(id_data_size))
+        id_data_size += len(id) + 1
+    id_offsets.write(pack_uint64(id_data_size))
+    id_offsets = id_offsets.getvalue()
+
+    storage_size = arena.storage_size
+    arena_start = arena.start_padding + arena.start * storage_size
+    arena_end = arena.start_padding + arena.end * storage_size
+    arena_size = arena_end - arena_start
+
+    # Lay out the sections
+    sections = []
+    offset = HEADER_SIZE
+    for size in (len(metadata_text), len(popcount_indices), len(id_offsets), id_data_size):
+        sections.append((offset, size))
+        offset += size
+    arena_offset = _align(offset, max(arena.alignment, MIN_ARENA_ALIGNMENT))
+    sections.append((arena_offset, arena_size))
+
+    flags = 0
+    if popcount_indices:
+        flags |= FLAG_POPCOUNT_SORTED
+
+    header_fields = [MAGIC, BYTE_ORDER_MARKER, arena.num_bits, storage_size,
+                     arena.alignment, num_fingerprints, flags]
+    for section in sections:
+        header_fields.extend(section)
+    header = _header_struct.pack(*header_fields)
+
+    need_close = False
+    if isinstance(destination, basestring):
+        outfile = open(destination, "wb")
+        need_close = True
+    else:
+        outfile = destination
+
+    try:
+        outfile.write(header)
+        outfile.write("\0" * (HEADER_SIZE - len(header)))
+        outfile.write(metadata_text)
+        outfile.write(popcount_indices)
+        outfile.write(id_offsets)
+        for id in ids:
+            outfile.write(id)
+            outfile.write("\n")
+        outfile.write("\0" * (arena_offset - offset))
+        # Write in chunks so saving a large arena doesn't make a copy
+        chunk_size = max(storage_size, 1) * 10000
+        for start in xrange(arena_start, arena_end, chunk_size):
+            outfile.write(arena.arena[start:min(start+chunk_size, arena_end)])
+    finally:
+        if need_close:
+            outfile.close()
+
+
+def _read_header(data, filename):
+    if len(data) < HEADER_SIZE:
+        raise FPBFormatError("File %r is too small to be an FPB file" % (filename,))
+    fields = _header_struct.unpack_from(data, 0)
+    (magic, byte_order, num_bits, storage_size, alignment,
+     num_fingerprints, flags) = fields[:7]
+    if magic != MAGIC:
+        raise FPBFormatError("File %r does not start with the FPB magic" % (filename,))
+    if byte_order != BYTE_ORDER_MARKER:
+        raise FPBFormatError("File %r was written on a machine with a different byte order"
+                             % (filename,))
+    sections = zip(fields[7::2], fields[8::2])
+    for offset, size in sections:
+        if offset + size > len(data):
+            raise FPBFormatError("File %r is truncated" % (filename,))
+    return num_bits, storage_size, alignment, num_fingerprints, flags, sections
+
+
+class _MappedOffsets(object):
+    # The uint64 id offsets, read directly from the memory-mapped file
+    def __init__(self, data, offset, n):
+        self._data = data
+        self._offset = offset
+        self._n = n
+    def __len__(self):
+        return self._n
+    def __getitem__(self, i):
+        if not (0 <= i < self._n):
+            raise IndexError("offset index out of range")
+        return _uint64_struct.unpack_from(self._data, self._offset + 8*i)[0]
+    def _get_buffer(self, start, n):
+        # The offsets are in native byte order, like the rest of the
+        # file (_read_header() checks the byte order marker), so the
+        # C code can use them directly
+        return buffer(self._data, self._offset + 8*start, 8*n)
+
+def _mmap_file(source):
+    import mmap
+    if isinstance(source, basestring):
+        f = open(source, "rb")
+        filename = source
+    else:
+        f = source
+        filename = getattr(source, "name", None)
+    try:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), filename
+        except (AttributeError, ValueError, EnvironmentError):
+            # Not a real file (or an empty one). Read it into memory.
+            if isinstance(source, basestring):
+                raise
+            return f.read(), filename
+    finally:
+        if isinstance(source, basestring):
+            f.close()
+
+def open_fpb(source):
+    """Memory-map the FPB file and return a FingerprintArena
+
+    The arena's fingerprint data is the memory-mapped file, so the
+    search functions work on it directly.
+    """
+    from .readers import read_header
+    from .arena import FingerprintArena, IdStore
+
+    data, filename = _mmap_file(source)
+    (num_bits, storage_size, alignment, num_fingerprints, flags,
+     sections) = _read_header(data, filename)
+    ((metadata_offset, metadata_size),
+     (popcount_offset, popcount_size),
+     (id_offsets_offset, id_offsets_size),
+     (id_data_offset, id_data_size),
+     (arena_offset, arena_size)) = sections
+
+    metadata, _, _ = read_header(
+        StringIO(data[metadata_offset:metadata_offset+metadata_size]), filename)
+    metadata.num_bits = num_bits
+    metadata.num_bytes = (num_bits + 7) // 8
+
+    if arena_size != num_fingerprints * storage_size:
+        raise FPBFormatError("File %r has an incorrect arena size" % (filename,))
+    if (flags & FLAG_POPCOUNT_SORTED) and popcount_size != (num_bits+2) * struct.calcsize("i"):
+        raise FPBFormatError("File %r has an incorrect popcount index size" % (filename,))
+    popcount_indices = data[popcount_offset:popcount_offset+popcount_size]
+
+    if id_offsets_size != (num_fingerprints+1) * _uint64_struct.size:
+        raise FPBFormatError("File %r has an incorrect number of ids" % (filename,))
+    ids = IdStore(buffer(data, id_data_offset, id_data_size),
+                  _MappedOffsets(data, id_offsets_offset, num_fingerprints+1))
+
+    return FingerprintArena(metadata, alignment,
+                            arena_offset, len(data) - arena_offset - arena_size,
+                            storage_size, data, popcount_indices, ids,
+                            0, num_fingerprints)
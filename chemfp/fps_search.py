@@ -3,11 +3,15 @@ from __future__ import absolute_import
 
 import ctypes
 import itertools
+import math
 import array
+import threading
+import Queue
 
 import _chemfp
 from . import ChemFPError
 from . import check_fp_problems, check_metadata_problems
+from . import metrics
 
 class FPSFormatError(ChemFPError):
     def __init__(self, code, filename, lineno):
@@ -18,11 +22,11 @@ class FPSFormatError(ChemFPError):
     def __repr__(self):
         return "FPSFormatError(%r, %r, %r)" % (self.code, self.filename, self.lineno)
     def __str__(self):
-        return "%s at line %s of %r" % (_chemfp.strerror(code), lineno, filename)
+        return "%s at line %s of %r" % (_chemfp.strerror(self.code), self.lineno, self.filename)
 
 def _chemfp_error(err, lineno, filename):
     if -40 <= err <= -30:
-        return FPSFormatError(err, lineno, filename)
+        return FPSFormatError(err, filename, lineno)
     elif err == -2:
         raise MemoryError(_chemfp.strerror(err))
     else:
@@ -52,6 +56,131 @@ def report_errors(problem_report):
             raise TypeError(msg_template % dict(metadata1 = "query",
                                                 metadata2 = "target"))
 
+######## Target block selection #########
+
+def _get_tanimoto_popcount_range(query_arena, threshold):
+    """Return the (min, max) target popcounts which might have a hit
+
+    A query with popcount A and a target with popcount B have a
+    Tanimoto score of at most min(A, B) / max(A, B). Returns (None,
+    None) if any target might have a hit.
+    """
+    if threshold <= 0.0:
+        return None, None
+    byte_popcount = _chemfp.byte_popcount
+    min_popcount = max_popcount = None
+    for id, fp in query_arena:
+        A = byte_popcount(fp)
+        if A == 0:
+            # The score is always 0.0
+            continue
+        # Allow a bit of slop for the floating point comparisons
+        lo = int(math.ceil(A * threshold - 1e-6))
+        hi = int(math.floor(A / threshold + 1e-6))
+        if min_popcount is None or lo < min_popcount:
+            min_popcount = lo
+        if max_popcount is None or hi > max_popcount:
+            max_popcount = hi
+    if min_popcount is None:
+        # None of the queries can have a hit
+        return 1, 0
+    return min_popcount, max_popcount
+
+def _iter_target_blocks(target_reader, query_arena, threshold):
+    """Yield the (lineno, block) pairs of the target blocks to search
+
+    'lineno' is the line number of the first line in the block. If
+    the target reader has an FPS index then the blocks which cannot
+    have a Tanimoto score of at least 'threshold' for any of the
+    queries are skipped. 'query_arena' may be any iterable of (id,
+    fingerprint) pairs.
+    """
+    min_popcount = max_popcount = None
+    if target_reader.index is not None:
+        min_popcount, max_popcount = _get_tanimoto_popcount_range(query_arena, threshold)
+    return target_reader._iter_search_blocks(min_popcount, max_popcount)
+
+######## Parallel scan support #########
+
+# The FPS search functions release the GIL, so several threads can
+# search different blocks of the same file at the same time. The
+# calling thread reads and queues the blocks, and each worker thread
+# searches the blocks it takes from the queue.
+
+def _get_num_scan_threads():
+    from . import get_num_threads
+    return get_num_threads()
+
+class _ScanError(Exception):
+    pass
+
+def _parallel_scan(target_reader, target_blocks, num_threads, make_worker):
+    """Search the target blocks using 'num_threads' worker threads
+
+    'target_blocks' is an iterator of (lineno, block) pairs, from
+    _iter_target_blocks(). 'make_worker' is called once per thread and
+    returns a function
+    which takes a (lineno, block) and returns (err, num_lines, result). If err
+    is non-zero then num_lines is the number of lines processed
+    before the error. This returns the results in block order, and the
+    list of worker functions. On error it raises the exception for
+    the first failing block, with the correct line number.
+    """
+    block_queue = Queue.Queue(maxsize = 2*num_threads)
+    results = {}
+    errors = {}
+    failed = threading.Event()
+    workers = [make_worker() for i in xrange(num_threads)]
+    
+    def run(worker):
+        while 1:
+            item = block_queue.get()
+            if item is None:
+                break
+            if failed.isSet():
+                continue
+            block_num, lineno, block = item
+            try:
+                err, num_lines, result = worker(lineno, block)
+            except BaseException, exc:
+                errors[block_num] = exc
+                failed.set()
+                continue
+            if err:
+                errors[block_num] = (err, lineno + num_lines)
+                failed.set()
+                continue
+            results[block_num] = result
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    num_blocks = 0
+    try:
+        for lineno, block in target_blocks:
+            if failed.isSet():
+                break
+            block_queue.put( (num_blocks, lineno, block) )
+            num_blocks += 1
+    finally:
+        for thread in threads:
+            block_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        block_num = min(errors)
+        error = errors[block_num]
+        if isinstance(error, BaseException):
+            raise error
+        err, lineno = error
+        raise _chemfp_error(err, lineno, target_reader._filename)
+
+    return [results[i] for i in xrange(num_blocks)], workers
+
+
 ######## count Tanimoto search #########
 
 def _fp_to_arena(query_fp, metadata):
@@ -64,22 +193,48 @@ def count_tanimoto_hits_fp(query_fp, target_reader, threshold):
 
 def count_tanimoto_hits_arena(query_arena, target_reader, threshold):
     require_matching_sizes(query_arena, target_reader)
+    num_threads = _get_num_scan_threads()
+    if num_threads > 1:
+        return _parallel_count_tanimoto_hits_arena(query_arena, target_reader,
+                                                   threshold, num_threads)
     counts = array.array("i", (0 for i in xrange(len(query_arena))))
 
-    lineno = target_reader._first_fp_lineno
-
-    for block in target_reader.iter_blocks():
+    for lineno, block in _iter_target_blocks(target_reader, query_arena, threshold):
         err, num_lines = _chemfp.fps_count_tanimoto_hits(
             query_arena.metadata.num_bits,
             query_arena.start_padding, query_arena.end_padding,
             query_arena.storage_size, query_arena.arena, 0, -1,
             block, 0, -1,
             threshold, counts)
-        lineno += num_lines
         if err:
-            raise _chemfp_error(err, lineno, target_reader._filename)
+            raise _chemfp_error(err, lineno + num_lines, target_reader._filename)
 
     return list(counts)
+
+def _parallel_count_tanimoto_hits_arena(query_arena, target_reader, threshold, num_threads):
+    num_queries = len(query_arena)
+    def make_worker():
+        # Each worker accumulates its own counts
+        counts = array.array("i", (0 for i in xrange(num_queries)))
+        def count_block(lineno, block):
+            err, num_lines = _chemfp.fps_count_tanimoto_hits(
+                query_arena.metadata.num_bits,
+                query_arena.start_padding, query_arena.end_padding,
+                query_arena.storage_size, query_arena.arena, 0, -1,
+                block, 0, -1,
+                threshold, counts)
+            return err, num_lines, None
+        count_block.counts = counts
+        return count_block
+
+    results, workers = _parallel_scan(
+        target_reader, _iter_target_blocks(target_reader, query_arena, threshold),
+        num_threads, make_worker)
+    counts = [0] * num_queries
+    for worker in workers:
+        for i, count in enumerate(worker.counts):
+            counts[i] += count
+    return counts
     
 
 
@@ -98,6 +253,13 @@ def id_threshold_tanimoto_search_fp(query_fp, target_reader, threshold):
 
     The results is an FPSSearchResults instance contain the result.
     """
+    num_threads = _get_num_scan_threads()
+    if num_threads > 1:
+        query_arena = _fp_to_arena(query_fp, target_reader.metadata)
+        result = _parallel_threshold_tanimoto_search_arena(query_arena, target_reader,
+                                                           threshold, num_threads)[0]
+        return result.get_ids_and_scores()
+
     hits = []
 
     fp_size = len(query_fp)
@@ -106,9 +268,7 @@ def id_threshold_tanimoto_search_fp(query_fp, target_reader, threshold):
     NUM_CELLS = 1000
     cells = (TanimotoCell*NUM_CELLS)()
 
-    lineno = target_reader._first_fp_lineno
-    
-    for block in target_reader.iter_blocks():
+    for lineno, block in _iter_target_blocks(target_reader, [(None, query_fp)], threshold):
         start = 0
         end = len(block)
         while 1:
@@ -149,6 +309,12 @@ def threshold_tanimoto_search_arena(query_arena, target_reader, threshold):
 
     if not query_arena:
         return FPSSearchResults([])
+
+    num_threads = _get_num_scan_threads()
+    if num_threads > 1:
+        return _parallel_threshold_tanimoto_search_arena(query_arena, target_reader,
+                                                         threshold, num_threads)
+    
     results = [FPSSearchResult([], []) for i in xrange(len(query_arena))]
     
     # Compute at least 100 tanimotos per query, but at most 10,000 at a time
@@ -156,9 +322,7 @@ def threshold_tanimoto_search_arena(query_arena, target_reader, threshold):
     NUM_CELLS = max(10000, len(query_arena) * 100)
     cells = (TanimotoCell*NUM_CELLS)()
 
-    lineno = target_reader._first_fp_lineno
-
-    for block in target_reader.iter_blocks():
+    for lineno, block in _iter_target_blocks(target_reader, query_arena, threshold):
         start = 0
         end = len(block)
         while 1:
@@ -182,6 +346,46 @@ def threshold_tanimoto_search_arena(query_arena, target_reader, threshold):
                 break
 
     return FPSSearchResults(results)
+
+def _parallel_threshold_tanimoto_search_arena(query_arena, target_reader, threshold,
+                                              num_threads):
+    num_cells = max(10000, len(query_arena) * 100)
+    def make_worker():
+        cells = (TanimotoCell*num_cells)()
+        def search_block(lineno, block):
+            hits = []
+            start = 0
+            end = len(block)
+            total_lines = 0
+            while 1:
+                err, start, num_lines, num_cells_found = _chemfp.fps_threshold_tanimoto_search(
+                    query_arena.metadata.num_bits,
+                    query_arena.start_padding, query_arena.end_padding,
+                    query_arena.storage_size, query_arena.arena, 0, -1,
+                    block, start, end,
+                    threshold, cells)
+                total_lines += num_lines
+                if err:
+                    return err, total_lines, None
+                for cell in itertools.islice(cells, 0, num_cells_found):
+                    hits.append( (cell.query_index, block[cell.id_start:cell.id_end], cell.score) )
+                if start == end:
+                    break
+            return 0, total_lines, hits
+        return search_block
+
+    block_hits, workers = _parallel_scan(
+        target_reader, _iter_target_blocks(target_reader, query_arena, threshold),
+        num_threads, make_worker)
+
+    # Merge the hits in block order, which is the same order as the serial search
+    results = [FPSSearchResult([], []) for i in xrange(len(query_arena))]
+    for hits in block_hits:
+        for query_index, id, score in hits:
+            result = results[query_index]
+            result.ids.append(id)
+            result.scores.append(score)
+    return FPSSearchResults(results)
             
 ######### k-nearest Tanimoto search, with threshold
 
@@ -238,6 +442,10 @@ def knearest_tanimoto_search(query_arena, target_reader, k, threshold):
         raise ValueError("k must be non-negative")
 
     num_queries = len(query_arena)
+    num_threads = _get_num_scan_threads()
+    if num_threads > 1 and num_queries:
+        return _parallel_knearest_tanimoto_search(query_arena, target_reader, k, threshold,
+                                                  num_threads)
     search = _make_knearest_search(num_queries, k)
 
     _chemfp.fps_knearest_search_init(
@@ -248,7 +456,10 @@ def knearest_tanimoto_search(query_arena, target_reader, k, threshold):
         k, threshold)
 
     try:
-        for block in target_reader.iter_blocks():
+        for lineno, block in _iter_target_blocks(target_reader, query_arena, threshold):
+            # Ties are broken by record position, which doesn't count
+            # the blocks skipped by the index
+            search.num_targets_processed = lineno - target_reader._first_fp_lineno
             err = _chemfp.fps_knearest_tanimoto_search_feed(search, block, 0, -1)
             if err:
                 lineno = target_reader._first_fp_lineno + search.num_targets_processed
@@ -270,6 +481,173 @@ def knearest_tanimoto_search(query_arena, target_reader, k, threshold):
     finally:
         _chemfp.fps_knearest_search_free(search)
 
+def _get_knearest_hits(search, num_queries):
+    hits = []
+    for query_index in xrange(num_queries):
+        heap = search.heaps[0][query_index]
+        ids = [ctypes.string_at(heap.ids[0][i]) for i in xrange(heap.size)]
+        scores = heap.scores[0][:heap.size]
+        hits.append( (ids, scores) )
+    return hits
+
+def _get_knearest_positions(search, num_queries):
+    # The record position of each hit, in the same order as the hits
+    positions = []
+    for query_index in xrange(num_queries):
+        heap = search.heaps[0][query_index]
+        positions.append(heap.indices[0][:heap.size])
+    return positions
+
+def _parallel_knearest_tanimoto_search(query_arena, target_reader, k, threshold,
+                                       num_threads):
+    # Each worker has its own set of k-nearest heaps. Merge them at the end.
+    num_queries = len(query_arena)
+    searches = []
+    def make_worker():
+        search = _make_knearest_search(num_queries, k)
+        _chemfp.fps_knearest_search_init(
+            search,
+            query_arena.metadata.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, 0, -1,
+            k, threshold)
+        searches.append(search)
+        def search_block(lineno, block):
+            # Use the global record position, so ties are broken the
+            # same way as in the serial search
+            num_processed = search.num_targets_processed = lineno - target_reader._first_fp_lineno
+            err = _chemfp.fps_knearest_tanimoto_search_feed(search, block, 0, -1)
+            return err, search.num_targets_processed - num_processed, None
+        return search_block
+
+    try:
+        _parallel_scan(target_reader, _iter_target_blocks(target_reader, query_arena, threshold),
+                       num_threads, make_worker)
+
+        all_hits = []
+        for search in searches:
+            _chemfp.fps_knearest_search_finish(search)
+            all_hits.append(zip(_get_knearest_hits(search, num_queries),
+                                _get_knearest_positions(search, num_queries)))
+
+        results = []
+        for query_index in xrange(num_queries):
+            merged = []
+            for hits in all_hits:
+                (ids, scores), positions = hits[query_index]
+                merged.extend(zip(scores, positions, ids))
+            # Ties keep file order, like the serial search
+            merged.sort(key = lambda (score, position, id): (-score, position))
+            del merged[k:]
+            results.append(FPSSearchResult([id for (score, position, id) in merged],
+                                           [score for (score, position, id) in merged]))
+        return FPSSearchResults(results)
+    finally:
+        for search in searches:
+            _chemfp.fps_knearest_search_free(search)
+
+######### Searches with other similarity measures
+
+# These take a 'metric', which is a chemfp.metrics.Metric, a metric
+# name, or None for Tanimoto. The Tanimoto searches use the
+# Tanimoto-specific (and multi-threaded) code above.
+
+def count_hits_arena(query_arena, target_reader, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return count_tanimoto_hits_arena(query_arena, target_reader, threshold)
+    require_matching_sizes(query_arena, target_reader)
+    counts = array.array("i", (0 for i in xrange(len(query_arena))))
+
+    lineno = target_reader._first_fp_lineno
+    for block in target_reader.iter_blocks():
+        err, num_lines = _chemfp.fps_count_metric_hits(*metric._args() + (
+            query_arena.metadata.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, 0, -1,
+            block, 0, -1,
+            threshold, counts))
+        lineno += num_lines
+        if err:
+            raise _chemfp_error(err, lineno, target_reader._filename)
+
+    return list(counts)
+
+def threshold_search_arena(query_arena, target_reader, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return threshold_tanimoto_search_arena(query_arena, target_reader, threshold)
+    require_matching_sizes(query_arena, target_reader)
+    if not query_arena:
+        return FPSSearchResults([])
+
+    results = [FPSSearchResult([], []) for i in xrange(len(query_arena))]
+    NUM_CELLS = max(10000, len(query_arena) * 100)
+    cells = (TanimotoCell*NUM_CELLS)()
+
+    lineno = target_reader._first_fp_lineno
+    for block in target_reader.iter_blocks():
+        start = 0
+        end = len(block)
+        while 1:
+            err, start, num_lines, num_cells = _chemfp.fps_threshold_metric_search(
+                *metric._args() + (
+                query_arena.metadata.num_bits,
+                query_arena.start_padding, query_arena.end_padding,
+                query_arena.storage_size, query_arena.arena, 0, -1,
+                block, start, end,
+                threshold, cells))
+            lineno += num_lines
+            if err:
+                raise _chemfp_error(err, lineno, target_reader._filename)
+
+            for cell in itertools.islice(cells, 0, num_cells):
+                result = results[cell.query_index]
+                result.ids.append(block[cell.id_start:cell.id_end])
+                result.scores.append(cell.score)
+            if start == end:
+                break
+
+    return FPSSearchResults(results)
+
+def id_threshold_search_arena(query_arena, target_reader, threshold, metric=None):
+    return zip(query_arena.arena_ids,
+               threshold_search_arena(query_arena, target_reader, threshold, metric))
+
+def knearest_search(query_arena, target_reader, k, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return knearest_tanimoto_search(query_arena, target_reader, k, threshold)
+    require_matching_sizes(query_arena, target_reader)
+    if k < 0:
+        raise ValueError("k must be non-negative")
+
+    num_queries = len(query_arena)
+    search = _make_knearest_search(num_queries, k)
+    _chemfp.fps_knearest_search_init(
+        search,
+        query_arena.metadata.num_bits,
+        query_arena.start_padding, query_arena.end_padding,
+        query_arena.storage_size, query_arena.arena, 0, -1,
+        k, threshold)
+    try:
+        for block in target_reader.iter_blocks():
+            err = _chemfp.fps_knearest_metric_search_feed(
+                *metric._args() + (query_arena.metadata.num_bits, search, block, 0, -1))
+            if err:
+                lineno = target_reader._first_fp_lineno + search.num_targets_processed
+                raise _chemfp_error(err, lineno, target_reader._filename)
+
+        _chemfp.fps_knearest_search_finish(search)
+        return FPSSearchResults([FPSSearchResult(ids, scores)
+                                     for (ids, scores) in _get_knearest_hits(search, num_queries)])
+    finally:
+        _chemfp.fps_knearest_search_free(search)
+
+def id_knearest_search(query_arena, target_reader, k, threshold, metric=None):
+    return zip(query_arena.arena_ids,
+               knearest_search(query_arena, target_reader, k, threshold, metric))
+
 def _reorder_row(ids, scores, name):
     indices = range(len(ids))
     if name == "decreasing-scores":
@@ -0,0 +1,350 @@
+"""Read and write the ".fpsidx" random-access index for FPS files
+
+NOTE: This module should not be used directly. Use the fpsindex
+program or write_fps1_output(..., index=True) to make an index, and
+chemfp.open() to use it.
+
+An FPS file can only be read from the start to the end. The index is
+a small sidecar file, stored next to the FPS file with ".fpsidx"
+added to the filename, which splits the fingerprint records into
+blocks of 'records_per_block' records. For each block it stores where
+the block starts in the FPS file, its first line number, the number of
+records, the smallest and largest fingerprint popcount, and a CRC-32
+hash of the ids.
+
+With the index, an FPSReader can start reading at any block, split the
+file into record ranges for several workers, and skip the blocks
+which cannot contain a fingerprint similar enough to the query during
+a threshold or k-nearest Tanimoto scan.
+
+The index is a text file. Each block line has the tab-separated
+offset, line number, number of records, min popcount, max popcount,
+and the id hash as 8 hex digits:
+
+  #FPSIDX1
+  #records_per_block=1000
+  #fps_size=131237
+  #fps_mtime=1334567890.25
+  #fps_hash=5c0e19f2
+  #num_records=1000
+  #offset lineno num_records min_popcount max_popcount id_hash
+  153     7       1000    2       61      9a0c3e41
+
+Only uncompressed FPS files can be indexed. The index is ignored if
+the FPS file size or modification time is not the same as 'fps_size'
+and 'fps_mtime', or if 'fps_hash', the CRC-32 of the header, the first
+block and the last block, doesn't match.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import os
+import zlib
+import tempfile
+from __builtin__ import open as _builtin_open
+
+import _chemfp
+
+__all__ = []
+
+INDEX_EXTENSION = ".fpsidx"
+
+# Smaller blocks skip more precisely but make a bigger index
+RECORDS_PER_BLOCK = 1000
+
+
+class FPSIndexFormatError(ValueError):
+    pass
+
+
+def _get_umask():
+    # The only way to read the umask is to set it
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def get_index_filename(fps_filename):
+    """Return the name of the index file for 'fps_filename'"""
+    return fps_filename + INDEX_EXTENSION
+
+
+class FPSIndex(object):
+    """The block locations and popcount ranges for an FPS file
+
+    'blocks' is a list of (offset, lineno, num_records, min_popcount,
+    max_popcount, id_hash) tuples, in file order. Every block except
+    the last has 'records_per_block' records. The last block ends at
+    byte 'fps_size'. 'fps_mtime' and 'fps_hash' are the modification
+    time and get_fps_hash() of the indexed FPS file.
+    """
+    def __init__(self, records_per_block, fps_size, fps_mtime, fps_hash, blocks):
+        if records_per_block < 1:
+            raise ValueError("records_per_block must be positive")
+        self.records_per_block = records_per_block
+        self.fps_size = fps_size
+        self.fps_mtime = fps_mtime
+        self.fps_hash = fps_hash
+        self.blocks = blocks
+        self.num_records = sum(block[2] for block in blocks)
+
+    def __repr__(self):
+        return "FPSIndex(records_per_block=%d, fps_size=%d, num_records=%d)" % (
+            self.records_per_block, self.fps_size, self.num_records)
+
+    def __eq__(self, other):
+        if not isinstance(other, FPSIndex):
+            return NotImplemented
+        return ((self.records_per_block, self.fps_size, self.fps_mtime,
+                 self.fps_hash, self.blocks) ==
+                (other.records_per_block, other.fps_size, other.fps_mtime,
+                 other.fps_hash, other.blocks))
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def get_block_span(self, block_num):
+        """Return the (start, end) byte offsets of block 'block_num'"""
+        start = self.blocks[block_num][0]
+        if block_num + 1 < len(self.blocks):
+            end = self.blocks[block_num+1][0]
+        else:
+            end = self.fps_size
+        return start, end
+
+    def get_record_range(self, start=0, end=None):
+        """Clip the record range [start, end) to the file, like a slice"""
+        start, end, step = slice(start, end).indices(self.num_records)
+        return start, max(start, end)
+
+    def get_chunk_ranges(self, num_chunks):
+        """Split the records into at most 'num_chunks' (start, end) ranges
+
+        The ranges start on a block boundary and have about the same
+        number of blocks, so each one can be read independently with
+        FPSReader.iter_records() or FPSReader.iter_arenas().
+        """
+        if num_chunks < 1:
+            raise ValueError("num_chunks must be positive")
+        num_blocks = len(self.blocks)
+        num_chunks = min(num_chunks, num_blocks)
+        ranges = []
+        record_start = 0
+        for i in xrange(num_chunks):
+            block_end = (num_blocks * (i+1)) // num_chunks
+            record_end = min(block_end * self.records_per_block, self.num_records)
+            ranges.append( (record_start, record_end) )
+            record_start = record_end
+        return ranges
+
+    def iter_blocks(self, infile, start_block=0, end_block=None,
+                    min_popcount=None, max_popcount=None, lock=None):
+        """Yield (block_num, lineno, block text) using the FPS file object 'infile'
+
+        Blocks whose popcounts are all below 'min_popcount' or above
+        'max_popcount' are not read. If several threads share 'infile'
+        then pass in a 'lock' to hold during each seek and read.
+        """
+        if end_block is None:
+            end_block = len(self.blocks)
+        for block_num in xrange(start_block, end_block):
+            offset, lineno, num_records, block_min, block_max, id_hash = self.blocks[block_num]
+            if min_popcount is not None and block_max < min_popcount:
+                continue
+            if max_popcount is not None and block_min > max_popcount:
+                continue
+            start, end = self.get_block_span(block_num)
+            if lock is None:
+                infile.seek(start)
+                text = infile.read(end - start)
+            else:
+                with lock:
+                    infile.seek(start)
+                    text = infile.read(end - start)
+            yield block_num, lineno, text
+
+    def save(self, destination):
+        """Write the index to the file named 'destination'"""
+        # Write to a temporary file then rename, so an interrupted
+        # save never leaves a truncated index.
+        fd, tmp_filename = tempfile.mkstemp(
+            prefix="." + os.path.basename(destination), suffix=".tmp",
+            dir=os.path.dirname(destination) or ".")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write("#FPSIDX1\n")
+                outfile.write("#records_per_block=%d\n" % (self.records_per_block,))
+                outfile.write("#fps_size=%d\n" % (self.fps_size,))
+                outfile.write("#fps_mtime=%r\n" % (self.fps_mtime,))
+                outfile.write("#fps_hash=%08x\n" % (self.fps_hash,))
+                outfile.write("#num_records=%d\n" % (self.num_records,))
+                outfile.write("#offset\tlineno\tnum_records\tmin_popcount\tmax_popcount\tid_hash\n")
+                outfile.writelines("%d\t%d\t%d\t%d\t%d\t%08x\n" % block for block in self.blocks)
+            os.chmod(tmp_filename, 0666 & ~_get_umask())
+            os.rename(tmp_filename, destination)
+        except:
+            os.unlink(tmp_filename)
+            raise
+
+
+class IndexBuilder(object):
+    """Make an FPSIndex while writing or reading an FPS file
+
+    Call add() for each record, in order, with the byte offset and
+    line number where the record starts. Call finish() with the name
+    of the complete FPS file to get the index.
+    """
+    def __init__(self, records_per_block=RECORDS_PER_BLOCK):
+        if records_per_block < 1:
+            raise ValueError("records_per_block must be positive")
+        self.records_per_block = records_per_block
+        self.blocks = []
+        self._block = None
+
+    def add(self, offset, lineno, id, popcount):
+        block = self._block
+        if block is None:
+            block = self._block = [offset, lineno, 0, popcount, popcount, 0]
+        block[2] += 1
+        if popcount < block[3]:
+            block[3] = popcount
+        elif popcount > block[4]:
+            block[4] = popcount
+        block[5] = zlib.crc32(id + "\n", block[5])
+        if block[2] == self.records_per_block:
+            self._end_block()
+
+    def _end_block(self):
+        block = self._block
+        if block is not None:
+            block[5] &= 0xffffffff
+            self.blocks.append(tuple(block))
+            self._block = None
+
+    def finish(self, fps_filename):
+        self._end_block()
+        with _builtin_open(fps_filename, "rb") as infile:
+            info = os.fstat(infile.fileno())
+            fps_hash = get_fps_hash(infile, info.st_size, self.blocks)
+        return FPSIndex(self.records_per_block, info.st_size, info.st_mtime,
+                        fps_hash, self.blocks)
+
+
+def get_fps_hash(infile, fps_size, blocks):
+    """Return the CRC-32 of the header, first block and last block of an FPS file
+
+    'blocks' are the index blocks for the open file 'infile', which has
+    'fps_size' bytes. This is a quick check that the index still
+    describes the file, without reading all of it.
+    """
+    if len(blocks) > 1:
+        # The header and first block, then the last block
+        spans = [(0, blocks[1][0]), (blocks[-1][0], fps_size)]
+    else:
+        spans = [(0, fps_size)]
+    crc = 0
+    for start, end in spans:
+        infile.seek(start)
+        crc = zlib.crc32(infile.read(end - start), crc)
+    return crc & 0xffffffff
+
+
+def build_index(fps_filename, records_per_block=RECORDS_PER_BLOCK):
+    """Read the FPS file 'fps_filename' and return its FPSIndex
+
+    Raises a readers.FPSParseError if a record isn't valid.
+    """
+    from . import readers
+    builder = IndexBuilder(records_per_block)
+    with _builtin_open(fps_filename, "rb") as infile:
+        metadata, lineno, block = readers.read_header(infile, fps_filename)
+        if block is not None:
+            offset = infile.tell() - len(block)
+            expected_hex_len = 2*metadata.num_bytes
+            byte_popcount = _chemfp.byte_popcount
+            parse_id_fp = _chemfp.fps_parse_id_fp
+            blocks = readers._read_blocks(infile)
+            while block is not None:
+                for line in block.splitlines(True):
+                    err, id_fp = parse_id_fp(expected_hex_len, line)
+                    if err:
+                        raise readers.FPSParseError(err, lineno, fps_filename)
+                    builder.add(offset, lineno, id_fp[0], byte_popcount(id_fp[1]))
+                    offset += len(line)
+                    lineno += 1
+                try:
+                    block = blocks.next()
+                except StopIteration:
+                    block = None
+    return builder.finish(fps_filename)
+
+
+def read_index(filename):
+    """Read the index file 'filename' and return the FPSIndex"""
+    with _builtin_open(filename, "rb") as infile:
+        lines = infile.read().splitlines()
+    if not lines or lines[0] != "#FPSIDX1":
+        raise FPSIndexFormatError("File %r does not start with the FPSIDX1 magic" % (filename,))
+    values = {}
+    i = 1
+    while i < len(lines) and lines[i][:1] == "#":
+        if "=" in lines[i]:
+            key, value = lines[i][1:].split("=", 1)
+            values[key] = value
+        i += 1
+    try:
+        records_per_block = int(values["records_per_block"])
+        fps_size = int(values["fps_size"])
+        fps_mtime = float(values["fps_mtime"])
+        fps_hash = int(values["fps_hash"], 16)
+        num_records = int(values["num_records"])
+        blocks = []
+        for line in lines[i:]:
+            fields = line.split("\t")
+            if len(fields) != 6:
+                raise ValueError
+            blocks.append( (int(fields[0]), int(fields[1]), int(fields[2]),
+                            int(fields[3]), int(fields[4]), int(fields[5], 16)) )
+    except (KeyError, ValueError):
+        raise FPSIndexFormatError("File %r is not a valid FPS index" % (filename,))
+    if blocks and not (all(block[2] == records_per_block for block in blocks[:-1]) and
+                       0 < blocks[-1][2] <= records_per_block):
+        raise FPSIndexFormatError("File %r has an incorrect block size" % (filename,))
+    index = FPSIndex(records_per_block, fps_size, fps_mtime, fps_hash, blocks)
+    if index.num_records != num_records:
+        raise FPSIndexFormatError("File %r has an incorrect number of records" % (filename,))
+    return index
+
+
+def open_index(fps_filename, first_fp_lineno=None):
+    """Return the FPSIndex for 'fps_filename', or None if there isn't a current one
+
+    The index is not used if it can't be read, if the FPS file size,
+    modification time or hash have changed or, when 'first_fp_lineno'
+    is given, if the fingerprints start on a different line.
+    """
+    index_filename = get_index_filename(fps_filename)
+    if not os.path.exists(index_filename):
+        return None
+    # An unreadable index is as useless as a stale one. Don't let it
+    # stop the FPS file from being read.
+    try:
+        index = read_index(index_filename)
+    except (IOError, FPSIndexFormatError):
+        return None
+    info = os.stat(fps_filename)
+    if index.fps_size != info.st_size or index.fps_mtime != info.st_mtime:
+        return None
+    if (first_fp_lineno is not None and index.blocks and
+        index.blocks[0][1] != first_fp_lineno):
+        return None
+    with _builtin_open(fps_filename, "rb") as infile:
+        if index.fps_hash != get_fps_hash(infile, index.fps_size, index.blocks):
+            return None
+    return index
+
+
+def remove_index(fps_filename):
+    """Remove the index file for 'fps_filename', if there is one"""
+    index_filename = get_index_filename(fps_filename)
+    if os.path.exists(index_filename):
+        os.unlink(index_filename)
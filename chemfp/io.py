@@ -4,9 +4,12 @@ import re
 import os
 import sys
 import binascii
+from cStringIO import StringIO
 
 from datetime import datetime
 
+import _chemfp
+
 if sys.platform.startswith("win"):
     DEV_STDIN = "CON"
 else:
@@ -33,6 +36,7 @@ def remove_special_characters_from_id(id):
 _compression_extensions = {
     ".gz": ".gz",
     ".gzip": ".gz",
+    ".bgz": ".bgz",
     ".bz2": ".bz2",
     ".bzip": ".bz2",
     ".bzip2": ".bz2",
@@ -125,14 +129,14 @@ def open_output(destination):
     if ext not in _compression_extensions:
         return open(destination, "w")
     else:
-        return open_compressed_output(destination, ext)
+        return open_compressed_output(destination, _compression_extensions[ext])
 
 def open_compressed_output(destination, compression):
     if not compression:
         if destination is None:
             return sys.stdout
-        elif isinstance(source, basestring):
-            return open(source, "w")
+        elif isinstance(destination, basestring):
+            return open(destination, "w")
         else:
             return destination
 
@@ -145,10 +149,17 @@ def open_compressed_output(destination, compression):
         else:
             return gzip.GzipFile(mode="w", fileobj=destination)
 
+    if compression == ".bgz":
+        # Block compressed gzip. A named file also gets a ".gzi" block index.
+        from . import bgzf
+        if destination is None:
+            return bgzf.BGZFWriter(sys.stdout)
+        return bgzf.BGZFWriter(destination)
+
     if compression == ".bz2":
         import bz2
         if destination is None:
-            if not exists("/dev/stdout"):
+            if not os.path.exists("/dev/stdout"):
                 raise NotImplementedError("Cannot write bz2 compressed data to stdout on this platform")
             return bz2.BZ2File("/dev/stdout", "w")
         elif isinstance(destination, basestring):
@@ -170,7 +181,12 @@ def open_compressed_input_universal(source, compression):
         else:
             return source
 
-    if compression == ".gz":
+    if compression == ".gz" or compression == ".bgz":
+        # BGZF is also gzip, but its blocks can be decompressed in parallel
+        if isinstance(source, basestring):
+            from . import bgzf
+            if bgzf.is_bgzf_file(source):
+                return bgzf.BGZFReader(source)
         import gzip
         if source is None:
             # GzipFile doesn't have a "U"/universal file mode?
@@ -270,14 +286,39 @@ class _closing_output(object):
         if self.output is not sys.stdout:
             self.output.close()
 
-def write_fps1_output(reader, destination, metadata=None):
+def write_fps1_output(reader, destination, metadata=None, index=False, records_per_block=None):
+    """Write the (id, fingerprint) pairs from 'reader' to 'destination' in FPS format
+
+    If 'index' is true then also write the ".fpsidx" index file, with
+    'records_per_block' records per index block. The destination must
+    be the name of an uncompressed file. Any old index file for the
+    destination is removed.
+    """
+    from . import fpsidx
     if metadata is None:
         metadata = reader.metadata
+    builder = None
+    is_indexable = (isinstance(destination, basestring) and
+                    not normalize_format(destination, None)[1])
+    if index:
+        if not is_indexable:
+            raise ValueError("An FPS index can only be written for an uncompressed FPS file name")
+        if records_per_block is None:
+            records_per_block = fpsidx.RECORDS_PER_BLOCK
+        builder = fpsidx.IndexBuilder(records_per_block)
+    if is_indexable:
+        fpsidx.remove_index(destination)
     hexlify = binascii.hexlify
     with _closing_output(destination) as outfile:
         with ignore_pipe_errors:
-            write_fps1_magic(outfile)
-            write_fps1_header(outfile, metadata)
+            header = StringIO()
+            write_fps1_magic(header)
+            write_fps1_header(header, metadata)
+            header = header.getvalue()
+            outfile.write(header)
+            # The index needs the location of each record
+            offset = len(header)
+            lineno = header.count("\n") + 1
 
             for (id, fp) in reader:
                 if "\t" in id:
@@ -286,4 +327,11 @@ def write_fps1_output(reader, destination, metadata=None):
                     raise ValueError("fingerprint ids must not contain a newline: %r" % (id,))
                 if not id:
                     raise ValueError("fingerprint ids must contain characters: %r" % (id,))
-                outfile.write("%s\t%s\n" % (hexlify(fp), id))
+                line = "%s\t%s\n" % (hexlify(fp), id)
+                outfile.write(line)
+                if builder is not None:
+                    builder.add(offset, lineno, id, _chemfp.byte_popcount(fp))
+                    offset += len(line)
+                    lineno += 1
+    if builder is not None:
+        builder.finish(destination).save(fpsidx.get_index_filename(destination))
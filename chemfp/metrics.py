@@ -0,0 +1,142 @@
+"""Similarity measures for the count, threshold and k-nearest searches
+
+Every measure is computed from the popcount of the query (A), the
+popcount of the target (B), the popcount of their intersection (C),
+and the number of bits in the fingerprint (N):
+
+  tanimoto    C / (A + B - C)
+  tversky     C / (alpha*(A-C) + beta*(B-C) + C)
+  dice        2C / (A + B)
+  cosine      C / sqrt(A*B)
+  hamming     1 - (A + B - 2C)/N
+  euclidean   sqrt(1 - (A + B - 2C)/N)
+  contains    1.0 if every query bit is in the target, otherwise 0.0
+
+Hamming and Euclidean are distances. They are reported as
+similarities between 0.0 and 1.0 so that "higher is better" for every
+metric and so a threshold means "at least this similar". A Hamming
+score of 1-d/N is a Hamming distance of d bits.
+
+"contains" is a substructure screen. Use a threshold of 1.0 to find
+the targets which have all of the query bits set.
+
+  metric = metrics.get_metric("tversky", alpha=0.9, beta=0.1)
+  results = search.threshold_search(queries, targets, 0.8, metric)
+"""
+
+from __future__ import absolute_import
+
+import math
+
+__all__ = ["Metric", "get_metric", "METRIC_NAMES", "TANIMOTO"]
+
+# These must match enum chemfp_metric_types in chemfp.h
+_METRIC_TYPES = {
+    "tanimoto": 0,
+    "tversky": 1,
+    "dice": 2,
+    "cosine": 3,
+    "hamming": 4,
+    "euclidean": 5,
+    "contains": 6,
+    }
+
+METRIC_NAMES = ("tanimoto", "tversky", "dice", "cosine", "hamming", "euclidean", "contains")
+
+_TITLES = {
+    "tanimoto": "Tanimoto",
+    "tversky": "Tversky",
+    "dice": "Dice",
+    "cosine": "cosine",
+    "hamming": "Hamming",
+    "euclidean": "Euclidean",
+    "contains": "contains",
+    }
+
+
+class Metric(object):
+    """A similarity measure
+
+    'name' is one of METRIC_NAMES. 'alpha' and 'beta' are the Tversky
+    weights for the query and target bits; they are ignored by the
+    other metrics.
+    """
+    def __init__(self, name, alpha=1.0, beta=1.0):
+        if name not in _METRIC_TYPES:
+            raise ValueError("Unknown metric %r; must be one of %s" %
+                             (name, ", ".join(METRIC_NAMES)))
+        if name == "tversky":
+            if alpha < 0.0 or beta < 0.0:
+                raise ValueError("Tversky alpha and beta must be non-negative")
+        else:
+            alpha = beta = 1.0
+        self.name = name
+        self.alpha = float(alpha)
+        self.beta = float(beta)
+        self.type = _METRIC_TYPES[name]
+
+    @property
+    def is_tanimoto(self):
+        return self.type == 0
+
+    def __repr__(self):
+        if self.name == "tversky":
+            return "Metric(%r, alpha=%r, beta=%r)" % (self.name, self.alpha, self.beta)
+        return "Metric(%r)" % (self.name,)
+
+    def __str__(self):
+        "The description used in the simsearch '#type' header line"
+        if self.name == "tversky":
+            return "Tversky alpha=%s beta=%s" % (self.alpha, self.beta)
+        return _TITLES[self.name]
+
+    def __eq__(self, other):
+        if not isinstance(other, Metric):
+            return NotImplemented
+        return (self.type, self.alpha, self.beta) == (other.type, other.alpha, other.beta)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def _args(self):
+        # The first three arguments to the _chemfp *_metric_* functions
+        return (self.type, self.alpha, self.beta)
+
+    def score(self, num_bits, query_popcount, target_popcount, intersect_popcount):
+        """Compute the score from the popcounts, in Python
+
+        This is the same calculation as the C code, and is mostly
+        useful for testing.
+        """
+        A, B, C = query_popcount, target_popcount, intersect_popcount
+        name = self.name
+        if name == "tanimoto":
+            denominator = A + B - C
+        elif name == "tversky":
+            denominator = self.alpha * (A-C) + self.beta * (B-C) + C
+        elif name == "dice":
+            if A + B == 0:
+                return 0.0
+            return (2.0 * C) / (A + B)
+        elif name == "cosine":
+            denominator = math.sqrt(float(A) * B)
+        elif name == "hamming":
+            return 1.0 - float(A + B - 2*C) / num_bits
+        elif name == "euclidean":
+            return math.sqrt(1.0 - float(A + B - 2*C) / num_bits)
+        else:
+            return 1.0 if C == A else 0.0
+        if denominator == 0:
+            return 0.0
+        return C / float(denominator)
+
+
+TANIMOTO = Metric("tanimoto")
+
+def get_metric(metric=None, alpha=1.0, beta=1.0):
+    """Return a Metric given a metric name, a Metric, or None for Tanimoto"""
+    if metric is None:
+        return TANIMOTO
+    if isinstance(metric, Metric):
+        return metric
+    return Metric(metric, alpha, beta)
@@ -9,9 +9,11 @@ import sys
 import heapq
 import itertools
 import ctypes
+import threading
 
 from . import load_fingerprints, Metadata
 from . import fps_search
+from . import fpsidx
 from . import io
 
 # I tried a wide range of sizes for my laptop, with both compressed
@@ -35,7 +37,14 @@ class FPSParseError(Exception):
         return msg
 
 
-def open_fps(source, format=None):
+def open_fps(source, format=None, index=None):
+    """Open an FPS file and return an FPSReader
+
+    If 'index' is None and 'source' is the name of an uncompressed
+    file with a current ".fpsidx" index then the reader uses the
+    index. Use index=False to not use an index, or pass in an
+    fpsidx.FPSIndex for the file.
+    """
     format_name, compression = io.normalize_format(source, format)
     if format_name != "fps":
         raise TypeError("Unknown format %r" % (format_name,))
@@ -44,7 +53,15 @@ def open_fps(source, format=None):
     filename = io.get_filename(source)
 
     metadata, lineno, block = read_header(infile, filename)
-    return FPSReader(infile, metadata, lineno, block)
+    is_indexable = not compression and isinstance(source, basestring)
+    if index is None:
+        if is_indexable:
+            index = fpsidx.open_index(source, lineno)
+    elif index is False:
+        index = None
+    elif not is_indexable:
+        raise ValueError("An FPS index can only be used with an uncompressed FPS file name")
+    return FPSReader(infile, metadata, lineno, block, index)
 
 
 # This never buffers
@@ -67,7 +84,7 @@ def _read_blocks(infile):
 
 class FPSReader(object):
     _search = fps_search
-    def __init__(self, infile, metadata, first_fp_lineno, first_fp_block):
+    def __init__(self, infile, metadata, first_fp_lineno, first_fp_block, index=None):
         self._infile = infile
         self._filename = getattr(infile, "name", "<unknown>")
         self.metadata = metadata
@@ -80,6 +97,14 @@ class FPSReader(object):
         self._it = None
         self._block_reader = None
 
+        # The optional fpsidx.FPSIndex. The random-access reads use
+        # their own file object, so they don't change the position
+        # of the forward iteration.
+        self.index = index
+        if index is not None:
+            self._index_infile = _builtin_open(self._filename, "rb")
+            self._index_lock = threading.Lock()
+
 # Not sure if this is complete. Also, should have a context manager
 #    def close(self):
 #        self._infile.close()
@@ -103,8 +128,70 @@ class FPSReader(object):
         for block in block_stream:
             yield block
 
-    def iter_arenas(self, arena_size = 1000):
-        id_fps = iter(self)
+    def _iter_search_blocks(self, min_popcount=None, max_popcount=None):
+        # Yield the (lineno, block) pairs for the FPS searches. With an
+        # index, skip the blocks outside of the popcount range.
+        if self.index is None:
+            lineno = self._first_fp_lineno
+            for block in self.iter_blocks():
+                yield lineno, block
+                lineno += block.count("\n")
+            return
+
+        if not self._at_start:
+            raise TypeError("Already iterating")
+        self._at_start = False
+        for block_num, lineno, block in self.index.iter_blocks(
+                self._index_infile, min_popcount=min_popcount, max_popcount=max_popcount,
+                lock=self._index_lock):
+            yield lineno, block
+
+    def iter_records(self, start=0, end=None):
+        """Iterate over the (id, fingerprint) pairs for records start <= i < end
+
+        With an FPS index this reads only the blocks which contain the
+        records, and it does not use or change the position of the
+        forward iteration, so several threads can read different
+        ranges. 'start' and 'end' work like slice indices. Without an
+        index this is part of the forward iteration, which reads and
+        skips the records before 'start'.
+        """
+        if self.index is None:
+            return itertools.islice(self, start, end)
+        return self._iter_index_records(start, end)
+
+    def _iter_index_records(self, start, end):
+        start, end = self.index.get_record_range(start, end)
+        if start == end:
+            return
+        records_per_block = self.index.records_per_block
+        start_block = start // records_per_block
+        end_block = (end + records_per_block - 1) // records_per_block
+        record_num = start_block * records_per_block
+        expected_hex_len = self._expected_hex_len
+        for block_num, lineno, block in self.index.iter_blocks(
+                self._index_infile, start_block, end_block, lock=self._index_lock):
+            for line in block.splitlines(True):
+                if record_num >= end:
+                    return
+                if record_num >= start:
+                    err, id_fp = _chemfp.fps_parse_id_fp(expected_hex_len, line)
+                    if err:
+                        raise FPSParseError(err, lineno, self._filename)
+                    yield id_fp
+                record_num += 1
+                lineno += 1
+
+    def iter_arenas(self, arena_size = 1000, start = 0, end = None):
+        """Iterate over arenas of up to 'arena_size' fingerprints
+
+        If 'start' or 'end' is given then only the records in that
+        range are used, as with iter_records().
+        """
+        if start == 0 and end is None:
+            id_fps = iter(self)
+        else:
+            id_fps = self.iter_records(start, end)
         while 1:
             arena = load_fingerprints(itertools.islice(id_fps, 0, arena_size),
                                       metadata = self.metadata,
@@ -186,6 +273,29 @@ class FPSReader(object):
             for item in results:
                 yield item
 
+    def id_count_hits(self, queries, threshold=0.7, metric=None, arena_size=100):
+        for query_arena in self._iter_batches(queries, arena_size):
+            results = fps_search.count_hits_arena(query_arena, self, threshold, metric)
+            for item in zip(query_arena.arena_ids, results):
+                yield item
+
+    def id_threshold_search(self, queries, threshold=0.7, metric=None, arena_size=100):
+        self._check_at_start()
+        for query_arena in self._iter_batches(queries, arena_size):
+            results = fps_search.id_threshold_search_arena(query_arena, self,
+                                                           threshold, metric)
+            for item in results:
+                yield item
+
+    def id_knearest_search(self, queries, k=3, threshold=0.7, metric=None, arena_size=100):
+        self._check_at_start()
+        for query_arena in self._iter_batches(queries, arena_size):
+            results = fps_search.id_knearest_search(query_arena, self,
+                                                    k, threshold, metric)
+            for item in results:
+                yield item
+
+
 def _where(filename, lineno):
     if filename is None:
         return "line %d" % (lineno,)
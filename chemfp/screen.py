@@ -0,0 +1,142 @@
+"""Substructure screening index for a FingerprintArena
+
+A substructure screen finds the targets whose fingerprint contains
+every bit set in the query fingerprint. Those are the only targets
+which can have the query as a substructure, so this is a pre-filter
+before the much slower atom-by-atom match.
+
+  targets = chemfp.load_fingerprints("pubchem.fps.gz")
+  index = screen.ScreenIndex(targets)
+  for target_index in index.contains_fp(query_fp):
+      print targets.ids[target_index]
+
+The index is the arena transposed into one bitmap per fingerprint
+bit, with one bit per target. It uses about as much memory as the
+arena itself. A screen is the intersection of the bitmaps for the
+query bits, starting with the rarest bits. If the arena is ordered
+by popcount (the default for load_fingerprints()) then the targets
+with fewer bits than the query are skipped without looking at them.
+
+The target indices are the same as in the chemfp.search results, so
+use arena.ids[index] to get the target id, even for a subarena.
+"""
+
+from __future__ import absolute_import
+
+import array
+import ctypes
+import struct
+
+from . import search
+import _chemfp
+
+__all__ = ["ScreenIndex"]
+
+_INT_SIZE = struct.calcsize("i")
+
+
+class ScreenIndex(object):
+    """A substructure screening index over the fingerprints in an arena
+
+    The index keeps a reference to the arena for its ids and popcount
+    indices. Build a new index if the arena changes.
+    """
+    def __init__(self, arena):
+        self.arena = arena
+        self.num_bits = num_bits = arena.metadata.num_bits
+        self.num_bytes = arena.metadata.num_bytes
+        self.num_fingerprints = n = len(arena)
+        self._num_words = num_words = (n + 63) // 64
+        self._bitmaps = (ctypes.c_uint64 * (num_bits * max(num_words, 1)))()
+        self.bit_counts = (ctypes.c_int * num_bits)()
+        err = _chemfp.screen_build(num_bits, arena.start_padding, arena.end_padding,
+                                   arena.storage_size, arena.arena, arena.start, arena.end,
+                                   self._bitmaps, self.bit_counts)
+        assert not err, err
+
+    def __len__(self):
+        return self.num_fingerprints
+
+    def _check_fp(self, query_fp):
+        if len(query_fp) != self.num_bytes:
+            raise ValueError("query_fp uses %d bytes while the index uses %d bytes" % (
+                len(query_fp), self.num_bytes))
+
+    def _min_index(self, query_fp):
+        # Targets with fewer bits than the query can't contain it
+        popcount_indices = self.arena.popcount_indices
+        if not popcount_indices:
+            return 0
+        popcount = _chemfp.byte_popcount(query_fp)
+        if popcount > self.num_bits:
+            # The query has bits past the end of the fingerprint
+            return self.num_fingerprints
+        return struct.unpack_from("i", popcount_indices, popcount * _INT_SIZE)[0] - self.arena.start
+
+    def _screen(self, query_fp):
+        # Returns (count, start_word, end_word, candidates). The C code
+        # releases the GIL, so each call needs its own candidate bitmap.
+        self._check_fp(query_fp)
+        candidates = (ctypes.c_uint64 * max(self._num_words, 1))()
+        count, start_word, end_word = _chemfp.screen_contains(
+            self.num_bits, self._bitmaps, self.bit_counts, self.num_fingerprints,
+            self._min_index(query_fp), query_fp, candidates)
+        return count, start_word, end_word, candidates
+
+    def count_contains_fp(self, query_fp):
+        """Return the number of targets which contain every bit of the query fingerprint
+
+        :param query_fp: query fingerprint
+        :type query_fp: byte string
+        :returns: integer count
+        """
+        return self._screen(query_fp)[0]
+
+    def contains_fp(self, query_fp):
+        """Return the indices of the targets which contain every bit of the query fingerprint
+
+        The indices are in increasing order.
+
+        :param query_fp: query fingerprint
+        :type query_fp: byte string
+        :returns: an array.array("i") of target indices
+        """
+        count, start_word, end_word, candidates = self._screen(query_fp)
+        indices = array.array("i", [0]) * count
+        if count:
+            _chemfp.screen_get_indices(candidates, start_word, end_word,
+                                       self.arena.start, indices)
+        return indices
+
+    def contains_ids_fp(self, query_fp):
+        "Return the ids of the targets which contain every bit of the query fingerprint"
+        ids = self.arena.ids
+        return [ids[i] for i in self.contains_fp(query_fp)]
+
+    def contains_arena(self, query_arena):
+        """Screen each fingerprint in the query arena
+
+        The queries are screened in C, using multiple threads if
+        chemfp.get_num_threads() is more than 1. Each hit has a score
+        of 1.0, the same as the "contains" metric.
+
+        :param query_arena: query fingerprints
+        :type query_arena: FingerprintArena
+        :returns: SearchResults
+        """
+        if query_arena.metadata.num_bytes != self.num_bytes:
+            raise ValueError("query_arena uses %d bytes while the index uses %d bytes" % (
+                query_arena.metadata.num_bytes, self.num_bytes))
+        num_queries = len(query_arena)
+        results = search.SearchResults(num_queries, self.arena.ids)
+        if num_queries:
+            err = _chemfp.screen_contains_arena(
+                self.num_bits, self._bitmaps, self.bit_counts, self.num_fingerprints,
+                self.arena.popcount_indices, self.arena.start,
+                query_arena.start_padding, query_arena.end_padding,
+                query_arena.storage_size, query_arena.arena,
+                query_arena.start, query_arena.end,
+                results)
+            if err:
+                raise MemoryError(_chemfp.strerror(err))
+        return results
@@ -15,6 +15,7 @@ __all__ = ["open_sdf", "iter_sdf_records", "iter_two_tags", "iter_title_and_tag"
 import sys
 import re
 import chemfp
+import _chemfp
 
 class SDFParseError(ParseError):
     def __init__(self, msg, filename, lineno):
@@ -127,7 +128,10 @@ def open_sdf(source=None, decompressor="auto", errors="strict", location=None):
 # My original implementation used a slow line-oriented parser.  That
 # was decently fast, but this version, which reads a block at a time
 # and works directly on those blocks, is over 3 times as fast. It's
-# also a lot more complicated
+# also a lot more complicated. The splitting and the record format
+# check are done in C by _chemfp.sdf_split_records(). The
+# _sdf_check_pat regular expression is kept as the definition of
+# what that check does.
 
 def iter_sdf_records(fileobj, errors="strict", location=None):
     """Iterate over records in an SD file, returning records as blocks of text
@@ -145,101 +149,68 @@ def iter_sdf_records(fileobj, errors="strict", location=None):
     else:
         error = errors
     pushback_buffer = ''
-    records = None
     while 1:
-        if not records:
-            read_data = fileobj.read(32768)
-            if not read_data:
-                # No more data from the file. If there is something in the
-                # pushback buffer then it's an incomplete record
-                if pushback_buffer:
-                    if pushback_buffer.endswith("\n$$$$"):
-                        # The file is missing the terminal newline. Compensate.
-                        # This will cause an extra read after the known end-of-file.
-                        # (Is that a problem? It's not supposed to be one.)
-                        pushback_buffer += "\n"
-                    else:
-                        location._record = None
-                        if location.lineno == 1:
-                            # No records read. Wrong format.
-                            error("Could not find a valid SD record", location)
-                        else:
-                            error(
-   "unexpected content at the end of the file (perhaps the last record is truncated?)",
-                                location)
-                        break
-                else:
-                    # We're done!
-                    break
-            # Join the two blocks of text. This should be enough to
-            # have lots of records, so split, and the last term is
-            # either a partial record or the empty string. Keep track
-            # of that for use in the next go-around.
-            records = (pushback_buffer + read_data).split("\n$$$$\n")
-            pushback_buffer = records.pop()  # either '' or a partial record
-
-            # It is possible though unlikely that the merged blocks of
-            # text contains only an incomplete record, so this might
-            # loop again. However, the joining and searching is an
-            # O(n**2) operation, so I don't want to do that too often.
-            # While it's possible to fix this, there should be no
-            # reason to support huge records - they don't exist unless
-            # you are really stretching and doing things like storing
-            # images or other large data in the SD tags.
-            # To prevent timing problems, don't allow huge records.
-            if len(pushback_buffer) > 2000000:
+        read_data = fileobj.read(32768)
+        if not read_data:
+            # No more data from the file. If there is something in the
+            # pushback buffer then it's an incomplete record
+            if not pushback_buffer:
+                # We're done!
+                break
+            if not pushback_buffer.endswith("\n$$$$"):
                 location._record = None
-                error("record is too large for this reader", location)
-                return
-        else:
-            # We have a set of records, one string per record. Pass them back.
-            for record in records:
-                # A simple, quick check that it looks about right
-                if not _sdf_check_pat.match(record):
-                    location._record = record
-                    error("incorrectly formatted record", location)
-                    # If the error callback returns then just skip the record
+                if location.lineno == 1:
+                    # No records read. Wrong format.
+                    error("Could not find a valid SD record", location)
                 else:
-                    record += "\n$$$$\n"  # restore the split text
-                    location._record = record
-                    yield record
-                location.lineno += record.count("\n")
-            records = None
-
-
-# This is complicated. I tried implementing this search with a regular
-# expression but it was about 30% slower than this more direct search.
-
-# Note: tag_substr must contain the "<" and ">"
-def _find_tag_data(rec, tag_substr):
-    "Return the first data line for the given tag substring, or return None"
-    startpos = 0
-    while 1:
-        tag_start = rec.find(tag_substr, startpos)
-        if tag_start == -1:
-            return None
-
-        # rfind cannot return -1 because _sdf_check_pat verified there
-        # are at least 3 newlines. The +1 is safe because there's at
-        # least the "<" and ">" from the tag.
-        tag_line_start = rec.rfind("\n", 0, tag_start) + 1
-        if rec[tag_line_start] != ">":
-            # This tag is not on a data tag line. It might be the value for
-            # some of the text field.
-            startpos = tag_start + 1
-            continue
-
-        # This is an actual tag line. Find the start of the next line.
-        # The record must end with "\n$$$$\n" so find will never return -1
-        # and never return the last character position.
-        next_line_start = rec.find("\n", tag_start) + 1
-
-        # These might occur if there is no data content
-        if rec[next_line_start]==">" or rec[next_line_start:next_line_start+4]=="$$$$":
-            return ""
-
-        # Otherwise, get up to the end of the line
-        return rec[next_line_start:rec.find("\n", next_line_start)]
+                    error(
+   "unexpected content at the end of the file (perhaps the last record is truncated?)",
+                        location)
+                break
+            # The file is missing the terminal newline. Compensate.
+            read_data = "\n"
+
+        # Join the two blocks of text. This should be enough to have
+        # lots of records. Everything after 'end' is either a partial
+        # record or the empty string. Keep track of that for use in
+        # the next go-around.
+        text = pushback_buffer + read_data
+        records, bad_records, end = _chemfp.sdf_split_records(text)
+        pushback_buffer = text[end:]
+
+        # It is possible though unlikely that the merged blocks of
+        # text contains only an incomplete record, so this might
+        # loop again. However, the joining and searching is an
+        # O(n**2) operation, so I don't want to do that too often.
+        # While it's possible to fix this, there should be no
+        # reason to support huge records - they don't exist unless
+        # you are really stretching and doing things like storing
+        # images or other large data in the SD tags.
+        # To prevent timing problems, don't allow huge records.
+        if len(pushback_buffer) > 2000000:
+            location._record = None
+            error("record is too large for this reader", location)
+            return
+
+        # Pass the records back. An invalid record is None in 'records'
+        # and its text is in 'bad_records'.
+        bad_record_iter = iter(bad_records)
+        for record in records:
+            if record is None:
+                record = next(bad_record_iter)
+                location._record = record
+                error("incorrectly formatted record", location)
+                # If the error callback returns then just skip the record
+            else:
+                location._record = record
+                yield record
+            location.lineno += record.count("\n")
+
+
+# The tag search is done in C by _chemfp.sdf_get_values(). A tag
+# value is the first data line after the first data header line (a
+# line starting with ">") which contains "<tag>". The value is "" if
+# there is no data line and None if the tag isn't present.
 
 # These are not legal tag characters (while others may be against the
 # SD file spec, these will break the parser)
@@ -265,10 +236,10 @@ def iter_two_tags(sdf_iter, tag1, tag2):
     if m:
         raise TypeError("tag2 must not contain the character %r" % (m.group(0),))
         
-    tag1_substr = "<" + tag1 + ">"
-    tag2_substr = "<" + tag2 + ">"
+    tag_substrs = ("<" + tag1 + ">", "<" + tag2 + ">")
+    get_values = _chemfp.sdf_get_values
     for rec in sdf_iter:
-        yield _find_tag_data(rec, tag1_substr), _find_tag_data(rec, tag2_substr)
+        yield get_values(rec, tag_substrs, 0)
 
 def iter_title_and_tag(sdf_iter, tag):
     """Iterate over SD records to get the title line and data line for the specified tag
@@ -286,15 +257,17 @@ def iter_title_and_tag(sdf_iter, tag):
     if m:
         raise TypeError("tag must not contain the character %r" % (m.group(0),))
     
-    tag_substr = "<" + tag + ">"
+    tag_substrs = ("<" + tag + ">",)
+    get_values = _chemfp.sdf_get_values
     for rec in sdf_iter:
-        yield rec[:rec.find("\n")].strip(), _find_tag_data(rec, tag_substr)
+        yield get_values(rec, tag_substrs, 1)
 
 def iter_tag_and_record(sdf_iter, tag):
     m = _bad_char.search(tag)
     if m:
         raise TypeError("tag must not contain the character %r" % (m.group(0),))
 
-    tag_substr = "<" + tag + ">"
+    tag_substrs = ("<" + tag + ">",)
+    get_values = _chemfp.sdf_get_values
     for rec in sdf_iter:
-        yield _find_tag_data(rec, tag_substr), rec
+        yield get_values(rec, tag_substrs, 0)[0], rec
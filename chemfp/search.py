@@ -4,6 +4,8 @@ import _chemfp
 import ctypes
 import array
 
+from chemfp import metrics
+
 
 class SearchResult(object):
     def __init__(self, search_results, row):
@@ -42,6 +44,32 @@ class SearchResult(object):
             
     def reorder(self, ordering="decreasing-score"):
         self._search_results._reorder_row(self._row, ordering)
+
+    def get_indices_array(self):
+        """Return the hit indices as a read-only NumPy int array, without a copy
+
+        The array is a view of the row's memory. Hits cannot be added to
+        or removed from the SearchResults while the view exists, though
+        the rows may still be reordered in-place.
+        """
+        import numpy
+        indices, scores = self._search_results._get_row_buffers(self._row)
+        return numpy.frombuffer(indices, dtype=numpy.intc)
+
+    def get_scores_array(self):
+        """Return the hit scores as a read-only NumPy array, without a copy
+
+        The array is a view of the row's memory, with the same
+        restrictions as get_indices_array(). The dtype depends on the
+        SearchResults score_type: float64 for "double", float32 for
+        "float", and the quantized uint16 values, which are the score
+        times 65535, for "uint16".
+        """
+        import numpy
+        indices, scores = self._search_results._get_row_buffers(self._row)
+        dtype = {"double": numpy.float64, "float": numpy.float32,
+                 "uint16": numpy.uint16}[self._search_results.score_type]
+        return numpy.frombuffer(scores, dtype=dtype)
         
     @property
     def target_id(self):
@@ -51,8 +79,22 @@ class SearchResult(object):
         return ids[self._row]
 
 class SearchResults(_chemfp.SearchResults):
-    def __init__(self, n, ids=None):
-        super(SearchResults, self).__init__(n, ids)
+    """The search results for each query, as one SearchResult row per query
+
+    The 'score_type' sets how the scores are stored. The default,
+    "double", keeps the exact score. "float" uses 4 bytes per score
+    and "uint16" stores the score quantized to 1/65535 in 2 bytes,
+    which, with the 4 byte target index, saves 33% or 50% of the
+    memory of a large result set. The compact scores are rounded, so a
+    stored score may be slightly below the search threshold. For
+    Tanimoto scores of fingerprints with at most 256 bits, different
+    scores always have different "uint16" values, so the ordering is
+    unchanged. Only threshold searches support the compact types, and
+    they trim() the compact results to release the unused space in
+    each row.
+    """
+    def __init__(self, n, ids=None, score_type="double"):
+        super(SearchResults, self).__init__(n, ids, score_type)
         self._results = [SearchResult(self, i) for i in xrange(n)]
     def __iter__(self):
         return iter(self._results)
@@ -86,6 +128,36 @@ class SearchResults(_chemfp.SearchResults):
         for i in xrange(len(self)):
             yield [(ids[idx], score) for (idx, score) in self[i]]
 
+    def to_csr(self, num_columns=None):
+        """Return the hits as a SciPy compressed sparse row matrix
+
+        Row i of the matrix is row i of the results, the column is the
+        target index, and the value is the score. The hits are copied
+        once, directly into the matrix arrays, and the column indices
+        in each row are in the current order of the hits. The values
+        are float32 for "float" scores, otherwise float64.
+
+        :param num_columns: the number of columns (default: len(target_ids))
+        :type num_columns: integer, or None
+        :returns: a scipy.sparse.csr_matrix
+        """
+        import numpy
+        from scipy import sparse
+        if num_columns is None:
+            if self.target_ids is None:
+                raise TypeError("num_columns must be given when target_ids are not available")
+            num_columns = len(self.target_ids)
+        total = self._get_total_size()
+        indptr = numpy.empty(len(self) + 1, dtype=numpy.intc)
+        indices = numpy.empty(total, dtype=numpy.intc)
+        if self.score_type == "float":
+            data = numpy.empty(total, dtype=numpy.float32)
+        else:
+            data = numpy.empty(total, dtype=numpy.float64)
+        self._fill_csr(indptr, indices, data)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(self), num_columns),
+                                 copy=False)
+
 
         
 def require_matching_fp_size(query_fp, target_arena):
@@ -203,12 +275,12 @@ def threshold_tanimoto_search_fp(query_fp, target_arena, threshold):
     return results[0]
 
 
-def threshold_tanimoto_search(query_arena, target_arena, threshold):
+def threshold_tanimoto_search(query_arena, target_arena, threshold, score_type="double"):
     require_matching_sizes(query_arena, target_arena)
 
     num_queries = len(query_arena)
 
-    results = SearchResults(num_queries, target_arena.ids)
+    results = SearchResults(num_queries, target_arena.ids, score_type)
     if num_queries:
         _chemfp.threshold_tanimoto_arena(
             threshold, target_arena.num_bits,
@@ -218,13 +290,16 @@ def threshold_tanimoto_search(query_arena, target_arena, threshold):
             target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
             target_arena.popcount_indices,
             results, 0)
+        if score_type != "double":
+            results.trim()
     
     return results
 
-def threshold_tanimoto_search_symmetric(arena, threshold, include_lower_triangle=True):
+def threshold_tanimoto_search_symmetric(arena, threshold, include_lower_triangle=True,
+                                        score_type="double"):
     assert arena.popcount_indices
     N = len(arena)
-    results = SearchResults(N, arena.ids)
+    results = SearchResults(N, arena.ids, score_type)
 
     if N:
         _chemfp.threshold_tanimoto_arena_symmetric(
@@ -236,6 +311,8 @@ def threshold_tanimoto_search_symmetric(arena, threshold, include_lower_triangle
 
         if include_lower_triangle:
             _chemfp.fill_lower_triangle(results, N)
+        if score_type != "double":
+            results.trim()
         
     return results
 
@@ -283,7 +360,87 @@ def fill_lower_triangle(results):
 
 # These all return indices into the arena!
 
-def knearest_tanimoto_search_fp(query_fp, target_arena, k, threshold):
+class KNearestStatistics(object):
+    """Pruning statistics for k-nearest searches which use a block index
+
+    Pass an instance as the 'stats' parameter of the k-nearest search
+    functions. The counts are accumulated over every search which uses
+    it. They are only collected when the target arena has a k-nearest
+    index; see FingerprintArena.build_knearest_index().
+
+    The attributes are:
+      num_queries: number of query fingerprints
+      num_blocks_scanned: number of target blocks which were searched
+      num_blocks_pruned: number of target blocks skipped because their
+          upper bound could not beat the k-th best score
+      num_fingerprints: number of target fingerprints compared
+    """
+    def __init__(self):
+        self._counts = array.array("l", (0, 0, 0))
+        self.num_queries = 0
+
+    @property
+    def num_blocks_scanned(self):
+        return self._counts[0]
+
+    @property
+    def num_blocks_pruned(self):
+        return self._counts[1]
+
+    @property
+    def num_fingerprints(self):
+        return self._counts[2]
+
+    def report(self):
+        "Return a human-readable summary of the statistics"
+        num_blocks = self.num_blocks_scanned + self.num_blocks_pruned
+        if num_blocks:
+            pruned = 100.0 * self.num_blocks_pruned / num_blocks
+        else:
+            pruned = 0.0
+        if self.num_queries:
+            per_query = float(self.num_fingerprints) / self.num_queries
+        else:
+            per_query = 0.0
+        return ("queries: %d  blocks scanned: %d  blocks pruned: %d (%.1f%%)  "
+                "fingerprints compared: %d (%.1f per query)" % (
+                    self.num_queries, self.num_blocks_scanned, self.num_blocks_pruned,
+                    pruned, self.num_fingerprints, per_query))
+
+
+def _knearest_arena(k, threshold,
+                    query_start_padding, query_end_padding, query_storage_size,
+                    query_arena, query_start, query_end,
+                    target_arena, results, stats):
+    index = getattr(target_arena, "knearest_index", None)
+    if index is None:
+        _chemfp.knearest_tanimoto_arena(
+            k, threshold, target_arena.num_bits,
+            query_start_padding, query_end_padding,
+            query_storage_size, query_arena, query_start, query_end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0)
+        return
+
+    if stats is None:
+        counts = array.array("l", (0, 0, 0))
+    else:
+        counts = stats._counts
+        stats.num_queries += query_end - query_start
+    _chemfp.knearest_tanimoto_arena_blocks(
+        k, threshold, target_arena.num_bits,
+        query_start_padding, query_end_padding,
+        query_storage_size, query_arena, query_start, query_end,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        index.block_size, index.block_indices,
+        index.start_padding, index.end_padding, index.block_unions,
+        results, 0, counts)
+
+def knearest_tanimoto_search_fp(query_fp, target_arena, k, threshold, stats=None):
     require_matching_fp_size(query_fp, target_arena)
     query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
         query_fp, target_arena.alignment, target_arena.storage_size)
@@ -292,32 +449,26 @@ def knearest_tanimoto_search_fp(query_fp, target_arena, k, threshold):
         raise ValueError("k must be non-negative")
 
     results = SearchResults(1)
-    _chemfp.knearest_tanimoto_arena(
-        k, threshold, target_arena.num_bits,
-        query_start_padding, query_end_padding, target_arena.storage_size, query_fp, 0, 1,
-        target_arena.start_padding, target_arena.end_padding,
-        target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
-        target_arena.popcount_indices,
-        results, 0)
+    _knearest_arena(k, threshold,
+                    query_start_padding, query_end_padding, target_arena.storage_size,
+                    query_fp, 0, 1,
+                    target_arena, results, stats)
     _chemfp.knearest_results_finalize(results, 0, 1)
 
     return results[0]
 
-def knearest_tanimoto_search(query_arena, target_arena, k, threshold):
+def knearest_tanimoto_search(query_arena, target_arena, k, threshold, stats=None):
     require_matching_sizes(query_arena, target_arena)
 
     num_queries = len(query_arena)
 
     results = SearchResults(num_queries, target_arena.ids)
 
-    _chemfp.knearest_tanimoto_arena(
-        k, threshold, target_arena.num_bits,
-        query_arena.start_padding, query_arena.end_padding,
-        query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
-        target_arena.start_padding, target_arena.end_padding,
-        target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
-        target_arena.popcount_indices,
-        results, 0)
+    _knearest_arena(k, threshold,
+                    query_arena.start_padding, query_arena.end_padding,
+                    query_arena.storage_size, query_arena.arena,
+                    query_arena.start, query_arena.end,
+                    target_arena, results, stats)
     
     _chemfp.knearest_results_finalize(results, 0, num_queries)
     
@@ -348,3 +499,262 @@ def knearest_tanimoto_search_symmetric(arena, k, threshold):
 #                                               query_start=0, query_end=None,
 #                                               target_start=0, target_end=None):
 #    pass
+
+
+##### Searches with other similarity measures
+
+# These take a 'metric', which is a chemfp.metrics.Metric, a metric
+# name, or None for Tanimoto. The Tanimoto searches use the
+# Tanimoto-specific code above.
+
+def count_hits_fp(query_fp, target_arena, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return count_tanimoto_hits_fp(query_fp, target_arena, threshold)
+    require_matching_fp_size(query_fp, target_arena)
+    query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
+        query_fp, target_arena.alignment, target_arena.storage_size)
+
+    counts = array.array("i", [0])
+    _chemfp.count_metric_arena(*metric._args() + (
+        threshold, target_arena.num_bits,
+        query_start_padding, query_end_padding,
+        target_arena.storage_size, query_fp, 0, 1,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size, target_arena.arena,
+        target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        counts))
+    return counts[0]
+
+def count_hits(query_arena, target_arena, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return count_tanimoto_hits(query_arena, target_arena, threshold)
+    require_matching_sizes(query_arena, target_arena)
+
+    counts = (ctypes.c_int*len(query_arena))()
+    _chemfp.count_metric_arena(*metric._args() + (
+        threshold, target_arena.num_bits,
+        query_arena.start_padding, query_arena.end_padding,
+        query_arena.storage_size,
+        query_arena.arena, query_arena.start, query_arena.end,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size,
+        target_arena.arena, target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        counts))
+    return counts
+
+def threshold_search_fp(query_fp, target_arena, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return threshold_tanimoto_search_fp(query_fp, target_arena, threshold)
+    require_matching_fp_size(query_fp, target_arena)
+    query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
+        query_fp, target_arena.alignment, target_arena.storage_size)
+
+    results = SearchResults(1)
+    _chemfp.threshold_metric_arena(*metric._args() + (
+        threshold, target_arena.num_bits,
+        query_start_padding, query_end_padding, target_arena.storage_size, query_fp, 0, 1,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size, target_arena.arena,
+        target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        results, 0))
+    return results[0]
+
+def threshold_search(query_arena, target_arena, threshold, metric=None, score_type="double"):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return threshold_tanimoto_search(query_arena, target_arena, threshold, score_type)
+    require_matching_sizes(query_arena, target_arena)
+
+    num_queries = len(query_arena)
+    results = SearchResults(num_queries, target_arena.ids, score_type)
+    if num_queries:
+        _chemfp.threshold_metric_arena(*metric._args() + (
+            threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0))
+        if score_type != "double":
+            results.trim()
+    return results
+
+def knearest_search_fp(query_fp, target_arena, k, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return knearest_tanimoto_search_fp(query_fp, target_arena, k, threshold)
+    require_matching_fp_size(query_fp, target_arena)
+    query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
+        query_fp, target_arena.alignment, target_arena.storage_size)
+    if k < 0:
+        raise ValueError("k must be non-negative")
+
+    results = SearchResults(1)
+    _chemfp.knearest_metric_arena(*metric._args() + (
+        k, threshold, target_arena.num_bits,
+        query_start_padding, query_end_padding, target_arena.storage_size,
+        query_fp, 0, 1,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        results, 0))
+    _chemfp.knearest_results_finalize(results, 0, 1)
+    return results[0]
+
+def knearest_search(query_arena, target_arena, k, threshold, metric=None):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return knearest_tanimoto_search(query_arena, target_arena, k, threshold)
+    require_matching_sizes(query_arena, target_arena)
+    if k < 0:
+        raise ValueError("k must be non-negative")
+
+    num_queries = len(query_arena)
+    results = SearchResults(num_queries, target_arena.ids)
+    if num_queries:
+        _chemfp.knearest_metric_arena(*metric._args() + (
+            k, threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena,
+            query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0))
+        _chemfp.knearest_results_finalize(results, 0, num_queries)
+    return results
+
+
+##### Streaming searches
+
+# These yield (query_id, [(target_id, score), ...]) for each query as
+# soon as its chunk of queries is searched. Only one chunk of hits is
+# in memory at a time, and the same SearchResults is reused for every
+# chunk, so memory depends on 'chunk_size' and not on the number of
+# queries. The hits are in the same order as the corresponding
+# non-streaming search.
+
+def _iter_search(query_arena, target_arena, chunk_size, search_chunk, finalize):
+    # Check the arguments now rather than on the first next()
+    require_matching_sizes(query_arena, target_arena)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    return _iter_chunks(query_arena, target_arena, chunk_size, search_chunk, finalize)
+
+def _iter_chunks(query_arena, target_arena, chunk_size, search_chunk, finalize):
+    num_queries = len(query_arena)
+    if not num_queries:
+        return
+    query_ids = query_arena.ids
+    target_ids = target_arena.ids
+    results = SearchResults(min(chunk_size, num_queries), target_ids)
+    for start in xrange(query_arena.start, query_arena.end, chunk_size):
+        end = min(start + chunk_size, query_arena.end)
+        search_chunk(start, end, results)
+        if finalize:
+            _chemfp.knearest_results_finalize(results, 0, end-start)
+        for i in xrange(end-start):
+            yield query_ids[start+i], [(target_ids[idx], score) for (idx, score)
+                                           in results._get_indices_and_scores(i)]
+        results.clear_all()
+
+def iter_threshold_tanimoto_search(query_arena, target_arena, threshold, chunk_size=100):
+    def search_chunk(query_start, query_end, results):
+        _chemfp.threshold_tanimoto_arena(
+            threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_start, query_end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0)
+    return _iter_search(query_arena, target_arena, chunk_size, search_chunk, False)
+
+def iter_knearest_tanimoto_search(query_arena, target_arena, k, threshold, chunk_size=100,
+                                  stats=None):
+    if k < 0:
+        raise ValueError("k must be non-negative")
+    def search_chunk(query_start, query_end, results):
+        _knearest_arena(k, threshold,
+                        query_arena.start_padding, query_arena.end_padding,
+                        query_arena.storage_size, query_arena.arena,
+                        query_start, query_end,
+                        target_arena, results, stats)
+    return _iter_search(query_arena, target_arena, chunk_size, search_chunk, True)
+
+def iter_threshold_search(query_arena, target_arena, threshold, metric=None, chunk_size=100):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return iter_threshold_tanimoto_search(query_arena, target_arena, threshold, chunk_size)
+    def search_chunk(query_start, query_end, results):
+        _chemfp.threshold_metric_arena(*metric._args() + (
+            threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_start, query_end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0))
+    return _iter_search(query_arena, target_arena, chunk_size, search_chunk, False)
+
+def iter_knearest_search(query_arena, target_arena, k, threshold, metric=None, chunk_size=100):
+    metric = metrics.get_metric(metric)
+    if metric.is_tanimoto:
+        return iter_knearest_tanimoto_search(query_arena, target_arena, k, threshold, chunk_size)
+    if k < 0:
+        raise ValueError("k must be non-negative")
+    def search_chunk(query_start, query_end, results):
+        _chemfp.knearest_metric_arena(*metric._args() + (
+            k, threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_start, query_end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0))
+    return _iter_search(query_arena, target_arena, chunk_size, search_chunk, True)
+
+
+##### Output
+
+def format_hits(results, query_ids, num_digits, start=0, end=None):
+    """Return the simsearch output lines for the rows start:end of 'results'
+
+    'query_ids' has one id for each row. Each line is the number of
+    hits, the query id, and the target id and score of each hit, in
+    row order, separated by tabs. The scores have 'num_digits' digits
+    after the decimal point.
+    """
+    if end is None:
+        end = len(results)
+    target_ids = results.target_ids
+    if target_ids is None:
+        raise TypeError("target_ids are not available")
+    if not isinstance(query_ids, list):
+        query_ids = list(query_ids)
+    if len(query_ids) != end - start:
+        raise ValueError("must have one query id for each result row")
+    get_table = getattr(target_ids, "_get_table", None)
+    table = None
+    if get_table is not None:
+        table = get_table()
+    if table is not None:
+        # Format everything in C, without the GIL
+        id_data, id_offsets, offset_size = table
+        return _chemfp.format_hits(results, start, end, query_ids,
+                                   id_data, id_offsets, offset_size, num_digits)
+
+    hit_formatter = "\t%s\t%." + str(num_digits) + "f"
+    lines = []
+    for query_id, row in zip(query_ids, xrange(start, end)):
+        hits = [hit_formatter % (target_ids[index], score)
+                    for (index, score) in results._get_indices_and_scores(row)]
+        lines.append("%d\t%s%s\n" % (len(hits), query_id, "".join(hits)))
+    return "".join(lines)
@@ -0,0 +1,633 @@
+"""A similarity search server which keeps the targets in memory
+
+Loading a large FPS file takes much longer than searching it, so a
+command-line search of a few queries spends most of its time loading.
+A SearchServer loads one or more target arenas once and answers
+search requests over HTTP, with JSON requests and responses:
+
+  GET /targets   - the name, size and metadata of each target arena
+  GET /stats     - the number of requests and batches, and the latencies
+  POST /search   - search one of the target arenas
+
+The body of a search request is a JSON object like:
+
+  {"targets": "chebi",
+   "search": "knearest",
+   "queries": [["query_id", "hex fingerprint"], ...],
+   "k": 3, "threshold": 0.0,
+   "metric": "tanimoto", "alpha": 1.0, "beta": 1.0}
+
+"search" is one of "count", "threshold" or "knearest". "targets" is
+optional if the server has only one arena. The defaults are the same
+as the simsearch defaults. The response has the results, in query
+order, and the timings for the request in seconds:
+
+  {"results": [["query_id", 12], ...],                          (count)
+   "results": [["query_id", [["target_id", 0.95], ...]], ...],  (threshold, knearest)
+   "timings": {"queue": 0.0004, "search": 0.0021, "total": 0.0025}}
+
+An invalid request gets a 400 response with {"error": "message"}.
+
+FPS ids are byte strings, and are sent as UTF-8 text. An id which
+isn't valid UTF-8 is sent as if it were Latin-1.
+
+The HTTP requests are handled in their own threads, but the searches
+are done by one batch thread. It takes all of the requests which are
+waiting, plus any which arrive in the next 'max_wait' seconds, and
+merges the queries of the requests with the same target, search type
+and parameters into a single query arena. Many concurrent
+one-fingerprint requests become one arena search, which can use all
+of the OpenMP threads.
+
+Use SearchClient to talk to a server. The "chemfp-serve" command
+starts one and "simsearch --server" is a client.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import collections
+import threading
+import time
+import urllib2
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import chemfp
+from . import ChemFPError
+from . import search, metrics
+
+__all__ = ["SearchServer", "SearchClient", "RemoteTargets", "ServerError", "SEARCH_TYPES"]
+
+SEARCH_TYPES = ("count", "threshold", "knearest")
+
+# Keep this many of the most recent latencies for the statistics
+_NUM_LATENCIES = 10000
+
+
+class ServerError(ChemFPError):
+    """The server could not do the request"""
+    pass
+
+
+class _Request(object):
+    def __init__(self, key, target_arena, metric, query_ids, query_fps):
+        self.key = key
+        self.target_arena = target_arena
+        self.metric = metric
+        self.query_ids = query_ids
+        self.query_fps = query_fps
+        self.results = None
+        self.error = None
+        self.received_time = time.time()
+        self.start_time = self.end_time = None
+        self.done = threading.Event()
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values)-1, int(fraction * len(sorted_values)))]
+
+def _latency_summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "mean": sum(values) / len(values),
+        "p50": _percentile(values, 0.50),
+        "p90": _percentile(values, 0.90),
+        "p99": _percentile(values, 0.99),
+        "max": values[-1],
+        }
+
+class _Statistics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_queries = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.num_searches = 0
+        self._latencies = dict((name, collections.deque(maxlen=_NUM_LATENCIES))
+                                   for name in ("queue", "search", "total"))
+
+    def add_batch(self, num_searches):
+        with self._lock:
+            self.num_batches += 1
+            self.num_searches += num_searches
+
+    def add_request(self, num_queries, timings):
+        with self._lock:
+            self.num_requests += 1
+            self.num_queries += num_queries
+            for name, value in timings.items():
+                self._latencies[name].append(value)
+
+    def add_error(self):
+        with self._lock:
+            self.num_errors += 1
+
+    def as_dict(self):
+        with self._lock:
+            d = {
+                "num_requests": self.num_requests,
+                "num_queries": self.num_queries,
+                "num_errors": self.num_errors,
+                "num_batches": self.num_batches,
+                "num_searches": self.num_searches,
+                "latency": dict((name, _latency_summary(list(values)))
+                                    for (name, values) in self._latencies.items()),
+                }
+        if self.num_searches:
+            d["queries_per_search"] = float(self.num_queries) / self.num_searches
+        else:
+            d["queries_per_search"] = None
+        return d
+
+
+def _run_search(target_arena, search_type, threshold, k, metric, query_fps):
+    queries = chemfp.load_fingerprints(
+        [(str(i), fp) for (i, fp) in enumerate(query_fps)],
+        target_arena.metadata, reorder=False)
+    if search_type == "count":
+        return list(search.count_hits(queries, target_arena, threshold, metric))
+    if search_type == "threshold":
+        results = search.threshold_search(queries, target_arena, threshold, metric)
+    else:
+        results = search.knearest_search(queries, target_arena, k, threshold, metric)
+    return list(results.iter_ids_and_scores())
+
+
+class _Batcher(object):
+    def __init__(self, max_batch_size, max_wait, statistics):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._statistics = statistics
+        self._queue = Queue.Queue()
+        self._held_request = None  # Didn't fit in the previous batch
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, request):
+        self._queue.put(request)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _get_batch(self):
+        # Wait for the first request, then take everything else which
+        # is waiting or arrives within max_wait seconds, up to
+        # max_batch_size queries. A request which doesn't fit is held
+        # for the next batch. (A single request may be larger.)
+        request = self._held_request
+        if request is None:
+            request = self._queue.get()
+            if request is None:
+                return None
+        else:
+            self._held_request = None
+        batch = [request]
+        num_queries = len(request.query_fps)
+        deadline = time.time() + self.max_wait
+        while num_queries < self.max_batch_size:
+            try:
+                timeout = deadline - time.time()
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                # Finish this batch first
+                self._queue.put(None)
+                break
+            if num_queries + len(request.query_fps) > self.max_batch_size:
+                self._held_request = request
+                break
+            batch.append(request)
+            num_queries += len(request.query_fps)
+        return batch
+
+    def _run(self):
+        while 1:
+            batch = self._get_batch()
+            if batch is None:
+                break
+            # Merge the requests which can be done in one search
+            groups = {}
+            keys = []
+            for request in batch:
+                if request.key not in groups:
+                    groups[request.key] = []
+                    keys.append(request.key)
+                groups[request.key].append(request)
+            for key in keys:
+                self._search(key, groups[key])
+            self._statistics.add_batch(len(keys))
+
+    def _search(self, key, requests):
+        search_type, threshold, k = key[1:4]
+        query_fps = []
+        for request in requests:
+            query_fps.extend(request.query_fps)
+        start_time = time.time()
+        try:
+            results = _run_search(requests[0].target_arena, search_type,
+                                  threshold, k, requests[0].metric, query_fps)
+            error = None
+        except Exception, err:
+            results = None
+            error = "search failed: %s" % (err,)
+        end_time = time.time()
+
+        offset = 0
+        for request in requests:
+            n = len(request.query_fps)
+            if error is None:
+                request.results = results[offset:offset+n]
+            else:
+                request.error = error
+            offset += n
+            request.start_time = start_time
+            request.end_time = end_time
+            request.done.set()
+
+
+class _RequestError(Exception):
+    pass
+
+def _get_float(d, name, default, low, high):
+    value = d.get(name, default)
+    if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+        raise _RequestError("%r must be a number" % (name,))
+    value = float(value)
+    if low is not None and value < low:
+        raise _RequestError("%r must be at least %s" % (name, low))
+    if high is not None and value > high:
+        raise _RequestError("%r must be at most %s" % (name, high))
+    return value
+
+
+def _decode_strings(obj):
+    # Make the byte strings in 'obj' into unicode for json.dumps(),
+    # using Latin-1 for those which aren't valid UTF-8
+    if isinstance(obj, str):
+        try:
+            return obj.decode("utf8")
+        except UnicodeDecodeError:
+            return obj.decode("latin1")
+    if isinstance(obj, dict):
+        return dict((_decode_strings(key), _decode_strings(value))
+                        for (key, value) in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_decode_strings(value) for value in obj]
+    return obj
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "chemfp-serve/" + chemfp.__version__
+
+    def log_message(self, format, *args):
+        if self.server.search_server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send_json(self, status, d):
+        try:
+            content = json.dumps(d)
+        except UnicodeDecodeError:
+            content = json.dumps(_decode_strings(d))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_error(self, status, message):
+        self.server.search_server._statistics.add_error()
+        self._send_json(status, {"error": message})
+
+    def do_GET(self):
+        search_server = self.server.search_server
+        if self.path == "/targets":
+            self._send_json(200, {"targets": search_server.get_target_info()})
+        elif self.path == "/stats":
+            self._send_json(200, search_server.get_statistics())
+        else:
+            self._send_error(404, "Unknown path %r" % (self.path,))
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send_error(404, "Unknown path %r" % (self.path,))
+            return
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self._send_error(411, "Content-Length required")
+            return
+        try:
+            try:
+                d = json.loads(self.rfile.read(length))
+            except ValueError, err:
+                raise _RequestError("Cannot parse JSON: %s" % (err,))
+            request = self.server.search_server._make_request(d)
+        except _RequestError, err:
+            self._send_error(400, str(err))
+            return
+
+        search_server = self.server.search_server
+        search_server._batcher.submit(request)
+        request.done.wait()
+        if request.error is not None:
+            self._send_error(500, request.error)
+            return
+
+        timings = {
+            "queue": request.start_time - request.received_time,
+            "search": request.end_time - request.start_time,
+            "total": time.time() - request.received_time,
+            }
+        search_server._statistics.add_request(len(request.query_fps), timings)
+        self._send_json(200, {
+            "results": zip(request.query_ids, request.results),
+            "timings": timings,
+            })
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SearchServer(object):
+    """Serve similarity searches of in-memory arenas over HTTP
+
+    'targets' is a list of (name, arena) pairs. The server listens on
+    'address', which is a (host, port) pair. Use port 0 to pick any
+    free port; the actual address is in 'server_address'.
+
+    A batch search has at most 'max_batch_size' queries, unless a
+    single request has more. The batch thread waits up to 'max_wait'
+    seconds after the first request for more requests.
+
+    Call serve_forever() to handle requests, and shutdown() from
+    another thread to stop.
+    """
+    def __init__(self, targets, address=("127.0.0.1", 0),
+                 max_batch_size=1000, max_wait=0.001, verbose=False):
+        if not targets:
+            raise ValueError("must have at least one target arena")
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_wait < 0.0:
+            raise ValueError("max_wait must not be negative")
+        self._targets = {}
+        self._target_order = []
+        for (name, arena) in targets:
+            if name in self._targets:
+                raise ValueError("Duplicate target name %r" % (name,))
+            if arena.metadata.num_bytes is None:
+                raise ValueError("target %r must define num_bytes" % (name,))
+            self._targets[name] = arena
+            self._target_order.append(name)
+        self.verbose = verbose
+        self._statistics = _Statistics()
+        self._batcher = _Batcher(max_batch_size, max_wait, self._statistics)
+        self._http_server = _HTTPServer(address, _Handler)
+        self._http_server.search_server = self
+        self.server_address = self._http_server.server_address
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def get_target_info(self):
+        """Return a list of dictionaries describing each target arena"""
+        info = []
+        for name in self._target_order:
+            arena = self._targets[name]
+            metadata = arena.metadata
+            info.append({
+                "name": name,
+                "num_fingerprints": len(arena),
+                "num_bits": metadata.num_bits,
+                "num_bytes": metadata.num_bytes,
+                "type": metadata.type,
+                "software": metadata.software,
+                "sources": list(metadata.sources),
+                })
+        return info
+
+    def get_statistics(self):
+        """Return the request counts and latency summary as a dictionary"""
+        return self._statistics.as_dict()
+
+    def serve_forever(self):
+        self._http_server.serve_forever()
+
+    def shutdown(self):
+        """Stop serve_forever(), wait for the batch thread and close the socket"""
+        self._http_server.shutdown()
+        self._batcher.stop()
+        self._http_server.server_close()
+
+    def _make_request(self, d):
+        if not isinstance(d, dict):
+            raise _RequestError("The request must be a JSON object")
+        target_name = d.get("targets")
+        if target_name is None:
+            if len(self._target_order) != 1:
+                raise _RequestError("Must specify 'targets'; the server has %d target arenas"
+                                    % (len(self._target_order),))
+            target_name = self._target_order[0]
+        try:
+            target_arena = self._targets[target_name]
+        except (KeyError, TypeError):
+            raise _RequestError("Unknown targets %r" % (target_name,))
+
+        search_type = d.get("search", "knearest")
+        if search_type not in SEARCH_TYPES:
+            raise _RequestError("'search' must be one of %s" % (", ".join(SEARCH_TYPES),))
+        threshold = _get_float(d, "threshold", 0.7, 0.0, 1.0)
+        k = None
+        if search_type == "knearest":
+            k = d.get("k", 3)
+            if not isinstance(k, (int, long)) or isinstance(k, bool) or k < 0:
+                raise _RequestError("'k' must be a non-negative integer")
+        metric_name = d.get("metric", "tanimoto")
+        try:
+            metric = metrics.get_metric(metric_name,
+                                        _get_float(d, "alpha", 1.0, None, None),
+                                        _get_float(d, "beta", 1.0, None, None))
+        except (ValueError, TypeError), err:
+            raise _RequestError(str(err))
+
+        queries = d.get("queries")
+        if not isinstance(queries, list):
+            raise _RequestError("'queries' must be a list of [id, hex fingerprint] pairs")
+        num_bytes = target_arena.metadata.num_bytes
+        query_ids = []
+        query_fps = []
+        for item in queries:
+            try:
+                query_id, hex_fp = item
+                fp = hex_fp.decode("hex")
+            except (TypeError, ValueError, AttributeError):
+                raise _RequestError("'queries' must be a list of [id, hex fingerprint] pairs")
+            if len(fp) != num_bytes:
+                raise _RequestError("query #%d has %d bytes but the targets have %d"
+                                    % (len(query_ids)+1, len(fp), num_bytes))
+            query_ids.append(query_id)
+            query_fps.append(fp)
+
+        key = (target_name, search_type, threshold, k, metric.name, metric.alpha, metric.beta)
+        return _Request(key, target_arena, metric, query_ids, query_fps)
+
+
+class SearchClient(object):
+    """Send search requests to a SearchServer
+
+    'url' is the server's base URL, like "http://127.0.0.1:8080".
+    Errors from the server raise a ServerError.
+    """
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _call(self, path, data=None):
+        if data is not None:
+            data = json.dumps(data)
+        request = urllib2.Request(self.url + path, data,
+                                  {"Content-Type": "application/json"})
+        try:
+            if self.timeout is None:
+                response = urllib2.urlopen(request)
+            else:
+                response = urllib2.urlopen(request, timeout=self.timeout)
+            content = response.read()
+        except urllib2.HTTPError, err:
+            try:
+                message = json.loads(err.read())["error"]
+            except Exception:
+                message = str(err)
+            raise ServerError(message)
+        except urllib2.URLError, err:
+            raise ServerError("Cannot connect to %r: %s" % (self.url, err.reason))
+        return json.loads(content)
+
+    def get_targets(self):
+        """Return the list of target arena descriptions"""
+        return self._call("/targets")["targets"]
+
+    def get_statistics(self):
+        """Return the server statistics"""
+        return self._call("/stats")
+
+    def search(self, search_type, queries, threshold=0.7, k=3, metric=None, targets=None):
+        """Search the server's targets and return (results, timings)
+
+        'queries' is a list of (id, fingerprint) pairs, where the
+        fingerprint is a byte string. 'search_type' is one of
+        SEARCH_TYPES. The results are a list of (query_id, count) or
+        (query_id, [(target_id, score), ...]) pairs, in query order.
+        """
+        metric = metrics.get_metric(metric)
+        d = {"search": search_type,
+             "queries": [[query_id, fp.encode("hex")] for (query_id, fp) in queries],
+             "threshold": threshold,
+             "metric": metric.name,
+             "alpha": metric.alpha,
+             "beta": metric.beta}
+        if search_type == "knearest":
+            d["k"] = k
+        if targets is not None:
+            d["targets"] = targets
+        response = self._call("/search", d)
+        # JSON ids are unicode. Return the original query ids and
+        # UTF-8 encoded target ids, like the ids of an FPS file.
+        query_ids = [query_id for (query_id, fp) in queries]
+        if search_type == "count":
+            results = [(query_id, count) for (query_id, (_, count))
+                           in zip(query_ids, response["results"])]
+        else:
+            results = [(query_id, [(target_id.encode("utf8"), score) for (target_id, score) in hits])
+                           for (query_id, (_, hits)) in zip(query_ids, response["results"])]
+        return results, response["timings"]
+
+    def open_targets(self, name=None):
+        """Return a RemoteTargets for the server's target arena called 'name'
+
+        The name may be None if the server has only one target arena.
+        """
+        targets = self.get_targets()
+        if name is None:
+            if len(targets) != 1:
+                raise ServerError("Must specify the target name; the server has %d target arenas"
+                                  % (len(targets),))
+            info = targets[0]
+        else:
+            for info in targets:
+                if info["name"] == name:
+                    break
+            else:
+                raise ServerError("The server has no targets named %r" % (name,))
+        return RemoteTargets(self, info)
+
+
+def _get_str(info, name):
+    value = info.get(name)
+    if value is not None:
+        value = value.encode("utf8")
+    return value
+
+class RemoteTargets(object):
+    """The target arena of a SearchServer
+
+    This has the 'metadata' and the id-based search methods of a
+    FingerprintArena, like id_knearest_tanimoto_search(), but the
+    searches are done by the server. Use SearchClient.open_targets()
+    to make one.
+    """
+    def __init__(self, client, info):
+        self.client = client
+        self.name = info["name"]
+        self.num_fingerprints = info["num_fingerprints"]
+        self.metadata = chemfp.Metadata(num_bits=info["num_bits"], num_bytes=info["num_bytes"],
+                                        type=_get_str(info, "type"),
+                                        software=_get_str(info, "software"),
+                                        sources=[source.encode("utf8") for source in info["sources"]])
+
+    def __len__(self):
+        return self.num_fingerprints
+
+    def _search(self, search_type, queries, threshold, k, metric, arena_size):
+        for query_arena in queries.iter_arenas(arena_size):
+            results, timings = self.client.search(search_type, list(query_arena),
+                                                  threshold=threshold, k=k,
+                                                  metric=metric, targets=self.name)
+            for result in results:
+                yield result
+
+    def id_count_tanimoto_hits(self, queries, threshold=0.7, arena_size=100):
+        return self._search("count", queries, threshold, None, None, arena_size)
+
+    def id_threshold_tanimoto_search(self, queries, threshold=0.7, arena_size=100):
+        return self._search("threshold", queries, threshold, None, None, arena_size)
+
+    def id_knearest_tanimoto_search(self, queries, k=3, threshold=0.7, arena_size=100):
+        return self._search("knearest", queries, threshold, k, None, arena_size)
+
+    def id_count_hits(self, queries, threshold=0.7, metric=None, arena_size=100):
+        return self._search("count", queries, threshold, None, metric, arena_size)
+
+    def id_threshold_search(self, queries, threshold=0.7, metric=None, arena_size=100):
+        return self._search("threshold", queries, threshold, None, metric, arena_size)
+
+    def id_knearest_search(self, queries, k=3, threshold=0.7, metric=None, arena_size=100):
+        return self._search("knearest", queries, threshold, k, metric, arena_size)
@@ -0,0 +1,112 @@
+"""Share a FingerprintArena between processes through shared memory
+
+A search service often runs several worker processes which all search
+the same targets. Rather than have each worker load its own copy of
+the arena, one process publishes the arena and the others attach to
+it. An attached arena is a read-only memory map of the same pages, so
+the fingerprint data is only in memory once no matter how many workers
+use it, and attaching takes milliseconds.
+
+  # In the loader process
+  arena = chemfp.load_fingerprints("pubchem.fps.gz")
+  shm.publish_arena(arena, "pubchem")
+
+  # In each worker process
+  targets = shm.attach_arena("pubchem")
+  results = chemfp.search.knearest_tanimoto_search(queries, targets)
+
+The arena is stored in the FPB format (see chemfp.fpb) in a POSIX
+shared memory file, which is a file in /dev/shm on Linux. Set the
+CHEMFP_SHM_DIR environment variable to use another directory. It is
+required on systems without /dev/shm. The published arena stays
+available until unpublish_arena() is called, even after the
+publishing process exits.
+"""
+
+from __future__ import absolute_import
+
+import os
+import errno
+import tempfile
+
+from . import fpb
+
+__all__ = ["publish_arena", "attach_arena", "unpublish_arena", "get_shm_directory"]
+
+_SUFFIX = ".chemfp.fpb"
+
+_DEFAULT_SHM_DIR = "/dev/shm"
+
+def get_shm_directory():
+    """Return the directory used for the shared memory arenas
+
+    This is $CHEMFP_SHM_DIR if set, otherwise /dev/shm. Raises an
+    IOError if there is no /dev/shm, rather than silently using a
+    disk-backed directory.
+    """
+    dirname = os.environ.get("CHEMFP_SHM_DIR")
+    if dirname:
+        return dirname
+    if not os.path.isdir(_DEFAULT_SHM_DIR):
+        raise IOError(errno.ENOENT,
+                      "No shared memory directory; set CHEMFP_SHM_DIR to use another directory",
+                      _DEFAULT_SHM_DIR)
+    return _DEFAULT_SHM_DIR
+
+def _get_filename(name):
+    if not name or "/" in name or "\\" in name or name.startswith("."):
+        raise ValueError("shared arena name must be a non-empty name without a path: %r" %
+                         (name,))
+    return os.path.join(get_shm_directory(), name + _SUFFIX)
+
+def publish_arena(arena, name):
+    """Publish the arena to shared memory under the given name
+
+    Any existing arena with the same name is replaced. Processes
+    which are already attached to the old arena keep using it.
+
+    :param arena: the arena to share
+    :type arena: FingerprintArena
+    :param name: the shared memory name
+    :type name: string
+    """
+    filename = _get_filename(name)
+    # Write to a temporary file then rename, so an attach never sees
+    # a partially written arena.
+    fd, tmp_filename = tempfile.mkstemp(prefix="." + name, suffix=".tmp",
+                                        dir=os.path.dirname(filename))
+    try:
+        outfile = os.fdopen(fd, "wb")
+        try:
+            fpb.write_fpb(arena, outfile)
+        finally:
+            outfile.close()
+        os.chmod(tmp_filename, 0444)
+        os.rename(tmp_filename, filename)
+    except:
+        os.unlink(tmp_filename)
+        raise
+
+def attach_arena(name):
+    """Attach to the arena published under the given name
+
+    :param name: the shared memory name
+    :type name: string
+    :returns: a read-only FingerprintArena
+    """
+    filename = _get_filename(name)
+    if not os.path.exists(filename):
+        raise KeyError("No shared arena named %r" % (name,))
+    return fpb.open_fpb(filename)
+
+def unpublish_arena(name):
+    """Remove the arena with the given name from shared memory
+
+    Processes which are attached to the arena can still use it. The
+    memory is released once the last of them is finished.
+    """
+    filename = _get_filename(name)
+    try:
+        os.unlink(filename)
+    except OSError:
+        raise KeyError("No shared arena named %r" % (name,))
@@ -142,15 +142,18 @@ setup(name = "chemfp",
       
       packages = ["chemfp", "chemfp.commandline", "chemfp.futures", "chemfp.progressbar"],
       package_data = {"chemfp": ["rdmaccs.patterns", "substruct.patterns"]},
-      scripts = ["ob2fps", "oe2fps", "rdkit2fps", "sdf2fps", "simsearch"],
+      scripts = ["ob2fps", "oe2fps", "rdkit2fps", "sdf2fps", "simsearch", "fpcluster", "fpsindex",
+                 "chemfp-bench", "chemfp-serve"],
 
       ext_modules = [Extension("_chemfp",
                                ["src/bitops.c", "src/chemfp.c",
                                 "src/heapq.c", "src/fps.c",
-                                "src/searches.c", "src/hits.c",
+                                "src/searches.c", "src/hits.c", "src/cluster.c", "src/metrics.c",
+                                "src/screen.c", "src/format.c", "src/sdf.c",
+                                "src/decoders.c",
                                 "src/select_popcount.c", "src/popcount_popcnt.c",
                                 "src/popcount_lauradoux.c", "src/popcount_lut.c",
-                                "src/popcount_gillies.c", "src/popcount_SSSE3.c",
+                                "src/popcount_gillies.c", "src/popcount_SSSE3.c", "src/popcount_avx.c",
                                 "src/python_api.c", "src/pysearch_results.c"],
                                )],
       cmdclass = {"build_ext": build_ext_subclass},
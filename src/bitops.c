@@ -314,3 +314,33 @@ double chemfp_byte_hex_tanimoto(int size,
   }
   return (intersect_popcount + 0.0) / union_popcount;  /* +0.0 to coerce to double */
 }
+
+/* Return the intersection popcount between a byte fingerprint and a hex
+   fingerprint, or -1 if the hex fingerprint is invalid. The popcount of
+   the hex fingerprint is stored in *hex_popcount. */
+/* The size is the number of bytes in the byte_fp */
+int chemfp_byte_hex_intersect_popcount(int size,
+                                       const unsigned char *byte_fp,
+                                       const char *shex_fp,
+                                       int *hex_popcount) {
+  const unsigned char *hex_fp = (unsigned char *) shex_fp;
+  int union_w=0;
+  int target_popcount=0, intersect_popcount=0;
+  int w1, w2;
+  unsigned char wc;
+
+  while (size > 0) {
+    w1 = hex_to_value[*hex_fp++];
+    w2 = hex_to_value[*hex_fp++];
+    union_w |= (w1|w2);
+    wc = (unsigned char)((w1<<4) | w2);
+    target_popcount += byte_popcounts[wc];
+    intersect_popcount += byte_popcounts[*byte_fp++ & wc];
+    size--;
+  }
+  if (union_w >= BIG) {
+    return -1;
+  }
+  *hex_popcount = target_popcount;
+  return intersect_popcount;
+}
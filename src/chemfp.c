@@ -45,6 +45,8 @@ const chemfp_option_type chemfp_options[] = {
   {"report-popcount", chemfp_get_option_report_popcount, chemfp_set_option_report_popcount},
   {"report-intersect", chemfp_get_option_report_intersect_popcount,
    chemfp_set_option_report_intersect_popcount},
+  {"fixed-kernels", chemfp_get_option_fixed_kernels, chemfp_set_option_fixed_kernels},
+  {"tile-size", chemfp_get_option_tile_size, chemfp_set_option_tile_size},
 };
 
 int
@@ -97,6 +99,13 @@ int chemfp_get_num_threads(void) {
   if (chemfp_num_threads == 0) {
     chemfp_num_threads = omp_get_max_threads();
   }
+  /* omp_set_num_threads() only changes the setting for the thread
+     which calls it. The searches call this function before they
+     start a parallel region, so use it to make a search from another
+     (Python) thread use the same number of threads. */
+  if (omp_get_max_threads() != chemfp_num_threads) {
+    omp_set_num_threads(chemfp_num_threads);
+  }
   return chemfp_num_threads;
 #else
   return 1;
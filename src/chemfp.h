@@ -1,6 +1,9 @@
 #ifndef CHEMFP_H
 #define CHEMFP_H
 
+#include <stddef.h>
+#include <stdint.h>
+
 /* Errors are always negative numbers. */
 enum chemfp_errors {
   CHEMFP_OK = 0,
@@ -82,21 +85,36 @@ typedef struct chemfp_hit_block {
 } chemfp_hit_block;
 
 
+/* How the scores in a search result row are stored. The compact types
+   use less memory but only keep the score to within float precision,
+   or to within 1/131070 for the quantized 16-bit scores. */
+#define CHEMFP_SCORE_DOUBLE 0
+#define CHEMFP_SCORE_FLOAT 1
+#define CHEMFP_SCORE_UINT16 2
+
 typedef struct chemfp_search_result {
   int num_hits;
   int num_allocated;
   int *indices;
+  /* Points to 'score_type' values. Only rows with CHEMFP_SCORE_DOUBLE */
+  /* scores may be used as a double array; use chemfp_get_score() */
   double *scores;
+  int score_type;
 } chemfp_search_result;
 
 chemfp_search_result *chemfp_alloc_search_results(int num_results);
+chemfp_search_result *chemfp_alloc_search_results_with_score_type(int num_results,
+                                                                  int score_type);
 void chemfp_free_results(int num_results, chemfp_search_result *);
 int chemfp_get_num_hits(chemfp_search_result *results);
+size_t chemfp_get_score_size(int score_type);
+double chemfp_get_score(const chemfp_search_result *result, int i);
 
 int chemfp_search_result_reorder(chemfp_search_result *result, const char *ordering);
 int chemfp_search_results_reorder(int num_results, chemfp_search_result *results,
                                   const char *ordering);
 void chemfp_search_result_clear(chemfp_search_result *result);
+int chemfp_search_results_trim(int num_results, chemfp_search_result *results);
 
 /*** Low-level operations directly on hex fingerprints ***/
 
@@ -135,6 +153,12 @@ double chemfp_byte_tanimoto(int len, const unsigned char *fp1,
 double chemfp_byte_hex_tanimoto(int size, const unsigned char *byte_fp,
                                 const char *hex_fp);
 
+/* Return the intersection popcount between a byte fingerprint and a hex
+   fingerprint, or -1 for an invalid hex fingerprint. The hex fingerprint
+   popcount is stored in *hex_popcount */
+int chemfp_byte_hex_intersect_popcount(int size, const unsigned char *byte_fp,
+                                       const char *hex_fp, int *hex_popcount);
+
 /* Return 1 if the query fingerprint is contained in the target, 0 if it isn't */
 int chemfp_byte_contains(int len, const unsigned char *query_fp,
                          const unsigned char *target_fp);
@@ -175,7 +199,7 @@ typedef struct {
   int heap_state;
 
   /* These all point to arrays of size k */
-  int *indices;      /* [k]; contains a unique id or index */
+  int *indices;      /* [k]; the target's record position, to break ties */
   char **ids;          /* [k]; array of NULL or malloc'ed identifier */
   double *scores;     /* [k]; the Tanimoto similarity */
 } chemfp_fps_heap;
@@ -190,6 +214,9 @@ typedef struct {
   double threshold;   /* initial threshold */
   chemfp_fps_heap *heaps;    /* [num_queries] heaps */
 
+  /* Incremented by each feed. It is also the record position of the
+     first target in the next block, so the caller may set it before a
+     feed when the blocks are not contiguous. */
   int num_targets_processed;
   char **_all_ids;
   double *_all_scores;
@@ -329,6 +356,49 @@ int chemfp_knearest_tanimoto_arena(
         chemfp_search_result *results
                                    );
 
+/* Build the per-block union index for chemfp_knearest_tanimoto_arena_blocks() */
+int chemfp_get_num_knearest_blocks(int num_bits, int *popcount_indices, int block_size);
+
+int chemfp_make_knearest_block_index(
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int *popcount_indices, int block_size,
+        int *block_indices, unsigned char *block_unions);
+
+int chemfp_knearest_tanimoto_arena_blocks(
+        /* Find the 'k' nearest items */
+        int k,
+        /* Within the given threshold */
+        double threshold,
+
+        /* Number of bits in the fingerprint */
+        int num_bits,
+
+        /* Query arena, start and end indices */
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+
+        /* Target arena, start and end indices */
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+
+        /* Target popcount distribution information */
+        /*  (must have at least num_bits+1 elements) */
+        int *target_popcount_indices,
+
+        /* The block size, the index of the first block for each popcount
+           (num_bits+2 elements), and the union of each block */
+        int block_size, int *block_indices, const unsigned char *block_unions,
+
+        /* Results go into this data structure  */
+        chemfp_search_result *results,
+
+        /* Incremented by the number of blocks scanned, blocks pruned,
+           and fingerprints compared */
+        long *stats
+                                   );
+
+
 
 
 int chemfp_count_tanimoto_hits_arena_symmetric(
@@ -403,6 +473,160 @@ void chemfp_knearest_results_finalize(chemfp_search_result *results_start,
                                       chemfp_search_result *results_end);
 
 int chemfp_fill_lower_triangle(int n, chemfp_search_result *results);
+int chemfp_fill_lower_triangle_tile(chemfp_search_result *results,
+                                    int query_start, int query_end,
+                                    int target_start, int target_end);
+
+/* Similarity measures other than Tanimoto (see metrics.c) */
+enum chemfp_metric_types {
+  CHEMFP_METRIC_TANIMOTO = 0,
+  CHEMFP_METRIC_TVERSKY = 1,
+  CHEMFP_METRIC_DICE = 2,
+  CHEMFP_METRIC_COSINE = 3,
+  CHEMFP_METRIC_HAMMING = 4,
+  CHEMFP_METRIC_EUCLIDEAN = 5,
+  CHEMFP_METRIC_CONTAINS = 6
+};
+
+typedef struct {
+  int type;
+  double alpha, beta;  /* Tversky weights for the query and target */
+} chemfp_metric;
+
+/* Return CHEMFP_OK if the metric type and parameters are valid, else CHEMFP_BAD_ARG */
+int chemfp_metric_check(const chemfp_metric *metric);
+
+double chemfp_metric_score(const chemfp_metric *metric, int num_bits,
+                           int query_popcount, int target_popcount, int intersect_popcount);
+
+/* The highest possible score for any target with the given popcount */
+double chemfp_metric_best_score(const chemfp_metric *metric, int num_bits,
+                                int query_popcount, int target_popcount);
+
+int chemfp_count_metric_arena(
+        const chemfp_metric *metric, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts);
+
+int chemfp_threshold_metric_arena(
+        const chemfp_metric *metric, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+int chemfp_knearest_metric_arena(
+        const chemfp_metric *metric, int k, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+/* The FPS block versions of the count, threshold and k-nearest searches */
+int chemfp_fps_count_metric_hits(
+        const chemfp_metric *metric,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double threshold,
+        int *counts, int *num_lines_processed);
+
+int chemfp_fps_threshold_metric_search(
+        const chemfp_metric *metric,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double threshold,
+        int num_cells, chemfp_tanimoto_cell *cells,
+        const char ** stopped_at, int *num_lines_processed, int *num_cells_processed);
+
+int chemfp_fps_knearest_metric_search_feed(
+        const chemfp_metric *metric, int num_bits,
+        chemfp_fps_knearest_search *knearest_search,
+        int target_block_len, const char *target_block);
+
+/* Substructure screening index (see screen.c) */
+int chemfp_screen_get_num_words(int num_fingerprints);
+
+int chemfp_screen_build(int num_bits, int storage_size,
+                        const unsigned char *arena, int start, int end,
+                        int num_words, uint64_t *bitmaps, int *bit_counts);
+
+int chemfp_screen_contains(int num_bits, int num_words, const uint64_t *bitmaps,
+                           const int *bit_counts, int num_fingerprints, int min_index,
+                           const unsigned char *query_fp,
+                           uint64_t *candidates, int *start_word, int *end_word);
+
+int chemfp_screen_get_indices(const uint64_t *candidates, int start_word, int end_word,
+                              int index_offset, int *indices);
+
+int chemfp_screen_contains_arena(int num_bits, int num_words, const uint64_t *bitmaps,
+                                 const int *bit_counts, int num_fingerprints,
+                                 const int *target_popcount_indices, int target_start,
+                                 int query_storage_size, const unsigned char *query_arena,
+                                 int query_start, int query_end,
+                                 chemfp_search_result *results);
+
+/* Clustering */
+enum {
+  CHEMFP_BUTINA_TIE_RANK = 0,
+  CHEMFP_BUTINA_TIE_DENSITY = 1
+};
+
+int chemfp_butina_order(int n, const chemfp_search_result *results,
+                        int tie_break, const int *ranks, int *order);
+
+int chemfp_cluster_assign(int n, const chemfp_search_result *results,
+                          const int *order, int *assignments);
+
+/* Simsearch output formatting (see format.c) */
+int chemfp_format_hits(int num_rows, const chemfp_search_result *results,
+                       const char * const *query_ids, const int *query_id_lens,
+                       const char *target_id_data, size_t target_id_data_size,
+                       const void *target_id_offsets, int offset_size, int num_target_ids,
+                       int num_digits, char **output, size_t *output_size);
+
+/* SD file records (see sdf.c) */
+int chemfp_sdf_find_separator(const char *data, int start, int end);
+
+int chemfp_sdf_check_record(const char *data, int start, int end);
+
+void chemfp_sdf_get_title(const char *data, int start, int end,
+                          int *title_start, int *title_end);
+
+int chemfp_sdf_find_tag_value(const char *data, int start, int end,
+                              const char *tag_substr, int tag_len,
+                              int *value_start, int *value_end);
+
+/* Fingerprint decoders (see decoders.c) */
+enum {
+  CHEMFP_ENCODING_BINARY_LSB = 0,
+  CHEMFP_ENCODING_BINARY_MSB = 1,
+  CHEMFP_ENCODING_HEX = 2,
+  CHEMFP_ENCODING_HEX_LSB = 3,
+  CHEMFP_ENCODING_HEX_MSB = 4,
+  CHEMFP_ENCODING_BASE64 = 5,
+  CHEMFP_ENCODING_CACTVS = 6,
+  CHEMFP_ENCODING_DAYLIGHT = 7
+};
+
+int chemfp_decode_fingerprint(int encoding, const char *text, int text_len,
+                              unsigned char *fp, int *num_bits);
+
+int chemfp_decode_fingerprints(int encoding, int num_fps,
+                               const char * const *texts, const int *text_lens,
+                               int storage_size, unsigned char *output,
+                               int *num_bytes, int *num_bits);
 
 
 typedef int (*chemfp_popcount_f)(int len, const unsigned char *p1);
@@ -418,6 +642,23 @@ chemfp_select_intersect_popcount(int num_bits,
                                  int storage_len1, const unsigned char *arena1,
                                  int storage_len2, const unsigned char *arena2);
 
+/* The Tanimoto searches have kernels specialized for these sizes */
+enum {
+  CHEMFP_FIXED_NONE = 0,
+  CHEMFP_FIXED_166_POPCNT,
+  CHEMFP_FIXED_881_POPCNT,
+  CHEMFP_FIXED_1024_POPCNT,
+  CHEMFP_FIXED_2048_POPCNT,
+  CHEMFP_FIXED_881_AVX512,
+  CHEMFP_FIXED_1024_AVX512,
+  CHEMFP_FIXED_2048_AVX512
+};
+
+int
+chemfp_select_fixed_kernel(int num_bits,
+                           int storage_len1, const unsigned char *arena1,
+                           int storage_len2, const unsigned char *arena2);
+
 
 /* OpenMP interface */
 
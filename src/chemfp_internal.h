@@ -17,6 +17,12 @@ int chemfp_set_option_report_popcount(int);
 int chemfp_get_option_report_intersect_popcount(void);
 int chemfp_set_option_report_intersect_popcount(int);
 
+int chemfp_get_option_fixed_kernels(void);
+int chemfp_set_option_fixed_kernels(int);
+
+int chemfp_get_option_tile_size(void);
+int chemfp_set_option_tile_size(int);
+
 int chemfp_add_hit(chemfp_search_result *result, int target_index, double score);
 
 #endif
@@ -0,0 +1,121 @@
+#include <stdlib.h>
+
+#include "chemfp.h"
+
+/* Clustering on top of the symmetric threshold search results.
+
+   Each row of 'results' is the list of neighbors for one fingerprint,
+   which must not include the fingerprint itself. Both the upper and
+   lower triangles must be present. */
+
+typedef struct {
+  int num_hits;
+  int rank;
+  double tie_score;
+  int index;
+} butina_candidate;
+
+static int compare_butina_candidates(const void *left_p, const void *right_p) {
+  const butina_candidate *left = (butina_candidate *) left_p;
+  const butina_candidate *right = (butina_candidate *) right_p;
+  /* More neighbors go first */
+  if (left->num_hits > right->num_hits) {
+    return -1;
+  }
+  if (left->num_hits < right->num_hits) {
+    return 1;
+  }
+  /* Then the larger tie-breaker score */
+  if (left->tie_score > right->tie_score) {
+    return -1;
+  }
+  if (left->tie_score < right->tie_score) {
+    return 1;
+  }
+  /* Then the smaller rank */
+  if (left->rank < right->rank) {
+    return -1;
+  }
+  if (left->rank > right->rank) {
+    return 1;
+  }
+  return 0;
+}
+
+/* Put the fingerprint indices in Taylor-Butina centroid order, which
+   is by decreasing number of neighbors. Ties are broken by the
+   'tie_break' method, then by 'ranks' (smaller first), or by index if
+   'ranks' is NULL.
+     CHEMFP_BUTINA_TIE_RANK - only use the ranks
+     CHEMFP_BUTINA_TIE_DENSITY - larger sum of neighbor scores first
+*/
+int chemfp_butina_order(int n, const chemfp_search_result *results,
+                        int tie_break, const int *ranks, int *order) {
+  int i, j;
+  double total;
+  butina_candidate *candidates;
+
+  if (tie_break != CHEMFP_BUTINA_TIE_RANK && tie_break != CHEMFP_BUTINA_TIE_DENSITY) {
+    return CHEMFP_BAD_ARG;
+  }
+  candidates = (butina_candidate *) malloc(n * sizeof(butina_candidate));
+  if (!candidates) {
+    return CHEMFP_NO_MEM;
+  }
+  for (i=0; i<n; i++) {
+    candidates[i].num_hits = results[i].num_hits;
+    candidates[i].rank = ranks ? ranks[i] : i;
+    candidates[i].index = i;
+    total = 0.0;
+    if (tie_break == CHEMFP_BUTINA_TIE_DENSITY) {
+      for (j=0; j<results[i].num_hits; j++) {
+        total += chemfp_get_score(results+i, j);
+      }
+    }
+    candidates[i].tie_score = total;
+  }
+  qsort(candidates, n, sizeof(butina_candidate), compare_butina_candidates);
+  for (i=0; i<n; i++) {
+    order[i] = candidates[i].index;
+  }
+  free(candidates);
+  return CHEMFP_OK;
+}
+
+/* Sphere exclusion assignment. Visit the fingerprints in 'order'. An
+   unassigned fingerprint becomes a centroid and every unassigned
+   neighbor joins its cluster. On return assignments[i] is the index
+   of the centroid for fingerprint i, and a centroid is assigned to
+   itself. Returns the number of centroids, or CHEMFP_BAD_ARG if
+   'order' or a neighbor list contains an index which is out of range. */
+int chemfp_cluster_assign(int n, const chemfp_search_result *results,
+                          const int *order, int *assignments) {
+  int i, j, centroid, neighbor, num_centroids = 0;
+  const int *indices;
+
+  for (i=0; i<n; i++) {
+    assignments[i] = -1;
+  }
+  for (i=0; i<n; i++) {
+    centroid = order[i];
+    if (centroid < 0 || centroid >= n) {
+      return CHEMFP_BAD_ARG;
+    }
+    if (assignments[centroid] != -1) {
+      continue;
+    }
+    assignments[centroid] = centroid;
+    num_centroids++;
+    indices = results[centroid].indices;
+    for (j=0; j<results[centroid].num_hits; j++) {
+      neighbor = indices[j];
+      if (neighbor < 0 || neighbor >= n) {
+        return CHEMFP_BAD_ARG;
+      }
+      if (assignments[neighbor] == -1) {
+        assignments[neighbor] = centroid;
+      }
+    }
+  }
+  return num_centroids;
+}
@@ -35,13 +35,29 @@
 #define bit_POPCNT  (1 << 23)
 #define bit_AVX     (1 << 28)
 
+#define bit_OSXSAVE (1 << 27)
+
 /* %edx bit flags */
 #define bit_SSE     (1 << 25)
 #define bit_SSE2    (1 << 26)
 
+/* Leaf 7 (extended features) flags, as returned by get_cpuid_ext_flags() */
+#define bit_AVX2              (1 << 0)
+#define bit_AVX512F           (1 << 1)
+#define bit_AVX512BW          (1 << 2)
+#define bit_AVX512_VPOPCNTDQ  (1 << 3)
+#define bit_AVX512_BITALG     (1 << 4)
+
+#if defined(__GNUC__)
+  #define CPUID_MAYBE_UNUSED __attribute__((unused))
+#else
+  #define CPUID_MAYBE_UNUSED
+#endif
+
 /**
  * Portable cpuid implementation for x86 and x86-64 CPUs
  * (supports PIC and non-PIC code).
+ * On input, *ecx is the sub-leaf, which is only used by some leafs.
  * @return  1 if the CPU supports the cpuid instruction else -1.
  */
 static int cpuid(unsigned int info,
@@ -52,7 +68,7 @@ static int cpuid(unsigned int info,
 {
 #if defined(_MSC_VER) && (defined(_WIN32) || defined(_WIN64))
   int regs[4];
-  __cpuid(regs, info);
+  __cpuidex(regs, info, *ecx);
   *eax = regs[0];
   *ebx = regs[1];
   *ecx = regs[2];
@@ -67,14 +83,14 @@ static int cpuid(unsigned int info,
    "xchg %%ebx, %%esi;"
    : "+a" (*eax), 
      "=S" (*ebx),
-     "=c" (*ecx),
+     "+c" (*ecx),
      "=d" (*edx));
   #else
   __asm__ __volatile__ (
    "cpuid;"
    : "+a" (*eax), 
      "=b" (*ebx),
-     "=c" (*ecx),
+     "+c" (*ecx),
      "=d" (*edx));
   #endif
   return 1;
@@ -84,7 +100,7 @@ static int cpuid(unsigned int info,
    "cpuid;"
    : "+a" (*eax), 
      "=b" (*ebx),
-     "=c" (*ecx),
+     "+c" (*ecx),
      "=d" (*edx));
   return 1;
 #else
@@ -106,7 +122,7 @@ static int get_cpuid_flags(void)
 {
   int flags = 0;
   unsigned int info = 0x00000001;
-  unsigned int eax, ebx, ecx, edx;
+  unsigned int eax, ebx, ecx = 0, edx;
   if (cpuid(info, &eax, &ebx, &ecx, &edx) != -1) {
     flags = (edx & (bit_SSE    | 
                     bit_SSE2)) | 
@@ -120,4 +136,74 @@ static int get_cpuid_flags(void)
   return flags;
 }
 
+/**
+ * @return  The contents of the XCR0 register, which says which
+ *          register states the operating system saves on a
+ *          context switch, or 0 if XGETBV is not available.
+ */
+CPUID_MAYBE_UNUSED
+static unsigned int get_xcr0(void)
+{
+  unsigned int eax, ebx, ecx = 0, edx;
+  if (cpuid(1, &eax, &ebx, &ecx, &edx) == -1 || !(ecx & bit_OSXSAVE)) {
+    return 0;
+  }
+#if defined(_MSC_VER) && (defined(_WIN32) || defined(_WIN64))
+  return (unsigned int) _xgetbv(0);
+#elif defined(__i386__) || defined(__i386) || defined(__x86_64__)
+  /* This is the "xgetbv" instruction, for older assemblers */
+  __asm__ __volatile__ (
+   ".byte 0x0f, 0x01, 0xd0"
+   : "=a" (eax),
+     "=d" (edx)
+   : "c" (0));
+  return eax;
+#else
+  return 0;
+#endif
+}
+
+/**
+ * @return  An int value with the bit_AVX2 and AVX-512 flags set if
+ *          the CPU supports the corresponding instruction sets and
+ *          the operating system saves the YMM (for AVX2) or ZMM
+ *          (for AVX-512) registers.
+ */
+CPUID_MAYBE_UNUSED
+static int get_cpuid_ext_flags(void)
+{
+  int flags = 0;
+  unsigned int eax, ebx, ecx, edx;
+  unsigned int xcr0;
+
+  eax = ebx = ecx = edx = 0;
+  if (cpuid(0, &eax, &ebx, &ecx, &edx) == -1 || eax < 7) {
+    return 0;
+  }
+  xcr0 = get_xcr0();
+  /* The OS must save the XMM and YMM state (bits 1 and 2) */
+  if ((xcr0 & 0x06) != 0x06) {
+    return 0;
+  }
+  ecx = 0;
+  cpuid(7, &eax, &ebx, &ecx, &edx);
+  if (ebx & (1 << 5)) {
+    flags |= bit_AVX2;
+  }
+  /* AVX-512 also needs the opmask and ZMM state (bits 5, 6 and 7) */
+  if ((xcr0 & 0xe6) == 0xe6 && (ebx & (1 << 16))) {
+    flags |= bit_AVX512F;
+    if (ebx & (1 << 30)) {
+      flags |= bit_AVX512BW;
+    }
+    if (ecx & (1 << 14)) {
+      flags |= bit_AVX512_VPOPCNTDQ;
+    }
+    if (ecx & (1 << 12)) {
+      flags |= bit_AVX512_BITALG;
+    }
+  }
+  return flags;
+}
+
 #endif /* CPUID_H */
@@ -0,0 +1,318 @@
+#include <stdlib.h>
+#include <string.h>
+
+#include "chemfp.h"
+
+/* Fingerprint decoders for the encodings in chemfp/decoders.py.
+
+   These only accept well-formed input: '0' and '1' for the binary
+   encodings, an even number of hex digits, and base64 text without
+   whitespace and with the correct "=" padding. The Python functions
+   are more forgiving (binascii skips characters which aren't part of
+   the base64 alphabet), so chemfp.decoders uses the Python code when
+   these return CHEMFP_BAD_FINGERPRINT. */
+
+static signed char hex_table[256];
+static signed char base64_table[256];
+static signed char daylight_table[256];
+static unsigned char reverse_bits_table[256];
+static int tables_initialized = 0;
+
+static void init_tables(void) {
+  int i, j, c;
+  const char *base64_chars =
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+  const char *daylight_chars =
+    ".+0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz";
+
+  memset(hex_table, -1, sizeof(hex_table));
+  memset(base64_table, -1, sizeof(base64_table));
+  memset(daylight_table, -1, sizeof(daylight_table));
+  for (i = 0; i < 10; i++) {
+    hex_table['0' + i] = (signed char) i;
+  }
+  for (i = 0; i < 6; i++) {
+    hex_table['a' + i] = hex_table['A' + i] = (signed char) (10 + i);
+  }
+  for (i = 0; i < 64; i++) {
+    base64_table[(unsigned char) base64_chars[i]] = (signed char) i;
+    daylight_table[(unsigned char) daylight_chars[i]] = (signed char) i;
+  }
+  /* The '+' used to be represented as ',' in pre-4.61 code */
+  daylight_table[','] = daylight_table['+'];
+
+  for (i = 0; i < 256; i++) {
+    c = 0;
+    for (j = 0; j < 8; j++) {
+      if (i & (1 << j)) {
+        c |= 1 << (7 - j);
+      }
+    }
+    reverse_bits_table[i] = (unsigned char) c;
+  }
+  tables_initialized = 1;
+}
+
+/* The binary decoders work 8 characters at a time. Each character
+   must be 0x30 or 0x31, so the low bit of each byte is the bit value.
+   Multiplying by the magic number moves those 8 bits into the top
+   byte, in forward or reverse order, without any carries. */
+#define ALL_ZERO_CHARS UINT64_C(0x3030303030303030)
+#define NOT_LOW_BITS UINT64_C(0xfefefefefefefefe)
+#define LOW_BITS UINT64_C(0x0101010101010101)
+#define PACK_FORWARD UINT64_C(0x0102040810204080)
+#define PACK_REVERSE UINT64_C(0x8040201008040201)
+
+/* Load 8 characters with text[0] in the low byte, for any byte order */
+static uint64_t load_8_chars(const char *text) {
+  const unsigned char *p = (const unsigned char *) text;
+  return ((uint64_t) p[0]       | ((uint64_t) p[1] << 8)  |
+          ((uint64_t) p[2] << 16) | ((uint64_t) p[3] << 24) |
+          ((uint64_t) p[4] << 32) | ((uint64_t) p[5] << 40) |
+          ((uint64_t) p[6] << 48) | ((uint64_t) p[7] << 56));
+}
+
+static int decode_binary_lsb(const char *text, int len, unsigned char *fp) {
+  int i, num_bytes = (len + 7) / 8;
+  uint64_t chars;
+  memset(fp, 0, num_bytes);
+  for (i = 0; i + 8 <= len; i += 8) {
+    chars = load_8_chars(text + i);
+    if ((chars & NOT_LOW_BITS) != ALL_ZERO_CHARS) {
+      return CHEMFP_BAD_FINGERPRINT;
+    }
+    fp[i / 8] = (unsigned char) (((chars & LOW_BITS) * PACK_FORWARD) >> 56);
+  }
+  for (; i < len; i++) {
+    if (text[i] == '1') {
+      fp[i / 8] |= (unsigned char) (1 << (i % 8));
+    } else if (text[i] != '0') {
+      return CHEMFP_BAD_FINGERPRINT;
+    }
+  }
+  return num_bytes;
+}
+
+static int decode_binary_msb(const char *text, int len, unsigned char *fp) {
+  int i, bitno, end;
+  /* Like the Python version, the empty string is one 0 byte */
+  int num_bytes = (len == 0) ? 1 : (len + 7) / 8;
+  uint64_t chars;
+  memset(fp, 0, num_bytes);
+  /* Bit #0 is the last character, so work backwards from the end */
+  for (end = len; end >= 8; end -= 8) {
+    chars = load_8_chars(text + end - 8);
+    if ((chars & NOT_LOW_BITS) != ALL_ZERO_CHARS) {
+      return CHEMFP_BAD_FINGERPRINT;
+    }
+    fp[(len - end) / 8] = (unsigned char) (((chars & LOW_BITS) * PACK_REVERSE) >> 56);
+  }
+  for (i = 0; i < end; i++) {
+    bitno = len - 1 - i;
+    if (text[i] == '1') {
+      fp[bitno / 8] |= (unsigned char) (1 << (bitno % 8));
+    } else if (text[i] != '0') {
+      return CHEMFP_BAD_FINGERPRINT;
+    }
+  }
+  return num_bytes;
+}
+
+static int decode_hex(const char *text, int len, unsigned char *fp) {
+  int i, hi, lo;
+  if (len % 2) {
+    return CHEMFP_BAD_FINGERPRINT;
+  }
+  for (i = 0; i < len; i += 2) {
+    hi = hex_table[(unsigned char) text[i]];
+    lo = hex_table[(unsigned char) text[i+1]];
+    if ((hi | lo) < 0) {
+      return CHEMFP_BAD_FINGERPRINT;
+    }
+    fp[i / 2] = (unsigned char) ((hi << 4) | lo);
+  }
+  return len / 2;
+}
+
+static int decode_base64(const char *text, int len, unsigned char *fp) {
+  int i, num_pad = 0, num_bytes = 0, a, b, c, d;
+  if (len % 4) {
+    return CHEMFP_BAD_FINGERPRINT;
+  }
+  if (len && text[len-1] == '=') {
+    num_pad = (text[len-2] == '=') ? 2 : 1;
+  }
+  for (i = 0; i < len; i += 4) {
+    a = base64_table[(unsigned char) text[i]];
+    b = base64_table[(unsigned char) text[i+1]];
+    if (i + 4 == len && num_pad) {
+      /* The last quad is "xx==" or "xxx=" */
+      c = (num_pad == 2) ? 0 : base64_table[(unsigned char) text[i+2]];
+      d = 0;
+    } else {
+      c = base64_table[(unsigned char) text[i+2]];
+      d = base64_table[(unsigned char) text[i+3]];
+    }
+    if ((a | b | c | d) < 0) {
+      return CHEMFP_BAD_FINGERPRINT;
+    }
+    fp[num_bytes++] = (unsigned char) ((a << 2) | (b >> 4));
+    fp[num_bytes++] = (unsigned char) (((b & 0x0f) << 4) | (c >> 2));
+    fp[num_bytes++] = (unsigned char) (((c & 0x03) << 6) | d);
+  }
+  return num_bytes - num_pad;
+}
+
+/* PubChem's CACTVS fingerprints are base64 encoded, start with the
+   4 byte big-endian bit length (always 881), and are in LSB bit order. */
+static int decode_cactvs(const char *text, int len, unsigned char *fp) {
+  int i, num_bytes = decode_base64(text, len, fp);
+  if (num_bytes < 4 || fp[0] != 0 || fp[1] != 0 || fp[2] != 3 || fp[3] != 'q') {
+    return CHEMFP_BAD_FINGERPRINT;
+  }
+  num_bytes -= 4;
+  for (i = 0; i < num_bytes; i++) {
+    fp[i] = reverse_bits_table[fp[i+4]];
+  }
+  return num_bytes;
+}
+
+/* Daylight's binary2ascii: 4 characters for every 3 bytes, followed
+   by '1', '2' or '3', the number of real bytes in the last triplet. */
+static int decode_daylight(const char *text, int len, unsigned char *fp) {
+  int i, a, b, c, d, v, num_bytes = 0;
+  char count;
+  if (len == 1 && text[0] == '3') {
+    return 0;
+  }
+  if (len < 5 || len % 4 != 1) {
+    return CHEMFP_BAD_FINGERPRINT;
+  }
+  count = text[len-1];
+  if (count < '1' || count > '3') {
+    return CHEMFP_BAD_FINGERPRINT;
+  }
+  for (i = 0; i < len - 1; i += 4) {
+    a = daylight_table[(unsigned char) text[i]];
+    b = daylight_table[(unsigned char) text[i+1]];
+    c = daylight_table[(unsigned char) text[i+2]];
+    d = daylight_table[(unsigned char) text[i+3]];
+    if ((a | b | c | d) < 0) {
+      return CHEMFP_BAD_FINGERPRINT;
+    }
+    v = (a << 18) | (b << 12) | (c << 6) | d;
+    fp[num_bytes++] = (unsigned char) (v >> 16);
+    fp[num_bytes++] = (unsigned char) ((v >> 8) & 0xff);
+    fp[num_bytes++] = (unsigned char) (v & 0xff);
+  }
+  return num_bytes - ('3' - count);
+}
+
+/* Decode 'text' into 'fp', which must have room for text_len+1 bytes.
+   Returns the number of bytes or CHEMFP_BAD_FINGERPRINT, and sets
+   *num_bits to the exact number of bits, or -1 if that isn't known. */
+int chemfp_decode_fingerprint(int encoding, const char *text, int text_len,
+                              unsigned char *fp, int *num_bits) {
+  int i, num_bytes;
+  unsigned char tmp;
+  if (!tables_initialized) {
+    init_tables();
+  }
+  *num_bits = -1;
+  switch (encoding) {
+  case CHEMFP_ENCODING_BINARY_LSB:
+    num_bytes = decode_binary_lsb(text, text_len, fp);
+    *num_bits = text_len;
+    break;
+  case CHEMFP_ENCODING_BINARY_MSB:
+    num_bytes = decode_binary_msb(text, text_len, fp);
+    *num_bits = text_len;
+    break;
+  case CHEMFP_ENCODING_HEX:
+    num_bytes = decode_hex(text, text_len, fp);
+    break;
+  case CHEMFP_ENCODING_HEX_LSB:
+    num_bytes = decode_hex(text, text_len, fp);
+    for (i = 0; i < num_bytes; i++) {
+      fp[i] = reverse_bits_table[fp[i]];
+    }
+    break;
+  case CHEMFP_ENCODING_HEX_MSB:
+    num_bytes = decode_hex(text, text_len, fp);
+    for (i = 0; i < num_bytes / 2; i++) {
+      tmp = fp[i];
+      fp[i] = fp[num_bytes - 1 - i];
+      fp[num_bytes - 1 - i] = tmp;
+    }
+    break;
+  case CHEMFP_ENCODING_BASE64:
+    num_bytes = decode_base64(text, text_len, fp);
+    break;
+  case CHEMFP_ENCODING_CACTVS:
+    num_bytes = decode_cactvs(text, text_len, fp);
+    *num_bits = 881;
+    break;
+  case CHEMFP_ENCODING_DAYLIGHT:
+    num_bytes = decode_daylight(text, text_len, fp);
+    break;
+  default:
+    return CHEMFP_BAD_ARG;
+  }
+  if (num_bytes < 0) {
+    *num_bits = -1;
+  }
+  return num_bytes;
+}
+
+/* Decode 'num_fps' fingerprints into 'output', one every 'storage_size'
+   bytes, with 0 bytes for the rest of each row. A NULL text is a
+   missing fingerprint. num_bytes[i] is the decoded size, or -1 if it
+   couldn't be decoded, and num_bits[i] is the exact number of bits or
+   -1. A fingerprint longer than storage_size isn't stored. Returns the
+   number of fingerprints (not counting the NULLs) which couldn't be
+   decoded, or a negative error code. */
+int chemfp_decode_fingerprints(int encoding, int num_fps,
+                               const char * const *texts, const int *text_lens,
+                               int storage_size, unsigned char *output,
+                               int *num_bytes, int *num_bits) {
+  int i, max_len = 0, n, num_failures = 0;
+  unsigned char *fp, *scratch;
+
+  if (encoding < 0 || encoding > CHEMFP_ENCODING_DAYLIGHT || storage_size < 0) {
+    return CHEMFP_BAD_ARG;
+  }
+  for (i = 0; i < num_fps; i++) {
+    if (texts[i] != NULL && text_lens[i] > max_len) {
+      max_len = text_lens[i];
+    }
+  }
+  scratch = (unsigned char *) malloc(max_len + 1);
+  if (scratch == NULL) {
+    return CHEMFP_NO_MEM;
+  }
+  for (i = 0; i < num_fps; i++) {
+    fp = output + (size_t) i * storage_size;
+    if (texts[i] == NULL) {
+      n = CHEMFP_BAD_FINGERPRINT;
+      num_bits[i] = -1;
+    } else {
+      n = chemfp_decode_fingerprint(encoding, texts[i], text_lens[i], scratch, num_bits + i);
+    }
+    if (n < 0 || n > storage_size) {
+      memset(fp, 0, storage_size);
+    } else {
+      memcpy(fp, scratch, n);
+      memset(fp + n, 0, storage_size - n);
+    }
+    if (n < 0) {
+      num_bytes[i] = -1;
+      if (texts[i] != NULL) {
+        num_failures++;
+      }
+    } else {
+      num_bytes[i] = n;
+    }
+  }
+  free(scratch);
+  return num_failures;
+}
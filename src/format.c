@@ -0,0 +1,173 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "chemfp.h"
+
+/* Write search results in the simsearch output format:
+
+     <num_hits> TAB <query_id> ( TAB <target_id> TAB <score> )* NEWLINE
+
+   The target ids are in one block of text, with an offset table like
+   the Python IdStore: id i is data[offsets[i]:offsets[i+1]-1]. The
+   offsets are 4 or 8 byte unsigned integers in native byte order.
+
+   Most of the time goes into formatting the scores. There are only a
+   few distinct score values (for Tanimoto, at most one per pair of
+   popcounts), so the formatted text is kept in a small hash table. */
+
+#define SCORE_CACHE_SIZE 1024
+#define MAX_SCORE_SIZE 32
+
+typedef struct {
+  double score;
+  int len;
+  char text[MAX_SCORE_SIZE];
+} cached_score;
+
+typedef struct {
+  char *data;
+  size_t size;
+  size_t allocated;
+} output_buffer;
+
+static int reserve(output_buffer *buffer, size_t n) {
+  size_t new_allocated;
+  char *data;
+  if (buffer->size + n <= buffer->allocated) {
+    return 1;
+  }
+  new_allocated = buffer->allocated + (buffer->allocated >> 1) + n + 4096;
+  data = (char *) realloc(buffer->data, new_allocated);
+  if (data == NULL) {
+    return 0;
+  }
+  buffer->data = data;
+  buffer->allocated = new_allocated;
+  return 1;
+}
+
+static char *write_int(char *p, int value) {
+  char digits[16];
+  int n = 0;
+  unsigned int v = (value < 0) ? (unsigned int) -value : (unsigned int) value;
+  if (value < 0) {
+    *p++ = '-';
+  }
+  do {
+    digits[n++] = (char) ('0' + (v % 10));
+    v /= 10;
+  } while (v);
+  while (n) {
+    *p++ = digits[--n];
+  }
+  return p;
+}
+
+static unsigned int hash_score(double score) {
+  uint64_t bits;
+  memcpy(&bits, &score, sizeof(bits));
+  bits ^= bits >> 29;
+  bits *= (uint64_t) 0xbf58476d1ce4e5b9ULL;
+  return (unsigned int) (bits >> 54) & (SCORE_CACHE_SIZE-1);
+}
+
+static const cached_score *format_score(cached_score *cache, int num_digits, double score) {
+  cached_score *entry = cache + hash_score(score);
+  if (entry->len == 0 || memcmp(&entry->score, &score, sizeof(double)) != 0) {
+    entry->score = score;
+    entry->len = snprintf(entry->text, MAX_SCORE_SIZE, "%.*f", num_digits, score);
+    if (entry->len < 0 || entry->len >= MAX_SCORE_SIZE) {
+      /* Can't happen for scores between 0 and 1 */
+      entry->len = snprintf(entry->text, MAX_SCORE_SIZE, "%g", score);
+    }
+  }
+  return entry;
+}
+
+static uint64_t get_offset(const void *offsets, int offset_size, int i) {
+  if (offset_size == 4) {
+    return ((const uint32_t *) offsets)[i];
+  }
+  return ((const uint64_t *) offsets)[i];
+}
+
+int chemfp_format_hits(int num_rows, const chemfp_search_result *results,
+                       const char * const *query_ids, const int *query_id_lens,
+                       const char *target_id_data, size_t target_id_data_size,
+                       const void *target_id_offsets, int offset_size, int num_target_ids,
+                       int num_digits, char **output, size_t *output_size) {
+  output_buffer buffer = {NULL, 0, 0};
+  cached_score *cache;
+  const cached_score *score_text;
+  const chemfp_search_result *result;
+  uint64_t id_start, id_end;
+  size_t id_len;
+  int row, i, target_index;
+  char *p;
+  int retval = CHEMFP_OK;
+
+  if ((offset_size != 4 && offset_size != 8) || num_digits < 0 || num_digits > 20) {
+    return CHEMFP_BAD_ARG;
+  }
+  cache = (cached_score *) calloc(SCORE_CACHE_SIZE, sizeof(cached_score));
+  if (cache == NULL) {
+    return CHEMFP_NO_MEM;
+  }
+
+  for (row = 0; row < num_rows; row++) {
+    result = results + row;
+    /* count, tab, query id, and the newline if there are no hits */
+    if (!reserve(&buffer, 16 + query_id_lens[row])) {
+      retval = CHEMFP_NO_MEM;
+      goto done;
+    }
+    p = buffer.data + buffer.size;
+    p = write_int(p, result->num_hits);
+    *p++ = '\t';
+    memcpy(p, query_ids[row], query_id_lens[row]);
+    p += query_id_lens[row];
+    buffer.size = p - buffer.data;
+
+    for (i = 0; i < result->num_hits; i++) {
+      target_index = result->indices[i];
+      if (target_index < 0 || target_index >= num_target_ids) {
+        retval = CHEMFP_BAD_ARG;
+        goto done;
+      }
+      id_start = get_offset(target_id_offsets, offset_size, target_index);
+      id_end = get_offset(target_id_offsets, offset_size, target_index+1);
+      if (id_end <= id_start || id_end > target_id_data_size) {
+        retval = CHEMFP_BAD_ARG;
+        goto done;
+      }
+      id_len = (size_t) (id_end - id_start - 1);  /* don't include the newline */
+      score_text = format_score(cache, num_digits, chemfp_get_score(result, i));
+
+      /* two tabs, the id, the score, and room for the final newline */
+      if (!reserve(&buffer, 3 + id_len + score_text->len)) {
+        retval = CHEMFP_NO_MEM;
+        goto done;
+      }
+      p = buffer.data + buffer.size;
+      *p++ = '\t';
+      memcpy(p, target_id_data + id_start, id_len);
+      p += id_len;
+      *p++ = '\t';
+      memcpy(p, score_text->text, score_text->len);
+      p += score_text->len;
+      buffer.size = p - buffer.data;
+    }
+    buffer.data[buffer.size++] = '\n';
+  }
+
+ done:
+  free(cache);
+  if (retval != CHEMFP_OK) {
+    free(buffer.data);
+    return retval;
+  }
+  *output = buffer.data;
+  *output_size = buffer.size;
+  return CHEMFP_OK;
+}
@@ -345,6 +345,7 @@ int chemfp_fps_knearest_tanimoto_search_feed(
             retval = CHEMFP_NO_MEM;
             goto finish;
           }
+          heap->indices[heap->size] = knearest_search->num_targets_processed + num_added;
           heap->ids[heap->size] = s;
           heap->size++;
         }
@@ -365,6 +366,7 @@ int chemfp_fps_knearest_tanimoto_search_feed(
             retval = CHEMFP_NO_MEM;
             goto finish;
           }
+          heap->indices[0] = knearest_search->num_targets_processed + num_added;
           heap->ids[0] = s;
           chemfp_heapq_siftup(k, (void *) heap, 0,
                               (chemfp_heapq_lt) fps_heap_lt,
@@ -412,3 +414,267 @@ void chemfp_fps_knearest_search_finish(chemfp_fps_knearest_search *knearest_sear
                           (chemfp_heapq_lt) fps_heap_lt, (chemfp_heapq_swap) fps_heap_swap);
   }
 }
+
+
+/****** Searches using a similarity measure other than Tanimoto ********/
+
+/* These are the same as the Tanimoto versions, except the score comes
+   from chemfp_metric_score() and the query popcounts are computed once
+   for each block. */
+
+static int *fps_query_popcounts(int fp_size, int query_storage_size,
+                                const unsigned char *query_arena,
+                                int query_start, int query_end) {
+  int *popcounts, query_index;
+  if (query_end <= query_start) {
+    return (int *) malloc(sizeof(int));
+  }
+  popcounts = (int *) malloc((query_end - query_start) * sizeof(int));
+  if (!popcounts) {
+    return NULL;
+  }
+  for (query_index=query_start; query_index<query_end; query_index++) {
+    popcounts[query_index-query_start] = chemfp_byte_popcount(
+                     fp_size, query_arena + query_index * query_storage_size);
+  }
+  return popcounts;
+}
+
+/* Return the score, or -1.0 if the hex fingerprint is not valid */
+static double fps_metric_score(const chemfp_metric *metric, int num_bits, int fp_size,
+                               const unsigned char *query_fp, int query_popcount,
+                               const char *line) {
+  int target_popcount, intersect_popcount;
+  intersect_popcount = chemfp_byte_hex_intersect_popcount(fp_size, query_fp, line,
+                                                          &target_popcount);
+  if (intersect_popcount < 0) {
+    return -1.0;
+  }
+  return chemfp_metric_score(metric, num_bits, query_popcount, target_popcount,
+                             intersect_popcount);
+}
+
+int chemfp_fps_count_metric_hits(
+        const chemfp_metric *metric,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double threshold,
+        int *counts, int *num_lines_processed) {
+  const unsigned char *query_fp;
+  const char *line, *next_line, *end;
+  int fp_size = (num_bits+7)/8;
+  int num_lines = 0, query_index;
+  const char *id_start, *id_end;
+  int err;
+  int *query_popcounts = NULL;
+  double score;
+
+  end = target_block + target_block_end;
+  if (target_block_end == 0 || end[-1] != '\n') {
+    err = CHEMFP_MISSING_NEWLINE;
+    goto finish;
+  }
+  query_popcounts = fps_query_popcounts(fp_size, query_storage_size, query_arena,
+                                        query_start, query_end);
+  if (!query_popcounts) {
+    err = CHEMFP_NO_MEM;
+    goto finish;
+  }
+  line = target_block;
+  while (line < end) {
+    err = chemfp_fps_find_id(fp_size*2, line, &id_start, &id_end);
+    if (err < 0)
+      goto finish;
+    next_line = chemfp_to_next_line(id_end);
+
+    query_fp = query_arena + query_start * query_storage_size;
+    for (query_index=query_start; query_index<query_end;
+         query_index++, query_fp += query_storage_size) {
+      score = fps_metric_score(metric, num_bits, fp_size, query_fp,
+                               query_popcounts[query_index-query_start], line);
+      if (score >= threshold)
+        counts[query_index]++;
+    }
+    num_lines++;
+    line = next_line;
+  }
+  err = CHEMFP_OK;
+ finish:
+  free(query_popcounts);
+  *num_lines_processed = num_lines;
+  return err;
+}
+
+int chemfp_fps_threshold_metric_search(
+        const chemfp_metric *metric,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double threshold,
+        int num_cells, chemfp_tanimoto_cell *cells,
+        const char ** stopped_at, int *num_lines_processed, int *num_cells_processed) {
+  const char *line = target_block;
+  const char *next_line;
+  const char *end = target_block+target_block_end;
+  const char *id_start, *id_end;
+  const unsigned char *query_fp;
+  chemfp_tanimoto_cell *current_cell;
+  double score;
+  int query_index;
+  int num_lines = 0, num_queries;
+  int err, retval;
+  int fp_size = (num_bits+7)/8;
+  int *query_popcounts = NULL;
+
+  current_cell = cells;
+  if (query_start >= query_end) {
+    retval = CHEMFP_OK;
+    goto finish;
+  }
+  num_queries = query_end - query_start;
+  if (end[-1] != '\n') {
+    retval = CHEMFP_MISSING_NEWLINE;
+    goto finish;
+  }
+  query_popcounts = fps_query_popcounts(fp_size, query_storage_size, query_arena,
+                                        query_start, query_end);
+  if (!query_popcounts) {
+    retval = CHEMFP_NO_MEM;
+    goto finish;
+  }
+
+  while (line < end) {
+    if (num_cells < num_queries) {
+      goto success;
+    }
+    err = chemfp_fps_find_id(2*fp_size, line, &id_start, &id_end);
+    if (err < 0) {
+      retval = err;
+      goto finish;
+    }
+    next_line = chemfp_to_next_line(id_end);
+
+    query_fp = query_arena + query_start * query_storage_size;
+    for (query_index=query_start; query_index<query_end;
+         query_index++, query_fp += query_storage_size) {
+      score = fps_metric_score(metric, num_bits, fp_size, query_fp,
+                               query_popcounts[query_index-query_start], line);
+      if (score >= threshold) {
+        current_cell->score = score;
+        current_cell->query_index = query_index;
+        current_cell->id_start = (int)(id_start - target_block);
+        current_cell->id_end = (int)(id_end - target_block);
+        current_cell++;
+        num_cells--;
+      }
+    }
+    line = next_line;
+    num_lines++;
+  }
+ success:
+  retval = CHEMFP_OK;
+
+ finish:
+  free(query_popcounts);
+  *stopped_at = line;
+  *num_lines_processed = num_lines;
+  *num_cells_processed = (int)(current_cell - cells);
+  return retval;
+}
+
+int chemfp_fps_knearest_metric_search_feed(
+        const chemfp_metric *metric, int num_bits,
+        chemfp_fps_knearest_search *knearest_search,
+        int target_block_len, const char *target_block) {
+  int k;
+  double score, threshold;
+  int num_added = 0;
+  char *s;
+  const char *line, *next_line, *end, *id_start, *id_end;
+  const unsigned char *query_fp;
+  chemfp_fps_heap *heap;
+  int query_hex_size, query_fp_size, query_storage_size;
+  int i, err, retval;
+  int *query_popcounts;
+
+  if (target_block_len == 0 || target_block[target_block_len-1] != '\n')
+    return CHEMFP_MISSING_NEWLINE;
+  end = target_block+target_block_len;
+
+  threshold = knearest_search->threshold;
+  k = knearest_search->k;
+  query_fp_size = knearest_search->query_fp_size;
+  query_hex_size = query_fp_size * 2;
+  query_storage_size = knearest_search->query_storage_size;
+
+  query_popcounts = fps_query_popcounts(query_fp_size, query_storage_size,
+                                        knearest_search->query_start,
+                                        0, knearest_search->num_queries);
+  if (!query_popcounts) {
+    return CHEMFP_NO_MEM;
+  }
+
+  line = target_block;
+  while (line < end) {
+    err = chemfp_fps_find_id(query_hex_size, line, &id_start, &id_end);
+    if (err < 0) {
+      retval = err;
+      goto finish;
+    }
+    next_line = chemfp_to_next_line(id_end);
+    query_fp = knearest_search->query_start;
+
+    heap = knearest_search->heaps;
+    for (i=0; i<knearest_search->num_queries; i++, query_fp += query_storage_size, heap++) {
+      if (heap->heap_state == MAXED_OUT_HEAP) {
+        continue;
+      }
+      score = fps_metric_score(metric, num_bits, query_fp_size, query_fp,
+                               query_popcounts[i], line);
+      if (heap->heap_state == ADD_TO_HEAP) {
+        if (score >= threshold) {
+          s = new_string(id_start, id_end);
+          if (!s) {
+            retval = CHEMFP_NO_MEM;
+            goto finish;
+          }
+          heap->indices[heap->size] = knearest_search->num_targets_processed + num_added;
+          heap->scores[heap->size] = score;
+          heap->ids[heap->size] = s;
+          heap->size++;
+          if (heap->size == k) {
+            chemfp_heapq_heapify(k, (void *)heap, (chemfp_heapq_lt) fps_heap_lt,
+                                 (chemfp_heapq_swap) fps_heap_swap);
+            heap->heap_state = REPLACE_IN_HEAP;
+          }
+        }
+      } else if (score > heap->scores[0]) {
+        s = new_string(id_start, id_end);
+        if (!s) {
+          retval = CHEMFP_NO_MEM;
+          goto finish;
+        }
+        free(heap->ids[0]);
+        heap->indices[0] = knearest_search->num_targets_processed + num_added;
+        heap->scores[0] = score;
+        heap->ids[0] = s;
+        chemfp_heapq_siftup(k, (void *) heap, 0,
+                            (chemfp_heapq_lt) fps_heap_lt,
+                            (chemfp_heapq_swap) fps_heap_swap);
+        if (heap->scores[0] == 1.0) {
+          heap->heap_state = MAXED_OUT_HEAP;
+        }
+      }
+    }
+    line = next_line;
+    num_added++;
+  }
+  retval = CHEMFP_OK;
+ finish:
+  free(query_popcounts);
+  knearest_search->num_targets_processed += num_added;
+  return retval;
+}
@@ -549,15 +549,30 @@ static inline void heapify(SORT_TYPE1 *dst1, SORT_TYPE2 *dst2, const size_t size
 /****************************** End of TimSort code ************************/
 
 chemfp_search_result *chemfp_alloc_search_results(int size) {
+  return chemfp_alloc_search_results_with_score_type(size, CHEMFP_SCORE_DOUBLE);
+}
+
+chemfp_search_result *chemfp_alloc_search_results_with_score_type(int size, int score_type) {
+  int i;
+  chemfp_search_result *results;
+  if (chemfp_get_score_size(score_type) == 0) {
+    return NULL;
+  }
   /* Initializes all of the counts to 0 (and makes everything else nice too) */
-  return (chemfp_search_result *) calloc(size, sizeof(chemfp_search_result));
+  results = (chemfp_search_result *) calloc(size, sizeof(chemfp_search_result));
+  if (results) {
+    for (i=0; i<size; i++) {
+      results[i].score_type = score_type;
+    }
+  }
+  return results;
 }
 
 void chemfp_free_results(int num_results, chemfp_search_result *results) {
   int i;
   for (i=0; i<num_results; i++) {
-    if (results[i].num_hits) {
-      free(results[i].scores);
+    if (results[i].num_allocated) {
+      free(results[i].indices);
     }
   }
   free(results);
@@ -567,112 +582,194 @@ int chemfp_get_num_hits(chemfp_search_result *result) {
   return result->num_hits;
 }
 
+/* The number of bytes used to store one score, or 0 for an unknown score type */
+size_t chemfp_get_score_size(int score_type) {
+  switch (score_type) {
+  case CHEMFP_SCORE_DOUBLE: return sizeof(double);
+  case CHEMFP_SCORE_FLOAT: return sizeof(float);
+  case CHEMFP_SCORE_UINT16: return sizeof(uint16_t);
+  default: return 0;
+  }
+}
+
+double chemfp_get_score(const chemfp_search_result *result, int i) {
+  switch (result->score_type) {
+  case CHEMFP_SCORE_FLOAT:
+    return ((const float *) result->scores)[i];
+  case CHEMFP_SCORE_UINT16:
+    return ((const uint16_t *) result->scores)[i] / 65535.0;
+  default:
+    return result->scores[i];
+  }
+}
+
+static void set_score(chemfp_search_result *result, int i, double score) {
+  switch (result->score_type) {
+  case CHEMFP_SCORE_FLOAT:
+    ((float *) result->scores)[i] = (float) score;
+    break;
+  case CHEMFP_SCORE_UINT16:
+    /* All of the similarity scores are between 0.0 and 1.0 */
+    if (score <= 0.0) {
+      ((uint16_t *) result->scores)[i] = 0;
+    } else if (score >= 1.0) {
+      ((uint16_t *) result->scores)[i] = 65535;
+    } else {
+      ((uint16_t *) result->scores)[i] = (uint16_t) (score * 65535.0 + 0.5);
+    }
+    break;
+  default:
+    result->scores[i] = score;
+  }
+}
+
+/* Each row has a single block of memory with the 'num_allocated'
+   indices followed by the 'num_allocated' scores. 'num_allocated' is
+   always even, so the scores are 8-byte aligned. */
+static int resize_row(chemfp_search_result *result, int num_allocated) {
+  size_t score_size = chemfp_get_score_size(result->score_type);
+  int *indices;
+  char *scores;
+
+  num_allocated += (num_allocated & 1);
+  if (num_allocated < result->num_allocated) {
+    /* Shrinking. Move the scores down before the memory goes away. */
+    memmove((char *) (result->indices + num_allocated), result->scores,
+            result->num_hits * score_size);
+  }
+  indices = (int *) realloc(result->num_allocated ? result->indices : NULL,
+                            num_allocated * (sizeof(int) + score_size));
+  if (!indices) {
+    if (num_allocated < result->num_allocated) {
+      /* The old block is still there, with the scores already moved */
+      result->num_allocated = num_allocated;
+      result->scores = (double *) (result->indices + num_allocated);
+      return 1;
+    }
+    return 0;
+  }
+  scores = (char *) (indices + num_allocated);
+  if (result->num_hits && num_allocated > result->num_allocated) {
+    /* Shift the scores to their new location */
+    memmove(scores, (char *) (indices + result->num_allocated),
+            result->num_hits * score_size);
+  }
+  result->num_allocated = num_allocated;
+  result->indices = indices;
+  result->scores = (double *) scores;
+  return 1;
+}
+
 int chemfp_add_hit(chemfp_search_result *result,
                    int target_index, double score) {
   int num_hits = result->num_hits;
   int num_allocated = result->num_allocated;
-  int *indices, *old_indices;
-  double *scores;
 
   if (num_hits == num_allocated) {
-    if (num_hits == 0) {
-      num_allocated = 6;
-      scores = (double *) malloc(num_allocated * (sizeof(int)+sizeof(double)));
-      if (!scores) {
-	return 0;
-      }
-      indices = (int *) (scores + num_allocated);
-      result->num_allocated = num_allocated;
-      result->indices = indices;
-      result->scores = scores;
+    /* Grow small rows by 50%, which keeps the number of reallocs (and
+       the score moves) down, and large rows by 12.5%, which limits the
+       unused space to a small fraction of the row. Use
+       chemfp_search_results_trim() to release the unused space. */
+    if (num_allocated == 0) {
+      num_allocated = 8;
+    } else if (num_allocated < 1024) {
+      num_allocated += (num_allocated >> 1);
     } else {
-      /* Grow by about 12% each time; this is the Python listobject resize strategy */
-      num_allocated += (num_allocated >> 3) + (num_allocated < 9 ? 3 : 6);
-      scores = (double *) realloc(result->scores, num_allocated * (sizeof(int)+sizeof(double)));
-      if (!scores) {
-	return 0;
-      }
-      /* Shift the indices to its new location */
-      old_indices = (int *) (scores + num_hits);
-      indices = (int *) (scores + num_allocated);
-      memmove(indices, old_indices, num_hits*sizeof(int));
-      result->num_allocated = num_allocated;
-      result->indices = indices;
-      result->scores = scores;
+      num_allocated += (num_allocated >> 3);
+    }
+    if (!resize_row(result, num_allocated)) {
+      return 0;
     }
-  } else {
-    indices = result->indices;
-    scores = result->scores;
   }
-  indices[num_hits] = target_index;
-  scores[num_hits] = score;
+  result->indices[num_hits] = target_index;
+  set_score(result, num_hits, score);
   result->num_hits = num_hits+1;
   return 1;
 }
 
+/* Release the memory for the allocated but unused hits in each row */
+int chemfp_search_results_trim(int num_results, chemfp_search_result *results) {
+  int i;
+  chemfp_search_result *result;
+  for (i=0; i<num_results; i++) {
+    result = results+i;
+    if (result->num_hits == 0) {
+      chemfp_search_result_clear(result);
+    } else if (result->num_allocated - result->num_hits > 1) {
+      if (!resize_row(result, result->num_hits)) {
+        return CHEMFP_NO_MEM;
+      }
+    }
+  }
+  return CHEMFP_OK;
+}
+
 int chemfp_fill_lower_triangle(int n, chemfp_search_result *results) {
-  int i, j;
-  int *sizes = (int *) malloc(n * sizeof(int));
+  return chemfp_fill_lower_triangle_tile(results, 0, n, 0, n);
+}
+
+/* For each hit (i, j) in rows [query_start, query_end) with j in
+   [target_start, target_end), add the hit (j, i) with the same score.
+   The hits for other targets are not copied. The new hits for a row
+   are appended in increasing order of i. */
+int chemfp_fill_lower_triangle_tile(chemfp_search_result *results,
+                                    int query_start, int query_end,
+                                    int target_start, int target_end) {
+  int i, j, target_index;
+  int *sizes, *counts;
   int retval;
-  int *counts = (int *) malloc(n * sizeof(int));
-  int num_hits, num_allocated;
-  double *scores;
-  int *old_indices, *indices;
   chemfp_search_result *result;
 
-  if (!sizes) {
+  if (query_start >= query_end || target_start >= target_end) {
+    return CHEMFP_OK;
+  }
+  sizes = (int *) malloc((query_end - query_start) * sizeof(int));
+  counts = (int *) calloc(target_end - target_start, sizeof(int));
+  if (!sizes || !counts) {
+    free(sizes);
+    free(counts);
     return CHEMFP_NO_MEM;
   }
   /* Save all of the count information */
-  for (i=0; i<n; i++) {
-    sizes[i] = chemfp_get_num_hits(results+i);
-    counts[i] = 0;
-  }
-  for (i=0; i<n; i++) {
-    for (j=0; j<sizes[i]; j++) {
-      counts[results[i].indices[j]]++;
+  for (i=query_start; i<query_end; i++) {
+    sizes[i-query_start] = chemfp_get_num_hits(results+i);
+  }
+  for (i=query_start; i<query_end; i++) {
+    for (j=0; j<sizes[i-query_start]; j++) {
+      target_index = results[i].indices[j];
+      if (target_start <= target_index && target_index < target_end) {
+        counts[target_index-target_start]++;
+      }
     }
   }
 
   /* Increase the sizes */
-  for (i=0; i<n; i++) {
+  retval = CHEMFP_OK;
+  for (i=target_start; i<target_end; i++) {
     result = results+i;
-    num_allocated = result->num_hits + counts[i];
-    if (result->num_hits + counts[i] > result->num_allocated) {
-      if (result->num_allocated == 0) {
-        scores = (double *) malloc(num_allocated * (sizeof(int)+sizeof(double)));
-        if (!scores) {
-          return CHEMFP_NO_MEM;
-        }
-        indices = (int *) (scores + num_allocated);
-      } else {
-        num_hits = result->num_hits;
-        scores = (double *) realloc(result->scores, num_allocated * (sizeof(int)+sizeof(double)));
-        if (!scores) {
-          return CHEMFP_NO_MEM;
-        }
-        old_indices = (int *) (scores + result->num_allocated);
-        indices = (int *) (scores + num_allocated);
-        memmove(indices, old_indices, num_hits*sizeof(int));
+    if (result->num_hits + counts[i-target_start] > result->num_allocated) {
+      if (!resize_row(result, result->num_hits + counts[i-target_start])) {
+        retval = CHEMFP_NO_MEM;
+        goto done;
       }
-      result->num_allocated = num_allocated;
-      result->indices = indices;
-      result->scores = scores;
     }
   }
 
-  retval = CHEMFP_OK;
-  for (i=0; i<n; i++) {
-    for (j=0; j<sizes[i]; j++) {
-      if (!chemfp_add_hit(results+results[i].indices[j], i, results[i].scores[j])) {
-        retval = CHEMFP_NO_MEM;
-        goto done;
+  for (i=query_start; i<query_end; i++) {
+    for (j=0; j<sizes[i-query_start]; j++) {
+      target_index = results[i].indices[j];
+      if (target_start <= target_index && target_index < target_end) {
+        if (!chemfp_add_hit(results+target_index, i, chemfp_get_score(results+i, j))) {
+          retval = CHEMFP_NO_MEM;
+          goto done;
+        }
       }
     }
   }
 
  done:
   free(sizes);
+  free(counts);
   return retval;
 }
 
@@ -802,54 +899,70 @@ static reorder_method_t *chemfp_get_reorder_method(const char *name) {
   return NULL;
 }
 
+static void reorder_scores(reorder_method_t *reorder_method, int num_hits,
+                           int *indices, double *scores) {
+  if (reorder_method->reorder) {
+    reorder_method->reorder(num_hits, indices, scores);
+  } else {
+    hits_tim_sort(indices, scores, num_hits, reorder_method->hit_compare);
+  }
+}
+
+static int reorder_result(reorder_method_t *reorder_method, chemfp_search_result *result) {
+  int i, num_hits = result->num_hits;
+  double *scores;
+  if (num_hits <= 1) {
+    return CHEMFP_OK;
+  }
+  if (result->score_type == CHEMFP_SCORE_DOUBLE) {
+    reorder_scores(reorder_method, num_hits, result->indices, result->scores);
+    return CHEMFP_OK;
+  }
+  /* Sort compact scores as doubles. The conversion back is exact. */
+  scores = (double *) malloc(num_hits * sizeof(double));
+  if (!scores) {
+    return CHEMFP_NO_MEM;
+  }
+  for (i=0; i<num_hits; i++) {
+    scores[i] = chemfp_get_score(result, i);
+  }
+  reorder_scores(reorder_method, num_hits, result->indices, scores);
+  for (i=0; i<num_hits; i++) {
+    set_score(result, i, scores[i]);
+  }
+  free(scores);
+  return CHEMFP_OK;
+}
+
 int chemfp_search_results_reorder(int num_results, chemfp_search_result *results,
                                   const char *ordering) {
-  int i, num_hits;
+  int i, errval;
   reorder_method_t *reorder_method = chemfp_get_reorder_method(ordering);
   if (reorder_method == NULL) {
     return CHEMFP_UNKNOWN_ORDERING;
   }
-  if (reorder_method->reorder) {
-    for (i=0; i<num_results; i++) {
-      num_hits = results[i].num_hits;
-      if (num_hits > 1) {
-        reorder_method->reorder(num_hits, results[i].indices, results[i].scores);
-      }
-    }
-  } else {
-    for (i=0; i<num_results; i++) {
-      num_hits = results[i].num_hits;
-      if (num_hits > 1) {
-        hits_tim_sort(results[i].indices, results[i].scores, num_hits,
-                      reorder_method->hit_compare);
-      }
+  for (i=0; i<num_results; i++) {
+    errval = reorder_result(reorder_method, results+i);
+    if (errval != CHEMFP_OK) {
+      return errval;
     }
   }
   return CHEMFP_OK;
 }
 
 int chemfp_search_result_reorder(chemfp_search_result *result, const char *ordering) {
-  int num_hits;
   reorder_method_t *reorder_method = chemfp_get_reorder_method(ordering);
   if (reorder_method == NULL) {
     return CHEMFP_UNKNOWN_ORDERING;
   }
-  num_hits = result->num_hits;
-  if (num_hits > 1) {
-    if (reorder_method->reorder) {
-      reorder_method->reorder(num_hits, result->indices, result->scores);
-    } else {
-      hits_tim_sort(result->indices, result->scores, num_hits,
-                    reorder_method->hit_compare);
-    }
-  }
-  return CHEMFP_OK;
+  return reorder_result(reorder_method, result);
 }
 
 void chemfp_search_result_clear(chemfp_search_result *result) {
-  if (result->num_hits != 0) {
-    result->num_hits=0;
-    free(result->scores);
+  if (result->num_allocated != 0) {
+    free(result->indices);
+    result->num_hits = 0;
+    result->num_allocated = 0;
     result->scores = NULL;
     result->indices = NULL;
   }
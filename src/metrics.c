@@ -0,0 +1,90 @@
+#include <math.h>
+
+#include "chemfp.h"
+
+/* Similarity measures other than Tanimoto.
+
+   Every score is computed from the query popcount A, the target
+   popcount B, the popcount of the intersection C, and the number of
+   bits N:
+
+     Tanimoto      C / (A + B - C)
+     Tversky       C / (alpha*(A-C) + beta*(B-C) + C)
+     Dice          2C / (A + B)
+     cosine        C / sqrt(A*B)
+     Hamming       1 - (A + B - 2C)/N
+     Euclidean     sqrt(1 - (A + B - 2C)/N)
+     contains      1.0 if C == A (the query is a subset of the target), else 0.0
+
+   A zero denominator gives a score of 0.0, just like Tanimoto's 0/0.
+   Hamming and Euclidean are distances, so they are turned into
+   similarities in the range 0.0 to 1.0; a Hamming distance of d is a
+   score of 1-d/N.
+
+   With A and B fixed, every score increases (or stays the same) as C
+   increases, and C is at most min(A, B). That gives the best possible
+   score for a target popcount, which is what the searches use to skip
+   popcount bins. The bound increases as B goes from 0 to A then
+   decreases after that, so the k-nearest search can visit the bins in
+   best-first order by stepping up and down from A. */
+
+int chemfp_metric_check(const chemfp_metric *metric) {
+  switch (metric->type) {
+  case CHEMFP_METRIC_TANIMOTO:
+  case CHEMFP_METRIC_DICE:
+  case CHEMFP_METRIC_COSINE:
+  case CHEMFP_METRIC_HAMMING:
+  case CHEMFP_METRIC_EUCLIDEAN:
+  case CHEMFP_METRIC_CONTAINS:
+    return CHEMFP_OK;
+  case CHEMFP_METRIC_TVERSKY:
+    if (metric->alpha < 0.0 || metric->beta < 0.0) {
+      return CHEMFP_BAD_ARG;
+    }
+    return CHEMFP_OK;
+  default:
+    return CHEMFP_BAD_ARG;
+  }
+}
+
+double chemfp_metric_score(const chemfp_metric *metric, int num_bits,
+                           int query_popcount, int target_popcount, int intersect_popcount) {
+  double denominator;
+  switch (metric->type) {
+  case CHEMFP_METRIC_TANIMOTO:
+    denominator = query_popcount + target_popcount - intersect_popcount;
+    break;
+  case CHEMFP_METRIC_TVERSKY:
+    denominator = (metric->alpha * (query_popcount - intersect_popcount) +
+                   metric->beta * (target_popcount - intersect_popcount) +
+                   intersect_popcount);
+    break;
+  case CHEMFP_METRIC_DICE:
+    if (query_popcount + target_popcount == 0) {
+      return 0.0;
+    }
+    return (2.0 * intersect_popcount) / (query_popcount + target_popcount);
+  case CHEMFP_METRIC_COSINE:
+    denominator = sqrt(((double) query_popcount) * target_popcount);
+    break;
+  case CHEMFP_METRIC_HAMMING:
+    return 1.0 - ((double)(query_popcount + target_popcount - 2*intersect_popcount)) / num_bits;
+  case CHEMFP_METRIC_EUCLIDEAN:
+    return sqrt(1.0 - ((double)(query_popcount + target_popcount - 2*intersect_popcount)) / num_bits);
+  case CHEMFP_METRIC_CONTAINS:
+    return (intersect_popcount == query_popcount) ? 1.0 : 0.0;
+  default:
+    return 0.0;
+  }
+  if (denominator == 0.0) {
+    return 0.0;
+  }
+  return intersect_popcount / denominator;
+}
+
+double chemfp_metric_best_score(const chemfp_metric *metric, int num_bits,
+                                int query_popcount, int target_popcount) {
+  int max_intersect_popcount = (query_popcount < target_popcount) ? query_popcount : target_popcount;
+  return chemfp_metric_score(metric, num_bits, query_popcount, target_popcount,
+                             max_intersect_popcount);
+}
@@ -22,9 +22,26 @@ enum {
   CHEMFP_LAURADOUX,
   CHEMFP_POPCNT,
   CHEMFP_GILLIES,
-  CHEMFP_SSSE3
+  CHEMFP_SSSE3,
+  CHEMFP_AVX2,
+  CHEMFP_AVX512
 };
 
+/* The fixed-size search kernels in search_fixed.c use the POPCNT
+   instruction, and for the larger sizes AVX-512 VPOPCNTQ, inline. */
+#if defined(__x86_64__) && defined(__GNUC__)
+  #define CHEMFP_FIXED_POPCNT
+  #if (defined(__clang__) && __clang_major__ >= 6) || \
+      (!defined(__clang__) && __GNUC__ >= 8)
+    #define CHEMFP_FIXED_AVX512
+  #endif
+#elif defined(_MSC_VER) && defined(_WIN64)
+  #define CHEMFP_FIXED_POPCNT
+  #if (_MSC_VER >= 1920)
+    #define CHEMFP_FIXED_AVX512
+  #endif
+#endif
+
 typedef int (*chemfp_method_check_f)(void);
 
 typedef struct {
@@ -69,4 +86,12 @@ int chemfp_intersect_popcount_popcnt(int size, const uint64_t *fp1, const uint64
 int chemfp_popcount_SSSE3(int, const unsigned*);
 int chemfp_intersect_popcount_SSSE3(int, const unsigned*, const unsigned*);
 int chemfp_has_ssse3(void);
+
+int chemfp_popcount_avx2(int size, const uint64_t *fp);
+int chemfp_intersect_popcount_avx2(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_has_avx2(void);
+
+int chemfp_popcount_avx512(int size, const uint64_t *fp);
+int chemfp_intersect_popcount_avx512(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_has_avx512_vpopcnt(void);
 #endif
@@ -0,0 +1,269 @@
+/*
+  AVX2 and AVX-512 popcount methods.
+
+  The AVX2 method is the Harley-Seal carry-save adder algorithm from
+  Mula W, Kurz N, and Lemire D. Faster Population Counts Using AVX2
+  Instructions. The Computer Journal 2018. It sums 16 vectors (512
+  bytes) at a time, and uses the PSHUFB nibble lookup table for the
+  remaining vectors, which is the common case for fingerprints of
+  2048 bits or less.
+
+  The AVX-512 method uses the VPOPCNTQ instruction from the
+  AVX512_VPOPCNTDQ extension.
+
+  Both methods read the fingerprint as 64-bit words, like the POPCNT
+  method, so they only need 8 byte alignment. The loads are unaligned
+  loads, and the last partial vector is done with the POPCNT
+  instruction (AVX2) or a masked load (AVX-512), so they never read
+  past the last 64-bit word.
+
+  The kernels are compiled with function-level target attributes, so
+  the rest of chemfp doesn't need AVX compiler flags and still runs on
+  older CPUs. The cpuid checks make sure the methods are only used if
+  the CPU and the operating system support them.
+*/
+
+#include "popcount.h"
+#include "cpuid.h"
+
+#if defined(__x86_64__) && defined(__GNUC__)
+  #if defined(__clang__)
+    #if (__clang_major__ >= 4)
+      #define GENERATE_AVX2
+    #endif
+    #if (__clang_major__ >= 6)
+      #define GENERATE_AVX512
+    #endif
+  #else
+    #if (__GNUC__ > 4) || (__GNUC__ == 4 && __GNUC_MINOR__ >= 9)
+      #define GENERATE_AVX2
+    #endif
+    #if (__GNUC__ >= 8)
+      #define GENERATE_AVX512
+    #endif
+  #endif
+  #define TARGET_AVX2 __attribute__((target("avx2,popcnt")))
+  #define TARGET_AVX512 __attribute__((target("avx512f,avx512vpopcntdq")))
+#elif defined(_MSC_VER) && defined(_WIN64)
+  #if (_MSC_VER >= 1900)
+    #define GENERATE_AVX2
+  #endif
+  #if (_MSC_VER >= 1920)
+    #define GENERATE_AVX512
+  #endif
+  #define TARGET_AVX2
+  #define TARGET_AVX512
+#endif
+
+#if defined(GENERATE_AVX2) || defined(GENERATE_AVX512)
+  #include <immintrin.h>
+#endif
+
+
+#if defined(GENERATE_AVX2)
+
+/* Popcount of each byte, summed into four 64-bit counts */
+TARGET_AVX2
+static __m256i popcount256(__m256i v) {
+  const __m256i lookup = _mm256_setr_epi8(
+      0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+      0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+  const __m256i low_mask = _mm256_set1_epi8(0x0f);
+  __m256i lo = _mm256_and_si256(v, low_mask);
+  __m256i hi = _mm256_and_si256(_mm256_srli_epi16(v, 4), low_mask);
+  __m256i counts = _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo),
+                                   _mm256_shuffle_epi8(lookup, hi));
+  return _mm256_sad_epu8(counts, _mm256_setzero_si256());
+}
+
+/* Carry-save adder: (h, l) = a + b + c */
+#define CSA(h, l, a, b, c) {                      \
+    __m256i u = _mm256_xor_si256(a, b);           \
+    h = _mm256_or_si256(_mm256_and_si256(a, b),   \
+                        _mm256_and_si256(u, c));  \
+    l = _mm256_xor_si256(u, c);                   \
+  }
+
+/* fp2 is NULL for a popcount, otherwise this is the intersection popcount */
+TARGET_AVX2
+static int popcount_avx2(int size, const uint64_t *fp1, const uint64_t *fp2) {
+  const __m256i *v1 = (const __m256i *) fp1;
+  const __m256i *v2 = (const __m256i *) fp2;
+  int num_words = (size + 7) / 8;
+  int num_vectors = num_words / 4;
+  int i;
+  uint64_t count;
+  __m256i total = _mm256_setzero_si256();
+  __m256i ones = _mm256_setzero_si256();
+  __m256i twos = _mm256_setzero_si256();
+  __m256i fours = _mm256_setzero_si256();
+  __m256i eights = _mm256_setzero_si256();
+  __m256i sixteens;
+  __m256i twosA, twosB, foursA, foursB, eightsA, eightsB;
+  __m256i d[16];
+  int j;
+
+  for (i = 0; i + 16 <= num_vectors; i += 16) {
+    if (fp2 == NULL) {
+      for (j = 0; j < 16; j++) {
+        d[j] = _mm256_loadu_si256(v1 + i + j);
+      }
+    } else {
+      for (j = 0; j < 16; j++) {
+        d[j] = _mm256_and_si256(_mm256_loadu_si256(v1 + i + j),
+                                _mm256_loadu_si256(v2 + i + j));
+      }
+    }
+    CSA(twosA, ones, ones, d[0], d[1]);
+    CSA(twosB, ones, ones, d[2], d[3]);
+    CSA(foursA, twos, twos, twosA, twosB);
+    CSA(twosA, ones, ones, d[4], d[5]);
+    CSA(twosB, ones, ones, d[6], d[7]);
+    CSA(foursB, twos, twos, twosA, twosB);
+    CSA(eightsA, fours, fours, foursA, foursB);
+    CSA(twosA, ones, ones, d[8], d[9]);
+    CSA(twosB, ones, ones, d[10], d[11]);
+    CSA(foursA, twos, twos, twosA, twosB);
+    CSA(twosA, ones, ones, d[12], d[13]);
+    CSA(twosB, ones, ones, d[14], d[15]);
+    CSA(foursB, twos, twos, twosA, twosB);
+    CSA(eightsB, fours, fours, foursA, foursB);
+    CSA(sixteens, eights, eights, eightsA, eightsB);
+
+    total = _mm256_add_epi64(total, popcount256(sixteens));
+  }
+  total = _mm256_slli_epi64(total, 4);
+  total = _mm256_add_epi64(total, _mm256_slli_epi64(popcount256(eights), 3));
+  total = _mm256_add_epi64(total, _mm256_slli_epi64(popcount256(fours), 2));
+  total = _mm256_add_epi64(total, _mm256_slli_epi64(popcount256(twos), 1));
+  total = _mm256_add_epi64(total, popcount256(ones));
+
+  for (; i < num_vectors; i++) {
+    if (fp2 == NULL) {
+      total = _mm256_add_epi64(total, popcount256(_mm256_loadu_si256(v1 + i)));
+    } else {
+      total = _mm256_add_epi64(total, popcount256(
+                 _mm256_and_si256(_mm256_loadu_si256(v1 + i), _mm256_loadu_si256(v2 + i))));
+    }
+  }
+
+  count = ((uint64_t) _mm256_extract_epi64(total, 0) +
+           (uint64_t) _mm256_extract_epi64(total, 1) +
+           (uint64_t) _mm256_extract_epi64(total, 2) +
+           (uint64_t) _mm256_extract_epi64(total, 3));
+
+  /* The last 0 to 3 words */
+  for (i = num_vectors * 4; i < num_words; i++) {
+    if (fp2 == NULL) {
+      count += _mm_popcnt_u64(fp1[i]);
+    } else {
+      count += _mm_popcnt_u64(fp1[i] & fp2[i]);
+    }
+  }
+  return (int) count;
+}
+
+#endif /* GENERATE_AVX2 */
+
+
+#if defined(GENERATE_AVX512)
+
+TARGET_AVX512
+static int popcount_avx512(int size, const uint64_t *fp1, const uint64_t *fp2) {
+  int num_words = (size + 7) / 8;
+  int i;
+  __mmask8 mask;
+  __m512i v;
+  __m512i total = _mm512_setzero_si512();
+
+  for (i = 0; i + 8 <= num_words; i += 8) {
+    v = _mm512_loadu_si512((const void *) (fp1 + i));
+    if (fp2 != NULL) {
+      v = _mm512_and_si512(v, _mm512_loadu_si512((const void *) (fp2 + i)));
+    }
+    total = _mm512_add_epi64(total, _mm512_popcnt_epi64(v));
+  }
+  if (i < num_words) {
+    /* The masked-off words are not read */
+    mask = (__mmask8) ((1u << (num_words - i)) - 1);
+    v = _mm512_maskz_loadu_epi64(mask, (const void *) (fp1 + i));
+    if (fp2 != NULL) {
+      v = _mm512_and_si512(v, _mm512_maskz_loadu_epi64(mask, (const void *) (fp2 + i)));
+    }
+    total = _mm512_add_epi64(total, _mm512_popcnt_epi64(v));
+  }
+  return (int) _mm512_reduce_add_epi64(total);
+}
+
+#endif /* GENERATE_AVX512 */
+
+
+/**
+ * Count the number of bits set in a fingerprint using AVX2.
+ * @warning  Use chemfp_has_avx2() to test if the CPU supports AVX2.
+ */
+int chemfp_popcount_avx2(int size, const uint64_t *fp) {
+#if defined(GENERATE_AVX2)
+  return popcount_avx2(size, fp, NULL);
+#else
+  UNUSED(size);
+  UNUSED(fp);
+  return 0;
+#endif
+}
+
+int chemfp_intersect_popcount_avx2(int size, const uint64_t *fp1, const uint64_t *fp2) {
+#if defined(GENERATE_AVX2)
+  return popcount_avx2(size, fp1, fp2);
+#else
+  UNUSED(size);
+  UNUSED(fp1);
+  UNUSED(fp2);
+  return 0;
+#endif
+}
+
+/**
+ * Count the number of bits set in a fingerprint using AVX-512 VPOPCNTQ.
+ * @warning  Use chemfp_has_avx512_vpopcnt() to test if the CPU supports it.
+ */
+int chemfp_popcount_avx512(int size, const uint64_t *fp) {
+#if defined(GENERATE_AVX512)
+  return popcount_avx512(size, fp, NULL);
+#else
+  UNUSED(size);
+  UNUSED(fp);
+  return 0;
+#endif
+}
+
+int chemfp_intersect_popcount_avx512(int size, const uint64_t *fp1, const uint64_t *fp2) {
+#if defined(GENERATE_AVX512)
+  return popcount_avx512(size, fp1, fp2);
+#else
+  UNUSED(size);
+  UNUSED(fp1);
+  UNUSED(fp2);
+  return 0;
+#endif
+}
+
+int chemfp_has_avx2(void) {
+#if defined(GENERATE_AVX2)
+  /* Every AVX2 processor also has POPCNT, but check anyway */
+  return ((get_cpuid_ext_flags() & bit_AVX2) &&
+          (get_cpuid_flags() & bit_POPCNT));
+#else
+  (void)(get_cpuid_flags); /* suppress compiler warning */
+  return 0;
+#endif
+}
+
+int chemfp_has_avx512_vpopcnt(void) {
+#if defined(GENERATE_AVX512)
+  return ((get_cpuid_ext_flags() & (bit_AVX512F | bit_AVX512_VPOPCNTDQ)) ==
+          (bit_AVX512F | bit_AVX512_VPOPCNTDQ));
+#else
+  return 0;
+#endif
+}
@@ -1,5 +1,7 @@
 #include "pysearch_results.h"
 #include "structmember.h"
+#include <limits.h>
+#include <string.h>
 
 #include "chemfp_internal.h"
 
@@ -13,8 +15,40 @@ SearchResults_traverse(SearchResults *self, visitproc visit, void *arg) {
   return 0;
 }
 
+/* The searches release the GIL while they add hits to the rows, and
+   another Python thread must not change or read the rows until they
+   are done. */
+static int
+check_in_use(SearchResults *self) {
+  if (self->in_use) {
+    PyErr_SetString(PyExc_RuntimeError, "SearchResults is in use by another thread");
+    return 1;
+  }
+  return 0;
+}
+
+/* numpy and other buffer users may hold pointers directly into the
+   rows (see SearchResults_get_row_buffers). Anything which adds or
+   removes hits, and might reallocate a row, must check that there are
+   no live views. Reordering a row in-place is allowed. */
+int
+chemfp_py_check_no_exports(SearchResults *self) {
+  if (self->num_exports) {
+    PyErr_SetString(PyExc_BufferError,
+                    "SearchResults cannot be changed while there are exported row arrays");
+    return 1;
+  }
+  return 0;
+}
+
 static int
 SearchResults_clear_memory(SearchResults *self) {
+  if (self->num_exports) {
+    /* Called by the garbage collector to break a cycle. Keep the rows
+       for the row buffers which still point to them. */
+    Py_CLEAR(self->target_ids);
+    return 0;
+  }
   if (self->results) {
     chemfp_free_results(self->num_results, self->results);
     self->results = NULL;
@@ -41,39 +75,71 @@ SearchResults_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
     }
     self->num_results = 0;
     self->results = NULL;
+    self->in_use = 0;
+    self->num_exports = 0;
+    self->score_type = CHEMFP_SCORE_DOUBLE;
     Py_INCREF(Py_None);
     self->target_ids = Py_None;
     return (PyObject *)self;
 }
 
+static const char *score_type_names[] = {"double", "float", "uint16"};
+
+static int
+get_score_type(const char *name) {
+  int score_type;
+  for (score_type=CHEMFP_SCORE_DOUBLE; score_type<=CHEMFP_SCORE_UINT16; score_type++) {
+    if (!strcmp(name, score_type_names[score_type])) {
+      return score_type;
+    }
+  }
+  PyErr_Format(PyExc_ValueError,
+               "score_type must be 'double', 'float', or 'uint16', not '%.100s'", name);
+  return -1;
+}
+
 static int
 SearchResults_init(SearchResults *self, PyObject *args, PyObject *kwds)
 {
   int num_results=0;
   PyObject *target_ids=Py_None;
+  const char *score_type_name = "double";
+  int score_type;
   chemfp_search_result *results;
 
-  static char *kwlist[] = {"num_results", "target_ids", NULL};
+  static char *kwlist[] = {"num_results", "target_ids", "score_type", NULL};
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|O", kwlist, &num_results, &target_ids)) {
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|Os", kwlist,
+                                   &num_results, &target_ids, &score_type_name)) {
     return -1;
   }
   if (num_results < 0) {
     PyErr_SetString(PyExc_ValueError, "num_results must be non-negative");
     return -1;
   }
+  score_type = get_score_type(score_type_name);
+  if (score_type < 0) {
+    return -1;
+  }
+  if (check_in_use(self) || chemfp_py_check_no_exports(self)) {
+    return -1;
+  }
   if (num_results == 0) {
     results = NULL;
   } else {
-    results = chemfp_alloc_search_results(num_results);
+    results = chemfp_alloc_search_results_with_score_type(num_results, score_type);
     if (!results) {
       PyErr_NoMemory();
       return -1;
     }
   }
 
+  if (self->results) {
+    chemfp_free_results(self->num_results, self->results);
+  }
   self->num_results = num_results;
   self->results = results;
+  self->score_type = score_type;
 
   Py_XINCREF(target_ids);
   Py_XDECREF(self->target_ids);
@@ -114,7 +180,14 @@ SearchResults_reorder_all(SearchResults *self, PyObject *args, PyObject *kwds) {
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "|s:reorder_all", kwlist, &ordering)) {
     return NULL;
   }
+  if (check_in_use(self)) {
+    return NULL;
+  }
+  self->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
   errval = chemfp_search_results_reorder(self->num_results, self->results, ordering);
+  Py_END_ALLOW_THREADS;
+  self->in_use--;
   if (errval) {
     PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
     return NULL;
@@ -131,7 +204,7 @@ SearchResults_reorder_row(SearchResults *self, PyObject *args, PyObject *kwds) {
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|s:reorder_row", kwlist, &row, &ordering)) {
     return NULL;
   }
-  if (!check_row(self->num_results, &row)) {
+  if (check_in_use(self) || !check_row(self->num_results, &row)) {
     return NULL;
   }
   errval = chemfp_search_result_reorder(self->results+row, ordering);
@@ -146,9 +219,33 @@ SearchResults_reorder_row(SearchResults *self, PyObject *args, PyObject *kwds) {
 static PyObject *
 SearchResults_clear_all(SearchResults *self) {
   int i;
+  if (check_in_use(self) || chemfp_py_check_no_exports(self)) {
+    return NULL;
+  }
+  self->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
   for (i=0; i<self->num_results; i++) {
     chemfp_search_result_clear(self->results+i);
   }
+  Py_END_ALLOW_THREADS;
+  self->in_use--;
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+SearchResults_trim(SearchResults *self) {
+  int errval;
+  if (check_in_use(self) || chemfp_py_check_no_exports(self)) {
+    return NULL;
+  }
+  self->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_search_results_trim(self->num_results, self->results);
+  Py_END_ALLOW_THREADS;
+  self->in_use--;
+  if (errval) {
+    return PyErr_NoMemory();
+  }
   Py_RETURN_NONE;
 }
 
@@ -159,7 +256,8 @@ SearchResults_clear_row(SearchResults *self, PyObject *args, PyObject *kwds) {
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:clear", kwlist, &row)) {
     return NULL;
   }
-  if (!check_row(self->num_results, &row)) {
+  if (check_in_use(self) || chemfp_py_check_no_exports(self) ||
+      !check_row(self->num_results, &row)) {
     return NULL;
   }
   chemfp_search_result_clear(self->results+row);
@@ -177,7 +275,7 @@ SearchResults_get_indices_and_scores(SearchResults *self, PyObject *args, PyObje
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:get_indices", kwlist, &row)) {
     return NULL;
   }
-  if (!check_row(self->num_results, &row)) {
+  if (check_in_use(self) || !check_row(self->num_results, &row)) {
     return NULL;
   }
   result = self->results+row;
@@ -188,7 +286,7 @@ SearchResults_get_indices_and_scores(SearchResults *self, PyObject *args, PyObje
     return NULL;
   }
   for (i=0; i<n; i++) {
-    obj = Py_BuildValue("(id)", result->indices[i], result->scores[i]);
+    obj = Py_BuildValue("(id)", result->indices[i], chemfp_get_score(result, i));
     if (!obj) {
       goto error;
     }
@@ -269,7 +367,7 @@ SearchResults_get_indices(SearchResults *self, PyObject *args, PyObject *kwds) {
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:get_indices", kwlist, &row)) {
     return NULL;
   }
-  if (!check_row(self->num_results, &row)) {
+  if (check_in_use(self) || !check_row(self->num_results, &row)) {
     return NULL;
   }
   return data_blob_to_array(chemfp_get_num_hits(self->results+row),
@@ -280,16 +378,31 @@ SearchResults_get_indices(SearchResults *self, PyObject *args, PyObject *kwds) {
 static PyObject *
 SearchResults_get_scores(SearchResults *self, PyObject *args, PyObject *kwds) {
   static char *kwlist[] = {"row", NULL};
-  int row;
+  int row, num_hits, i;
+  chemfp_search_result *result;
+  double *scores;
+  PyObject *array;
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:get_scores", kwlist, &row)) {
     return NULL;
   }
-  if (!check_row(self->num_results, &row)) {
+  if (check_in_use(self) || !check_row(self->num_results, &row)) {
     return NULL;
   }
-  return data_blob_to_array(chemfp_get_num_hits(self->results+row),
-                            self->results[row].scores,
-                            "d", sizeof(double));
+  result = self->results+row;
+  num_hits = chemfp_get_num_hits(result);
+  if (result->score_type == CHEMFP_SCORE_DOUBLE || !num_hits) {
+    return data_blob_to_array(num_hits, result->scores, "d", sizeof(double));
+  }
+  scores = (double *) malloc(num_hits * sizeof(double));
+  if (!scores) {
+    return PyErr_NoMemory();
+  }
+  for (i=0; i<num_hits; i++) {
+    scores[i] = chemfp_get_score(result, i);
+  }
+  array = data_blob_to_array(num_hits, scores, "d", sizeof(double));
+  free(scores);
+  return array;
 }
 
 static PyObject *
@@ -299,7 +412,7 @@ SearchResults_size(SearchResults *self, PyObject *args, PyObject *kwds) {
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:size", kwlist, &row)) {
     return NULL;
   }
-  if (!check_row(self->num_results, &row)) {
+  if (check_in_use(self) || !check_row(self->num_results, &row)) {
     return NULL;
   }
   return PyInt_FromLong(chemfp_get_num_hits(self->results+row));
@@ -315,16 +428,229 @@ SearchResults_add_hit(SearchResults *self, PyObject *args, PyObject *kwds) {
                                    &row, &column, &score)) {
     return NULL;
   }
-  if (!check_row(self->num_results, &row)) {
+  if (check_in_use(self) || chemfp_py_check_no_exports(self) ||
+      !check_row(self->num_results, &row)) {
     return NULL;
   }
   return PyInt_FromLong(chemfp_add_hit(self->results+row, column, score));
   Py_RETURN_NONE;
 }
 
+/************ Zero-copy access to the rows ***************/
+
+/* A read-only buffer on the indices or scores of one row. It keeps a
+   reference to the SearchResults and counts as an export, so the row
+   memory stays valid and unchanged for as long as the buffer exists.
+   This is what numpy.frombuffer() uses to make a view of a row. */
+
+typedef struct {
+  PyObject_HEAD
+  SearchResults *owner;
+  void *data;
+  Py_ssize_t size;
+} RowBuffer;
+
+static PyObject *
+new_row_buffer(SearchResults *owner, void *data, Py_ssize_t size) {
+  static char empty[1] = {0};
+  RowBuffer *buffer = PyObject_New(RowBuffer, &chemfp_py_RowBufferType);
+  if (!buffer) {
+    return NULL;
+  }
+  Py_INCREF(owner);
+  owner->num_exports++;
+  buffer->owner = owner;
+  /* An empty row may not have any memory allocated */
+  buffer->data = (size ? data : empty);
+  buffer->size = size;
+  return (PyObject *) buffer;
+}
+
+static void
+RowBuffer_dealloc(RowBuffer *self) {
+  self->owner->num_exports--;
+  Py_DECREF(self->owner);
+  PyObject_Del(self);
+}
+
+static Py_ssize_t
+RowBuffer_getreadbuffer(RowBuffer *self, Py_ssize_t segment, void **ptrptr) {
+  if (segment != 0) {
+    PyErr_SetString(PyExc_SystemError, "accessing non-existent buffer segment");
+    return -1;
+  }
+  *ptrptr = self->data;
+  return self->size;
+}
+
+static Py_ssize_t
+RowBuffer_getsegcount(RowBuffer *self, Py_ssize_t *lenp) {
+  if (lenp) {
+    *lenp = self->size;
+  }
+  return 1;
+}
+
+static int
+RowBuffer_getbuffer(RowBuffer *self, Py_buffer *view, int flags) {
+  return PyBuffer_FillInfo(view, (PyObject *) self, self->data, self->size, 1, flags);
+}
+
+static Py_ssize_t
+RowBuffer_length(RowBuffer *self) {
+  return self->size;
+}
+
+static PyBufferProcs RowBuffer_as_buffer = {
+  (readbufferproc) RowBuffer_getreadbuffer,   /* bf_getreadbuffer */
+  0,                                          /* bf_getwritebuffer */
+  (segcountproc) RowBuffer_getsegcount,       /* bf_getsegcount */
+  0,                                          /* bf_getcharbuffer */
+  (getbufferproc) RowBuffer_getbuffer,        /* bf_getbuffer */
+  0,                                          /* bf_releasebuffer */
+};
+
+static PySequenceMethods RowBuffer_as_sequence = {
+  (lenfunc) RowBuffer_length,                 /* sq_length */
+};
+
+PyTypeObject chemfp_py_RowBufferType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "chemfp.search.RowBuffer", /*tp_name*/
+    sizeof(RowBuffer),         /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor) RowBuffer_dealloc,  /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    &RowBuffer_as_sequence,    /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    &RowBuffer_as_buffer,      /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER, /*tp_flags*/
+    "read-only view of the indices or scores of a search result row", /* tp_doc */
+};
+
+static PyObject *
+SearchResults_get_row_buffers(SearchResults *self, PyObject *args, PyObject *kwds) {
+  static char *kwlist[] = {"row", NULL};
+  int row, num_hits;
+  PyObject *indices, *scores, *buffers;
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:_get_row_buffers", kwlist, &row)) {
+    return NULL;
+  }
+  if (check_in_use(self) || !check_row(self->num_results, &row)) {
+    return NULL;
+  }
+  num_hits = chemfp_get_num_hits(self->results+row);
+  indices = new_row_buffer(self, self->results[row].indices, num_hits * sizeof(int));
+  if (!indices) {
+    return NULL;
+  }
+  scores = new_row_buffer(self, self->results[row].scores,
+                          num_hits * chemfp_get_score_size(self->score_type));
+  if (!scores) {
+    Py_DECREF(indices);
+    return NULL;
+  }
+  buffers = PyTuple_Pack(2, indices, scores);
+  Py_DECREF(indices);
+  Py_DECREF(scores);
+  return buffers;
+}
+
+/* The total number of hits in all of the rows */
+static PyObject *
+SearchResults_get_total_size(SearchResults *self) {
+  long total = 0;
+  int i;
+  if (check_in_use(self)) {
+    return NULL;
+  }
+  for (i=0; i<self->num_results; i++) {
+    total += chemfp_get_num_hits(self->results+i);
+  }
+  return PyInt_FromLong(total);
+}
+
+/* Copy all of the hits into the three arrays of a compressed sparse
+   row matrix: 'indptr' (num_results+1 ints), and 'indices' (ints) and
+   'data' (floats for "float" scores, otherwise doubles) with one
+   element for each hit. */
+static PyObject *
+SearchResults_fill_csr(SearchResults *self, PyObject *args, PyObject *kwds) {
+  static char *kwlist[] = {"indptr", "indices", "data", NULL};
+  int *indptr, *indices;
+  char *data;
+  int indptr_size, indices_size, data_size;
+  long total = 0;
+  int i, j, num_hits, offset;
+  /* Quantized scores are exported as doubles */
+  size_t data_item_size = (self->score_type == CHEMFP_SCORE_UINT16 ? sizeof(double)
+                           : chemfp_get_score_size(self->score_type));
+  chemfp_search_result *result;
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "w#w#w#:_fill_csr", kwlist,
+                                   &indptr, &indptr_size, &indices, &indices_size,
+                                   &data, &data_size)) {
+    return NULL;
+  }
+  if (check_in_use(self)) {
+    return NULL;
+  }
+  for (i=0; i<self->num_results; i++) {
+    total += chemfp_get_num_hits(self->results+i);
+  }
+  if (indptr_size != (int) ((self->num_results+1) * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "indptr must have one more integer than the number of rows");
+    return NULL;
+  }
+  if (total > (long) (INT_MAX / sizeof(double))) {
+    PyErr_SetString(PyExc_ValueError, "too many hits to export as a sparse matrix");
+    return NULL;
+  }
+  if ((long) indices_size != (long) (total * sizeof(int)) ||
+      (long) data_size != (long) (total * data_item_size)) {
+    PyErr_SetString(PyExc_ValueError, "indices and data must have one element for each hit");
+    return NULL;
+  }
+  self->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  offset = 0;
+  for (i=0; i<self->num_results; i++) {
+    result = self->results+i;
+    num_hits = chemfp_get_num_hits(result);
+    indptr[i] = offset;
+    if (num_hits) {
+      memcpy(indices+offset, result->indices, num_hits * sizeof(int));
+      if (self->score_type == CHEMFP_SCORE_UINT16) {
+        for (j=0; j<num_hits; j++) {
+          ((double *) data)[offset+j] = chemfp_get_score(result, j);
+        }
+      } else {
+        memcpy(data+offset*data_item_size, result->scores, num_hits * data_item_size);
+      }
+    }
+    offset += num_hits;
+  }
+  indptr[self->num_results] = offset;
+  Py_END_ALLOW_THREADS;
+  self->in_use--;
+  Py_RETURN_NONE;
+}
+
 static PyMethodDef SearchResults_methods[] = {
   {"clear_all", (PyCFunction) SearchResults_clear_all, METH_VARARGS | METH_KEYWORDS,
    "clear the hits in-place"},
+  {"trim", (PyCFunction) SearchResults_trim, METH_NOARGS,
+   "release the memory reserved for hits which were never added"},
   {"_clear_row", (PyCFunction) SearchResults_clear_row, METH_VARARGS | METH_KEYWORDS,
    "clear the hits in-place"},
   {"_get_indices", (PyCFunction) SearchResults_get_indices, METH_VARARGS | METH_KEYWORDS,
@@ -341,10 +667,27 @@ static PyMethodDef SearchResults_methods[] = {
    "Reorder search results for a given row, in-place"},
   {"_add_hit", (PyCFunction) SearchResults_add_hit, METH_VARARGS | METH_KEYWORDS,
    "(private method) add a hit"},
+  {"_get_row_buffers", (PyCFunction) SearchResults_get_row_buffers, METH_VARARGS | METH_KEYWORDS,
+   "(private method) read-only (indices, scores) buffers for a row, without a copy"},
+  {"_get_total_size", (PyCFunction) SearchResults_get_total_size, METH_NOARGS,
+   "(private method) the total number of hits in all of the rows"},
+  {"_fill_csr", (PyCFunction) SearchResults_fill_csr, METH_VARARGS | METH_KEYWORDS,
+   "(private method) copy the hits into compressed sparse row arrays"},
   
   {NULL}
 };
 
+static PyObject *
+SearchResults_get_score_type(SearchResults *self, void *closure) {
+  return PyString_FromString(score_type_names[self->score_type]);
+}
+
+static PyGetSetDef SearchResults_getset[] = {
+  {"score_type", (getter) SearchResults_get_score_type, NULL,
+   "how the scores are stored: 'double', 'float', or 'uint16'", NULL},
+  {NULL}
+};
+
 static PyMemberDef SearchResults_members[] = {
   {"target_ids", T_OBJECT_EX, offsetof(SearchResults, target_ids), 0,
    "list of fingerprint identifiers"},
@@ -398,7 +741,7 @@ PyTypeObject chemfp_py_SearchResultsType = {
     0,		               /* tp_iternext */
     SearchResults_methods,     /* tp_methods */
     SearchResults_members,     /* tp_members */
-    0,                         /* tp_getset */
+    SearchResults_getset,      /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
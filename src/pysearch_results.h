@@ -6,6 +6,16 @@ typedef struct {
     int num_results;
     chemfp_search_result *results;
     PyObject *target_ids;
+    /* Non-zero while a C function works on the rows without the GIL */
+    int in_use;
+    /* Number of live RowBuffer views on the rows. The hits can't be
+       added, removed or reallocated while there are any. */
+    int num_exports;
+    /* One of the CHEMFP_SCORE_* storage types, the same for every row */
+    int score_type;
 } SearchResults;
 
 extern PyTypeObject chemfp_py_SearchResultsType;
+extern PyTypeObject chemfp_py_RowBufferType;
+
+int chemfp_py_check_no_exports(SearchResults *self);
@@ -24,34 +24,54 @@ strerror_(PyObject *self, PyObject *args) {
   return PyString_FromString(chemfp_strerror(err));
 }
 
+/* The fingerprint functions below are usually called with one
+   fingerprint of a few hundred bytes, where releasing and reacquiring
+   the GIL costs more than the work itself. Like hashlib, only release
+   it for larger inputs. */
+#define GIL_RELEASE_MIN_SIZE 2048
+
+#define CALL_WITHOUT_GIL(size, result, call) \
+  if ((size) >= GIL_RELEASE_MIN_SIZE) {      \
+    Py_BEGIN_ALLOW_THREADS;                  \
+    result = call;                           \
+    Py_END_ALLOW_THREADS;                    \
+  } else {                                   \
+    result = call;                           \
+  }
+
 /*************** Hex fingerprint operations  *************/
 
 static PyObject *
 hex_isvalid(PyObject *self, PyObject *args) {
   char *s;
   int len;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#:hex_isvalid", &s, &len))
     return NULL;
-  return PyInt_FromLong(chemfp_hex_isvalid(len, s));
+  CALL_WITHOUT_GIL(len, result, chemfp_hex_isvalid(len, s));
+  return PyInt_FromLong(result);
 }
 
 static PyObject *
 hex_popcount(PyObject *self, PyObject *args) {
   char *s;
   int len;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#:hex_popcount", &s, &len))
     return NULL;
-  return PyInt_FromLong(chemfp_hex_popcount(len, s));
+  CALL_WITHOUT_GIL(len, result, chemfp_hex_popcount(len, s));
+  return PyInt_FromLong(result);
 }
 
 static PyObject *
 hex_intersect_popcount(PyObject *self, PyObject *args) {
   char *s1, *s2;
   int len1, len2;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#s#:hex_intersect_popcount", &s1, &len1, &s2, &len2))
@@ -61,13 +81,15 @@ hex_intersect_popcount(PyObject *self, PyObject *args) {
                     "hex fingerprints must have the same length");
     return NULL;
   }
-  return PyInt_FromLong(chemfp_hex_intersect_popcount(len1, s1, s2));
+  CALL_WITHOUT_GIL(len1, result, chemfp_hex_intersect_popcount(len1, s1, s2));
+  return PyInt_FromLong(result);
 }
 
 static PyObject *
 hex_tanimoto(PyObject *self, PyObject *args) {
   char *s1, *s2;
   int len1, len2;
+  double result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#s#:hex_tanimoto", &s1, &len1, &s2, &len2))
@@ -77,13 +99,15 @@ hex_tanimoto(PyObject *self, PyObject *args) {
                     "hex fingerprints must have the same length");
     return NULL;
   }
-  return PyFloat_FromDouble(chemfp_hex_tanimoto(len1, s1, s2));
+  CALL_WITHOUT_GIL(len1, result, chemfp_hex_tanimoto(len1, s1, s2));
+  return PyFloat_FromDouble(result);
 }
 
 static PyObject *
 hex_contains(PyObject *self, PyObject *args) {
   char *s1, *s2;
   int len1, len2;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#s#:hex_contains", &s1, &len1, &s2, &len2))
@@ -93,7 +117,8 @@ hex_contains(PyObject *self, PyObject *args) {
                     "hex fingerprints must have the same length");
     return NULL;
   }
-  return PyInt_FromLong(chemfp_hex_contains(len1, s1, s2));
+  CALL_WITHOUT_GIL(len1, result, chemfp_hex_contains(len1, s1, s2));
+  return PyInt_FromLong(result);
 }
 
 /********* Byte fingerprint operations  *************/
@@ -102,17 +127,20 @@ static PyObject *
 byte_popcount(PyObject *self, PyObject *args) {
   unsigned char *s;
   int len;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#:byte_popcount", &s, &len))
     return NULL;
-  return PyInt_FromLong(chemfp_byte_popcount(len, s));
+  CALL_WITHOUT_GIL(len, result, chemfp_byte_popcount(len, s));
+  return PyInt_FromLong(result);
 }
 
 static PyObject *
 byte_intersect_popcount(PyObject *self, PyObject *args) {
   unsigned char *s1, *s2;
   int len1, len2;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#s#:byte_intersect_popcount", &s1, &len1, &s2, &len2))
@@ -122,13 +150,15 @@ byte_intersect_popcount(PyObject *self, PyObject *args) {
                     "byte fingerprints must have the same length");
     return NULL;
   }
-  return PyInt_FromLong(chemfp_byte_intersect_popcount(len1, s1, s2));
+  CALL_WITHOUT_GIL(len1, result, chemfp_byte_intersect_popcount(len1, s1, s2));
+  return PyInt_FromLong(result);
 }
 
 static PyObject *
 byte_tanimoto(PyObject *self, PyObject *args) {
   unsigned char *s1, *s2;
   int len1, len2;
+  double result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#s#:byte_tanimoto", &s1, &len1, &s2, &len2))
@@ -138,13 +168,15 @@ byte_tanimoto(PyObject *self, PyObject *args) {
                     "byte fingerprints must have the same length");
     return NULL;
   }
-  return PyFloat_FromDouble(chemfp_byte_tanimoto(len1, s1, s2));
+  CALL_WITHOUT_GIL(len1, result, chemfp_byte_tanimoto(len1, s1, s2));
+  return PyFloat_FromDouble(result);
 }
 
 static PyObject *
 byte_contains(PyObject *self, PyObject *args) {
   unsigned char *s1, *s2;
   int len1, len2;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "s#s#:byte_contains", &s1, &len1, &s2, &len2))
@@ -154,7 +186,8 @@ byte_contains(PyObject *self, PyObject *args) {
                     "byte fingerprints must have the same length");
     return NULL;
   }
-  return PyInt_FromLong(chemfp_byte_contains(len1, s1, s2));
+  CALL_WITHOUT_GIL(len1, result, chemfp_byte_contains(len1, s1, s2));
+  return PyInt_FromLong(result);
 }
 
 static PyObject *
@@ -340,6 +373,31 @@ bad_results(SearchResults *results, int results_offset) {
     PyErr_SetString(PyExc_ValueError, "non-zero results_offset?");
     return 1;
   }
+  if (results->in_use) {
+    PyErr_SetString(PyExc_RuntimeError, "SearchResults is in use by another thread");
+    return 1;
+  }
+  return 0;
+}
+
+/* For the functions which add hits to the results */
+static int
+bad_results_for_update(SearchResults *results, int results_offset) {
+  return (bad_results(results, results_offset) ||
+          chemfp_py_check_no_exports(results));
+}
+
+/* The k-nearest searches keep the hits in a heap of double scores */
+static int
+bad_knearest_results(SearchResults *results, int results_offset) {
+  if (bad_results_for_update(results, results_offset)) {
+    return 1;
+  }
+  if (results->score_type != CHEMFP_SCORE_DOUBLE) {
+    PyErr_SetString(PyExc_ValueError,
+                    "k-nearest searches need SearchResults with 'double' scores");
+    return 1;
+  }
   return 0;
 }
 
@@ -504,17 +562,35 @@ bad_hex_size(int hex_size) {
 }
 
 /* Is this something I really need? Peering into a block might be better */
+static int
+bad_metric(int metric_type, double alpha, double beta, chemfp_metric *metric) {
+  metric->type = metric_type;
+  metric->alpha = alpha;
+  metric->beta = beta;
+  if (chemfp_metric_check(metric) != CHEMFP_OK) {
+    if (metric_type == CHEMFP_METRIC_TVERSKY) {
+      PyErr_SetString(PyExc_ValueError, "Tversky alpha and beta must be non-negative");
+    } else {
+      PyErr_SetString(PyExc_ValueError, "unknown metric type");
+    }
+    return 1;
+  }
+  return 0;
+}
+
 static PyObject *
 fps_line_validate(PyObject *self, PyObject *args) {
   int hex_size, line_size;
   char *line;
+  long result;
   UNUSED(self);
 
   if (!PyArg_ParseTuple(args, "is#:fps_line_validate", &hex_size, &line, &line_size))
     return NULL;
   if (bad_hex_size(hex_size))
     return NULL;
-  return PyInt_FromLong(chemfp_fps_line_validate(hex_size, line_size, line));
+  CALL_WITHOUT_GIL(line_size, result, chemfp_fps_line_validate(hex_size, line_size, line));
+  return PyInt_FromLong(result);
 }
 
 /* Extract the binary fingerprint and identifier from the line */
@@ -755,6 +831,154 @@ fps_knearest_tanimoto_search_feed(PyObject *self, PyObject *args) {
   return PyInt_FromLong(err);
 }
 
+static PyObject *
+fps_count_metric_hits(PyObject *self, PyObject *args) {
+  int num_bits, query_storage_size, query_arena_size, query_start, query_end;
+  int query_start_padding, query_end_padding;
+  const unsigned char *query_arena;
+  const char *target_block;
+  int target_block_size, target_start, target_end;
+  double threshold;
+  int *counts, counts_size;
+  int num_lines_processed = 0;
+  int err;
+  int metric_type;
+  double alpha, beta;
+  chemfp_metric metric;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iddiiiit#iit#iidw#:fps_count_metric_hits",
+                        &metric_type, &alpha, &beta,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_block, &target_block_size,
+                        &target_start, &target_end,
+                        &threshold,
+                        &counts, &counts_size))
+    return NULL;
+
+  if (bad_metric(metric_type, alpha, beta, &metric) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query_", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_arena_size("query_", num_bits, query_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_block_limits(target_block_size, &target_start, &target_end) ||
+      bad_threshold(threshold) ||
+      bad_counts(counts_size, query_arena_size / query_storage_size)) {
+    return NULL;
+  }
+
+  if (target_start >= target_end) {
+    /* start of next byte to process, num lines processed, num cells */
+    return Py_BuildValue("ii", CHEMFP_OK, 0);
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_fps_count_metric_hits(&metric,
+        num_bits, 
+        query_storage_size, query_arena, query_start, query_end,
+        target_block+target_start, target_end-target_start,
+        threshold, counts, &num_lines_processed);
+  Py_END_ALLOW_THREADS;
+
+  return Py_BuildValue("ii", err, num_lines_processed);
+                       
+}
+
+static PyObject *
+fps_threshold_metric_search(PyObject *self, PyObject *args) {
+  int num_bits, query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  const char *target_block, *stopped_at;
+  int target_block_size, target_start, target_end;
+  chemfp_tanimoto_cell *cells;
+  double threshold;
+  int cells_size;
+  int num_lines_processed = 0, num_cells_processed = 0;
+  int num_cells, err;
+  int metric_type;
+  double alpha, beta;
+  chemfp_metric metric;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iddiiiit#iit#iidw#:fps_threshold_metric_search",
+                        &metric_type, &alpha, &beta,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_block, &target_block_size,
+                        &target_start, &target_end,
+                        &threshold,
+                        &cells, &cells_size))
+    return NULL;
+
+  if (bad_metric(metric_type, alpha, beta, &metric) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query_", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_arena_size("query_", num_bits, query_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_block_limits(target_block_size, &target_start, &target_end) ||
+      bad_threshold(threshold) ||
+      bad_fps_cells(&num_cells, cells_size, query_arena_size / query_storage_size)) {
+    return NULL;
+  }
+  if (target_start >= target_end) {
+    /* start of next byte to process, num lines processed, num cells */
+    return Py_BuildValue("iiii", CHEMFP_OK, target_end, 0, 0);
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_fps_threshold_metric_search(&metric,
+        num_bits, 
+        query_storage_size, query_arena, query_start, query_end,
+        target_block+target_start, target_end-target_start,
+        threshold,
+        num_cells, cells,
+        &stopped_at, &num_lines_processed, &num_cells_processed);
+  Py_END_ALLOW_THREADS;
+
+  return Py_BuildValue("iiii", err, stopped_at - target_block,
+                       num_lines_processed, num_cells_processed);
+}
+
+static PyObject *
+fps_knearest_metric_search_feed(PyObject *self, PyObject *args) {
+  chemfp_fps_knearest_search *knearest_search;  
+  int knearest_search_size;
+  const char *target_block;
+  int target_block_size, target_start, target_end;
+  int num_bits, err;
+  int metric_type;
+  double alpha, beta;
+  chemfp_metric metric;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iddiw#t#ii:fps_knearest_metric_search_feed",
+                        &metric_type, &alpha, &beta, &num_bits,
+                        &knearest_search, &knearest_search_size,
+                        &target_block, &target_block_size, &target_start, &target_end))
+    return NULL;
+
+  if (bad_metric(metric_type, alpha, beta, &metric) ||
+      bad_num_bits(num_bits) ||
+      bad_knearest_search_size(knearest_search_size) ||
+      bad_block_limits(target_block_size, &target_start, &target_end))
+    return NULL;
+
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_fps_knearest_metric_search_feed(&metric, num_bits, knearest_search,
+                                               target_end-target_start,
+                                               target_block+target_start);
+  Py_END_ALLOW_THREADS;
+  return PyInt_FromLong(err);
+}
+
 static PyObject *
 fps_knearest_search_finish(PyObject *self, PyObject *args) {
   chemfp_fps_knearest_search *knearest_search;  
@@ -852,10 +1076,19 @@ _align_arena(PyObject *input_arena_obj, int alignment,
   /* Not aligned. We'll have to move it to a new string */
   output_arena_obj = _alloc_aligned_arena(input_arena_size, alignment,
                                           start_padding, end_padding);
+  if (!output_arena_obj) {
+    return NULL;
+  }
   output_arena = PyString_AS_STRING(output_arena_obj);
 
   /* Copy over into the new string */
-  memcpy(output_arena+*start_padding, input_arena, input_arena_size);
+  if (input_arena_size >= GIL_RELEASE_MIN_SIZE) {
+    Py_BEGIN_ALLOW_THREADS;
+    memcpy(output_arena+*start_padding, input_arena, input_arena_size);
+    Py_END_ALLOW_THREADS;
+  } else {
+    memcpy(output_arena+*start_padding, input_arena, input_arena_size);
+  }
 
   return output_arena_obj;
 }
@@ -1059,8 +1292,10 @@ make_sorted_aligned_arena(PyObject *self, PyObject *args) {
   }
 
 
+  Py_BEGIN_ALLOW_THREADS;
   need_to_sort = calculate_arena_popcounts(num_bits, storage_size, input_arena,
                                            num_fingerprints, ordering);
+  Py_END_ALLOW_THREADS;
 
   if (!need_to_sort) {
     /* Everything is ordered. Just need the right alignment .... */
@@ -1071,7 +1306,9 @@ make_sorted_aligned_arena(PyObject *self, PyObject *args) {
     }
 
     /* ... and to set the popcount indicies */
+    Py_BEGIN_ALLOW_THREADS;
     set_popcount_indicies(num_fingerprints, num_bits, ordering, popcount_indices);
+    Py_END_ALLOW_THREADS;
     
     /* Everything is aligned and ordered, so we're done */
     return Py_BuildValue("iiO", start_padding, end_padding, output_arena_obj);
@@ -1214,11 +1451,12 @@ threshold_tanimoto_arena(PyObject *self, PyObject *args) {
                        &target_start, &target_end) ||
       bad_popcount_indices("target ", 1, num_bits,
                             target_popcount_indices_size, &target_popcount_indices) ||
-      bad_results(results, result_offset)
+      bad_results_for_update(results, result_offset)
       ) {
     return NULL;
   }
 
+  results->in_use++;
   Py_BEGIN_ALLOW_THREADS;
   errval = chemfp_threshold_tanimoto_arena(
         threshold,
@@ -1228,6 +1466,7 @@ threshold_tanimoto_arena(PyObject *self, PyObject *args) {
         target_popcount_indices,
         results->results + result_offset);
   Py_END_ALLOW_THREADS;
+  results->in_use--;
 
   return PyInt_FromLong(errval);
 }
@@ -1280,10 +1519,11 @@ knearest_tanimoto_arena(PyObject *self, PyObject *args) {
                        &target_start, &target_end) ||
       bad_popcount_indices("target ", 1, num_bits,
                             target_popcount_indices_size, &target_popcount_indices) ||
-      bad_results(results, result_offset)) {
+      bad_knearest_results(results, result_offset)) {
     return NULL;
   }
   
+  results->in_use++;
   Py_BEGIN_ALLOW_THREADS;
   errval = chemfp_knearest_tanimoto_arena(
         k, threshold,
@@ -1293,198 +1533,1241 @@ knearest_tanimoto_arena(PyObject *self, PyObject *args) {
         target_popcount_indices,
         results->results);
   Py_END_ALLOW_THREADS;
+  results->in_use--;
   
   return PyInt_FromLong(errval);
 }
 
+/* count_metric_arena */
 static PyObject *
-knearest_results_finalize(PyObject *self, PyObject *args) {
-  int result_offset, num_results;
-  SearchResults *results;
-  UNUSED(self);
-    
-  if (!PyArg_ParseTuple(args, "Oii",
-                        &results, &result_offset, &num_results)) {
-    return NULL;
-  }
-  if (bad_results(results, result_offset) ||
-      bad_num_results(num_results)) {
-    return NULL;
-  }
-  Py_BEGIN_ALLOW_THREADS;
-  chemfp_knearest_results_finalize(results->results+result_offset,
-                                   results->results+result_offset+num_results);
-  Py_END_ALLOW_THREADS;
-  return Py_BuildValue("");
-}
-
-/***** Symmetric search code ****/
-
-static PyObject *
-count_tanimoto_hits_arena_symmetric(PyObject *self, PyObject *args) {
+count_metric_arena(PyObject *self, PyObject *args) {
   double threshold;
-  int num_bits, start_padding, end_padding, storage_size, arena_size;
-  int query_start, query_end, target_start, target_end;
-  const unsigned char *arena;
-  int *popcount_indices, *result_counts;
-  int popcount_indices_size, result_counts_size;
+  int num_bits;
+  const unsigned char *query_arena, *target_arena;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size=0, query_start=0, query_end=0;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size=0, target_start=0, target_end=0;
+  int *target_popcount_indices, target_popcount_indices_size;
+  int result_counts_size, *result_counts;
+  int metric_type;
+  double alpha, beta;
+  chemfp_metric metric;
   UNUSED(self);
 
-  if (!PyArg_ParseTuple(args, "diiiis#iiiis#w#:count_tanimoto_arena",
+  if (!PyArg_ParseTuple(args, "idddiiiis#iiiiis#iis#w#:count_metric_arena",
+                        &metric_type, &alpha, &beta,
                         &threshold,
                         &num_bits,
-                        &start_padding, &end_padding,
-                        &storage_size, &arena, &arena_size,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
                         &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
                         &target_start, &target_end,
-                        &popcount_indices, &popcount_indices_size,
-                        &result_counts, &result_counts_size)) {
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &result_counts, &result_counts_size))
     return NULL;
-  }
-  if (bad_threshold(threshold) ||
+
+  if (bad_metric(metric_type, alpha, beta, &metric) ||
+      bad_threshold(threshold) ||
       bad_num_bits(num_bits) ||
-      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
-      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
-      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
-      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
-      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
-    return NULL;
-  }
-  if (result_counts_size < (arena_size / storage_size) * sizeof(int) ) {
-    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits, 
+                            target_popcount_indices_size, &target_popcount_indices)) {
     return NULL;
   }
+
   if (query_start > query_end) {
     Py_RETURN_NONE;
   }
+
+  if (result_counts_size < (int)((query_end - query_start)*sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+    return NULL;
+  }
+
   Py_BEGIN_ALLOW_THREADS;
-  chemfp_count_tanimoto_hits_arena_symmetric(threshold,
-                                             num_bits,
-                                             storage_size, arena,
-                                             query_start, query_end,
-                                             target_start, target_end,
-                                             popcount_indices,
-                                             result_counts);
+  chemfp_count_metric_arena(&metric, threshold,
+                              num_bits,
+                              query_storage_size, query_arena, query_start, query_end,
+                              target_storage_size, target_arena, target_start, target_end,
+                              target_popcount_indices,
+                              result_counts);
   Py_END_ALLOW_THREADS;
-  
+
   Py_RETURN_NONE;
 }
 
+/* threshold_metric_arena */
 static PyObject *
-threshold_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
+threshold_metric_arena(PyObject *self, PyObject *args) {
   double threshold;
-  int num_bits, start_padding, end_padding, storage_size, arena_size;
-  int query_start, query_end, target_start, target_end;
-  const unsigned char *arena;
-  int *popcount_indices;
-  int popcount_indices_size;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+  int metric_type;
+  double alpha, beta;
+  chemfp_metric metric;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "idddiiiit#iiiiit#iit#Oi:threshold_metric_arena",
+                        &metric_type, &alpha, &beta,
+                        &threshold,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_metric(metric_type, alpha, beta, &metric) ||
+      bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding, 
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding, 
+                  &target_arena, &target_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results_for_update(results, result_offset)
+      ) {
+    return NULL;
+  }
+
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_threshold_metric_arena(&metric,
+        threshold,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results + result_offset);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+
+  return PyInt_FromLong(errval);
+}
+
+/* knearest_metric_arena */
+static PyObject *
+knearest_metric_arena(PyObject *self, PyObject *args) {
+  int k;
+  double threshold;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+
+  int metric_type;
+  double alpha, beta;
+  chemfp_metric metric;
+  UNUSED(self);
+    
+  if (!PyArg_ParseTuple(args, "iddidiiiit#iiiiit#iit#Oi:knearest_metric_arena",
+                        &metric_type, &alpha, &beta,
+                        &k, &threshold,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_metric(metric_type, alpha, beta, &metric) ||
+      bad_k(k) ||
+      bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_knearest_results(results, result_offset)) {
+    return NULL;
+  }
+  
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_knearest_metric_arena(&metric,
+        k, threshold,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  
+  return PyInt_FromLong(errval);
+}
+
+static PyObject *
+make_knearest_block_index(PyObject *self, PyObject *args) {
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  const unsigned char *arena;
+  int *popcount_indices, popcount_indices_size;
+  int block_size;
+  int *block_indices, block_indices_size;
+  unsigned char *block_unions;
+  int block_unions_size;
+  int start = 0, end = -1, num_blocks;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#t#iw#w#:make_knearest_block_index",
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &popcount_indices, &popcount_indices_size,
+                        &block_size,
+                        &block_indices, &block_indices_size,
+                        &block_unions, &block_unions_size)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_arena_size("", num_bits, storage_size) ||
+      bad_arena_limits("", arena_size, storage_size, &start, &end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
+    return NULL;
+  }
+  if (popcount_indices == NULL) {
+    PyErr_SetString(PyExc_ValueError, "the arena must be ordered by popcount");
+    return NULL;
+  }
+  if (block_size < 1) {
+    PyErr_SetString(PyExc_ValueError, "block_size must be positive");
+    return NULL;
+  }
+  if (block_indices_size < (int)((num_bits+2) * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "block_indices must have space for num_bits+2 integers");
+    return NULL;
+  }
+  num_blocks = chemfp_get_num_knearest_blocks(num_bits, popcount_indices, block_size);
+  if (block_unions_size / storage_size < num_blocks) {
+    PyErr_SetString(PyExc_ValueError, "block_unions is too small");
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  num_blocks = chemfp_make_knearest_block_index(num_bits, storage_size, arena,
+                                                popcount_indices, block_size,
+                                                block_indices, block_unions);
+  Py_END_ALLOW_THREADS;
+  return PyInt_FromLong(num_blocks);
+}
+
+static PyObject *
+get_num_knearest_blocks(PyObject *self, PyObject *args) {
+  int num_bits, block_size;
+  int *popcount_indices, popcount_indices_size;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "it#i:get_num_knearest_blocks",
+                        &num_bits, &popcount_indices, &popcount_indices_size,
+                        &block_size)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
+    return NULL;
+  }
+  if (popcount_indices == NULL) {
+    PyErr_SetString(PyExc_ValueError, "the arena must be ordered by popcount");
+    return NULL;
+  }
+  if (block_size < 1) {
+    PyErr_SetString(PyExc_ValueError, "block_size must be positive");
+    return NULL;
+  }
+  return PyInt_FromLong(chemfp_get_num_knearest_blocks(num_bits, popcount_indices, block_size));
+}
+
+static PyObject *
+knearest_tanimoto_arena_blocks(PyObject *self, PyObject *args) {
+  int k;
+  double threshold;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+  int block_size, *block_indices, block_indices_size;
+  int block_unions_start_padding, block_unions_end_padding, block_unions_size;
+  const unsigned char *block_unions;
+  long *stats;
+  int stats_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+
+  UNUSED(self);
+    
+  if (!PyArg_ParseTuple(args, "idiiiit#iiiiit#iit#it#iit#Oiw#:knearest_tanimoto_arena_blocks",
+                        &k, &threshold,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &block_size, &block_indices, &block_indices_size,
+                        &block_unions_start_padding, &block_unions_end_padding,
+                        &block_unions, &block_unions_size,
+                        &results, &result_offset,
+                        &stats, &stats_size)) {
+    return NULL;
+  }
+
+  if (bad_k(k) ||
+      bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_padding("block_unions ", block_unions_start_padding, block_unions_end_padding,
+                  &block_unions, &block_unions_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_knearest_results(results, result_offset)) {
+    return NULL;
+  }
+  if (target_popcount_indices == NULL) {
+    PyErr_SetString(PyExc_ValueError, "the target arena must be ordered by popcount");
+    return NULL;
+  }
+  if (block_size < 1) {
+    PyErr_SetString(PyExc_ValueError, "block_size must be positive");
+    return NULL;
+  }
+  if (block_indices_size != (int)((num_bits+2) * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "block_indices must contain num_bits+2 integers");
+    return NULL;
+  }
+  if (block_unions_size / target_storage_size < block_indices[num_bits+1]) {
+    PyErr_SetString(PyExc_ValueError, "block_unions is too small for the block_indices");
+    return NULL;
+  }
+  if (stats_size < (int)(3 * sizeof(long))) {
+    PyErr_SetString(PyExc_ValueError, "stats must have space for 3 longs");
+    return NULL;
+  }
+  
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_knearest_tanimoto_arena_blocks(
+        k, threshold,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        block_size, block_indices, block_unions,
+        results->results, stats);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  
+  return PyInt_FromLong(errval);
+}
+
+static PyObject *
+knearest_results_finalize(PyObject *self, PyObject *args) {
+  int result_offset, num_results;
+  SearchResults *results;
+  UNUSED(self);
+    
+  if (!PyArg_ParseTuple(args, "Oii",
+                        &results, &result_offset, &num_results)) {
+    return NULL;
+  }
+  if (bad_knearest_results(results, result_offset) ||
+      bad_num_results(num_results)) {
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  chemfp_knearest_results_finalize(results->results+result_offset,
+                                   results->results+result_offset+num_results);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  return Py_BuildValue("");
+}
+
+/***** Symmetric search code ****/
+
+static PyObject *
+count_tanimoto_hits_arena_symmetric(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices, *result_counts;
+  int popcount_indices_size, result_counts_size;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiis#iiiis#w#:count_tanimoto_arena",
+                        &threshold,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &result_counts, &result_counts_size)) {
+    return NULL;
+  }
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
+    return NULL;
+  }
+  if (result_counts_size < (arena_size / storage_size) * sizeof(int) ) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+    return NULL;
+  }
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  chemfp_count_tanimoto_hits_arena_symmetric(threshold,
+                                             num_bits,
+                                             storage_size, arena,
+                                             query_start, query_end,
+                                             target_start, target_end,
+                                             popcount_indices,
+                                             result_counts);
+  Py_END_ALLOW_THREADS;
+  
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+threshold_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices;
+  int popcount_indices_size;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiis#iiiis#O:threshold_tanimoto_arena_symmetric",
+                        &threshold,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &results)) {
+    return NULL;
+  }
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
+      bad_results_for_update(results, 0)) {
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  chemfp_threshold_tanimoto_arena_symmetric(threshold,
+                                            num_bits,
+                                            storage_size, arena,
+                                            query_start, query_end,
+                                            target_start, target_end,
+                                            popcount_indices,
+                                            results->results);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  
+  Py_RETURN_NONE;
+}
+
+/* knearest_tanimoto_arena */
+static PyObject *
+knearest_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
+  double threshold;
+  int k, num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices;
+  int popcount_indices_size;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "idiiiis#iiiis#O:knearest_tanimoto_arena_symmetric",
+                        &k, &threshold,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &results)) {
+    return NULL;
+  }
+  if (bad_k(k) ||
+      bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
+      bad_knearest_results(results, 0)) {
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  chemfp_knearest_tanimoto_arena_symmetric(k, threshold,
+                                           num_bits,
+                                           storage_size, arena,
+                                           query_start, query_end,
+                                           target_start, target_end,
+                                           popcount_indices,
+                                           results->results);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+fill_lower_triangle(PyObject *self, PyObject *args) {
+  int num_results, errval;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "Oi:fill_lower_triangle",
+                        &results, &num_results)) {
+    return NULL;
+  }
+  if (bad_results_for_update(results, 0) ||
+      bad_num_results(num_results)) {
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_fill_lower_triangle(num_results, results->results);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+
+  if (errval) {
+    PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
+    return NULL;
+  }
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+fill_lower_triangle_tile(PyObject *self, PyObject *args) {
+  int query_start, query_end, target_start, target_end, errval;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "Oiiii:fill_lower_triangle_tile",
+                        &results, &query_start, &query_end, &target_start, &target_end)) {
+    return NULL;
+  }
+  if (bad_results_for_update(results, 0)) {
+    return NULL;
+  }
+  if (query_start < 0 || query_end > results->num_results ||
+      target_start < 0 || target_end > results->num_results) {
+    PyErr_SetString(PyExc_ValueError, "tile is out of range for the results");
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_fill_lower_triangle_tile(results->results, query_start, query_end,
+                                           target_start, target_end);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+
+  if (errval) {
+    PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
+    return NULL;
+  }
+  Py_RETURN_NONE;
+}
+
+/* Clustering */
+
+static PyObject *
+butina_order(PyObject *self, PyObject *args) {
+  SearchResults *results;
+  int tie_break, errval;
+  PyObject *ranks_obj;
+  const void *ranks_buffer = NULL;
+  Py_ssize_t ranks_size = 0;
+  int *order, order_size;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "OiOw#:butina_order",
+                        &results, &tie_break, &ranks_obj, &order, &order_size)) {
+    return NULL;
+  }
+  if (bad_results(results, 0)) {
+    return NULL;
+  }
+  if (ranks_obj != Py_None) {
+    if (PyObject_AsReadBuffer(ranks_obj, &ranks_buffer, &ranks_size)) {
+      return NULL;
+    }
+    if (ranks_size < (Py_ssize_t) (results->num_results * sizeof(int))) {
+      PyErr_SetString(PyExc_ValueError, "ranks must have one integer for each result");
+      return NULL;
+    }
+  }
+  if (order_size < (int) (results->num_results * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "order must have space for one integer for each result");
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_butina_order(results->num_results, results->results,
+                               tie_break, (const int *) ranks_buffer, order);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  if (errval) {
+    PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
+    return NULL;
+  }
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+cluster_assign(PyObject *self, PyObject *args) {
+  SearchResults *results;
+  const int *order;
+  int order_size;
+  int *assignments, assignments_size;
+  int num_centroids;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "Os#w#:cluster_assign",
+                        &results, &order, &order_size, &assignments, &assignments_size)) {
+    return NULL;
+  }
+  if (bad_results(results, 0)) {
+    return NULL;
+  }
+  if (order_size != (int) (results->num_results * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "order must have one integer for each result");
+    return NULL;
+  }
+  if (assignments_size < (int) (results->num_results * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError,
+                    "assignments must have space for one integer for each result");
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  num_centroids = chemfp_cluster_assign(results->num_results, results->results,
+                                        order, assignments);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  if (num_centroids < 0) {
+    PyErr_SetString(PyExc_ValueError, "order or results contain an index which is out of range");
+    return NULL;
+  }
+  return PyInt_FromLong(num_centroids);
+}
+
+
+/* Simsearch output */
+
+static PyObject *
+format_hits(PyObject *self, PyObject *args) {
   SearchResults *results;
+  int start, end, num_rows, row;
+  PyObject *query_ids, *query_seq, *item;
+  const char *target_id_data, *target_id_offsets;
+  int target_id_data_size, target_id_offsets_size, offset_size, num_digits;
+  const char **query_id_strs = NULL;
+  int *query_id_lens = NULL;
+  char *output = NULL;
+  size_t output_size = 0;
+  int errval;
+  PyObject *retval = NULL;
   UNUSED(self);
 
-  if (!PyArg_ParseTuple(args, "diiiis#iiiis#O:threshold_tanimoto_arena_symmetric",
-                        &threshold,
-                        &num_bits,
-                        &start_padding, &end_padding,
-                        &storage_size, &arena, &arena_size,
-                        &query_start, &query_end,
-                        &target_start, &target_end,
-                        &popcount_indices, &popcount_indices_size,
-                        &results)) {
+  if (!PyArg_ParseTuple(args, "OiiOs#s#ii:format_hits",
+                        &results, &start, &end, &query_ids,
+                        &target_id_data, &target_id_data_size,
+                        &target_id_offsets, &target_id_offsets_size, &offset_size,
+                        &num_digits)) {
     return NULL;
   }
-  if (bad_threshold(threshold) ||
-      bad_num_bits(num_bits) ||
-      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
-      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
-      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
-      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
-      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
-      bad_results(results, 0)) {
+  if (bad_results(results, 0)) {
+    return NULL;
+  }
+  if (start < 0 || end < start || end > results->num_results) {
+    PyErr_SetString(PyExc_ValueError, "start and end must be a valid range of result rows");
+    return NULL;
+  }
+  if ((offset_size != 4 && offset_size != 8) ||
+      target_id_offsets_size < offset_size || target_id_offsets_size % offset_size != 0) {
+    PyErr_SetString(PyExc_ValueError, "target id offsets must be an array of 4 or 8 byte integers");
+    return NULL;
+  }
+  if (num_digits < 0 || num_digits > 20) {
+    PyErr_SetString(PyExc_ValueError, "num_digits must be between 0 and 20");
+    return NULL;
+  }
+  /* Work from a tuple copy, as in decode_fingerprints() */
+  query_seq = PySequence_Tuple(query_ids);
+  if (query_seq == NULL) {
     return NULL;
   }
+  num_rows = end - start;
+  if (PyTuple_GET_SIZE(query_seq) != num_rows) {
+    PyErr_SetString(PyExc_ValueError, "must have one query id for each result row");
+    goto done;
+  }
+  query_id_strs = (const char **) PyMem_Malloc((num_rows+1) * sizeof(const char *));
+  query_id_lens = (int *) PyMem_Malloc((num_rows+1) * sizeof(int));
+  if (query_id_strs == NULL || query_id_lens == NULL) {
+    PyErr_NoMemory();
+    goto done;
+  }
+  for (row = 0; row < num_rows; row++) {
+    item = PyTuple_GET_ITEM(query_seq, row);
+    if (!PyString_Check(item)) {
+      PyErr_SetString(PyExc_TypeError, "query ids must be strings");
+      goto done;
+    }
+    query_id_strs[row] = PyString_AS_STRING(item);
+    query_id_lens[row] = (int) PyString_GET_SIZE(item);
+  }
+
+  /* The query id strings are kept alive by the query_seq tuple */
+  results->in_use++;
   Py_BEGIN_ALLOW_THREADS;
-  chemfp_threshold_tanimoto_arena_symmetric(threshold,
-                                            num_bits,
-                                            storage_size, arena,
-                                            query_start, query_end,
-                                            target_start, target_end,
-                                            popcount_indices,
-                                            results->results);
+  errval = chemfp_format_hits(num_rows, results->results + start,
+                              query_id_strs, query_id_lens,
+                              target_id_data, (size_t) target_id_data_size,
+                              target_id_offsets, offset_size,
+                              target_id_offsets_size / offset_size - 1,
+                              num_digits, &output, &output_size);
   Py_END_ALLOW_THREADS;
-  
-  Py_RETURN_NONE;
+  results->in_use--;
+
+  if (errval == CHEMFP_NO_MEM) {
+    PyErr_NoMemory();
+  } else if (errval != CHEMFP_OK) {
+    PyErr_SetString(PyExc_ValueError, "a hit index is not in the target id table");
+  } else {
+    retval = PyString_FromStringAndSize(output, (Py_ssize_t) output_size);
+  }
+  free(output);
+
+ done:
+  PyMem_Free(query_id_strs);
+  PyMem_Free(query_id_lens);
+  Py_DECREF(query_seq);
+  return retval;
+}
+
+
+/* SD file records */
+
+static int
+bad_data_range(int data_size, int *start, int *end) {
+  if (*end == -1) {
+    *end = data_size;
+  }
+  if (*start < 0 || *end < *start || *end > data_size) {
+    PyErr_SetString(PyExc_ValueError, "start and end must be a valid range of the data");
+    return 1;
+  }
+  return 0;
 }
 
-/* knearest_tanimoto_arena */
 static PyObject *
-knearest_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
-  double threshold;
-  int k, num_bits, start_padding, end_padding, storage_size, arena_size;
-  int query_start, query_end, target_start, target_end;
+sdf_split_records(PyObject *self, PyObject *args) {
+  const char *data;
+  int data_size, start=0, end=-1, sep;
+  PyObject *records = NULL, *bad_records = NULL, *record;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#|ii:sdf_split_records", &data, &data_size, &start, &end)) {
+    return NULL;
+  }
+  if (bad_data_range(data_size, &start, &end)) {
+    return NULL;
+  }
+  records = PyList_New(0);
+  bad_records = PyList_New(0);
+  if (records == NULL || bad_records == NULL) {
+    goto error;
+  }
+  while ((sep = chemfp_sdf_find_separator(data, start, end)) != -1) {
+    if (chemfp_sdf_check_record(data, start, sep)) {
+      /* Include the "\n$$$$\n" */
+      record = PyString_FromStringAndSize(data + start, sep + 6 - start);
+      if (record == NULL || PyList_Append(records, record) < 0) {
+        Py_XDECREF(record);
+        goto error;
+      }
+    } else {
+      record = PyString_FromStringAndSize(data + start, sep - start);
+      if (record == NULL || PyList_Append(bad_records, record) < 0 ||
+          PyList_Append(records, Py_None) < 0) {
+        Py_XDECREF(record);
+        goto error;
+      }
+    }
+    Py_DECREF(record);
+    start = sep + 6;
+  }
+  return Py_BuildValue("NNi", records, bad_records, start);
+
+ error:
+  Py_XDECREF(records);
+  Py_XDECREF(bad_records);
+  return NULL;
+}
+
+static PyObject *
+sdf_get_values(PyObject *self, PyObject *args) {
+  const char *data;
+  int data_size, with_title, i, num_tags, offset=0;
+  int value_start, value_end;
+  PyObject *tag_substrs, *tag_seq, *tag_substr, *value, *retval = NULL;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#Oi:sdf_get_values", &data, &data_size,
+                        &tag_substrs, &with_title)) {
+    return NULL;
+  }
+  tag_seq = PySequence_Fast(tag_substrs, "tag_substrs must be a sequence");
+  if (tag_seq == NULL) {
+    return NULL;
+  }
+  num_tags = (int) PySequence_Fast_GET_SIZE(tag_seq);
+  if (with_title) {
+    offset = 1;
+  }
+  retval = PyTuple_New(num_tags + offset);
+  if (retval == NULL) {
+    goto done;
+  }
+  if (with_title) {
+    chemfp_sdf_get_title(data, 0, data_size, &value_start, &value_end);
+    value = PyString_FromStringAndSize(data + value_start, value_end - value_start);
+    if (value == NULL) {
+      goto error;
+    }
+    PyTuple_SET_ITEM(retval, 0, value);
+  }
+  for (i = 0; i < num_tags; i++) {
+    tag_substr = PySequence_Fast_GET_ITEM(tag_seq, i);
+    if (!PyString_Check(tag_substr)) {
+      PyErr_SetString(PyExc_TypeError, "tag_substrs must be strings");
+      goto error;
+    }
+    if (chemfp_sdf_find_tag_value(data, 0, data_size,
+                                  PyString_AS_STRING(tag_substr),
+                                  (int) PyString_GET_SIZE(tag_substr),
+                                  &value_start, &value_end)) {
+      value = PyString_FromStringAndSize(data + value_start, value_end - value_start);
+      if (value == NULL) {
+        goto error;
+      }
+    } else {
+      Py_INCREF(Py_None);
+      value = Py_None;
+    }
+    PyTuple_SET_ITEM(retval, i + offset, value);
+  }
+  goto done;
+
+ error:
+  Py_CLEAR(retval);
+ done:
+  Py_DECREF(tag_seq);
+  return retval;
+}
+
+
+/* Fingerprint decoders */
+
+static PyObject *
+decode_fingerprint(PyObject *self, PyObject *args) {
+  int encoding, text_len, num_bytes, num_bits;
+  const char *text;
+  PyObject *fp;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "is#:decode_fingerprint", &encoding, &text, &text_len)) {
+    return NULL;
+  }
+  fp = PyString_FromStringAndSize(NULL, text_len + 1);
+  if (fp == NULL) {
+    return NULL;
+  }
+  num_bytes = chemfp_decode_fingerprint(encoding, text, text_len,
+                                        (unsigned char *) PyString_AS_STRING(fp), &num_bits);
+  if (num_bytes == CHEMFP_BAD_ARG) {
+    Py_DECREF(fp);
+    PyErr_SetString(PyExc_ValueError, "unknown encoding");
+    return NULL;
+  }
+  if (num_bytes < 0) {
+    /* Let the caller decide what to do with it */
+    Py_DECREF(fp);
+    Py_RETURN_NONE;
+  }
+  if (_PyString_Resize(&fp, num_bytes) < 0) {
+    return NULL;
+  }
+  if (num_bits == -1) {
+    return Py_BuildValue("ON", Py_None, fp);
+  }
+  return Py_BuildValue("iN", num_bits, fp);
+}
+
+static PyObject *
+decode_fingerprints(PyObject *self, PyObject *args) {
+  int encoding, storage_size, num_bytes_size, num_bits_size;
+  int num_fps, i, errval;
+  PyObject *encoded_fps, *fp_seq = NULL, *item;
+  Py_buffer output;
+  int *num_bytes, *num_bits;
+  const char **texts = NULL;
+  int *text_lens = NULL;
+  PyObject *retval = NULL;
+  UNUSED(self);
+
+  /* Use "w*" for the output so it can be a bytearray */
+  if (!PyArg_ParseTuple(args, "iOiw*w#w#:decode_fingerprints",
+                        &encoding, &encoded_fps, &storage_size, &output,
+                        &num_bytes, &num_bytes_size,
+                        &num_bits, &num_bits_size)) {
+    return NULL;
+  }
+  if (encoding < CHEMFP_ENCODING_BINARY_LSB || encoding > CHEMFP_ENCODING_DAYLIGHT) {
+    PyErr_SetString(PyExc_ValueError, "unknown encoding");
+    goto done;
+  }
+  if (storage_size < 0) {
+    PyErr_SetString(PyExc_ValueError, "storage_size must not be negative");
+    goto done;
+  }
+  /* Work from a tuple copy. PySequence_Fast() returns a list argument
+     as-is, and another thread could change that list, and free its
+     strings, while the GIL is released. */
+  fp_seq = PySequence_Tuple(encoded_fps);
+  if (fp_seq == NULL) {
+    goto done;
+  }
+  num_fps = (int) PyTuple_GET_SIZE(fp_seq);
+  if (storage_size && num_fps > output.len / storage_size) {
+    PyErr_SetString(PyExc_ValueError, "output is not large enough");
+    goto done;
+  }
+  if (num_fps > num_bytes_size / (int) sizeof(int) ||
+      num_fps > num_bits_size / (int) sizeof(int)) {
+    PyErr_SetString(PyExc_ValueError, "num_bytes and num_bits must have room for each fingerprint");
+    goto done;
+  }
+  texts = (const char **) PyMem_Malloc((num_fps+1) * sizeof(const char *));
+  text_lens = (int *) PyMem_Malloc((num_fps+1) * sizeof(int));
+  if (texts == NULL || text_lens == NULL) {
+    PyErr_NoMemory();
+    goto done;
+  }
+  for (i = 0; i < num_fps; i++) {
+    item = PyTuple_GET_ITEM(fp_seq, i);
+    if (item == Py_None) {
+      texts[i] = NULL;
+      text_lens[i] = 0;
+    } else if (PyString_Check(item)) {
+      texts[i] = PyString_AS_STRING(item);
+      text_lens[i] = (int) PyString_GET_SIZE(item);
+    } else {
+      PyErr_SetString(PyExc_TypeError, "encoded fingerprints must be strings or None");
+      goto done;
+    }
+  }
+
+  /* The strings are kept alive by the fp_seq tuple */
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_decode_fingerprints(encoding, num_fps, texts, text_lens,
+                                      storage_size, (unsigned char *) output.buf,
+                                      num_bytes, num_bits);
+  Py_END_ALLOW_THREADS;
+  if (errval == CHEMFP_NO_MEM) {
+    PyErr_NoMemory();
+  } else if (errval < 0) {
+    PyErr_SetString(PyExc_ValueError, "bad decoder arguments");
+  } else {
+    retval = PyInt_FromLong(errval);
+  }
+
+ done:
+  PyMem_Free(texts);
+  PyMem_Free(text_lens);
+  Py_XDECREF(fp_seq);
+  PyBuffer_Release(&output);
+  return retval;
+}
+
+
+/* Substructure screening index */
+
+static int
+bad_screen_bitmaps(int num_bits, int bitmaps_size, int bit_counts_size, int *num_words) {
+  if (bitmaps_size % (num_bits * sizeof(uint64_t)) != 0) {
+    PyErr_SetString(PyExc_ValueError,
+                    "bitmaps size must be a multiple of num_bits 64-bit words");
+    return 1;
+  }
+  if (bit_counts_size != (int) (num_bits * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "bit_counts must have one integer for each bit");
+    return 1;
+  }
+  *num_words = (int) (bitmaps_size / (num_bits * sizeof(uint64_t)));
+  return 0;
+}
+
+static PyObject *
+screen_build(PyObject *self, PyObject *args) {
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
   const unsigned char *arena;
-  int *popcount_indices;
-  int popcount_indices_size;
-  SearchResults *results;
+  int start, end;
+  uint64_t *bitmaps;
+  int bitmaps_size, *bit_counts, bit_counts_size, num_words;
+  int err;
   UNUSED(self);
 
-  if (!PyArg_ParseTuple(args, "idiiiis#iiiis#O:knearest_tanimoto_arena_symmetric",
-                        &k, &threshold,
-                        &num_bits,
-                        &start_padding, &end_padding,
-                        &storage_size, &arena, &arena_size,
-                        &query_start, &query_end,
-                        &target_start, &target_end,
-                        &popcount_indices, &popcount_indices_size,
-                        &results)) {
+  if (!PyArg_ParseTuple(args, "iiiis#iiw#w#:screen_build",
+                        &num_bits, &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size, &start, &end,
+                        &bitmaps, &bitmaps_size, &bit_counts, &bit_counts_size)) {
     return NULL;
   }
-  if (bad_k(k) ||
-      bad_threshold(threshold) ||
-      bad_num_bits(num_bits) ||
+  if (bad_num_bits(num_bits) ||
       bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
-      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
-      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
-      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
-      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
-      bad_results(results, 0)) {
+      bad_arena_size("", num_bits, storage_size) ||
+      bad_arena_limits("", arena_size, storage_size, &start, &end) ||
+      bad_screen_bitmaps(num_bits, bitmaps_size, bit_counts_size, &num_words)) {
+    return NULL;
+  }
+  if (num_words < chemfp_screen_get_num_words(end-start)) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for the bitmaps");
     return NULL;
   }
   Py_BEGIN_ALLOW_THREADS;
-  chemfp_knearest_tanimoto_arena_symmetric(k, threshold,
-                                           num_bits,
-                                           storage_size, arena,
-                                           query_start, query_end,
-                                           target_start, target_end,
-                                           popcount_indices,
-                                           results->results);
+  err = chemfp_screen_build(num_bits, storage_size, arena, start, end,
+                            num_words, bitmaps, bit_counts);
   Py_END_ALLOW_THREADS;
-  
-  Py_RETURN_NONE;
+  return PyInt_FromLong(err);
 }
 
+/* (count, start_word, end_word) = screen_contains(num_bits, bitmaps, bit_counts,
+                       num_fingerprints, min_index, query_fp, candidates) */
 static PyObject *
-fill_lower_triangle(PyObject *self, PyObject *args) {
-  int num_results, errval;
-  SearchResults *results;
+screen_contains(PyObject *self, PyObject *args) {
+  int num_bits, num_words, num_fingerprints, min_index;
+  const uint64_t *bitmaps;
+  const int *bit_counts;
+  int bitmaps_size, bit_counts_size;
+  const unsigned char *query_fp;
+  int query_fp_size;
+  uint64_t *candidates;
+  int candidates_size;
+  int count, start_word, end_word;
   UNUSED(self);
 
-  if (!PyArg_ParseTuple(args, "Oi:fill_lower_triangle",
-                        &results, &num_results)) {
+  if (!PyArg_ParseTuple(args, "is#s#iis#w#:screen_contains",
+                        &num_bits, &bitmaps, &bitmaps_size, &bit_counts, &bit_counts_size,
+                        &num_fingerprints, &min_index, &query_fp, &query_fp_size,
+                        &candidates, &candidates_size)) {
     return NULL;
   }
-  if (bad_results(results, 0) ||
-      bad_num_results(num_results)) {
+  if (bad_num_bits(num_bits) ||
+      bad_screen_bitmaps(num_bits, bitmaps_size, bit_counts_size, &num_words)) {
+    return NULL;
+  }
+  if (query_fp_size != (num_bits+7)/8) {
+    PyErr_SetString(PyExc_ValueError, "query fingerprint has the wrong size");
+    return NULL;
+  }
+  if (num_fingerprints < 0 || chemfp_screen_get_num_words(num_fingerprints) > num_words ||
+      candidates_size < (int) (num_words * sizeof(uint64_t))) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for the candidates");
     return NULL;
   }
   Py_BEGIN_ALLOW_THREADS;
-  errval = chemfp_fill_lower_triangle(num_results, results->results);
+  count = chemfp_screen_contains(num_bits, num_words, bitmaps, bit_counts,
+                                 num_fingerprints, min_index, query_fp,
+                                 candidates, &start_word, &end_word);
   Py_END_ALLOW_THREADS;
+  if (count < 0) {
+    PyErr_SetString(PyExc_MemoryError, chemfp_strerror(count));
+    return NULL;
+  }
+  return Py_BuildValue("iii", count, start_word, end_word);
+}
 
-  if (errval) {
-    PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
+static PyObject *
+screen_get_indices(PyObject *self, PyObject *args) {
+  const uint64_t *candidates;
+  int candidates_size, start_word, end_word, index_offset;
+  int *indices, indices_size, word_index, n;
+  uint64_t word;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#iiiw#:screen_get_indices",
+                        &candidates, &candidates_size, &start_word, &end_word,
+                        &index_offset, &indices, &indices_size)) {
     return NULL;
   }
-  Py_RETURN_NONE;
+  if (start_word < 0 || end_word < start_word ||
+      end_word > (int) (candidates_size / sizeof(uint64_t))) {
+    PyErr_SetString(PyExc_ValueError, "candidate word range is out of range");
+    return NULL;
+  }
+  /* Make sure there's enough space for all of the indices */
+  n = 0;
+  for (word_index=start_word; word_index<end_word; word_index++) {
+    for (word=candidates[word_index]; word; word &= word - 1) {
+      n++;
+    }
+  }
+  if (indices_size < (int) (n * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for the indices");
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  n = chemfp_screen_get_indices(candidates, start_word, end_word, index_offset, indices);
+  Py_END_ALLOW_THREADS;
+  return PyInt_FromLong(n);
+}
+
+static PyObject *
+screen_contains_arena(PyObject *self, PyObject *args) {
+  int num_bits, num_words, num_fingerprints;
+  const uint64_t *bitmaps;
+  const int *bit_counts;
+  int bitmaps_size, bit_counts_size;
+  int *target_popcount_indices, target_popcount_indices_size, target_start;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  SearchResults *results;
+  int err;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "is#s#is#iiiis#iiO:screen_contains_arena",
+                        &num_bits, &bitmaps, &bitmaps_size, &bit_counts, &bit_counts_size,
+                        &num_fingerprints,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &target_start,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &results)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_screen_bitmaps(num_bits, bitmaps_size, bit_counts_size, &num_words) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_arena_size("query_", num_bits, query_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_results_for_update(results, 0)) {
+    return NULL;
+  }
+  if (num_fingerprints < 0 || chemfp_screen_get_num_words(num_fingerprints) > num_words) {
+    PyErr_SetString(PyExc_ValueError, "num_fingerprints is too large for the bitmaps");
+    return NULL;
+  }
+  if (results->num_results < query_end - query_start) {
+    PyErr_SetString(PyExc_ValueError, "not enough results for the queries");
+    return NULL;
+  }
+  results->in_use++;
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_screen_contains_arena(num_bits, num_words, bitmaps, bit_counts,
+                                     num_fingerprints, target_popcount_indices, target_start,
+                                     query_storage_size, query_arena, query_start, query_end,
+                                     results->results);
+  Py_END_ALLOW_THREADS;
+  results->in_use--;
+  return PyInt_FromLong(err);
 }
 
 
@@ -1749,6 +3032,12 @@ static PyMethodDef chemfp_methods[] = {
 
   {"knearest_tanimoto_arena", knearest_tanimoto_arena, METH_VARARGS,
    "knearest_tanimoto_arena (TODO: document)"},
+  {"knearest_tanimoto_arena_blocks", knearest_tanimoto_arena_blocks, METH_VARARGS,
+   "knearest_tanimoto_arena_blocks (TODO: document)"},
+  {"make_knearest_block_index", make_knearest_block_index, METH_VARARGS,
+   "make_knearest_block_index (TODO: document)"},
+  {"get_num_knearest_blocks", get_num_knearest_blocks, METH_VARARGS,
+   "get_num_knearest_blocks (TODO: document)"},
   {"knearest_results_finalize", knearest_results_finalize, METH_VARARGS,
    "knearest_results_finalize (TODO: document)"},
 
@@ -1761,6 +3050,62 @@ static PyMethodDef chemfp_methods[] = {
 
   {"fill_lower_triangle", fill_lower_triangle, METH_VARARGS,
    "fill_lower_triangle (TODO: document)"},
+  {"fill_lower_triangle_tile", fill_lower_triangle_tile, METH_VARARGS,
+   "fill_lower_triangle_tile (TODO: document)"},
+
+  {"butina_order", butina_order, METH_VARARGS,
+   "butina_order (TODO: document)"},
+  {"cluster_assign", cluster_assign, METH_VARARGS,
+   "cluster_assign (TODO: document)"},
+
+  {"format_hits", format_hits, METH_VARARGS,
+   "format_hits(results, start, end, query_ids, target_id_data, target_id_offsets, offset_size, num_digits)\n\n"
+   "Return the simsearch output lines for result rows start to end"},
+
+  {"sdf_split_records", sdf_split_records, METH_VARARGS,
+   "sdf_split_records(data, start=0, end=len(data)) -> (records, bad_records, end)\n\n"
+   "Split the complete SD records in data[start:end]. 'records' has the text of\n"
+   "each record, including its \"\\n$$$$\\n\", or None if the record is not in the\n"
+   "correct format. 'bad_records' has the text of those records, without the\n"
+   "\"\\n$$$$\\n\". 'end' is where the incomplete record, if any, starts."},
+  {"sdf_get_values", sdf_get_values, METH_VARARGS,
+   "sdf_get_values(record, tag_substrs, with_title) -> tuple\n\n"
+   "Return the first data line for each \"<tag>\" in tag_substrs, or None if the\n"
+   "record doesn't have the tag. If with_title is true, start with the title."},
+
+  {"decode_fingerprint", decode_fingerprint, METH_VARARGS,
+   "decode_fingerprint(encoding, text) -> (num_bits, fp) or None\n\n"
+   "Decode a well-formed encoded fingerprint. num_bits is None unless the\n"
+   "encoding gives the exact bit length. Returns None if the text can't be decoded."},
+  {"decode_fingerprints", decode_fingerprints, METH_VARARGS,
+   "decode_fingerprints(encoding, encoded_fps, storage_size, output, num_bytes, num_bits)\n\n"
+   "Decode fingerprint i into output[i*storage_size:(i+1)*storage_size], padded with\n"
+   "0 bytes. num_bytes[i] is its decoded size, or -1 if it can't be decoded, and\n"
+   "num_bits[i] is its exact bit length, or -1. A fingerprint longer than\n"
+   "storage_size is not stored. Returns the number of fingerprints, other than\n"
+   "the None values, which couldn't be decoded."},
+
+  {"screen_build", screen_build, METH_VARARGS,
+   "screen_build (TODO: document)"},
+  {"screen_contains", screen_contains, METH_VARARGS,
+   "screen_contains (TODO: document)"},
+  {"screen_get_indices", screen_get_indices, METH_VARARGS,
+   "screen_get_indices (TODO: document)"},
+  {"screen_contains_arena", screen_contains_arena, METH_VARARGS,
+   "screen_contains_arena (TODO: document)"},
+
+  {"count_metric_arena", count_metric_arena, METH_VARARGS,
+   "count_metric_arena (TODO: document)"},
+  {"threshold_metric_arena", threshold_metric_arena, METH_VARARGS,
+   "threshold_metric_arena (TODO: document)"},
+  {"knearest_metric_arena", knearest_metric_arena, METH_VARARGS,
+   "knearest_metric_arena (TODO: document)"},
+  {"fps_count_metric_hits", fps_count_metric_hits, METH_VARARGS,
+   "fps_count_metric_hits (TODO: document)"},
+  {"fps_threshold_metric_search", fps_threshold_metric_search, METH_VARARGS,
+   "fps_threshold_metric_search (TODO: document)"},
+  {"fps_knearest_metric_search_feed", fps_knearest_metric_search_feed, METH_VARARGS,
+   "fps_knearest_metric_search_feed (TODO: document)"},
 
   {"make_sorted_aligned_arena", make_sorted_aligned_arena, METH_VARARGS,
    "make_sorted_aligned_arena (TODO: document)"},
@@ -1826,7 +3171,16 @@ init_chemfp(void)
   if (PyType_Ready(&chemfp_py_SearchResultsType) < 0) {
     return ;
   }
+  if (PyType_Ready(&chemfp_py_RowBufferType) < 0) {
+    return ;
+  }
   m = Py_InitModule3("_chemfp", chemfp_methods, "Documentation goes here");
+
+  /* The popcount methods and the number of threads are set up on
+     first use. Do it now, while the GIL is held, so two Python
+     threads can't race to do it in a search which released the GIL. */
+  chemfp_get_num_alignments();
+  chemfp_get_num_threads();
   Py_INCREF(&chemfp_py_SearchResultsType);
   PyModule_AddObject(m, "SearchResults", (PyObject *)&chemfp_py_SearchResultsType);
 }
@@ -0,0 +1,283 @@
+#include <stdlib.h>
+#include <string.h>
+
+#include "chemfp.h"
+#include "chemfp_internal.h"
+
+#if defined(_OPENMP)
+  #include <omp.h>
+#endif
+
+/* Substructure screening index.
+
+   The index is the arena transposed into one bitmap per fingerprint
+   bit. Bit j of bitmap b is set if fingerprint j (relative to the
+   start of the indexed arena) has bit b set. The bitmaps are stored
+   one after the other, each with 'num_words' 64-bit words:
+
+     bitmaps[b*num_words + j/64] & (1 << (j%64))
+
+   A target contains the query if it has every query bit set, so the
+   candidates are the intersection of the bitmaps for the query bits.
+   The rarest bits are intersected first, and the words at either end
+   of the candidate range which are all 0 are dropped as soon as
+   possible, so most queries only touch a few words of the later
+   bitmaps.
+
+   If the arena is ordered by popcount then a target with fewer bits
+   than the query can't contain it, which gives a lower bound on the
+   first candidate index. */
+
+int chemfp_screen_get_num_words(int num_fingerprints) {
+  return (num_fingerprints + 63) / 64;
+}
+
+int chemfp_screen_build(int num_bits, int storage_size,
+                        const unsigned char *arena, int start, int end,
+                        int num_words, uint64_t *bitmaps, int *bit_counts) {
+  int fp_size = (num_bits+7)/8;
+  int i, byte_index, bit, j;
+  unsigned char c;
+  const unsigned char *fp;
+  uint64_t mask;
+
+  if (start < 0 || end < start || chemfp_screen_get_num_words(end-start) > num_words) {
+    return CHEMFP_BAD_ARG;
+  }
+  memset(bitmaps, 0, sizeof(uint64_t) * num_bits * num_words);
+  memset(bit_counts, 0, sizeof(int) * num_bits);
+
+  for (i=start, j=0, fp=arena+start*storage_size; i<end; i++, j++, fp+=storage_size) {
+    mask = ((uint64_t) 1) << (j % 64);
+    for (byte_index=0; byte_index<fp_size; byte_index++) {
+      c = fp[byte_index];
+      for (bit=byte_index*8; c; c >>= 1, bit++) {
+        if (c & 1) {
+          bitmaps[bit*num_words + j/64] |= mask;
+          bit_counts[bit]++;
+        }
+      }
+    }
+  }
+  return CHEMFP_OK;
+}
+
+static int count_word_bits(uint64_t word) {
+  int count = 0;
+  while (word) {
+    word &= word - 1;
+    count++;
+  }
+  return count;
+}
+
+/* Put the candidates for one query in candidates[*start_word:*end_word] */
+/* Returns the number of candidates, or CHEMFP_NO_MEM */
+int chemfp_screen_contains(int num_bits, int num_words, const uint64_t *bitmaps,
+                           const int *bit_counts, int num_fingerprints, int min_index,
+                           const unsigned char *query_fp,
+                           uint64_t *candidates, int *start_word, int *end_word) {
+  int *query_bits;
+  int num_query_bits = 0;
+  int i, j, bit, lo, hi, count;
+  const uint64_t *bitmap;
+
+  *start_word = *end_word = 0;
+  if (min_index < 0) {
+    min_index = 0;
+  }
+  if (min_index >= num_fingerprints) {
+    return 0;
+  }
+
+  /* No target has a bit past the end of the fingerprint */
+  for (bit=num_bits; bit%8; bit++) {
+    if (query_fp[bit/8] & (1 << (bit%8))) {
+      return 0;
+    }
+  }
+
+  query_bits = (int *) malloc(sizeof(int) * (num_bits > 0 ? num_bits : 1));
+  if (!query_bits) {
+    return CHEMFP_NO_MEM;
+  }
+
+  /* Get the query bits, ordered from the rarest to the most common */
+  for (bit=0; bit<num_bits; bit++) {
+    if (query_fp[bit/8] & (1 << (bit%8))) {
+      if (bit_counts[bit] == 0) {
+        /* No target has this bit */
+        free(query_bits);
+        return 0;
+      }
+      for (j=num_query_bits; j>0 && bit_counts[query_bits[j-1]] > bit_counts[bit]; j--) {
+        query_bits[j] = query_bits[j-1];
+      }
+      query_bits[j] = bit;
+      num_query_bits++;
+    }
+  }
+
+  lo = min_index / 64;
+  hi = chemfp_screen_get_num_words(num_fingerprints);
+
+  if (num_query_bits == 0) {
+    /* Every fingerprint contains the empty fingerprint */
+    for (i=lo; i<hi; i++) {
+      candidates[i] = ~((uint64_t) 0);
+    }
+    if (num_fingerprints % 64) {
+      candidates[hi-1] = (((uint64_t) 1) << (num_fingerprints % 64)) - 1;
+    }
+  } else {
+    bitmap = bitmaps + query_bits[0]*num_words;
+    memcpy(candidates+lo, bitmap+lo, (hi-lo) * sizeof(uint64_t));
+  }
+  /* Remove the fingerprints before the popcount lower bound */
+  candidates[lo] &= ~((((uint64_t) 1) << (min_index % 64)) - 1);
+
+  for (i=1; ; i++) {
+    /* Trim the empty words from either end */
+    while (lo < hi && candidates[lo] == 0) {
+      lo++;
+    }
+    while (hi > lo && candidates[hi-1] == 0) {
+      hi--;
+    }
+    if (lo == hi || i >= num_query_bits) {
+      break;
+    }
+    bitmap = bitmaps + query_bits[i]*num_words;
+    for (j=lo; j<hi; j++) {
+      candidates[j] &= bitmap[j];
+    }
+  }
+  free(query_bits);
+
+  count = 0;
+  for (j=lo; j<hi; j++) {
+    count += count_word_bits(candidates[j]);
+  }
+  *start_word = lo;
+  *end_word = hi;
+  return count;
+}
+
+/* Convert the candidate bitmap words to indices, plus 'index_offset' */
+int chemfp_screen_get_indices(const uint64_t *candidates, int start_word, int end_word,
+                              int index_offset, int *indices) {
+  int word_index, n = 0, bit;
+  uint64_t word;
+  for (word_index=start_word; word_index<end_word; word_index++) {
+    word = candidates[word_index];
+    for (bit=0; word; bit++, word >>= 1) {
+      if (word & 1) {
+        indices[n++] = index_offset + word_index*64 + bit;
+      }
+    }
+  }
+  return n;
+}
+
+/* Screen every query in the query arena. The candidates go into the
+   results, with a score of 1.0 to match the "contains" metric. The
+   target index is relative to the start of the target arena, plus
+   'target_start'. The lower bound uses 'target_popcount_indices' if
+   it isn't NULL. */
+
+static int screen_one_query(int num_bits, int num_words, const uint64_t *bitmaps,
+                            const int *bit_counts, int num_fingerprints,
+                            const int *target_popcount_indices, int target_start,
+                            const unsigned char *query_fp, uint64_t *candidates,
+                            chemfp_search_result *result) {
+  int min_index = 0, popcount, count, start_word, end_word, word_index, bit;
+  int fp_size = (num_bits+7)/8;
+  uint64_t word;
+
+  if (target_popcount_indices != NULL) {
+    popcount = chemfp_byte_popcount(fp_size, query_fp);
+    if (popcount > num_bits) {
+      /* The query has bits past the end of the fingerprint */
+      return CHEMFP_OK;
+    }
+    min_index = target_popcount_indices[popcount] - target_start;
+  }
+  count = chemfp_screen_contains(num_bits, num_words, bitmaps, bit_counts,
+                                 num_fingerprints, min_index, query_fp,
+                                 candidates, &start_word, &end_word);
+  if (count < 0) {
+    return count;
+  }
+  for (word_index=start_word; word_index<end_word; word_index++) {
+    word = candidates[word_index];
+    for (bit=0; word; bit++, word >>= 1) {
+      if (word & 1) {
+        if (!chemfp_add_hit(result, target_start + word_index*64 + bit, 1.0)) {
+          return CHEMFP_NO_MEM;
+        }
+      }
+    }
+  }
+  return CHEMFP_OK;
+}
+
+int chemfp_screen_contains_arena(int num_bits, int num_words, const uint64_t *bitmaps,
+                                 const int *bit_counts, int num_fingerprints,
+                                 const int *target_popcount_indices, int target_start,
+                                 int query_storage_size, const unsigned char *query_arena,
+                                 int query_start, int query_end,
+                                 chemfp_search_result *results) {
+  int query_index, err, retval = CHEMFP_OK;
+  uint64_t *candidates;
+
+  if (query_start >= query_end) {
+    return CHEMFP_OK;
+  }
+
+#if defined(_OPENMP)
+  if (chemfp_get_num_threads() > 1) {
+    /* Each thread has its own candidate bitmap and its own result rows */
+    #pragma omp parallel private(candidates, query_index, err)
+    {
+      candidates = (uint64_t *) malloc(sizeof(uint64_t) * (num_words > 0 ? num_words : 1));
+      if (!candidates) {
+        #pragma omp critical (screen_error)
+        retval = CHEMFP_NO_MEM;
+      }
+      #pragma omp for schedule(dynamic)
+      for (query_index = query_start; query_index < query_end; query_index++) {
+        if (!candidates) {
+          continue;
+        }
+        err = screen_one_query(num_bits, num_words, bitmaps, bit_counts, num_fingerprints,
+                               target_popcount_indices, target_start,
+                               query_arena + query_index * query_storage_size,
+                               candidates, results + (query_index - query_start));
+        if (err < 0) {
+          #pragma omp critical (screen_error)
+          retval = err;
+        }
+      }
+      free(candidates);
+    }
+    return retval;
+  }
+#endif
+
+  candidates = (uint64_t *) malloc(sizeof(uint64_t) * (num_words > 0 ? num_words : 1));
+  if (!candidates) {
+    return CHEMFP_NO_MEM;
+  }
+  for (query_index = query_start; query_index < query_end; query_index++) {
+    err = screen_one_query(num_bits, num_words, bitmaps, bit_counts, num_fingerprints,
+                           target_popcount_indices, target_start,
+                           query_arena + query_index * query_storage_size,
+                           candidates, results + (query_index - query_start));
+    if (err < 0) {
+      retval = err;
+      break;
+    }
+  }
+  free(candidates);
+  return retval;
+}
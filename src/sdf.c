@@ -0,0 +1,193 @@
+#include <string.h>
+
+#include "chemfp.h"
+
+/* SD file record splitting and tag extraction.
+
+   These work on a block of text, which may be part of a larger buffer
+   such as a memory-mapped file. Offsets are relative to the start of
+   the buffer. They implement the same rules as the original Python
+   code in chemfp/sdf_reader.py:
+
+     - records are separated by "\n$$$$\n"
+     - the record check is the same as the _sdf_check_pat regular expression
+     - a tag value is the first line after the first ">" data header
+       line which contains "<tag>" */
+
+static const char *find_separator(const char *s, const char *end) {
+  const char *p;
+  /* Look for the '$' characters, then check the surrounding text */
+  while (end - s >= 6) {
+    p = (const char *) memchr(s, '\n', (end - s) - 5);
+    if (p == NULL) {
+      return NULL;
+    }
+    if (p[1] == '$' && p[2] == '$' && p[3] == '$' && p[4] == '$' && p[5] == '\n') {
+      return p;
+    }
+    s = p + 1;
+  }
+  return NULL;
+}
+
+/* Return the offset of the next "\n$$$$\n" separator at or after
+   'start', or -1 if there isn't one before 'end'. */
+int chemfp_sdf_find_separator(const char *data, int start, int end) {
+  const char *p = find_separator(data + start, data + end);
+  if (p == NULL) {
+    return -1;
+  }
+  return (int) (p - data);
+}
+
+#define IS_DIGIT(c) ((c) >= '0' && (c) <= '9')
+#define IS_SPACE(c) ((c) == ' ')
+
+/* The atom and bond count fields. The regular expression alternatives
+   are '  d', ' dd', 'ddd', 'dd ', 'd ' and ' d ', so a field can be 3
+   or 2 characters long. Return a bitmask of the possible lengths. */
+static int count_field_lengths(const char *s, const char *end) {
+  int lengths = 0;
+  if (end - s >= 3) {
+    if ((IS_SPACE(s[0]) && IS_SPACE(s[1]) && IS_DIGIT(s[2])) ||
+        (IS_SPACE(s[0]) && IS_DIGIT(s[1]) && IS_DIGIT(s[2])) ||
+        (IS_DIGIT(s[0]) && IS_DIGIT(s[1]) && IS_DIGIT(s[2])) ||
+        (IS_DIGIT(s[0]) && IS_DIGIT(s[1]) && IS_SPACE(s[2])) ||
+        (IS_SPACE(s[0]) && IS_DIGIT(s[1]) && IS_SPACE(s[2]))) {
+      lengths |= 8;
+    }
+  }
+  if (end - s >= 2 && IS_DIGIT(s[0]) && IS_SPACE(s[1])) {
+    lengths |= 4;
+  }
+  return lengths;
+}
+
+/* Only space and digits are allowed before the required V2000 or V3000 */
+static int check_version(const char *s, const char *end) {
+  int i;
+  if (end - s < 33) {
+    return 0;
+  }
+  for (i = 0; i < 28; i++) {
+    if (!IS_SPACE(s[i]) && !IS_DIGIT(s[i])) {
+      return 0;
+    }
+  }
+  s += 28;
+  return (s[0] == 'V' && (s[1] == '2' || s[1] == '3') &&
+          s[2] == '0' && s[3] == '0' && s[4] == '0');
+}
+
+/* Return 1 if the record in data[start:end] looks like an SD record, else 0 */
+int chemfp_sdf_check_record(const char *data, int start, int end) {
+  const char *s = data + start, *e = data + end;
+  int i, first, second, first_len, second_len;
+
+  /* The title, program, and comment lines */
+  for (i = 0; i < 3; i++) {
+    s = (const char *) memchr(s, '\n', e - s);
+    if (s == NULL) {
+      return 0;
+    }
+    s++;
+  }
+  first = count_field_lengths(s, e);
+  for (first_len = 3; first_len >= 2; first_len--) {
+    if (!(first & (1 << first_len))) {
+      continue;
+    }
+    second = count_field_lengths(s + first_len, e);
+    for (second_len = 3; second_len >= 2; second_len--) {
+      if ((second & (1 << second_len)) &&
+          check_version(s + first_len + second_len, e)) {
+        return 1;
+      }
+    }
+  }
+  return 0;
+}
+
+/* The title is the first line, without leading and trailing whitespace */
+void chemfp_sdf_get_title(const char *data, int start, int end,
+                          int *title_start, int *title_end) {
+  const char *s = data + start, *e = data + end;
+  const char *newline = (const char *) memchr(s, '\n', e - s);
+  if (newline != NULL) {
+    e = newline;
+  }
+  while (s < e && (*s == ' ' || *s == '\t' || *s == '\r' || *s == '\v' || *s == '\f')) {
+    s++;
+  }
+  while (e > s && (e[-1] == ' ' || e[-1] == '\t' || e[-1] == '\r' ||
+                   e[-1] == '\v' || e[-1] == '\f')) {
+    e--;
+  }
+  *title_start = (int) (s - data);
+  *title_end = (int) (e - data);
+}
+
+static const char *find_substr(const char *s, const char *end,
+                               const char *substr, int substr_len) {
+  const char *p;
+  if (substr_len == 0) {
+    return s;
+  }
+  while (end - s >= substr_len) {
+    p = (const char *) memchr(s, substr[0], (end - s) - substr_len + 1);
+    if (p == NULL) {
+      return NULL;
+    }
+    if (memcmp(p, substr, substr_len) == 0) {
+      return p;
+    }
+    s = p + 1;
+  }
+  return NULL;
+}
+
+/* Find the first data line for a tag in the record data[start:end].
+   'tag_substr' is the tag name with its "<" and ">". Returns 0 if the
+   tag is not present, otherwise returns 1 and sets the value range,
+   which is empty if the tag has no data line. */
+int chemfp_sdf_find_tag_value(const char *data, int start, int end,
+                              const char *tag_substr, int tag_len,
+                              int *value_start, int *value_end) {
+  const char *rec = data + start, *e = data + end;
+  const char *s = rec, *tag, *line_start, *next_line, *line_end;
+
+  while (1) {
+    tag = find_substr(s, e, tag_substr, tag_len);
+    if (tag == NULL) {
+      return 0;
+    }
+    /* Only count it if it's on a data header line, which starts with a ">" */
+    line_start = tag;
+    while (line_start > rec && line_start[-1] != '\n') {
+      line_start--;
+    }
+    if (*line_start != '>') {
+      s = tag + 1;
+      continue;
+    }
+    next_line = (const char *) memchr(tag, '\n', e - tag);
+    if (next_line == NULL || next_line + 1 == e) {
+      *value_start = *value_end = (int) (e - data);
+      return 1;
+    }
+    next_line++;
+    /* These might occur if there is no data content */
+    if (*next_line == '>' ||
+        (e - next_line >= 4 && memcmp(next_line, "$$$$", 4) == 0)) {
+      *value_start = *value_end = (int) (next_line - data);
+      return 1;
+    }
+    line_end = (const char *) memchr(next_line, '\n', e - next_line);
+    if (line_end == NULL) {
+      line_end = e;
+    }
+    *value_start = (int) (next_line - data);
+    *value_end = (int) (line_end - data);
+    return 1;
+  }
+}
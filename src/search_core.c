@@ -24,28 +24,110 @@ available, then this file will be #include'd twice.
 
 */
 
-/* count code */
-int RENAME(chemfp_count_tanimoto_arena)(
-        /* Count all matches within the given threshold */
-        double threshold,
+/***** Fixed-size kernels ******/
+
+/* See search_fixed.c. Each one is indexed by the CHEMFP_FIXED_* value
+   from chemfp_select_fixed_kernel(). */
+
+#if defined(CHEMFP_FIXED_POPCNT)
+
+#define FIXED_TARGET
+#define FIXED_POPCOUNT(fp) fixed_popcount_popcnt(FIXED_WORDS, fp)
+#define FIXED_INTERSECT_POPCOUNT(fp1, fp2) fixed_intersect_popcount_popcnt(FIXED_WORDS, fp1, fp2)
+
+#define FIXED_WORDS 3
+#define FIXED(name) RENAME(name ## _166_popcnt)
+#include "search_fixed.c"
+#undef FIXED
+#undef FIXED_WORDS
+
+#define FIXED_WORDS 14
+#define FIXED(name) RENAME(name ## _881_popcnt)
+#include "search_fixed.c"
+#undef FIXED
+#undef FIXED_WORDS
+
+#define FIXED_WORDS 16
+#define FIXED(name) RENAME(name ## _1024_popcnt)
+#include "search_fixed.c"
+#undef FIXED
+#undef FIXED_WORDS
+
+#define FIXED_WORDS 32
+#define FIXED(name) RENAME(name ## _2048_popcnt)
+#include "search_fixed.c"
+#undef FIXED
+#undef FIXED_WORDS
+
+#undef FIXED_TARGET
+#undef FIXED_POPCOUNT
+#undef FIXED_INTERSECT_POPCOUNT
+
+#if defined(CHEMFP_FIXED_AVX512)
+
+#define FIXED_TARGET TARGET_FIXED_AVX512
+#define FIXED_POPCOUNT(fp) fixed_popcount_avx512(FIXED_WORDS, fp, NULL)
+#define FIXED_INTERSECT_POPCOUNT(fp1, fp2) fixed_popcount_avx512(FIXED_WORDS, fp1, fp2)
+
+#define FIXED_WORDS 14
+#define FIXED(name) RENAME(name ## _881_avx512)
+#include "search_fixed.c"
+#undef FIXED
+#undef FIXED_WORDS
+
+#define FIXED_WORDS 16
+#define FIXED(name) RENAME(name ## _1024_avx512)
+#include "search_fixed.c"
+#undef FIXED
+#undef FIXED_WORDS
+
+#define FIXED_WORDS 32
+#define FIXED(name) RENAME(name ## _2048_avx512)
+#include "search_fixed.c"
+#undef FIXED
+#undef FIXED_WORDS
+
+#undef FIXED_TARGET
+#undef FIXED_POPCOUNT
+#undef FIXED_INTERSECT_POPCOUNT
+
+#define FIXED_AVX512_KERNELS(name) \
+  RENAME(name ## _881_avx512), RENAME(name ## _1024_avx512), RENAME(name ## _2048_avx512)
+#else
+#define FIXED_AVX512_KERNELS(name) NULL, NULL, NULL
+#endif /* CHEMFP_FIXED_AVX512 */
 
-        /* Number of bits in the fingerprint */
-        int num_bits,
+#define FIXED_KERNELS(name) NULL,                                        \
+  RENAME(name ## _166_popcnt), RENAME(name ## _881_popcnt),              \
+  RENAME(name ## _1024_popcnt), RENAME(name ## _2048_popcnt),            \
+  FIXED_AVX512_KERNELS(name)
 
-        /* Query arena, start and end indices */
-        int query_storage_size,
-        const unsigned char *query_arena, int query_start, int query_end,
+static const fixed_count_f RENAME(fixed_count_kernels)[] = {
+  FIXED_KERNELS(count_tanimoto_arena)
+};
+static const fixed_threshold_f RENAME(fixed_threshold_kernels)[] = {
+  FIXED_KERNELS(threshold_tanimoto_arena)
+};
+static const fixed_knearest_f RENAME(fixed_knearest_kernels)[] = {
+  FIXED_KERNELS(knearest_tanimoto_arena)
+};
 
-        /* Target arena, start and end indices */
-        int target_storage_size,
-        const unsigned char *target_arena, int target_start, int target_end,
+#undef FIXED_KERNELS
+#undef FIXED_AVX512_KERNELS
 
-        /* Target popcount distribution information */
-        int *target_popcount_indices,
+#endif /* CHEMFP_FIXED_POPCNT */
 
-        /* Results go into these arrays  */
-        int *result_counts
-                                           ) {
+
+/* count code */
+
+/* The count search once the special cases are out of the way. The
+   targets must have popcount indices and the threshold must be > 0.0 */
+static int
+RENAME(count_tanimoto_arena_popcounts)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, int *result_counts) {
   int query_index, target_index;
   const unsigned char *query_fp, *target_fp;
   int start, end;
@@ -55,59 +137,26 @@ int RENAME(chemfp_count_tanimoto_arena)(
   int query_popcount, start_target_popcount, end_target_popcount;
   int target_popcount;
   int intersect_popcount;
+#if defined(CHEMFP_FIXED_POPCNT)
+  int kernel;
+#endif
 
   chemfp_popcount_f calc_popcount;
   chemfp_intersect_popcount_f calc_intersect_popcount;
-  
-  if (query_start >= query_end) {
-    /* No queries */
-    return CHEMFP_OK;
-  }
-  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
-  /* (Not really needed unless you trap IEEE 754 overflow errors) */
-  if (threshold > 0.0 && threshold < 1.0/num_bits) {
-    threshold = 0.5 / num_bits;
-  }
-  if ((target_start >= target_end) || threshold > 1.0) {
-    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
-      /* No possible targets */
-      result_counts[query_index] = 0;
-    }
-    return CHEMFP_OK;
-  }
 
-  if (threshold <= 0.0) {
-    /* Everything will match, so there's no need to figure that out */
-    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
-      result_counts[query_index] = (target_end - target_start);
-    }
-    return CHEMFP_OK;
+#if defined(CHEMFP_FIXED_POPCNT)
+  /* Use the code specialized for this fingerprint size, if there is one */
+  kernel = chemfp_select_fixed_kernel(num_bits, query_storage_size, query_arena,
+                                      target_storage_size, target_arena);
+  if (kernel != CHEMFP_FIXED_NONE) {
+    return RENAME(fixed_count_kernels)[kernel](
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, result_counts);
   }
-
-  if (target_popcount_indices == NULL) {
-    /* Handle the case when precomputed targets aren't available. */
-    /* This is a slower algorithm because it tests everything. */
-#if USE_OPENMP == 1
-    #pragma omp parallel for private(query_fp, target_fp, count, target_index, score) schedule(dynamic)
 #endif
-    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
-      query_fp = query_arena + (query_start + query_index) * query_storage_size;
-      target_fp = target_arena + (target_start * target_storage_size);
-      /* Handle the popcount(query) == 0 special case? */
-      count = 0;
 
-      for (target_index = target_start; target_index < target_end;
-           target_index++, target_fp += target_storage_size) {
-        score = chemfp_byte_tanimoto(fp_size, query_fp, target_fp);
-        if (score >= threshold) {
-          count++;
-        }
-      }
-      result_counts[query_index] = count;
-    }
-    return CHEMFP_OK;
-  }
-                                                   
   /* Choose popcounts optimized for this case */
   calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
   calc_intersect_popcount = chemfp_select_intersect_popcount(
@@ -171,53 +220,106 @@ int RENAME(chemfp_count_tanimoto_arena)(
   return CHEMFP_OK;
 }
 
-int RENAME(chemfp_threshold_tanimoto_arena)(
-        /* Within the given threshold */
+
+/* Count the queries one tile of targets at a time; see QueryTiles */
+static int
+RENAME(count_tanimoto_arena_tiled)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, int *result_counts) {
+  QueryTiles tiles;
+  int *tile_counts;
+  int tile_start, tile_end, first = 0, last = 0;
+  int i;
+
+  tile_counts = (int *) malloc((query_end-query_start) * sizeof(int));
+  if (tile_counts == NULL ||
+      !init_query_tiles(&tiles, threshold, num_bits,
+                        query_storage_size, query_arena, query_start, query_end,
+                        target_storage_size, target_start, target_end,
+                        target_popcount_indices)) {
+    /* Not enough memory to sort the queries; search them in place */
+    free(tile_counts);
+    return RENAME(count_tanimoto_arena_popcounts)(
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, result_counts);
+  }
+
+  for (i = 0; i < tiles.num_queries; i++) {
+    result_counts[i] = 0;
+  }
+  for (tile_start = target_start; tile_start < target_end; tile_start = tile_end) {
+    tile_end = next_query_tile(&tiles, tile_start, target_end, &first, &last);
+    if (first == last) {
+      continue;
+    }
+    RENAME(count_tanimoto_arena_popcounts)(
+        threshold, num_bits,
+        query_storage_size, tiles.arena, first, last,
+        target_storage_size, target_arena, tile_start, tile_end,
+        target_popcount_indices, tile_counts);
+    for (i = first; i < last; i++) {
+      result_counts[tiles.order[i]] += tile_counts[i-first];
+    }
+  }
+
+  free(tile_counts);
+  free_query_tiles(&tiles);
+  return CHEMFP_OK;
+}
+
+int RENAME(chemfp_count_tanimoto_arena)(
+        /* Count all matches within the given threshold */
         double threshold,
 
         /* Number of bits in the fingerprint */
         int num_bits,
 
         /* Query arena, start and end indices */
-        int query_storage_size, const unsigned char *query_arena,
-        int query_start, int query_end,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
 
         /* Target arena, start and end indices */
-        int target_storage_size, const unsigned char *target_arena,
-        int target_start, int target_end,
+        int target_storage_size,
+        const unsigned char *target_arena, int target_start, int target_end,
 
         /* Target popcount distribution information */
-        /*  (must have at least num_bits+1 elements) */
         int *target_popcount_indices,
 
-        /* Results go here */
-        chemfp_search_result *results) {
-
+        /* Results go into these arrays  */
+        int *result_counts
+                                           ) {
   int query_index, target_index;
   const unsigned char *query_fp, *target_fp;
-  int start, end;
+  int count;
   int fp_size = (num_bits+7) / 8;
   double score;
-  int query_popcount, start_target_popcount, end_target_popcount;
-  int target_popcount;
-  int intersect_popcount, popcount_sum;
-  int numerator, denominator;
-  int add_hit_error = 0;
 
-  chemfp_popcount_f calc_popcount;
-  chemfp_intersect_popcount_f calc_intersect_popcount;
-  
   if (query_start >= query_end) {
     /* No queries */
     return CHEMFP_OK;
   }
-
   /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
   /* (Not really needed unless you trap IEEE 754 overflow errors) */
   if (threshold > 0.0 && threshold < 1.0/num_bits) {
     threshold = 0.5 / num_bits;
   }
   if ((target_start >= target_end) || threshold > 1.0) {
+    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+      /* No possible targets */
+      result_counts[query_index] = 0;
+    }
+    return CHEMFP_OK;
+  }
+
+  if (threshold <= 0.0) {
+    /* Everything will match, so there's no need to figure that out */
+    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+      result_counts[query_index] = (target_end - target_start);
+    }
     return CHEMFP_OK;
   }
 
@@ -225,31 +327,78 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
     /* Handle the case when precomputed targets aren't available. */
     /* This is a slower algorithm because it tests everything. */
 #if USE_OPENMP == 1
-    #pragma omp parallel for private(query_fp, target_fp, target_index, score) schedule(dynamic)
+    #pragma omp parallel for private(query_fp, target_fp, count, target_index, score) schedule(dynamic)
 #endif
-    for (query_index = query_start; query_index < query_end; query_index++) {
-      query_fp = query_arena + (query_index * query_storage_size);
+    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+      query_fp = query_arena + (query_start + query_index) * query_storage_size;
       target_fp = target_arena + (target_start * target_storage_size);
       /* Handle the popcount(query) == 0 special case? */
+      count = 0;
+
       for (target_index = target_start; target_index < target_end;
            target_index++, target_fp += target_storage_size) {
         score = chemfp_byte_tanimoto(fp_size, query_fp, target_fp);
         if (score >= threshold) {
-#if USE_OPENMP == 1
-          #pragma omp critical (add_hit_threshold)
-#endif
-          if (!chemfp_add_hit(results+(query_index-query_start), target_index, score)) {
-            add_hit_error = 1;
-          }
+          count++;
         }
       }
-    }
-    if (add_hit_error) {
-      return CHEMFP_NO_MEM;
+      result_counts[query_index] = count;
     }
     return CHEMFP_OK;
   }
-  
+
+  if (use_query_tiles(threshold, query_end-query_start,
+                      target_storage_size, target_start, target_end)) {
+    return RENAME(count_tanimoto_arena_tiled)(
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, result_counts);
+  }
+  return RENAME(count_tanimoto_arena_popcounts)(
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, result_counts);
+}
+
+/* The threshold search once the special cases are out of the way.
+   The targets must have popcount indices. */
+static int
+RENAME(threshold_tanimoto_arena_popcounts)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, chemfp_search_result *results) {
+  int query_index, target_index;
+  const unsigned char *query_fp, *target_fp;
+  int start, end;
+  int fp_size = (num_bits+7) / 8;
+  double score;
+  int query_popcount, start_target_popcount, end_target_popcount;
+  int target_popcount;
+  int intersect_popcount, popcount_sum;
+  int numerator, denominator;
+  int add_hit_error = 0;
+#if defined(CHEMFP_FIXED_POPCNT)
+  int kernel;
+#endif
+
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+
+#if defined(CHEMFP_FIXED_POPCNT)
+  /* Use the code specialized for this fingerprint size, if there is one */
+  kernel = chemfp_select_fixed_kernel(num_bits, query_storage_size, query_arena,
+                                      target_storage_size, target_arena);
+  if (kernel != CHEMFP_FIXED_NONE) {
+    return RENAME(fixed_threshold_kernels)[kernel](
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, results);
+  }
+#endif
 
   calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
   calc_intersect_popcount = chemfp_select_intersect_popcount(
@@ -339,6 +488,151 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
 }
 
 
+/* Search the queries one tile of targets at a time; see QueryTiles */
+static int
+RENAME(threshold_tanimoto_arena_tiled)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, chemfp_search_result *results) {
+  QueryTiles tiles;
+  chemfp_search_result *tile_results;
+  int tile_start, tile_end, first = 0, last = 0;
+  int i;
+  int result = CHEMFP_OK;
+
+  tile_results = (chemfp_search_result *) malloc((query_end-query_start) *
+                                                sizeof(chemfp_search_result));
+  if (tile_results == NULL ||
+      !init_query_tiles(&tiles, threshold, num_bits,
+                        query_storage_size, query_arena, query_start, query_end,
+                        target_storage_size, target_start, target_end,
+                        target_popcount_indices)) {
+    /* Not enough memory to sort the queries; search them in place */
+    free(tile_results);
+    return RENAME(threshold_tanimoto_arena_popcounts)(
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, results);
+  }
+
+  /* Work on the results in sorted query order. The tiles are in target */
+  /* order, so each query's hits are added in the same order as before. */
+  for (i = 0; i < tiles.num_queries; i++) {
+    tile_results[i] = results[tiles.order[i]];
+  }
+  for (tile_start = target_start; tile_start < target_end; tile_start = tile_end) {
+    tile_end = next_query_tile(&tiles, tile_start, target_end, &first, &last);
+    if (first == last) {
+      continue;
+    }
+    result = RENAME(threshold_tanimoto_arena_popcounts)(
+        threshold, num_bits,
+        query_storage_size, tiles.arena, first, last,
+        target_storage_size, target_arena, tile_start, tile_end,
+        target_popcount_indices, tile_results + first);
+    if (result != CHEMFP_OK) {
+      break;
+    }
+  }
+  for (i = 0; i < tiles.num_queries; i++) {
+    results[tiles.order[i]] = tile_results[i];
+  }
+
+  free(tile_results);
+  free_query_tiles(&tiles);
+  return result;
+}
+
+int RENAME(chemfp_threshold_tanimoto_arena)(
+        /* Within the given threshold */
+        double threshold,
+
+        /* Number of bits in the fingerprint */
+        int num_bits,
+
+        /* Query arena, start and end indices */
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+
+        /* Target arena, start and end indices */
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+
+        /* Target popcount distribution information */
+        /*  (must have at least num_bits+1 elements) */
+        int *target_popcount_indices,
+
+        /* Results go here */
+        chemfp_search_result *results) {
+
+  int query_index, target_index;
+  const unsigned char *query_fp, *target_fp;
+  int fp_size = (num_bits+7) / 8;
+  double score;
+  int add_hit_error = 0;
+
+  if (query_start >= query_end) {
+    /* No queries */
+    return CHEMFP_OK;
+  }
+
+  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
+  /* (Not really needed unless you trap IEEE 754 overflow errors) */
+  if (threshold > 0.0 && threshold < 1.0/num_bits) {
+    threshold = 0.5 / num_bits;
+  }
+  if ((target_start >= target_end) || threshold > 1.0) {
+    return CHEMFP_OK;
+  }
+
+  if (target_popcount_indices == NULL) {
+    /* Handle the case when precomputed targets aren't available. */
+    /* This is a slower algorithm because it tests everything. */
+#if USE_OPENMP == 1
+    #pragma omp parallel for private(query_fp, target_fp, target_index, score) schedule(dynamic)
+#endif
+    for (query_index = query_start; query_index < query_end; query_index++) {
+      query_fp = query_arena + (query_index * query_storage_size);
+      target_fp = target_arena + (target_start * target_storage_size);
+      /* Handle the popcount(query) == 0 special case? */
+      for (target_index = target_start; target_index < target_end;
+           target_index++, target_fp += target_storage_size) {
+        score = chemfp_byte_tanimoto(fp_size, query_fp, target_fp);
+        if (score >= threshold) {
+#if USE_OPENMP == 1
+          #pragma omp critical (add_hit_threshold)
+#endif
+          if (!chemfp_add_hit(results+(query_index-query_start), target_index, score)) {
+            add_hit_error = 1;
+          }
+        }
+      }
+    }
+    if (add_hit_error) {
+      return CHEMFP_NO_MEM;
+    }
+    return CHEMFP_OK;
+  }
+
+
+  if (use_query_tiles(threshold, query_end-query_start,
+                      target_storage_size, target_start, target_end)) {
+    return RENAME(threshold_tanimoto_arena_tiled)(
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, results);
+  }
+  return RENAME(threshold_tanimoto_arena_popcounts)(
+        threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, results);
+}
+
+
 
 static int 
 RENAME(knearest_tanimoto_arena_no_popcounts)(
@@ -452,6 +746,9 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
   int start, end;
   PopcountSearchOrder popcount_order;
   chemfp_search_result *result;
+#if defined(CHEMFP_FIXED_POPCNT)
+  int kernel;
+#endif
   
   chemfp_popcount_f calc_popcount;
   chemfp_intersect_popcount_f calc_intersect_popcount;
@@ -476,6 +773,19 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
         results);
   }
 
+#if defined(CHEMFP_FIXED_POPCNT)
+  /* Use the code specialized for this fingerprint size, if there is one */
+  kernel = chemfp_select_fixed_kernel(num_bits, query_storage_size, query_arena,
+                                      target_storage_size, target_arena);
+  if (kernel != CHEMFP_FIXED_NONE) {
+    return RENAME(fixed_knearest_kernels)[kernel](
+        k, threshold, num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, results);
+  }
+#endif
+
   /* Choose popcounts optimized for this case */
   calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
   calc_intersect_popcount = chemfp_select_intersect_popcount(
@@ -581,18 +891,224 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
       } /* looped over fingerprints */
     } /* Went through all the popcount regions */
 
-    /* We have scanned all the fingerprints. Is the heap full? */
-    if (result->num_hits < k) {
-      /* Not full, so need to heapify it. */
-      chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
-                           (chemfp_heapq_swap) double_score_swap);
+    /* We have scanned all the fingerprints. Is the heap full? */
+    if (result->num_hits < k) {
+      /* Not full, so need to heapify it. */
+      chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
+                           (chemfp_heapq_swap) double_score_swap);
+    }
+  } /* looped over all queries */
+  return CHEMFP_OK;
+}
+
+
+
+/***** k-nearest search using the per-block union index ******/
+
+/* The targets in each popcount bin are split into blocks of
+   'block_size' fingerprints, and 'block_unions' contains the bitwise
+   union (OR) of each block. Every target fingerprint in a block is a
+   subset of the union, so popcount(query & target) <= popcount(query & union).
+   Since every target in the block has the same popcount, and Tanimoto
+   increases with the intersection popcount, that gives an upper bound
+   for the whole block. If it can't beat the current k-th best score
+   then the entire block is skipped. */
+
+static void
+RENAME(knearest_blocks_one_query)(
+        int k, double threshold, int num_bits, int fp_size,
+        const unsigned char *query_fp, int query_popcount,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int block_size, int *block_indices, const unsigned char *block_unions,
+        chemfp_intersect_popcount_f calc_intersect_popcount,
+        chemfp_intersect_popcount_f calc_union_popcount,
+        chemfp_search_result *result,
+        long *num_blocks_scanned, long *num_blocks_pruned, long *num_fingerprints) {
+  PopcountSearchOrder popcount_order;
+  int target_popcount, intersect_popcount, union_popcount;
+  int start, end, block, block_start, block_end, target_index;
+  double score, best_possible_score, popcount_sum, query_threshold, block_bound;
+  const unsigned char *target_fp;
+
+  query_threshold = threshold;
+  init_search_order(&popcount_order, query_popcount, num_bits);
+
+  while (next_popcount(&popcount_order, query_threshold)) {
+    target_popcount = popcount_order.popcount;
+    best_possible_score = popcount_order.score;
+
+    if (best_possible_score < query_threshold) {
+      break;
+    }
+    if (result->num_hits == k && query_threshold >= best_possible_score) {
+      /* Can't do better than what's in the heap */
+      break;
+    }
+
+    start = target_popcount_indices[target_popcount];
+    end = target_popcount_indices[target_popcount+1];
+    if (!check_bounds(&popcount_order, &start, &end, target_start, target_end)) {
+      continue;
+    }
+    popcount_sum = (double)(query_popcount + target_popcount);
+
+    for (block = block_indices[target_popcount];
+         block < block_indices[target_popcount+1]; block++) {
+      block_start = target_popcount_indices[target_popcount] +
+        (block - block_indices[target_popcount]) * block_size;
+      block_end = block_start + block_size;
+      /* Only search the part of the block inside [start, end) */
+      if (block_start < start) {
+        block_start = start;
+      }
+      if (block_end > end) {
+        block_end = end;
+      }
+      if (block_start >= block_end) {
+        continue;
+      }
+
+      /* The query bits in the union of the block's fingerprints bound
+         the intersection, which also can't be more than the target
+         popcount. Every fingerprint in the block has that popcount. */
+      union_popcount = calc_union_popcount(fp_size, query_fp,
+                                           block_unions + block*target_storage_size);
+      if (union_popcount > target_popcount) {
+        union_popcount = target_popcount;
+      }
+      block_bound = union_popcount / (popcount_sum - union_popcount);
+      if ((result->num_hits == k) ? (block_bound <= query_threshold)
+                                  : (block_bound < query_threshold)) {
+        (*num_blocks_pruned)++;
+        continue;
+      }
+      (*num_blocks_scanned)++;
+      (*num_fingerprints) += (block_end - block_start);
+
+      target_fp = target_arena + block_start*target_storage_size;
+      for (target_index = block_start; target_index < block_end;
+           target_index++, target_fp += target_storage_size) {
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = intersect_popcount / (popcount_sum - intersect_popcount);
+
+        if (result->num_hits < k) {
+          /* The heap isn't full; only check if we're at or above the query threshold */
+          if (score >= query_threshold) {
+            chemfp_add_hit(result, target_index, score);
+            if (result->num_hits == k) {
+              chemfp_heapq_heapify(k, result,  (chemfp_heapq_lt) double_score_lt,
+                                   (chemfp_heapq_swap) double_score_swap);
+              query_threshold = result->scores[0];
+            }
+          }
+        } else if (score > query_threshold) {
+          /* We need to be strictly *better* than what's in the heap */
+          result->indices[0] = target_index;
+          result->scores[0] = score;
+          chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+                              (chemfp_heapq_swap) double_score_swap);
+          query_threshold = result->scores[0];
+        }
+      } /* looped over the fingerprints in the block */
+
+      if (result->num_hits == k && query_threshold >= best_possible_score) {
+        /* Nothing else in this popcount bin can improve the heap */
+        break;
+      }
+    } /* looped over the blocks */
+  } /* looped over the popcount bins */
+
+  if (result->num_hits < k) {
+    /* Not full, so need to heapify it. */
+    chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
+                         (chemfp_heapq_swap) double_score_swap);
+  }
+}
+
+int RENAME(chemfp_knearest_tanimoto_arena_blocks)(
+        /* Find the 'k' nearest items */
+        int k,
+        /* Within the given threshold */
+        double threshold,
+
+        /* Size of the fingerprints and size of the storage block */
+        int num_bits,
+
+        /* Query arena, start and end indices */
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+
+        /* Target arena, start and end indices */
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+
+        /* Target popcount distribution information */
+        int *target_popcount_indices,
+
+        /* Block index, from chemfp_make_knearest_block_index() */
+        int block_size, int *block_indices, const unsigned char *block_unions,
+
+        /* Results go into these arrays  */
+        chemfp_search_result *results,
+
+        /* Incremented with the number of blocks scanned, blocks pruned,
+           and fingerprints compared */
+        long *stats
+                                   ) {
+  int fp_size;
+  int query_index, query_popcount;
+  const unsigned char *query_fp;
+  long num_blocks_scanned = 0, num_blocks_pruned = 0, num_fingerprints = 0;
+
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount, calc_union_popcount;
+
+  if (query_start >= query_end) {
+    return CHEMFP_OK;
+  }
+  /* k == 0 is a valid input, and of course the result is no matches */
+  if (k == 0) {
+    return CHEMFP_OK;
+  }
+  fp_size = (num_bits+7)/8;
+
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+  calc_union_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, block_unions);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for private(query_fp, query_popcount) \
+      reduction(+:num_blocks_scanned, num_blocks_pruned, num_fingerprints) \
+      schedule(dynamic)
+#endif
+  for (query_index=0; query_index < (query_end-query_start); query_index++) {
+    query_fp = query_arena + (query_start+query_index) * query_storage_size;
+    query_popcount = calc_popcount(fp_size, query_fp);
+    if (query_popcount == 0) {
+      /* Same as chemfp_knearest_tanimoto_arena(); this never returns hits */
+      continue;
     }
-  } /* looped over all queries */
+    RENAME(knearest_blocks_one_query)(
+        k, threshold, num_bits, fp_size, query_fp, query_popcount,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices, block_size, block_indices, block_unions,
+        calc_intersect_popcount, calc_union_popcount,
+        results+query_index,
+        &num_blocks_scanned, &num_blocks_pruned, &num_fingerprints);
+  }
+
+  stats[0] += num_blocks_scanned;
+  stats[1] += num_blocks_pruned;
+  stats[2] += num_fingerprints;
   return CHEMFP_OK;
 }
 
-
-
 /***** Special support for the NxN symmetric case ******/
 
 /* TODO: implement the k-nearest variant. It's harder because a k-nearest
@@ -1085,3 +1601,299 @@ int RENAME(chemfp_knearest_tanimoto_arena_symmetric)(
   } /* looped over all queries */
   return CHEMFP_OK;
 }
+
+
+/***** Searches with a chemfp_metric ******/
+
+/* These are the generic versions of the count, threshold and
+   k-nearest searches, for the metrics in metrics.c. The popcount
+   bins are pruned with chemfp_metric_best_score() instead of the
+   Tanimoto-specific limits from Swamidass and Baldi, so the searches
+   are still sublinear. Without the popcount indices every target is
+   tested. */
+
+int RENAME(chemfp_count_metric_arena)(
+        const chemfp_metric *metric, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  int query_index, target_index;
+  const unsigned char *query_fp, *target_fp;
+  int start, end, count;
+  int fp_size = (num_bits+7) / 8;
+  int query_popcount, target_popcount, intersect_popcount;
+  double score;
+
+  chemfp_popcount_f calc_popcount, calc_target_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+
+  if (query_start >= query_end) {
+    return CHEMFP_OK;
+  }
+  if (target_start >= target_end || threshold > 1.0) {
+    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+      result_counts[query_index] = 0;
+    }
+    return CHEMFP_OK;
+  }
+  if (threshold <= 0.0) {
+    /* Every score is at least 0.0, so everything matches */
+    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+      result_counts[query_index] = (target_end - target_start);
+    }
+    return CHEMFP_OK;
+  }
+
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_target_popcount = chemfp_select_popcount(num_bits, target_storage_size, target_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_fp, query_popcount, count, target_popcount, start, end, \
+          target_fp, target_index, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
+  for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+    query_fp = query_arena + (query_start + query_index) * query_storage_size;
+    query_popcount = calc_popcount(fp_size, query_fp);
+    count = 0;
+
+    if (target_popcount_indices == NULL) {
+      target_fp = target_arena + (target_start * target_storage_size);
+      for (target_index = target_start; target_index < target_end;
+           target_index++, target_fp += target_storage_size) {
+        target_popcount = calc_target_popcount(fp_size, target_fp);
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = chemfp_metric_score(metric, num_bits, query_popcount,
+                                    target_popcount, intersect_popcount);
+        if (score >= threshold) {
+          count++;
+        }
+      }
+      result_counts[query_index] = count;
+      continue;
+    }
+
+    for (target_popcount = 0; target_popcount <= num_bits; target_popcount++) {
+      if (chemfp_metric_best_score(metric, num_bits, query_popcount, target_popcount) < threshold) {
+        continue;
+      }
+      start = target_popcount_indices[target_popcount];
+      end = target_popcount_indices[target_popcount+1];
+      if (start < target_start) {
+        start = target_start;
+      }
+      if (end > target_end) {
+        end = target_end;
+      }
+      target_fp = target_arena + (start * target_storage_size);
+      for (target_index = start; target_index < end;
+           target_index++, target_fp += target_storage_size) {
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = chemfp_metric_score(metric, num_bits, query_popcount,
+                                    target_popcount, intersect_popcount);
+        if (score >= threshold) {
+          count++;
+        }
+      }
+    }
+    result_counts[query_index] = count;
+  }
+  return CHEMFP_OK;
+}
+
+int RENAME(chemfp_threshold_metric_arena)(
+        const chemfp_metric *metric, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  int query_index, target_index;
+  const unsigned char *query_fp, *target_fp;
+  int start, end;
+  int fp_size = (num_bits+7) / 8;
+  int query_popcount, target_popcount, intersect_popcount;
+  double score;
+  int add_hit_error = 0;
+
+  chemfp_popcount_f calc_popcount, calc_target_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+
+  if (query_start >= query_end) {
+    return CHEMFP_OK;
+  }
+  if (target_start >= target_end || threshold > 1.0) {
+    return CHEMFP_OK;
+  }
+
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_target_popcount = chemfp_select_popcount(num_bits, target_storage_size, target_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_fp, query_popcount, target_popcount, start, end, \
+          target_fp, target_index, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
+  for (query_index = query_start; query_index < query_end; query_index++) {
+    query_fp = query_arena + (query_index * query_storage_size);
+    query_popcount = calc_popcount(fp_size, query_fp);
+
+    if (target_popcount_indices == NULL) {
+      target_fp = target_arena + (target_start * target_storage_size);
+      for (target_index = target_start; target_index < target_end;
+           target_index++, target_fp += target_storage_size) {
+        target_popcount = calc_target_popcount(fp_size, target_fp);
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = chemfp_metric_score(metric, num_bits, query_popcount,
+                                    target_popcount, intersect_popcount);
+        if (score >= threshold) {
+#if USE_OPENMP == 1
+          #pragma omp critical (add_hit_threshold)
+#endif
+          if (!chemfp_add_hit(results+(query_index-query_start), target_index, score)) {
+            add_hit_error = 1;
+          }
+        }
+      }
+      continue;
+    }
+
+    for (target_popcount = 0; target_popcount <= num_bits; target_popcount++) {
+      if (chemfp_metric_best_score(metric, num_bits, query_popcount, target_popcount) < threshold) {
+        continue;
+      }
+      start = target_popcount_indices[target_popcount];
+      end = target_popcount_indices[target_popcount+1];
+      if (start < target_start) {
+        start = target_start;
+      }
+      if (end > target_end) {
+        end = target_end;
+      }
+      target_fp = target_arena + (start * target_storage_size);
+      for (target_index = start; target_index < end;
+           target_index++, target_fp += target_storage_size) {
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = chemfp_metric_score(metric, num_bits, query_popcount,
+                                    target_popcount, intersect_popcount);
+        if (score >= threshold) {
+#if USE_OPENMP == 1
+          #pragma omp critical (add_hit_threshold)
+#endif
+          if (!chemfp_add_hit(results+(query_index-query_start), target_index, score)) {
+            add_hit_error = 1;
+          }
+        }
+      }
+    }
+  }
+  if (add_hit_error) {
+    return CHEMFP_NO_MEM;
+  }
+  return CHEMFP_OK;
+}
+
+int RENAME(chemfp_knearest_metric_arena)(
+        const chemfp_metric *metric, int k, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  int query_index, target_index;
+  const unsigned char *query_fp, *target_fp;
+  int start, end;
+  int fp_size = (num_bits+7) / 8;
+  int query_popcount, target_popcount, intersect_popcount;
+  double score;
+  MetricSearchOrder order;
+  chemfp_search_result *result;
+
+  chemfp_popcount_f calc_popcount, calc_target_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+
+  /* k == 0 is a valid input, and of course the result is no matches */
+  if (query_start >= query_end || k == 0) {
+    return CHEMFP_OK;
+  }
+
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_target_popcount = chemfp_select_popcount(num_bits, target_storage_size, target_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(result, query_fp, query_popcount, order, target_popcount, start, end, \
+          target_fp, target_index, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
+  for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+    result = results+query_index;
+    query_fp = query_arena + (query_start+query_index) * query_storage_size;
+    query_popcount = calc_popcount(fp_size, query_fp);
+
+    if (target_popcount_indices == NULL) {
+      target_fp = target_arena + (target_start * target_storage_size);
+      for (target_index = target_start; target_index < target_end;
+           target_index++, target_fp += target_storage_size) {
+        target_popcount = calc_target_popcount(fp_size, target_fp);
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = chemfp_metric_score(metric, num_bits, query_popcount,
+                                    target_popcount, intersect_popcount);
+        metric_heap_add(k, threshold, result, target_index, score);
+      }
+    } else {
+      /* Look through the popcount bins in best-first order */
+      init_metric_search_order(&order, metric, num_bits, query_popcount);
+      while (next_metric_popcount(&order)) {
+        if (result->num_hits < k) {
+          if (order.score < threshold) {
+            break;
+          }
+        } else if (order.score <= result->scores[0]) {
+          /* Can't do better. Might as well give up. */
+          break;
+        }
+        target_popcount = order.popcount;
+        start = target_popcount_indices[target_popcount];
+        end = target_popcount_indices[target_popcount+1];
+        if (start < target_start) {
+          start = target_start;
+        }
+        if (end > target_end) {
+          end = target_end;
+        }
+        target_fp = target_arena + (start * target_storage_size);
+        for (target_index = start; target_index < end;
+             target_index++, target_fp += target_storage_size) {
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          score = chemfp_metric_score(metric, num_bits, query_popcount,
+                                      target_popcount, intersect_popcount);
+          metric_heap_add(k, threshold, result, target_index, score);
+        }
+      }
+    }
+
+    /* Is the heap full? If not then it still needs to be heapified */
+    if (result->num_hits < k) {
+      chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
+                           (chemfp_heapq_swap) double_score_swap);
+    }
+  }
+  return CHEMFP_OK;
+}
@@ -0,0 +1,278 @@
+/* Fixed-size versions of the popcount-indexed Tanimoto searches.
+
+ This file is #include'd from search_core.c once for each
+ fingerprint size and popcount instruction, which means it's compiled
+ once for each combination of size, instruction and OpenMP path. The
+ includer defines:
+
+   FIXED(name) -- the function name for this size, like RENAME(name ## _166)
+   FIXED_WORDS -- the number of 64-bit words in the fingerprint
+   FIXED_TARGET -- the function attribute needed for the instruction set (may be empty)
+   FIXED_POPCOUNT(fp) -- popcount of FIXED_WORDS 64-bit words
+   FIXED_INTERSECT_POPCOUNT(fp1, fp2) -- popcount of their intersection
+
+ The loops are the same as in chemfp_count_tanimoto_arena(),
+ chemfp_threshold_tanimoto_arena() and chemfp_knearest_tanimoto_arena().
+ Those functions handle the special cases and only call these once
+ they know the arenas have popcount indices and the fingerprint
+ storage is 8 byte aligned. Since the number of words is a
+ compile-time constant, the compiler unrolls the popcount loop and
+ inlines it into the search loop, so there is no function call and
+ no length loop for each target. */
+
+FIXED_TARGET
+static int FIXED(count_tanimoto_arena)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, int *result_counts) {
+  int query_index, target_index;
+  const uint64_t *query_fp;
+  const unsigned char *target_fp;
+  int start, end;
+  int count;
+  double score, popcount_sum;
+  int query_popcount, start_target_popcount, end_target_popcount;
+  int target_popcount;
+  int intersect_popcount;
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_fp, query_popcount, start_target_popcount, end_target_popcount, \
+          count, target_popcount, start, end, target_fp, popcount_sum, target_index, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
+  for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+    query_fp = (const uint64_t *) (query_arena + (query_start + query_index) * query_storage_size);
+    query_popcount = FIXED_POPCOUNT(query_fp);
+    if (query_popcount == 0) {
+      if (threshold == 0.0) {
+        result_counts[query_index] = (target_end - target_start);
+      }
+      continue;
+    }
+    if (threshold == 0.0) {
+      start_target_popcount = 0;
+      end_target_popcount = num_bits;
+    } else {
+      start_target_popcount = (int)(query_popcount * threshold);
+      end_target_popcount = (int)(ceil(query_popcount / threshold));
+      if (end_target_popcount > num_bits) {
+        end_target_popcount = num_bits;
+      }
+    }
+    count = 0;
+    for (target_popcount = start_target_popcount; target_popcount <= end_target_popcount;
+         target_popcount++) {
+      start = target_popcount_indices[target_popcount];
+      end = target_popcount_indices[target_popcount+1];
+      if (start < target_start) {
+        start = target_start;
+      }
+      if (end > target_end) {
+        end = target_end;
+      }
+
+      target_fp = target_arena + (start * target_storage_size);
+      popcount_sum = query_popcount + target_popcount;
+      for (target_index = start; target_index < end;
+           target_index++, target_fp += target_storage_size) {
+        intersect_popcount = FIXED_INTERSECT_POPCOUNT(query_fp, (const uint64_t *) target_fp);
+        score = intersect_popcount / (popcount_sum - intersect_popcount);
+        if (score >= threshold) {
+          count++;
+        }
+      }
+    }
+    result_counts[query_index] = count;
+  }
+  return CHEMFP_OK;
+}
+
+FIXED_TARGET
+static int FIXED(threshold_tanimoto_arena)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, chemfp_search_result *results) {
+  int query_index, target_index;
+  const uint64_t *query_fp;
+  const unsigned char *target_fp;
+  int start, end;
+  double score;
+  int query_popcount, start_target_popcount, end_target_popcount;
+  int target_popcount;
+  int intersect_popcount, popcount_sum;
+  int numerator, denominator;
+  int add_hit_error = 0;
+
+  denominator = num_bits * 10;
+  numerator = (int)(threshold * denominator);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_fp, query_popcount, target_index, target_fp, start_target_popcount, \
+          end_target_popcount, target_popcount, start, end, popcount_sum, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
+  for (query_index = query_start; query_index < query_end; query_index++) {
+    query_fp = (const uint64_t *) (query_arena + (query_index * query_storage_size));
+    query_popcount = FIXED_POPCOUNT(query_fp);
+
+    if (query_popcount == 0) {
+      if (threshold == 0.0) {
+#if USE_OPENMP == 1
+        #pragma omp critical (add_hit_threshold)
+#endif
+        for (target_index = target_start; target_index < target_end; target_index++) {
+          if (!chemfp_add_hit(results+(query_index-query_start), target_index, 0.0)) {
+            add_hit_error = 1;
+          }
+        }
+      }
+      continue;
+    }
+
+    if (threshold == 0.0) {
+      start_target_popcount = 0;
+      end_target_popcount = num_bits;
+    } else {
+      start_target_popcount = (int)(query_popcount * threshold);
+      end_target_popcount = (int)(ceil(query_popcount / threshold));
+      if (end_target_popcount > num_bits) {
+        end_target_popcount = num_bits;
+      }
+    }
+
+    for (target_popcount=start_target_popcount; target_popcount<=end_target_popcount;
+         target_popcount++) {
+      start = target_popcount_indices[target_popcount];
+      end = target_popcount_indices[target_popcount+1];
+      if (start < target_start) {
+        start = target_start;
+      }
+      if (end > target_end) {
+        end = target_end;
+      }
+
+      target_fp = target_arena + (start * target_storage_size);
+      popcount_sum = query_popcount + target_popcount;
+      for (target_index = start; target_index < end;
+           target_index++, target_fp += target_storage_size) {
+        intersect_popcount = FIXED_INTERSECT_POPCOUNT(query_fp, (const uint64_t *) target_fp);
+        if (denominator * intersect_popcount  >=
+            numerator * (popcount_sum - intersect_popcount)) {
+          score = ((double) intersect_popcount) / (popcount_sum - intersect_popcount);
+#if USE_OPENMP == 1
+          #pragma omp critical (add_hit_threshold)
+#endif
+          if (!chemfp_add_hit(results+(query_index-query_start), target_index, score)) {
+            add_hit_error = 1;
+          }
+        }
+      }
+    }
+  }
+  if (add_hit_error) {
+    return CHEMFP_NO_MEM;
+  }
+  return CHEMFP_OK;
+}
+
+FIXED_TARGET
+static int FIXED(knearest_tanimoto_arena)(
+        int k, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, chemfp_search_result *results) {
+  int query_popcount, target_popcount, intersect_popcount;
+  double score, best_possible_score, popcount_sum, query_threshold;
+  const uint64_t *query_fp;
+  const unsigned char *target_fp;
+  int query_index, target_index;
+  int start, end;
+  PopcountSearchOrder popcount_order;
+  chemfp_search_result *result;
+
+  for (query_index=0; query_index < (query_end-query_start); query_index++) {
+    result = results+query_index;
+    query_fp = (const uint64_t *) (query_arena + (query_start+query_index) * query_storage_size);
+
+    query_threshold = threshold;
+    query_popcount = FIXED_POPCOUNT(query_fp);
+
+    if (query_popcount == 0) {
+      continue;
+    }
+
+    init_search_order(&popcount_order, query_popcount, num_bits);
+
+    while (next_popcount(&popcount_order, query_threshold)) {
+      target_popcount = popcount_order.popcount;
+      best_possible_score = popcount_order.score;
+
+      if (best_possible_score < query_threshold) {
+        break;
+      }
+
+      start = target_popcount_indices[target_popcount];
+      end = target_popcount_indices[target_popcount+1];
+
+      if (!check_bounds(&popcount_order, &start, &end, target_start, target_end)) {
+        continue;
+      }
+
+      target_fp = target_arena + start*target_storage_size;
+      popcount_sum = (double)(query_popcount + target_popcount);
+
+      target_index = start;
+
+      if (result->num_hits < k) {
+        for (; target_index<end; target_index++, target_fp += target_storage_size) {
+          intersect_popcount = FIXED_INTERSECT_POPCOUNT(query_fp, (const uint64_t *) target_fp);
+          score = intersect_popcount / (popcount_sum - intersect_popcount);
+
+          if (score >= query_threshold) {
+            chemfp_add_hit(result, target_index, score);
+            if (result->num_hits == k) {
+              chemfp_heapq_heapify(k, result,  (chemfp_heapq_lt) double_score_lt,
+                                   (chemfp_heapq_swap) double_score_swap);
+              query_threshold = result->scores[0];
+              target_index++;
+              target_fp += target_storage_size;
+              goto heap_replace;
+            }
+          }
+        }
+        continue;
+      }
+
+    heap_replace:
+      if (query_threshold >= best_possible_score) {
+        break;
+      }
+
+      for (; target_index<end; target_index++, target_fp += target_storage_size) {
+        intersect_popcount = FIXED_INTERSECT_POPCOUNT(query_fp, (const uint64_t *) target_fp);
+        score = intersect_popcount / (popcount_sum - intersect_popcount);
+
+        if (score > query_threshold) {
+          result->indices[0] = target_index;
+          result->scores[0] = score;
+          chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+                              (chemfp_heapq_swap) double_score_swap);
+          query_threshold = result->scores[0];
+          if (query_threshold >= best_possible_score) {
+            break;
+          }
+        }
+      }
+    }
+
+    if (result->num_hits < k) {
+      chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
+                           (chemfp_heapq_swap) double_score_swap);
+    }
+  }
+  return CHEMFP_OK;
+}
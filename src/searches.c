@@ -7,6 +7,7 @@
 #include "heapq.h"
 #include "chemfp.h"
 #include "chemfp_internal.h"
+#include "popcount.h"
 
 #if defined(_OPENMP)
   #include <omp.h>
@@ -180,8 +181,347 @@ void chemfp_knearest_results_finalize(chemfp_search_result *results_start,
 }
 
 
+/**** Support for the searches with a chemfp_metric ****/
+
+/* The best possible score for a target popcount increases up to the
+   query popcount then decreases (see metrics.c), so the best-first
+   order steps up and down from the query popcount, taking whichever
+   side has the better bound. */
+
+typedef struct {
+  const chemfp_metric *metric;
+  int num_bits;
+  int query_popcount;
+  int up_popcount;
+  int down_popcount;
+  double up_score;
+  double down_score;
+  int popcount;
+  double score;
+} MetricSearchOrder;
+
+static double metric_order_score(MetricSearchOrder *order, int target_popcount) {
+  if (target_popcount < 0 || target_popcount > order->num_bits) {
+    return -1.0;
+  }
+  return chemfp_metric_best_score(order->metric, order->num_bits,
+                                  order->query_popcount, target_popcount);
+}
+
+static void init_metric_search_order(MetricSearchOrder *order, const chemfp_metric *metric,
+                                     int num_bits, int query_popcount) {
+  order->metric = metric;
+  order->num_bits = num_bits;
+  order->query_popcount = query_popcount;
+  order->up_popcount = query_popcount;
+  order->down_popcount = query_popcount-1;
+  order->up_score = metric_order_score(order, order->up_popcount);
+  order->down_score = metric_order_score(order, order->down_popcount);
+}
+
+static int next_metric_popcount(MetricSearchOrder *order) {
+  if (order->up_score < 0.0 && order->down_score < 0.0) {
+    return 0;
+  }
+  if (order->up_score >= order->down_score) {
+    order->popcount = (order->up_popcount)++;
+    order->score = order->up_score;
+    order->up_score = metric_order_score(order, order->up_popcount);
+  } else {
+    order->popcount = (order->down_popcount)--;
+    order->score = order->down_score;
+    order->down_score = metric_order_score(order, order->down_popcount);
+  }
+  return 1;
+}
+
+/* Add a hit to a k-nearest heap, if it's good enough */
+static void metric_heap_add(int k, double threshold, chemfp_search_result *result,
+                            int target_index, double score) {
+  if (result->num_hits < k) {
+    if (score >= threshold) {
+      chemfp_add_hit(result, target_index, score);
+      if (result->num_hits == k) {
+        chemfp_heapq_heapify(k, result, (chemfp_heapq_lt) double_score_lt,
+                             (chemfp_heapq_swap) double_score_swap);
+      }
+    }
+  } else if (score > result->scores[0]) {
+    /* We need to be strictly *better* than what's in the heap */
+    result->indices[0] = target_index;
+    result->scores[0] = score;
+    chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+                        (chemfp_heapq_swap) double_score_swap);
+  }
+}
+
+
 #define MAX(x, y) ((x) > (y) ? (x) : (y))
 
+
+/***** Popcounts for the fixed-size kernels in search_fixed.c ***/
+
+/* The number of words is a compile-time constant at each call site,
+   so once these are inlined the compiler unrolls the loop. */
+
+#if defined(CHEMFP_FIXED_POPCNT)
+
+#if defined(_MSC_VER)
+  #include <nmmintrin.h>
+  #define FIXED_INLINE static __forceinline
+  #define TARGET_FIXED_AVX512
+static uint64_t fixed_popcnt64(uint64_t x) {
+  return _mm_popcnt_u64(x);
+}
+#else
+  #define FIXED_INLINE static inline __attribute__((always_inline))
+  #define TARGET_FIXED_AVX512 __attribute__((target("avx512f,avx512vpopcntdq")))
+FIXED_INLINE uint64_t fixed_popcnt64(uint64_t x) {
+  __asm__ ("popcnt %1, %0" : "=r" (x) : "0" (x));
+  return x;
+}
+#endif
+
+FIXED_INLINE int fixed_popcount_popcnt(int num_words, const uint64_t *fp) {
+  uint64_t count = 0;
+  int i;
+  for (i = 0; i < num_words; i++) {
+    count += fixed_popcnt64(fp[i]);
+  }
+  return (int) count;
+}
+
+FIXED_INLINE int fixed_intersect_popcount_popcnt(int num_words, const uint64_t *fp1,
+                                                 const uint64_t *fp2) {
+  uint64_t count = 0;
+  int i;
+  for (i = 0; i < num_words; i++) {
+    count += fixed_popcnt64(fp1[i] & fp2[i]);
+  }
+  return (int) count;
+}
+
+#endif /* CHEMFP_FIXED_POPCNT */
+
+#if defined(CHEMFP_FIXED_AVX512)
+
+#include <immintrin.h>
+
+/* fp2 is NULL for a popcount, otherwise this is the intersection popcount */
+TARGET_FIXED_AVX512
+FIXED_INLINE int fixed_popcount_avx512(int num_words, const uint64_t *fp1, const uint64_t *fp2) {
+  __m512i total = _mm512_setzero_si512();
+  __m512i v;
+  __mmask8 mask;
+  int i, count;
+
+  for (i = 0; i + 8 <= num_words; i += 8) {
+    v = _mm512_loadu_si512((const void *) (fp1 + i));
+    if (fp2 != NULL) {
+      v = _mm512_and_si512(v, _mm512_loadu_si512((const void *) (fp2 + i)));
+    }
+    total = _mm512_add_epi64(total, _mm512_popcnt_epi64(v));
+  }
+  if (i < num_words) {
+    mask = (__mmask8) ((1u << (num_words - i)) - 1);
+    v = _mm512_maskz_loadu_epi64(mask, (const void *) (fp1 + i));
+    if (fp2 != NULL) {
+      v = _mm512_and_si512(v, _mm512_maskz_loadu_epi64(mask, (const void *) (fp2 + i)));
+    }
+    total = _mm512_add_epi64(total, _mm512_popcnt_epi64(v));
+  }
+  count = (int) _mm512_reduce_add_epi64(total);
+  /* The rest of the search loop is SSE code. Clear the upper register */
+  /* state or each SSE instruction pays for the AVX-SSE transition. */
+  _mm256_zeroupper();
+  return count;
+}
+
+#endif /* CHEMFP_FIXED_AVX512 */
+
+typedef int (*fixed_count_f)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, int *result_counts);
+
+typedef int (*fixed_threshold_f)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, chemfp_search_result *results);
+
+typedef int (*fixed_knearest_f)(
+        int k, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices, chemfp_search_result *results);
+
+
+/***** Cache-blocked searches ***/
+
+/* Each query in a count or threshold search scans its own range of
+   target popcounts. For a large target arena and many queries, that
+   means the same targets are read from main memory once per query.
+
+   Instead, the tiled searches sort the queries by popcount and split
+   the targets into tiles of about 'chemfp_tile_size' bytes, which
+   should fit in the L2 cache. Each tile is searched by every query
+   whose popcount range overlaps it, before going on to the next tile.
+   Because the queries are sorted, those queries are a contiguous block
+   which moves forward with the tiles. */
+
+static int chemfp_tile_size = 256*1024;
+
+int chemfp_get_option_tile_size(void) {
+  return chemfp_tile_size;
+}
+int chemfp_set_option_tile_size(int value) {
+  /* 0 disables tiling */
+  if (value < 0) {
+    return CHEMFP_BAD_ARG;
+  }
+  chemfp_tile_size = value;
+  return CHEMFP_OK;
+}
+
+typedef struct {
+  int num_queries;
+  int tile_num_targets;
+  unsigned char *buffer;
+  const unsigned char *arena;  /* query fingerprints, sorted by popcount */
+  int *order;                  /* original query offset of each sorted query */
+  int *start_indices;          /* the target index range which might contain */
+  int *end_indices;            /*   a hit for each sorted query */
+} QueryTiles;
+
+static int use_query_tiles(double threshold, int num_queries, int target_storage_size,
+                           int target_start, int target_end) {
+  /* With a threshold of 0.0 everything is a hit, so there's nothing to gain */
+  if (chemfp_tile_size == 0 || threshold <= 0.0 || num_queries < 2) {
+    return 0;
+  }
+  return ((double) (target_end - target_start)) * target_storage_size > chemfp_tile_size;
+}
+
+static void free_query_tiles(QueryTiles *tiles) {
+  free(tiles->buffer);
+  free(tiles->order);
+}
+
+/* Returns 0 if there isn't enough memory */
+static int init_query_tiles(QueryTiles *tiles, double threshold, int num_bits,
+                            int query_storage_size, const unsigned char *query_arena,
+                            int query_start, int query_end,
+                            int target_storage_size, int target_start, int target_end,
+                            int *target_popcount_indices) {
+  int num_queries = query_end - query_start;
+  int fp_size = (num_bits+7) / 8;
+  int *popcounts, *popcount_starts;
+  unsigned char *arena;
+  chemfp_popcount_f calc_popcount;
+  int i, j, popcount, start_popcount, end_popcount, start, end;
+
+  tiles->num_queries = num_queries;
+  tiles->buffer = (unsigned char *) malloc(((size_t) num_queries) * query_storage_size + 64);
+  tiles->order = (int *) malloc(3 * ((size_t) num_queries) * sizeof(int));
+  popcounts = (int *) malloc(num_queries * sizeof(int));
+  popcount_starts = (int *) calloc(num_bits+2, sizeof(int));
+  if (tiles->buffer == NULL || tiles->order == NULL ||
+      popcounts == NULL || popcount_starts == NULL) {
+    free_query_tiles(tiles);
+    free(popcounts);
+    free(popcount_starts);
+    return 0;
+  }
+  tiles->start_indices = tiles->order + num_queries;
+  tiles->end_indices = tiles->start_indices + num_queries;
+
+  /* Keep the 64 byte alignment in case the popcount method needs it */
+  arena = tiles->buffer + ((64 - ALIGNMENT(tiles->buffer, 64)) % 64);
+  tiles->arena = arena;
+
+  tiles->tile_num_targets = chemfp_tile_size / target_storage_size;
+  if (tiles->tile_num_targets < 1) {
+    tiles->tile_num_targets = 1;
+  }
+
+  /* Counting sort by popcount. It's stable, so ties keep their order */
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  for (i = 0; i < num_queries; i++) {
+    popcounts[i] = calc_popcount(fp_size, query_arena + (query_start+i) * query_storage_size);
+    popcount_starts[popcounts[i]+1]++;
+  }
+  for (popcount = 1; popcount <= num_bits+1; popcount++) {
+    popcount_starts[popcount] += popcount_starts[popcount-1];
+  }
+
+  for (i = 0; i < num_queries; i++) {
+    popcount = popcounts[i];
+    j = popcount_starts[popcount]++;
+    tiles->order[j] = i;
+    memcpy(arena + ((size_t) j) * query_storage_size,
+           query_arena + ((size_t) (query_start+i)) * query_storage_size,
+           query_storage_size);
+
+    /* The same limits as the search code. A query with no bits set */
+    /* can't have a hit when the threshold is > 0.0. */
+    if (popcount == 0) {
+      start = end = target_start;
+    } else {
+      start_popcount = (int)(popcount * threshold);
+      end_popcount = (int)(ceil(popcount / threshold));
+      if (end_popcount > num_bits) {
+        end_popcount = num_bits;
+      }
+      start = target_popcount_indices[start_popcount];
+      end = target_popcount_indices[end_popcount+1];
+      /* Clip to the target range. Both limits still increase with the popcount */
+      start = (start < target_start) ? target_start : ((start > target_end) ? target_end : start);
+      end = (end < target_start) ? target_start : ((end > target_end) ? target_end : end);
+    }
+    tiles->start_indices[j] = start;
+    tiles->end_indices[j] = end;
+  }
+  free(popcounts);
+  free(popcount_starts);
+  return 1;
+}
+
+/* Find the next tile, starting at 'tile_start', and the sorted queries
+   [*first, *last) which need to search it. Returns the end of the tile.
+   If no query needs it then *first == *last and the returned tile
+   ends where the next query's range starts. */
+static int next_query_tile(const QueryTiles *tiles, int tile_start, int target_end,
+                           int *first, int *last) {
+  int tile_end;
+  int i = *first;
+
+  while (i < tiles->num_queries && tiles->end_indices[i] <= tile_start) {
+    i++;
+  }
+  *first = i;
+  if (*last < i) {
+    *last = i;
+  }
+  if (i == tiles->num_queries) {
+    return target_end;
+  }
+  if (tiles->start_indices[i] > tile_start) {
+    return tiles->start_indices[i];
+  }
+
+  if (target_end - tile_start > tiles->tile_num_targets) {
+    tile_end = tile_start + tiles->tile_num_targets;
+  } else {
+    tile_end = target_end;
+  }
+  while (*last < tiles->num_queries && tiles->start_indices[*last] < tile_end) {
+    (*last)++;
+  }
+  return tile_end;
+}
+
                              
 /***** Define the main interface code ***/
 
@@ -418,6 +758,124 @@ int chemfp_knearest_tanimoto_arena_symmetric(
 }  
   
 
+int chemfp_knearest_tanimoto_arena_blocks(
+        /* Find the 'k' nearest items */
+        int k,
+        /* Within the given threshold */
+        double threshold,
+
+        /* Number of bits in the fingerprint */
+        int num_bits,
+
+        /* Query arena, start and end indices */
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+
+        /* Target arena, start and end indices */
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+
+        /* Target popcount distribution information */
+        /*  (must have at least num_bits+1 elements) */
+        int *target_popcount_indices,
+
+        /* Block index, from chemfp_make_knearest_block_index() */
+        int block_size, int *block_indices, const unsigned char *block_unions,
+
+        /* Results go here */
+        chemfp_search_result *results,
+
+        /* Pruning statistics */
+        long *stats) {
+
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_knearest_tanimoto_arena_blocks_single(
+                           k, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices,
+                           block_size, block_indices, block_unions,
+                           results, stats);
+  } else {
+    return chemfp_knearest_tanimoto_arena_blocks_openmp(
+                           k, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices,
+                           block_size, block_indices, block_unions,
+                           results, stats);
+  }
+}
+
+int chemfp_count_metric_arena(
+        const chemfp_metric *metric, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_count_metric_arena_single(
+                           metric, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, result_counts);
+  } else {
+    return chemfp_count_metric_arena_openmp(
+                           metric, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, result_counts);
+  }
+}
+
+int chemfp_threshold_metric_arena(
+        const chemfp_metric *metric, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_threshold_metric_arena_single(
+                           metric, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  } else {
+    return chemfp_threshold_metric_arena_openmp(
+                           metric, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  }
+}
+
+int chemfp_knearest_metric_arena(
+        const chemfp_metric *metric, int k, double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_knearest_metric_arena_single(
+                           metric, k, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  } else {
+    return chemfp_knearest_metric_arena_openmp(
+                           metric, k, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  }
+}
+
 #else
 
 /* Not compiling for OpenMP; don't need the run-time switch */
@@ -431,3 +889,46 @@ int chemfp_knearest_tanimoto_arena_symmetric(
 
 #endif
 
+
+/* Build the block index used by chemfp_knearest_tanimoto_arena_blocks() */
+/* The caller must allocate 'block_unions' with space for
+   chemfp_get_num_knearest_blocks() * storage_size bytes, and
+   'block_indices' with space for num_bits+2 integers. */
+
+int chemfp_get_num_knearest_blocks(int num_bits, int *popcount_indices, int block_size) {
+  int popcount, num_blocks = 0, n;
+  for (popcount=0; popcount<=num_bits; popcount++) {
+    n = popcount_indices[popcount+1] - popcount_indices[popcount];
+    num_blocks += (n + block_size - 1) / block_size;
+  }
+  return num_blocks;
+}
+
+int chemfp_make_knearest_block_index(
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int *popcount_indices, int block_size,
+        int *block_indices, unsigned char *block_unions) {
+  int popcount, block, index, end, i;
+  const unsigned char *fp;
+  unsigned char *block_union;
+
+  block = 0;
+  for (popcount=0; popcount<=num_bits; popcount++) {
+    block_indices[popcount] = block;
+    end = popcount_indices[popcount+1];
+    for (index = popcount_indices[popcount]; index < end; index += block_size, block++) {
+      block_union = block_unions + block*storage_size;
+      memset(block_union, 0, storage_size);
+      for (fp = arena + index*storage_size;
+           fp < arena + (index+block_size < end ? index+block_size : end)*storage_size;
+           fp += storage_size) {
+        for (i=0; i<storage_size; i++) {
+          block_union[i] |= fp[i];
+        }
+      }
+    }
+  }
+  block_indices[num_bits+1] = block;
+  return block;
+}
@@ -32,6 +32,20 @@ int chemfp_set_option_report_popcount(int value) {
   return CHEMFP_BAD_ARG;
 }
 
+static int chemfp_use_fixed_kernels = 1;
+static int chemfp_fixed_kernel_reported = -1;
+
+int chemfp_get_option_fixed_kernels(void) {
+  return chemfp_use_fixed_kernels;
+}
+int chemfp_set_option_fixed_kernels(int value) {
+  if (value == 0 || value == 1) {
+    chemfp_use_fixed_kernels = value;
+    return CHEMFP_OK;
+  }
+  return CHEMFP_BAD_ARG;
+}
+
 int chemfp_get_option_report_intersect_popcount(void) {
   return chemfp_report_select_intersect_popcount;  
 }
@@ -39,6 +53,7 @@ int chemfp_set_option_report_intersect_popcount(int value) {
   if (value == 0 || value == 1) {
     chemfp_report_select_intersect_popcount = value;
     chemfp_intersect_popcount_method_p = NULL;
+    chemfp_fixed_kernel_reported = -1;
     return CHEMFP_OK;
   }
   return CHEMFP_BAD_ARG;
@@ -91,6 +106,16 @@ static chemfp_method_type compile_time_methods[] = {
   {0, CHEMFP_SSSE3, "ssse3", 64, 64, chemfp_has_ssse3,
    (chemfp_popcount_f) chemfp_popcount_SSSE3,
    (chemfp_intersect_popcount_f) chemfp_intersect_popcount_SSSE3},
+
+  /* These use unaligned vector loads and handle the last partial
+     vector a word at a time, so they only need 8 byte alignment */
+  {0, CHEMFP_AVX2, "avx2", 8, 8, chemfp_has_avx2,
+   (chemfp_popcount_f) chemfp_popcount_avx2,
+   (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx2},
+
+  {0, CHEMFP_AVX512, "avx512-vpopcnt", 8, 8, chemfp_has_avx512_vpopcnt,
+   (chemfp_popcount_f) chemfp_popcount_avx512,
+   (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx512},
 };
 
 
@@ -140,6 +165,35 @@ chemfp_get_method_name(int method) {
 }
 
 
+static unsigned long
+best_time(chemfp_popcount_f popcount, int size) {
+  /* Do it twice in case a context switch happens in the middle */
+  unsigned long first_time = timeit(popcount, size, 200);
+  unsigned long second_time = timeit(popcount, size, 200);
+  return (first_time < second_time) ? first_time : second_time;
+}
+
+static void
+use_if_faster(int alignment, int size) {
+  static const int vector_methods[] = {CHEMFP_AVX2, CHEMFP_AVX512};
+  chemfp_method_type *method_p;
+  unsigned long current_time, method_time;
+  int i;
+
+  current_time = best_time(chemfp_alignments[alignment].method_p->popcount, size);
+  for (i=0; i<(int)(sizeof(vector_methods)/sizeof(int)); i++) {
+    method_p = &compile_time_methods[vector_methods[i]];
+    if (method_p->check != NULL && !method_p->check()) {
+      continue;
+    }
+    method_time = best_time(method_p->popcount, size);
+    if (method_time < current_time) {
+      chemfp_alignments[alignment].method_p = method_p;
+      current_time = method_time;
+    }
+  }
+}
+
 static void
 set_default_alignment_methods(void) {
   int lut_method, best64_method, large_method, ssse3_method;
@@ -251,6 +305,12 @@ set_default_alignment_methods(void) {
   }
   chemfp_alignments[CHEMFP_ALIGN_SSSE3].method_p = &compile_time_methods[ssse3_method];
   }
+
+  /* The AVX2 and AVX-512 methods are faster for the larger
+     fingerprints, but might not be for the small ones. Use them if
+     they are faster than the current best method. */
+  use_if_faster(CHEMFP_ALIGN8_SMALL, 64);
+  use_if_faster(CHEMFP_ALIGN8_LARGE, 2048/8);
 }
 
 
@@ -449,6 +509,90 @@ chemfp_select_intersect_popcount(int num_bits,
   }
   return method_p->intersect_popcount;
 }
+
+/**** Find the fixed-size search kernel, if there is one *****/
+
+#if defined(CHEMFP_FIXED_POPCNT)
+/* Indexed by the CHEMFP_FIXED_* value minus one */
+static const char *fixed_kernel_names[] = {
+  "166-popcnt",
+  "881-popcnt",
+  "1024-popcnt",
+  "2048-popcnt",
+  "881-avx512",
+  "1024-avx512",
+  "2048-avx512",
+};
+#endif
+
+/* The Tanimoto searches have versions specialized for the common
+   fingerprint sizes. They replace the intersect popcount method, so
+   they are only used when that method would have been POPCNT or one of
+   the vector methods which use it. Anything else, including a method
+   set by chemfp_set_alignment_method(), uses the general search code. */
+int
+chemfp_select_fixed_kernel(int num_bits,
+                           int storage_len1, const unsigned char *arena1,
+                           int storage_len2, const unsigned char *arena2) {
+#if defined(CHEMFP_FIXED_POPCNT)
+  int kernel;
+  int alignment;
+  int size_index;
+
+  if (!chemfp_use_fixed_kernels) {
+    return CHEMFP_FIXED_NONE;
+  }
+  switch (num_bits) {
+  case 166: size_index = 0; break;
+  case 881: size_index = 1; break;
+  case 1024: size_index = 2; break;
+  case 2048: size_index = 3; break;
+  default:
+    return CHEMFP_FIXED_NONE;
+  }
+
+  alignment = chemfp_select_intersect_alignment(num_bits, storage_len1, arena1,
+                                                storage_len2, arena2);
+  if (alignment != CHEMFP_ALIGN8_SMALL && alignment != CHEMFP_ALIGN8_LARGE) {
+    return CHEMFP_FIXED_NONE;
+  }
+
+  switch (chemfp_alignments[alignment].method_p->id) {
+  case CHEMFP_AVX512:
+#if defined(CHEMFP_FIXED_AVX512)
+    /* Three words are faster with POPCNT than with a masked vector */
+    if (size_index > 0) {
+      kernel = CHEMFP_FIXED_881_AVX512 + size_index - 1;
+      break;
+    }
+#endif
+    /* Every CPU with AVX-512 also has POPCNT */
+    kernel = CHEMFP_FIXED_166_POPCNT + size_index;
+    break;
+  case CHEMFP_POPCNT:
+  case CHEMFP_AVX2:
+    kernel = CHEMFP_FIXED_166_POPCNT + size_index;
+    break;
+  default:
+    return CHEMFP_FIXED_NONE;
+  }
+
+  if (chemfp_report_select_intersect_popcount &&
+      chemfp_fixed_kernel_reported != kernel) {
+    chemfp_fixed_kernel_reported = kernel;
+    fprintf(stderr, "Fixed-size search kernel: %s num_bits: %d\n",
+            fixed_kernel_names[kernel-1], num_bits);
+  }
+  return kernel;
+#else
+  UNUSED(num_bits);
+  UNUSED(storage_len1);
+  UNUSED(arena1);
+  UNUSED(storage_len2);
+  UNUSED(arena2);
+  return CHEMFP_FIXED_NONE;
+#endif
+}
   
 
 
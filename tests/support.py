@@ -307,3 +307,50 @@ class TestIdAndErrors(object):
             self.assertNotIn("pubchem", errmsg)
         finally:
             tf.close()
+
+#### The --jobs option of the *2fps programs
+
+def _without_date(lines):
+    return [line for line in lines if not line.startswith("#date=")]
+
+class TestJobs(object):
+    # Set '_runner' in the derived class, and list this before
+    # unittest2.TestCase so its setUp() and tearDown() are used.
+    def setUp(self):
+        from chemfp.commandline import parallel
+        self._parallel = parallel
+        self._old_chunk_size = parallel.CHUNK_SIZE
+        # Use small blocks so every test has several of them
+        parallel.CHUNK_SIZE = 4
+
+    def tearDown(self):
+        self._parallel.CHUNK_SIZE = self._old_chunk_size
+
+    def _check_same(self, cmdline, source):
+        expected = self._runner.run(cmdline, source)
+        for jobs in ("1", "2", "5"):
+            result = self._runner.run(cmdline + ["--jobs", jobs], source)
+            self.assertEquals(_without_date(result), _without_date(expected))
+
+    def test_sdf(self):
+        self._check_same([], PUBCHEM_SDF)
+
+    def test_sdf_gz(self):
+        self._check_same([], PUBCHEM_SDF_GZ)
+
+    def test_id_tag(self):
+        self._check_same(["--id-tag", "PUBCHEM_CACTVS_XLOGP", "--errors", "ignore"], PUBCHEM_SDF)
+
+    def test_multiple_files(self):
+        self._check_same([PUBCHEM_SDF, PUBCHEM_SDF_GZ], None)
+
+    def test_error_location(self):
+        errmsg = self._runner.run_exit("--id-tag PUBCHEM_CACTVS_XLOGP --jobs 2")
+        # Record #7 is the 3rd record of the block which starts at record #5
+        self.assertIn("ERROR: Missing id tag 'PUBCHEM_CACTVS_XLOGP' for record #7 ", errmsg)
+        self.assertIn("pubchem.sdf", errmsg)
+        self.assertNotIn("chemfp_", errmsg)
+
+    def test_bad_jobs(self):
+        errmsg = self._runner.run_exit("--jobs 0")
+        self.assertIn("--jobs must be at least 1", errmsg)
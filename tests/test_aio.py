@@ -0,0 +1,239 @@
+from __future__ import absolute_import, with_statement
+import unittest2
+import threading
+
+import chemfp
+from chemfp import aio, search, fps_search
+
+from support import fullpath
+
+CHEBI_TARGETS = fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = fullpath("chebi_queries.fps.gz")
+
+_targets = None
+_queries = None
+def _get_arenas():
+    global _targets, _queries
+    if _targets is None:
+        _targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        _queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+    return _queries, _targets
+
+
+class BlockingFile(object):
+    # Wait for permission before each read of the underlying file
+    def __init__(self, infile):
+        self.infile = infile
+        self.name = getattr(infile, "name", None)
+        self.reading = threading.Event()
+        self.go = threading.Event()
+    def _wait(self):
+        self.reading.set()
+        self.go.wait()
+    def read(self, *args):
+        self._wait()
+        return self.infile.read(*args)
+    def readline(self, *args):
+        self._wait()
+        return self.infile.readline(*args)
+
+
+class TestArenaSearches(unittest2.TestCase):
+    def setUp(self):
+        self.queries, self.targets = _get_arenas()
+        self.executor = aio.SearchExecutor(max_workers=3)
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_default_max_workers(self):
+        executor = aio.SearchExecutor()
+        self.assertEquals(executor.max_workers, chemfp.get_max_threads())
+        executor.shutdown()
+
+    def test_bad_max_workers(self):
+        with self.assertRaisesRegexp(ValueError, "max_workers must be at least 1"):
+            aio.SearchExecutor(max_workers=0)
+
+    def test_count(self):
+        future = self.executor.count_tanimoto_hits(self.queries, self.targets, 0.4)
+        self.assertEquals(list(future.result()),
+                          list(search.count_tanimoto_hits(self.queries, self.targets, 0.4)))
+        query_fp = self.queries[3][1]
+        future = self.executor.count_tanimoto_hits_fp(query_fp, self.targets)
+        self.assertEquals(future.result(),
+                          search.count_tanimoto_hits_fp(query_fp, self.targets, 0.7))
+
+    def test_threshold(self):
+        future = self.executor.threshold_tanimoto_search(self.queries, self.targets, 0.4)
+        expected = search.threshold_tanimoto_search(self.queries, self.targets, 0.4)
+        self.assertEquals([sorted(row.get_ids_and_scores()) for row in future.result()],
+                          [sorted(row.get_ids_and_scores()) for row in expected])
+        query_fp = self.queries[3][1]
+        future = self.executor.threshold_tanimoto_search_fp(query_fp, self.targets, 0.4)
+        self.assertEquals(
+            sorted(future.result().get_indices_and_scores()),
+            sorted(search.threshold_tanimoto_search_fp(query_fp, self.targets,
+                                                       0.4).get_indices_and_scores()))
+
+    def test_knearest(self):
+        future = self.executor.knearest_tanimoto_search(self.queries, self.targets, 5, 0.2)
+        expected = search.knearest_tanimoto_search(self.queries, self.targets, 5, 0.2)
+        self.assertEquals([row.get_ids_and_scores() for row in future.result()],
+                          [row.get_ids_and_scores() for row in expected])
+
+    def test_many_in_flight(self):
+        query_fps = [fp for (id, fp) in self.queries]
+        futures = [self.executor.knearest_tanimoto_search_fp(fp, self.targets, 3, 0.0)
+                       for fp in query_fps]
+        expected = [search.knearest_tanimoto_search_fp(fp, self.targets, 3, 0.0)
+                        for fp in query_fps]
+        self.assertEquals([future.result().get_indices_and_scores() for future in futures],
+                          [result.get_indices_and_scores() for result in expected])
+
+    def test_exception(self):
+        future = self.executor.count_tanimoto_hits_fp("too short", self.targets, 0.4)
+        self.assertIsInstance(future.exception(), ValueError)
+        with self.assertRaises(ValueError):
+            future.result()
+
+    def test_cancel_queued(self):
+        executor = aio.SearchExecutor(max_workers=1)
+        go = threading.Event()
+        blocker = executor.submit(go.wait)
+        future = executor.count_tanimoto_hits(self.queries, self.targets, 0.4)
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        go.set()
+        executor.shutdown()
+        self.assertTrue(blocker.done())
+        with self.assertRaises(aio.CancelledError):
+            future.result()
+
+    def test_cannot_cancel_running_arena_search(self):
+        executor = aio.SearchExecutor(max_workers=1)
+        started = threading.Event()
+        go = threading.Event()
+        def wait():
+            started.set()
+            go.wait()
+            return 5
+        future = executor.submit(wait)
+        started.wait()
+        self.assertFalse(future.cancel())
+        go.set()
+        self.assertEquals(future.result(), 5)
+        executor.shutdown()
+
+    def test_context_manager(self):
+        with aio.SearchExecutor(max_workers=2) as executor:
+            future = executor.count_tanimoto_hits(self.queries, self.targets, 0.5)
+        self.assertTrue(future.done())
+
+
+class TestFPSSearches(unittest2.TestCase):
+    def setUp(self):
+        self.queries, self.targets = _get_arenas()
+        self.executor = aio.SearchExecutor(max_workers=2)
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_count(self):
+        future = self.executor.count_tanimoto_hits(self.queries, chemfp.open(CHEBI_TARGETS), 0.4)
+        self.assertEquals(future.result(),
+                          list(search.count_tanimoto_hits(self.queries, self.targets, 0.4)))
+
+    def test_threshold_fp(self):
+        query_fp = self.queries[0][1]
+        future = self.executor.threshold_tanimoto_search_fp(query_fp, chemfp.open(CHEBI_TARGETS), 0.4)
+        self.assertEquals(
+            sorted(future.result()),
+            sorted(fps_search.id_threshold_tanimoto_search_fp(
+                query_fp, chemfp.open(CHEBI_TARGETS), 0.4)))
+
+    def test_knearest(self):
+        future = self.executor.knearest_tanimoto_search(self.queries, chemfp.open(CHEBI_TARGETS),
+                                                        3, 0.0)
+        expected = fps_search.knearest_tanimoto_search(self.queries, chemfp.open(CHEBI_TARGETS),
+                                                       3, 0.0)
+        # The parallel scan may pick different targets for ties
+        self.assertEquals([sorted(row) for row in future.result().iter_scores()],
+                          [sorted(row) for row in expected.iter_scores()])
+
+    def test_cancel_running_scan(self):
+        reader = chemfp.open(CHEBI_TARGETS)
+        blocking_file = reader._infile = BlockingFile(reader._infile)
+        callbacks = []
+        future = self.executor.count_tanimoto_hits(self.queries, reader, 0.4)
+        future.add_done_callback(callbacks.append)
+        blocking_file.reading.wait()
+        self.assertTrue(future.running())
+        self.assertTrue(future.cancel())
+        blocking_file.go.set()
+        with self.assertRaises(aio.CancelledError):
+            future.result()
+        self.assertTrue(future.cancelled())
+        # The callbacks are called after the waiters are woken up
+        self.executor.shutdown()
+        self.assertEquals(callbacks, [future])
+
+
+class TestBlockStream(unittest2.TestCase):
+    def setUp(self):
+        self.executor = aio.SearchExecutor(max_workers=4)
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_blocks_in_order(self):
+        expected = list(chemfp.open(CHEBI_TARGETS).iter_blocks())
+        self.assertGreater(len(expected), 2)
+        stream = self.executor.read_blocks(chemfp.open(CHEBI_TARGETS))
+        futures = [stream.read() for i in range(len(expected) + 2)]
+        self.assertEquals([future.result() for future in futures], expected + [None, None])
+
+    def test_read_does_not_block(self):
+        reader = chemfp.open(CHEBI_TARGETS)
+        blocking_file = reader._infile = BlockingFile(reader._infile)
+        stream = self.executor.read_blocks(reader)
+        first = stream.read()
+        # The first block was read with the header
+        self.assertTrue(first.result().startswith("00"))
+        second = stream.read()
+        blocking_file.reading.wait()
+        self.assertFalse(second.done())
+        blocking_file.go.set()
+        self.assertTrue(second.result())
+
+    def test_cancelled_read(self):
+        expected = list(chemfp.open(CHEBI_TARGETS).iter_blocks())
+        executor = aio.SearchExecutor(max_workers=1)
+        go = threading.Event()
+        executor.submit(go.wait)
+        stream = executor.read_blocks(chemfp.open(CHEBI_TARGETS))
+        first = stream.read()
+        second = stream.read()
+        third = stream.read()
+        self.assertTrue(second.cancel())
+        go.set()
+        self.assertEquals(first.result(), expected[0])
+        self.assertEquals(third.result(), expected[1])
+        executor.shutdown()
+
+    def test_read_from_callback(self):
+        expected = list(chemfp.open(CHEBI_TARGETS).iter_blocks())
+        stream = self.executor.read_blocks(chemfp.open(CHEBI_TARGETS))
+        blocks = []
+        finished = threading.Event()
+        def next_block(future):
+            block = future.result()
+            if block is None:
+                finished.set()
+            else:
+                blocks.append(block)
+                stream.read().add_done_callback(next_block)
+        stream.read().add_done_callback(next_block)
+        finished.wait()
+        self.assertEquals(blocks, expected)
+
+
+if __name__ == "__main__":
+    unittest2.main()
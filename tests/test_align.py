@@ -199,6 +199,23 @@ class TestOptimalAlignment(unittest2.TestCase):
         self.assertEquals(arena.get_optimal_alignment(300), 8)
         self.assertEquals(arena.get_optimal_alignment(800), 8)
 
+    def test_avx_methods(self):
+        arena._has_popcnt = True
+        arena._has_ssse3 = True
+
+        self.data = {"align8-large": "avx512-vpopcnt",
+                     "align8-small": "POPCNT",
+                     "align-ssse3": "POPCNT"}
+        self.assertEquals(arena.get_optimal_alignment(300), 8)
+        self.assertEquals(arena.get_optimal_alignment(800), 64)
+
+        self.data = {"align8-large": "avx2",
+                     "align8-small": "avx2",
+                     "align-ssse3": "ssse3"}
+        self.assertEquals(arena.get_optimal_alignment(300), 64)
+        self.assertEquals(arena.get_optimal_alignment(800), 64)
+        self.assertEquals(arena.get_optimal_alignment(166), 8)
+
 
 # I can't find a better solution than this. (!?)
 def _addressof(s):
@@ -0,0 +1,115 @@
+from __future__ import absolute_import, with_statement
+import unittest2
+import os
+import shutil
+import tempfile
+
+import chemfp
+from chemfp import search, allpairs
+
+from support import fullpath
+
+targets = chemfp.load_fingerprints(fullpath("chebi_rdmaccs.fps"))
+
+def _get_expected(threshold, include_lower_triangle):
+    results = search.threshold_tanimoto_search_symmetric(
+        targets, threshold, include_lower_triangle=include_lower_triangle)
+    results.reorder_all("increasing-index")
+    return [list(result) for result in results]
+
+class TestAllPairs(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix="test_allpairs")
+        self.filename = os.path.join(self.dirname, "chebi.hits")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _check(self, hits, expected):
+        self.assertEquals(len(hits), len(expected))
+        self.assertTrue(hits.is_complete)
+        for row, row_hits in enumerate(expected):
+            self.assertEquals(hits[row], row_hits)
+            self.assertEquals(hits.get_num_hits(row), len(row_hits))
+
+    def test_include_lower_triangle(self):
+        hits = allpairs.threshold_tanimoto_search_symmetric(
+            targets, 0.8, self.filename, block_size=300)
+        with hits:
+            self.assertTrue(hits.include_lower_triangle)
+            self.assertEquals(hits.threshold, 0.8)
+            self._check(hits, _get_expected(0.8, True))
+
+    def test_upper_triangle(self):
+        hits = allpairs.threshold_tanimoto_search_symmetric(
+            targets, 0.7, self.filename, block_size=256, include_lower_triangle=False)
+        with hits:
+            self.assertFalse(hits.include_lower_triangle)
+            self._check(hits, _get_expected(0.7, False))
+
+    def test_one_block(self):
+        hits = allpairs.threshold_tanimoto_search_symmetric(
+            targets, 0.9, self.filename, block_size=len(targets)+10)
+        with hits:
+            self._check(hits, _get_expected(0.9, True))
+
+    def test_get_indices_and_scores(self):
+        expected = _get_expected(0.75, True)
+        with allpairs.threshold_tanimoto_search_symmetric(
+            targets, 0.75, self.filename, block_size=500) as hits:
+            row = max(xrange(len(expected)), key=lambda i: len(expected[i]))
+            self.assertEquals(list(hits.get_indices(row)), [i for (i, score) in expected[row]])
+            self.assertEquals(list(hits.get_scores(row)), [score for (i, score) in expected[row]])
+            with self.assertRaisesRegexp(IndexError, "row index is out of range"):
+                hits[len(targets)]
+
+    def test_threshold_zero(self):
+        arena = targets[:300]
+        with allpairs.threshold_tanimoto_search_symmetric(
+            arena, 0.0, self.filename, block_size=128) as hits:
+            for row in range(len(arena)):
+                self.assertEquals(list(hits.get_indices(row)),
+                                  [i for i in range(len(arena)) if i != row])
+
+    def test_subarena(self):
+        arena = targets[500:1700]
+        expected = [[(i-500, score) for (i, score) in row if 500 <= i < 1700]
+                        for row in _get_expected(0.75, True)[500:1700]]
+        with allpairs.threshold_tanimoto_search_symmetric(
+            arena, 0.75, self.filename, block_size=200) as hits:
+            self._check(hits, expected)
+
+    def test_arena_must_be_ordered(self):
+        arena = chemfp.load_fingerprints(fullpath("chebi_rdmaccs.fps"), reorder=False)
+        with self.assertRaisesRegexp(ValueError, "must be ordered by popcount"):
+            allpairs.threshold_tanimoto_search_symmetric(arena, 0.8, self.filename)
+
+    def test_restart(self):
+        allpairs.threshold_tanimoto_search_symmetric(
+            targets, 0.8, self.filename, block_size=300).close()
+        size = os.path.getsize(self.filename)
+        # Simulate a crash part way through a tile
+        with open(self.filename, "r+b") as f:
+            f.truncate(size // 2 + 17)
+        with allpairs.open_hits(self.filename) as hits:
+            self.assertFalse(hits.is_complete)
+        with allpairs.threshold_tanimoto_search_symmetric(
+            targets, 0.8, self.filename, block_size=300) as hits:
+            self._check(hits, _get_expected(0.8, True))
+        self.assertEquals(os.path.getsize(self.filename), size)
+
+    def test_restart_with_different_parameters(self):
+        allpairs.threshold_tanimoto_search_symmetric(
+            targets, 0.8, self.filename, block_size=300).close()
+        with self.assertRaisesRegexp(ValueError, "hits from a different search"):
+            allpairs.threshold_tanimoto_search_symmetric(
+                targets, 0.7, self.filename, block_size=300)
+
+    def test_not_a_hits_file(self):
+        with open(self.filename, "wb") as f:
+            f.write("#FPS1\n" + "\0" * 100)
+        with self.assertRaisesRegexp(allpairs.HitsFormatError, "not an all-pairs hits file"):
+            allpairs.open_hits(self.filename)
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -1,6 +1,11 @@
 from __future__ import absolute_import, with_statement
 import unittest2
 from cStringIO import StringIO
+import os
+import tempfile
+import shutil
+import atexit
+import struct
 
 import chemfp
 from chemfp import bitops
@@ -595,6 +600,51 @@ class TestFPSReader(unittest2.TestCase, CommonReaderAPI):
         
 
 
+class TestParallelFPSScan(unittest2.TestCase):
+    # Call the parallel implementations directly since the number of
+    # threads depends on the OpenMP configuration
+    def _open(self):
+        return chemfp.open(CHEBI_TARGETS)
+
+    def test_count(self):
+        from chemfp import fps_search
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES)
+        expected = [count for (id, count) in
+                    self._open().id_count_tanimoto_hits(queries, 0.5, arena_size=None)]
+        counts = fps_search._parallel_count_tanimoto_hits_arena(queries, self._open(), 0.5, 3)
+        self.assertEquals(counts, expected)
+
+    def test_threshold(self):
+        from chemfp import fps_search
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES)
+        expected = [hits for (id, hits) in
+                    self._open().id_threshold_tanimoto_search(queries, 0.6, arena_size=None)]
+        results = fps_search._parallel_threshold_tanimoto_search_arena(
+            queries, self._open(), 0.6, 3)
+        self.assertEquals([result.get_ids_and_scores() for result in results],
+                          [hits.get_ids_and_scores() for hits in expected])
+
+    def test_knearest(self):
+        from chemfp import fps_search
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES)
+        expected = [hits for (id, hits) in
+                    self._open().id_knearest_tanimoto_search(queries, 5, 0.2, arena_size=None)]
+        results = fps_search._parallel_knearest_tanimoto_search(
+            queries, self._open(), 5, 0.2, 4)
+        # Ties are broken by file order, so the ids are the same too
+        self.assertEquals([result.get_ids_and_scores() for result in results],
+                          [hits.get_ids_and_scores() for hits in expected])
+
+    def test_error_line_number(self):
+        from chemfp import fps_search
+        lines = open(CHEBI_TARGETS).readlines()
+        # Line 1800 of the file has a bad fingerprint
+        lines[1799] = "XYZ" + lines[1799][3:]
+        reader = chemfp.open(StringIO("".join(lines)))
+        with self.assertRaises(fps_search.FPSFormatError) as cm:
+            fps_search._parallel_count_tanimoto_hits_arena(QUERY_ARENA, reader, 0.5, 3)
+        self.assertEquals(cm.exception.lineno, 1800)
+
 class TestLoadFingerprints(unittest2.TestCase, CommonReaderAPI):
     hit_order = staticmethod(lambda x: x)
     # Hook to handle the common API
@@ -726,6 +776,216 @@ class TestLoadFingerprintsOrdered(unittest2.TestCase, CommonReaderAPI):
         
         
 
+class TestIdStore(unittest2.TestCase):
+    def _get_ids(self):
+        return [id for (id, fp) in chemfp.open(CHEBI_TARGETS)]
+
+    def test_load_fingerprints_uses_id_store(self):
+        from chemfp.arena import IdStore
+        for reorder in (True, False):
+            arena = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=reorder)
+            self.assertTrue(isinstance(arena.ids, IdStore))
+            self.assertEquals(sorted(arena.ids), sorted(self._get_ids()))
+        
+    def test_sequence(self):
+        ids = self._get_ids()
+        arena = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+        store = arena.ids
+        self.assertEquals(len(store), len(ids))
+        self.assertEquals(list(store), ids)
+        self.assertEquals(store[0], ids[0])
+        self.assertEquals(store[-1], ids[-1])
+        self.assertEquals(store[1500], ids[1500])
+        self.assertEquals(list(store[10:1200]), ids[10:1200])
+        self.assertEquals(store[10:1200][5:-5], ids[10:1200][5:-5])
+        self.assertEquals(store[10:20:3], ids[10:20:3])
+        self.assertEquals(list(store[20:10]), [])
+        self.assertFalse(store[:10] == ids[:11])
+        self.assertTrue(store[:10] != ids[1:11])
+        with self.assertRaisesRegexp(IndexError, "id index out of range"):
+            store[len(ids)]
+
+class TestKNearestIndex(unittest2.TestCase):
+    def _get_scores(self, results):
+        return [result.get_scores() for result in results]
+
+    def test_same_as_without_index(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES)
+        expected = chemfp.search.knearest_tanimoto_search(queries, targets, 10, 0.0)
+        for block_size in (1, 3, 8, 100):
+            targets.build_knearest_index(block_size)
+            stats = chemfp.search.KNearestStatistics()
+            results = chemfp.search.knearest_tanimoto_search(queries, targets, 10, 0.0,
+                                                             stats=stats)
+            self.assertEquals(self._get_scores(results), self._get_scores(expected))
+            self.assertEquals(stats.num_queries, len(queries))
+            self.assertTrue(stats.num_blocks_scanned > 0)
+            self.assertTrue(stats.num_fingerprints < len(queries) * len(targets))
+            self.assertTrue("blocks pruned" in stats.report())
+
+    def test_blocks_are_pruned(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES)
+        for block_size in (1, 8, 100):
+            targets.build_knearest_index(block_size)
+            stats = chemfp.search.KNearestStatistics()
+            chemfp.search.knearest_tanimoto_search(queries, targets, 10, 0.0, stats=stats)
+            self.assertGreater(stats.num_blocks_pruned, 0, block_size)
+            self.assertLessEqual(stats.num_fingerprints,
+                                 stats.num_blocks_scanned * block_size)
+        # With one fingerprint per block the bound is the exact score,
+        # so most blocks are pruned
+        targets.build_knearest_index(1)
+        stats = chemfp.search.KNearestStatistics()
+        chemfp.search.knearest_tanimoto_search(queries, targets, 10, 0.0, stats=stats)
+        self.assertGreater(stats.num_blocks_pruned, stats.num_blocks_scanned)
+        self.assertEquals(stats.num_fingerprints, stats.num_blocks_scanned)
+
+    def test_fp_search_and_subarenas(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        query_id, query_fp = QUERY_ARENA[0]
+        expected_arena = targets[100:1500]
+        expected = chemfp.search.knearest_tanimoto_search_fp(query_fp, expected_arena, 5, 0.2)
+        targets.build_knearest_index()
+        subarena = targets[100:1500]
+        self.assertTrue(subarena.knearest_index is targets.knearest_index)
+        stats = chemfp.search.KNearestStatistics()
+        result = chemfp.search.knearest_tanimoto_search_fp(query_fp, subarena, 5, 0.2,
+                                                           stats=stats)
+        self.assertEquals(result.get_scores(), expected.get_scores())
+        self.assertTrue(all(100 <= i < 1500 for i in result.get_indices()))
+        self.assertEquals(stats.num_queries, 1)
+
+    def test_requires_popcount_order(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+        with self.assertRaisesRegexp(ValueError, "must be ordered by popcount"):
+            targets.build_knearest_index()
+
+class TestTiledSearch(unittest2.TestCase):
+    # The count and threshold searches go through the targets one
+    # tile at a time when there are enough targets.
+    def setUp(self):
+        self._tile_size = bitops.get_option("tile-size")
+        self._num_threads = chemfp.get_num_threads()
+    def tearDown(self):
+        bitops.set_option("tile-size", self._tile_size)
+        chemfp.set_num_threads(self._num_threads)
+
+    def _search(self, queries, targets):
+        results = []
+        for threshold in (0.0, 0.3, 0.6, 1.0):
+            results.append(list(chemfp.search.count_tanimoto_hits(queries, targets, threshold)))
+            results.append([result.get_ids_and_scores() for result in
+                                chemfp.search.threshold_tanimoto_search(queries, targets, threshold)])
+        return results
+
+    def _check(self, queries, targets):
+        bitops.set_option("tile-size", 0)
+        expected = self._search(queries, targets)
+        for tile_size in (200, 5000):
+            bitops.set_option("tile-size", tile_size)
+            self.assertEquals(self._search(queries, targets), expected, tile_size)
+
+    def test_same_as_untiled(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        # Unsorted queries, so the results have to be put back in order
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+        for num_threads in (1, chemfp.get_max_threads()):
+            chemfp.set_num_threads(num_threads)
+            self._check(queries, targets)
+
+    def test_subarenas(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+        self._check(queries[5:40], targets[200:1500])
+
+    def test_default_tile_size(self):
+        self.assertEquals(bitops.get_option("tile-size"), 256*1024)
+        with self.assertRaises(ValueError):
+            bitops.set_option("tile-size", -1)
+
+_fpb_dirname = None
+def _get_fpb_filename(name, reorder=True):
+    global _fpb_dirname
+    if _fpb_dirname is None:
+        _fpb_dirname = tempfile.mkdtemp(prefix="test_api_fpb")
+        atexit.register(shutil.rmtree, _fpb_dirname)
+    filename = os.path.join(_fpb_dirname, "%s_%d.fpb" % (os.path.basename(name), reorder))
+    if not os.path.exists(filename):
+        chemfp.load_fingerprints(name, reorder=reorder).save(filename)
+    return filename
+
+class TestFPBArena(TestLoadFingerprintsOrdered):
+    # Hook to handle the common API
+    def _open(self, name):
+        if not isinstance(name, basestring):
+            # Test reading from a file object, which can't be memory-mapped
+            f = StringIO()
+            chemfp.load_fingerprints(name).save(f, "fpb")
+            return chemfp.open(StringIO(f.getvalue()), "fpb")
+        return chemfp.open(_get_fpb_filename(name))
+
+    def test_is_memory_mapped(self):
+        import mmap
+        arena = self._open(CHEBI_TARGETS)
+        self.assertTrue(isinstance(arena.arena, mmap.mmap))
+        self.assertEquals(len(arena), 2000)
+
+    def test_same_as_fps(self):
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS)
+        arena = self._open(CHEBI_TARGETS)
+        self.assertEquals(arena.ids, expected.ids)
+        self.assertEquals(list(arena), list(expected))
+        self.assertEquals(arena.popcount_indices, expected.popcount_indices)
+        self.assertEquals(arena.alignment, expected.alignment)
+        
+    def test_load_fingerprints_does_not_copy(self):
+        filename = _get_fpb_filename(CHEBI_TARGETS)
+        arena = chemfp.open(filename)
+        self.assertTrue(chemfp.load_fingerprints(arena) is arena)
+        copy = chemfp.load_fingerprints(arena, alignment=1)
+        self.assertFalse(copy is arena)
+        self.assertEquals(copy.alignment, 1)
+        self.assertEquals(list(copy), list(arena))
+
+    def test_unsorted(self):
+        arena = chemfp.open(_get_fpb_filename(CHEBI_TARGETS, reorder=False))
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+        self.assertEquals(arena.popcount_indices, "")
+        self.assertEquals(list(arena), list(expected))
+
+    def test_save_subarena(self):
+        arena = self._open(CHEBI_TARGETS)
+        subarena = arena[500:800]
+        filename = os.path.join(_fpb_dirname, "subarena.fpb")
+        subarena.save(filename)
+        arena2 = chemfp.open(filename)
+        self.assertEquals(list(arena2), list(subarena))
+        # The popcount indices must be adjusted for the new range
+        results = chemfp.search.threshold_tanimoto_search(QUERY_ARENA, arena2, 0.5)
+        expected = chemfp.search.threshold_tanimoto_search(QUERY_ARENA, subarena, 0.5)
+        self.assertEquals([sorted(x) for x in results.iter_ids_and_scores()],
+                          [sorted(x) for x in expected.iter_ids_and_scores()])
+
+    def test_id_offsets_are_used_directly(self):
+        arena = self._open(CHEBI_TARGETS)
+        data, offsets, itemsize = arena.arena_ids._get_table()
+        self.assertEquals(itemsize, 8)
+        self.assertEquals(len(offsets), 8 * (len(arena) + 1))
+        # The offsets are native uint64 values
+        self.assertEquals(struct.unpack("=%dQ" % (len(arena)+1), offsets)[-1], len(data))
+
+    def test_bad_magic(self):
+        with self.assertRaisesRegexp(ValueError, "does not start with the FPB magic"):
+            chemfp.open(CHEBI_TARGETS, "fpb")
+
+    def test_compression_not_supported(self):
+        arena = self._open(CHEBI_TARGETS)
+        with self.assertRaisesRegexp(ValueError, "does not support compression"):
+            arena.save("spam.fpb.gz")
+        
+
 SDF_IDS = ['9425004', '9425009', '9425012', '9425015', '9425018',
            '9425021', '9425030', '9425031', '9425032', '9425033',
            '9425034', '9425035', '9425036', '9425037', '9425040',
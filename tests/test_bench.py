@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+import unittest2
+import json
+import os
+import shutil
+import tempfile
+
+import chemfp
+from chemfp import bench, bitops
+from chemfp.commandline import bench as bench_command
+
+
+class TestGenerateFingerprints(unittest2.TestCase):
+    def test_size_and_ids(self):
+        fps = list(bench.generate_fingerprints(20, 166, seed=1))
+        self.assertEquals(len(fps), 20)
+        self.assertEquals(fps[0][0], "FP0")
+        self.assertEquals(fps[19][0], "FP19")
+        for (id, fp) in fps:
+            self.assertEquals(len(fp), 21)
+            # No bits past the end
+            self.assertEquals(ord(fp[-1]) & 0xc0, 0)
+
+    def test_same_seed(self):
+        self.assertEquals(list(bench.generate_fingerprints(10, 64, seed=5)),
+                          list(bench.generate_fingerprints(10, 64, seed=5)))
+        self.assertNotEquals(list(bench.generate_fingerprints(10, 64, seed=5)),
+                             list(bench.generate_fingerprints(10, 64, seed=6)))
+
+    def test_density(self):
+        fps = list(bench.generate_fingerprints(10, 1024, density=0.25, density_spread=0.0))
+        for (id, fp) in fps:
+            self.assertEquals(bitops.byte_popcount(fp), 256)
+
+    def test_density_spread(self):
+        popcounts = [bitops.byte_popcount(fp) for (id, fp) in
+                         bench.generate_fingerprints(200, 1024, density=0.1,
+                                                     density_spread=0.5, seed=2)]
+        self.assertGreater(len(set(popcounts)), 20)
+        self.assertTrue(60 < sum(popcounts) / 200.0 < 140, sum(popcounts))
+
+    def test_full_and_empty(self):
+        for (id, fp) in bench.generate_fingerprints(3, 20, density=1.0, density_spread=0.0):
+            self.assertEquals(bitops.byte_popcount(fp), 20)
+        for (id, fp) in bench.generate_fingerprints(3, 20, density=0.0):
+            self.assertEquals(fp, "\0\0\0")
+
+    def test_bad_density(self):
+        with self.assertRaisesRegexp(ValueError, "density must be between"):
+            list(bench.generate_fingerprints(3, 20, density=1.5))
+
+
+class TestRunBenchmarks(unittest2.TestCase):
+    def test_all_phases(self):
+        report = bench.run_benchmarks(num_targets=100, num_queries=5, num_bits_list=[166],
+                                      thresholds=[0.3], ks=[2], alignments=[None, 8])
+        self.assertEquals(report["environment"]["software"], chemfp.SOFTWARE)
+        self.assertEquals(report["parameters"]["num_targets"], 100)
+        results = report["results"]
+        # The arena phases are timed for each alignment; the FPS phases only once
+        self.assertEquals(len(results), 2*7 + 3)
+        self.assertEquals(set(result["phase"] for result in results), set(bench.PHASES))
+        for result in results:
+            self.assertEquals(result["time"], min(result["times"]))
+            self.assertEquals(result["num_bits"], 166)
+
+    def test_results_match(self):
+        report = bench.run_benchmarks(num_targets=200, num_queries=10, num_bits_list=[64],
+                                      thresholds=[0.4], ks=[3])
+        hits = dict((result["phase"], result) for result in report["results"])
+        self.assertEquals(hits["count"]["num_hits"], hits["threshold"]["num_hits"])
+        self.assertEquals(hits["count"]["num_hits"], hits["fps-count"]["num_hits"])
+        self.assertEquals(hits["count"]["num_hits"], hits["fps-threshold"]["num_hits"])
+        self.assertEquals(hits["count-symmetric"]["num_hits"],
+                          hits["threshold-symmetric"]["num_hits"])
+        self.assertEquals(hits["knearest"]["num_hits"], 30)
+        self.assertEquals(hits["fps-knearest"]["num_hits"], 30)
+        self.assertEquals(hits["count"]["num_fingerprints"], 2000)
+        self.assertEquals(hits["count-symmetric"]["num_fingerprints"], 200*199//2)
+        self.assertEquals(hits["load"]["num_fingerprints"], 200)
+
+    def test_thread_sweep_restores_num_threads(self):
+        num_threads = chemfp.get_num_threads()
+        report = bench.run_benchmarks(num_targets=50, num_queries=5, num_bits_list=[32],
+                                      num_threads_list=[1, chemfp.get_max_threads()],
+                                      phases=["count"])
+        self.assertEquals([result["num_threads"] for result in report["results"]],
+                          [1, chemfp.get_max_threads()])
+        self.assertEquals(chemfp.get_num_threads(), num_threads)
+
+    def test_no_seed(self):
+        report = bench.run_benchmarks(num_targets=50, num_queries=5, num_bits_list=[32],
+                                      phases=["count"], seed=None)
+        self.assertEquals(report["parameters"]["seed"], None)
+        self.assertEquals(len(report["results"]), 1)
+
+    def test_python_threads(self):
+        report = bench.run_benchmarks(num_targets=50, num_queries=5, num_bits_list=[32],
+                                      num_threads_list=[1], python_threads_list=[1, 3],
+                                      thresholds=[0.3], phases=["load", "count", "threshold"])
+        self.assertEquals(report["parameters"]["python_threads"], [1, 3])
+        results = report["results"]
+        self.assertEquals([(result["phase"], result["python_threads"]) for result in results],
+                          [("load", None), ("count", 1), ("count", 3),
+                           ("threshold", 1), ("threshold", 3)])
+        # Every thread does the whole search
+        self.assertEquals(results[1]["num_hits"], results[2]["num_hits"])
+        self.assertEquals(results[1]["num_fingerprints"], 250)
+        self.assertEquals(results[2]["num_fingerprints"], 750)
+
+    def test_bad_python_threads(self):
+        with self.assertRaisesRegexp(ValueError, "the number of Python threads must be at least 1"):
+            bench.run_benchmarks(python_threads_list=[0])
+
+    def test_bad_phase(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown phase 'tanimoto'"):
+            bench.run_benchmarks(phases=["tanimoto"])
+
+
+class TestCommandline(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_json_output(self):
+        filename = os.path.join(self.dirname, "bench.json")
+        bench_command.main(["--num-targets", "50", "--num-queries", "5", "--num-bits", "32,64",
+                            "-t", "0.5,0.9", "-k", "1", "--phases", "load,threshold,fps-knearest",
+                            "--alignment", "auto", "--repeat", "2", "-q", "-o", filename])
+        report = json.load(open(filename))
+        self.assertEquals(report["parameters"]["num_bits"], [32, 64])
+        self.assertEquals(report["parameters"]["repeat"], 2)
+        self.assertEquals([(result["phase"], result["num_bits"]) for result in report["results"]],
+                          [("load", 32), ("threshold", 32), ("threshold", 32), ("fps-knearest", 32),
+                           ("load", 64), ("threshold", 64), ("threshold", 64), ("fps-knearest", 64)])
+
+    def test_bad_phase(self):
+        with self.assertRaises(SystemExit):
+            bench_command.main(["--phases", "load,spam", "-q"])
+
+    def test_python_threads(self):
+        filename = os.path.join(self.dirname, "bench.json")
+        bench_command.main(["--num-targets", "50", "--num-queries", "5", "--num-bits", "32",
+                            "--python-threads", "1,2", "--phases", "knearest",
+                            "-q", "-o", filename])
+        report = json.load(open(filename))
+        self.assertEquals([result["python_threads"] for result in report["results"]], [1, 2])
+
+    def test_bad_python_threads(self):
+        with self.assertRaises(SystemExit):
+            bench_command.main(["--python-threads", "0", "-q"])
+
+    def test_bad_alignment(self):
+        with self.assertRaises(SystemExit):
+            bench_command.main(["--alignment", "3", "-q"])
+
+
+if __name__ == "__main__":
+    unittest2.main()
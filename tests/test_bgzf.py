@@ -0,0 +1,249 @@
+from __future__ import absolute_import, with_statement
+import unittest2
+import gzip
+import os
+import shutil
+import tempfile
+
+import chemfp
+from chemfp import bgzf, io, fps_search
+
+from support import fullpath
+
+CHEBI_TARGETS = fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = fullpath("chebi_queries.fps.gz")
+
+with open(CHEBI_TARGETS, "rb") as infile:
+    # About 330 KB, so there are several blocks
+    TEXT = infile.read() * 3
+
+
+class BGZFTestCase(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix="test_bgzf")
+        self.filename = os.path.join(self.dirname, "data.fps.bgz")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _write(self, text, filename=None, index=True):
+        if filename is None:
+            filename = self.filename
+        with bgzf.BGZFWriter(filename, index=index) as outfile:
+            for i in range(0, len(text), 1000):
+                outfile.write(text[i:i+1000])
+        return filename
+
+
+class TestWriter(BGZFTestCase):
+    def test_gzip_can_read_it(self):
+        self._write(TEXT)
+        self.assertEquals(gzip.open(self.filename).read(), TEXT)
+
+    def test_blocks(self):
+        self._write(TEXT)
+        block_offsets = bgzf.read_block_index(self.filename + ".gzi")
+        self.assertEquals(len(block_offsets), len(TEXT) // bgzf.MAX_BLOCK_DATA + 1)
+        with open(self.filename, "rb") as infile:
+            data = infile.read()
+        self.assertTrue(data.endswith(bgzf.EOF_BLOCK))
+        block_offsets.append( (len(data) - len(bgzf.EOF_BLOCK), len(TEXT)) )
+        for (start, ustart), (end, uend) in zip(block_offsets, block_offsets[1:]):
+            block = bgzf._decompress_block(data[start:end])
+            self.assertEquals(block, TEXT[ustart:uend])
+            # Each block has whole lines
+            self.assertEquals(block[-1], "\n")
+            self.assertLessEqual(len(block), bgzf.MAX_BLOCK_DATA)
+
+    def test_long_line(self):
+        text = "A" * 200000 + "\nB\n"
+        self._write(text)
+        self.assertEquals(gzip.open(self.filename).read(), text)
+
+    def test_empty(self):
+        self._write("")
+        self.assertEquals(gzip.open(self.filename).read(), "")
+        self.assertFalse(os.path.exists(self.filename + ".gzi"))
+        with open(self.filename, "rb") as infile:
+            self.assertEquals(infile.read(), bgzf.EOF_BLOCK)
+
+    def test_without_index(self):
+        self._write(TEXT, index=False)
+        self.assertFalse(os.path.exists(self.filename + ".gzi"))
+
+
+class TestReader(BGZFTestCase):
+    def test_read(self):
+        self._write(TEXT)
+        for num_threads in (1, 3):
+            with bgzf.BGZFReader(self.filename, num_threads) as infile:
+                self.assertEquals(infile.read(5), TEXT[:5])
+                self.assertEquals(infile.readline(), TEXT[5:TEXT.index("\n")+1])
+                self.assertEquals(infile.read(), TEXT[TEXT.index("\n")+1:])
+                self.assertEquals(infile.read(), "")
+                self.assertEquals(infile.tell(), len(TEXT))
+
+    def test_readlines(self):
+        self._write(TEXT)
+        with bgzf.BGZFReader(self.filename, 2) as infile:
+            self.assertEquals(list(infile), TEXT.splitlines(True))
+
+    def test_readline_size(self):
+        self._write("abcdef\nxyz")
+        with bgzf.BGZFReader(self.filename, 1) as infile:
+            self.assertEquals(infile.readline(3), "abc")
+            self.assertEquals(infile.readline(), "def\n")
+            self.assertEquals(infile.readline(), "xyz")
+            self.assertEquals(infile.readline(), "")
+
+    def _check_seek(self, num_threads):
+        with bgzf.BGZFReader(self.filename, num_threads) as infile:
+            for offset in (100000, 0, 5, bgzf.MAX_BLOCK_DATA - 1, bgzf.MAX_BLOCK_DATA,
+                           200000, 200010, len(TEXT) - 3, len(TEXT), len(TEXT) + 10):
+                infile.seek(offset)
+                self.assertEquals(infile.tell(), min(offset, len(TEXT)))
+                self.assertEquals(infile.read(1000), TEXT[offset:offset+1000], offset)
+            infile.seek(10)
+            infile.seek(20, 1)
+            self.assertEquals(infile.read(10), TEXT[30:40])
+
+    def test_seek_with_index(self):
+        self._write(TEXT)
+        for num_threads in (1, 3):
+            self._check_seek(num_threads)
+
+    def test_seek_without_index(self):
+        self._write(TEXT, index=False)
+        for num_threads in (1, 3):
+            self._check_seek(num_threads)
+
+    def test_block_offsets(self):
+        self._write(TEXT)
+        expected = bgzf.read_block_index(self.filename + ".gzi")
+        os.unlink(self.filename + ".gzi")
+        with bgzf.BGZFReader(self.filename, 1) as infile:
+            # This also finds the empty block at the end
+            self.assertEquals(infile.get_block_offsets(),
+                              expected + [(os.path.getsize(self.filename) - len(bgzf.EOF_BLOCK),
+                                           len(TEXT))])
+
+    def _assert_threads_stop(self, threads):
+        self.assertTrue(threads)
+        for thread in threads:
+            # The idle workers check every 0.1 seconds if they should exit
+            thread.join(5.0)
+            self.assertFalse(thread.is_alive())
+
+    def test_threads_stop_at_the_end(self):
+        # Enough blocks that they aren't all queued after the first read
+        text = TEXT * 5
+        self._write(text)
+        infile = bgzf.BGZFReader(self.filename, 2)
+        self.assertEquals(infile.read(10), text[:10])
+        threads = list(infile._executor._threads)
+        self.assertEquals(infile.read(), text[10:])
+        self.assertIs(infile._executor, None)
+        self._assert_threads_stop(threads)
+        # A seek starts them again
+        infile.seek(10)
+        threads = list(infile._executor._threads)
+        self.assertEquals(infile.read(), text[10:])
+        self.assertIs(infile._executor, None)
+        self._assert_threads_stop(threads)
+
+    def test_threads_stop_when_the_reader_is_deleted(self):
+        text = TEXT * 5
+        self._write(text)
+        infile = bgzf.BGZFReader(self.filename, 2)
+        self.assertEquals(infile.read(10), text[:10])
+        threads = list(infile._executor._threads)
+        del infile
+        self._assert_threads_stop(threads)
+
+    def test_seek_from_end(self):
+        self._write(TEXT)
+        with bgzf.BGZFReader(self.filename, 1) as infile:
+            with self.assertRaisesRegexp(ValueError, "Seek from end not supported"):
+                infile.seek(-10, 2)
+
+    def test_bad_crc(self):
+        self._write("Hello!\n")
+        with open(self.filename, "rb") as infile:
+            data = infile.read()
+        i = len(data) - len(bgzf.EOF_BLOCK) - 8
+        with open(self.filename, "wb") as outfile:
+            outfile.write(data[:i] + "XXXX" + data[i+4:])
+        for num_threads in (1, 2):
+            with bgzf.BGZFReader(self.filename, num_threads) as infile:
+                with self.assertRaisesRegexp(IOError, "CRC check failed"):
+                    infile.read()
+
+    def test_not_bgzf(self):
+        filename = os.path.join(self.dirname, "data.fps.gz")
+        gzip_file = gzip.open(filename, "w")
+        gzip_file.write(TEXT)
+        gzip_file.close()
+        self.assertFalse(bgzf.is_bgzf_file(filename))
+        with bgzf.BGZFReader(filename, 1) as infile:
+            with self.assertRaisesRegexp(IOError, "Not a BGZF block at byte 0"):
+                infile.read()
+
+    def test_truncated(self):
+        self._write(TEXT)
+        with open(self.filename, "rb") as infile:
+            data = infile.read()
+        with open(self.filename, "wb") as outfile:
+            outfile.write(data[:1000])
+        with bgzf.BGZFReader(self.filename, 1) as infile:
+            with self.assertRaisesRegexp(IOError, "Truncated BGZF block at byte 0"):
+                infile.read()
+
+
+class TestFPS(BGZFTestCase):
+    def setUp(self):
+        super(TestFPS, self).setUp()
+        self._num_threads = chemfp.get_num_threads()
+
+    def tearDown(self):
+        super(TestFPS, self).tearDown()
+        chemfp.set_num_threads(self._num_threads)
+
+    def test_format(self):
+        self.assertEquals(io.normalize_format("x.fps.bgz", None), ("fps", ".bgz"))
+        self.assertEquals(io.normalize_format(None, "fps.bgz"), ("fps", ".bgz"))
+
+    def test_write_fps1_output(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        io.write_fps1_output(targets, self.filename)
+        self.assertTrue(os.path.exists(self.filename + ".gzi"))
+        self.assertEquals(list(chemfp.open(self.filename)), list(targets))
+
+    def test_open_bgzf_with_gz_extension(self):
+        with open(CHEBI_TARGETS, "rb") as infile:
+            filename = self._write(infile.read(), os.path.join(self.dirname, "data.fps.gz"))
+        reader = chemfp.open(filename)
+        self.assertTrue(isinstance(reader._infile, bgzf.BGZFReader))
+        self.assertEquals(list(reader), list(chemfp.open(CHEBI_TARGETS)))
+
+    def test_load_fingerprints(self):
+        with open(CHEBI_TARGETS, "rb") as infile:
+            self._write(infile.read())
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS)
+        for num_threads in (1, chemfp.get_max_threads()):
+            chemfp.set_num_threads(num_threads)
+            arena = chemfp.load_fingerprints(self.filename)
+            self.assertEquals(list(arena), list(expected))
+
+    def test_scan(self):
+        with open(CHEBI_TARGETS, "rb") as infile:
+            self._write(infile.read())
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+        for num_threads in (1, chemfp.get_max_threads()):
+            chemfp.set_num_threads(num_threads)
+            self.assertEquals(
+                fps_search.count_tanimoto_hits_arena(queries, chemfp.open(self.filename), 0.4),
+                fps_search.count_tanimoto_hits_arena(queries, chemfp.open(CHEBI_TARGETS), 0.4))
+
+
+if __name__ == "__main__":
+    unittest2.main()
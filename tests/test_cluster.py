@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+import unittest2
+import array
+
+import chemfp
+from chemfp import search, cluster
+from chemfp.commandline import fpcluster
+
+import support
+
+CHEBI_TARGETS = support.fullpath("chebi_rdmaccs.fps")
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+neighbors = search.threshold_tanimoto_search_symmetric(targets, 0.8)
+
+def slow_sphere_exclusion(results, order):
+    # A reference implementation, like the one in demo/butina.py
+    seen = set()
+    centroids = []
+    for i in order:
+        if i in seen:
+            continue
+        seen.add(i)
+        members = [j for j in results[i].get_indices() if j not in seen]
+        seen.update(members)
+        centroids.append((i, sorted(members)))
+    return centroids
+
+def slow_butina(results, key):
+    order = sorted(xrange(len(results)), key=lambda i: (-len(results[i]), key(i)))
+    return slow_sphere_exclusion(results, order)
+
+def get_clusters(clusters):
+    return [(clusters.get_centroid(i), sorted(clusters.get_members(i)[1:]))
+                for i in xrange(len(clusters))]
+
+class TestButina(unittest2.TestCase):
+    def test_default(self):
+        clusters = cluster.butina(targets, 0.8)
+        self.assertEquals(clusters.method, "Butina")
+        self.assertEquals(clusters.threshold, 0.8)
+        self.assertEquals(get_clusters(clusters), slow_butina(neighbors, lambda i: i))
+
+    def test_reverse_index(self):
+        clusters = cluster.butina(targets, 0.8, tie_break="reverse-index", results=neighbors)
+        self.assertEquals(get_clusters(clusters), slow_butina(neighbors, lambda i: -i))
+
+    def test_density(self):
+        clusters = cluster.butina(targets, 0.8, tie_break="density", results=neighbors)
+        def density_key(i):
+            return (-sum(neighbors[i].get_scores()), i)
+        self.assertEquals(get_clusters(clusters), slow_butina(neighbors, density_key))
+
+    def test_random_with_seed(self):
+        clusters1 = cluster.butina(targets, 0.8, tie_break="random", seed=123)
+        clusters2 = cluster.butina(targets, 0.8, tie_break="random", seed=123)
+        self.assertEquals(list(clusters1.centroids), list(clusters2.centroids))
+
+    def test_every_fingerprint_is_assigned(self):
+        clusters = cluster.butina(targets, 0.8)
+        self.assertEquals(sum(clusters.get_size(i) for i in xrange(len(clusters))), len(targets))
+        for i in xrange(len(clusters)):
+            for index in clusters.get_members(i):
+                self.assertEquals(clusters.get_cluster(index), i)
+
+    def test_members_and_scores(self):
+        clusters = cluster.butina(targets, 0.8)
+        hits = clusters.get_members_and_scores(0)
+        self.assertEquals(len(hits)+1, clusters.get_size(0))
+        scores = [score for (index, score) in hits]
+        self.assertEquals(scores, sorted(scores, reverse=True))
+        self.assertTrue(min(scores) >= 0.8)
+        self.assertEquals(clusters.get_num_neighbors(0),
+                          len(neighbors[clusters.get_centroid(0)]))
+
+    def test_bad_tie_break(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown tie_break 'largest'"):
+            cluster.butina(targets, 0.8, tie_break="largest")
+
+    def test_unsorted_arena(self):
+        arena = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+        with self.assertRaisesRegexp(ValueError, "ordered by popcount"):
+            cluster.butina(arena, 0.8)
+
+    def test_empty(self):
+        clusters = cluster.butina(targets[:0], 0.8)
+        self.assertEquals(len(clusters), 0)
+
+class TestSphereExclusion(unittest2.TestCase):
+    def test_index(self):
+        clusters = cluster.sphere_exclusion(targets, 0.8, results=neighbors)
+        self.assertEquals(clusters.method, "sphere-exclusion")
+        self.assertEquals(get_clusters(clusters),
+                          slow_sphere_exclusion(neighbors, range(len(targets))))
+
+    def test_reverse_index(self):
+        clusters = cluster.sphere_exclusion(targets, 0.8, order="reverse-index")
+        self.assertEquals(get_clusters(clusters),
+                          slow_sphere_exclusion(neighbors, range(len(targets)-1, -1, -1)))
+
+    def test_sequence(self):
+        order = range(0, len(targets), 2) + range(1, len(targets), 2)
+        clusters = cluster.sphere_exclusion(targets, 0.8, order=order, results=neighbors)
+        self.assertEquals(get_clusters(clusters), slow_sphere_exclusion(neighbors, order))
+
+    def test_bad_sequence(self):
+        with self.assertRaisesRegexp(ValueError, "one index for each fingerprint"):
+            cluster.sphere_exclusion(targets, 0.8, order=[0, 1, 2], results=neighbors)
+        with self.assertRaisesRegexp(ValueError, "out of range"):
+            cluster.sphere_exclusion(targets, 0.8, order=range(1, len(targets)+1),
+                                     results=neighbors)
+        with self.assertRaisesRegexp(ValueError, "every arena index"):
+            cluster.sphere_exclusion(targets, 0.8, order=[0]*len(targets), results=neighbors)
+
+    def test_bad_order(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown order 'density'"):
+            cluster.sphere_exclusion(targets, 0.8, order="density")
+
+
+class ClusterRunner(support.Runner):
+    def verify_result(self, result):
+        assert result[0] == "#Clusters/1", result[0]
+
+runner = ClusterRunner(fpcluster.main)
+
+class TestFPCluster(unittest2.TestCase):
+    def test_default(self):
+        lines = runner.run("", CHEBI_TARGETS)
+        header = [line for line in lines if line.startswith("#")]
+        self.assertIn("#type=Butina threshold=0.8 tie-break=index", header)
+        self.assertIn("#num_bits=166", header)
+        body = [line for line in lines if not line.startswith("#")]
+        expected = slow_butina(neighbors, lambda i: i)
+        self.assertEquals(len(body), len(expected))
+        fields = body[0].split("\t")
+        centroid, members = expected[0]
+        self.assertEquals(fields[0], str(len(members)+1))
+        self.assertEquals(fields[1], targets.ids[centroid])
+        self.assertEquals(sorted(fields[2::2]), sorted(targets.ids[i] for i in members))
+        self.assertEquals(sum(int(line.split("\t")[0]) for line in body), len(targets))
+
+    def test_sphere_exclusion(self):
+        lines = runner.run("--method sphere-exclusion -t 0.9 --tie-break random --seed 5",
+                           CHEBI_TARGETS)
+        self.assertIn("#type=sphere-exclusion threshold=0.9 tie-break=random seed=5", lines)
+
+    def test_bad_tie_break_for_sphere_exclusion(self):
+        with self.assertRaises(SystemExit):
+            runner.run("--method sphere-exclusion --tie-break density", CHEBI_TARGETS)
+
+if __name__ == "__main__":
+    unittest2.main()
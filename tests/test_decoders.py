@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+import unittest2
+
+from chemfp import decoders
+
+CACTVS = ("AAADceB7sQAEAAAAAAAAAAAAAAAAAWAAAAAwAAAAAAAAAAABwAAAHwIYAAAADA" +
+          "rBniwygJJqAACqAyVyVACSBAAhhwIa+CC4ZtgIYCLB0/CUpAhgmADIyYcAgAAO" +
+          "AAAAAAABAAAAAAAAAAIAAAAAAAAAAA==")
+
+# (decoder name, decoder function, list of encoded fingerprints)
+TEST_CASES = [
+    ("binary", decoders.from_binary_lsb, ["00010101", "11101", "0" * 29 + "1", "", "1" * 64]),
+    ("binary_msb", decoders.from_binary_msb, ["10101000", "00111", "1" + "0" * 28, "", "01" * 40]),
+    ("hex", decoders.from_hex, ["10f2", "", "ABCdef0123456789"]),
+    ("hex_lsb", decoders.from_hex_lsb, ["102f", "", "ABCdef0123456789"]),
+    ("hex_msb", decoders.from_hex_msb, ["10f2", "", "ABCdef0123456789"]),
+    ("base64", decoders.from_base64, ["SGk=", "AfI=", "", "SGVsbG8h", "QQ=="]),
+    ("cactvs", decoders.from_cactvs, [CACTVS]),
+    ("daylight", decoders.from_daylight, ["I5Z2MLZgOKRcR...1", "3", "I5Z2MLZgOKRcR...3"]),
+    ]
+
+def _get_row(data, storage_size, i):
+    return str(data[i*storage_size:(i+1)*storage_size])
+
+
+class TestDecodeFingerprints(unittest2.TestCase):
+    def test_same_as_one_at_a_time(self):
+        for name, decoder, encoded_fps in TEST_CASES:
+            expected = [decoder(encoded_fp) for encoded_fp in encoded_fps]
+            storage_size = max(len(fp) for (num_bits, fp) in expected) + 3
+            for decoder_arg in (name, decoder):
+                data, num_bytes, num_bits = decoders.decode_fingerprints(
+                    encoded_fps, decoder_arg, storage_size)
+                self.assertEquals(len(data), len(encoded_fps) * storage_size)
+                for i, (expected_num_bits, fp) in enumerate(expected):
+                    self.assertEquals(num_bytes[i], len(fp), (name, i))
+                    if expected_num_bits is None:
+                        self.assertEquals(num_bits[i], -1)
+                    else:
+                        self.assertEquals(num_bits[i], expected_num_bits)
+                    self.assertEquals(_get_row(data, storage_size, i),
+                                      fp + "\0" * (storage_size - len(fp)))
+
+    def test_bad_and_missing_fingerprints(self):
+        data, num_bytes, num_bits = decoders.decode_fingerprints(
+            ["01", "012", None, "1"], "binary", 1)
+        self.assertEquals(num_bytes.tolist(), [1, -1, -1, 1])
+        self.assertEquals(num_bits.tolist(), [2, -1, -1, 1])
+        self.assertEquals(str(data), "\x02\x00\x00\x01")
+
+    def test_too_large(self):
+        data, num_bytes, num_bits = decoders.decode_fingerprints(["AB", "ABCD", "CD"], "hex", 1)
+        self.assertEquals(num_bytes.tolist(), [1, 2, 1])
+        self.assertEquals(str(data), "\xab\x00\xcd")
+
+    def test_uses_the_python_decoder_for_the_rest(self):
+        # binascii skips the newline, so the C code passes this to the Python code
+        data, num_bytes, num_bits = decoders.decode_fingerprints(["SG\nk=", "SGk=", "S"], "base64", 2)
+        self.assertEquals(num_bytes.tolist(), [2, 2, -1])
+        self.assertEquals(str(data), "HiHi\0\0")
+
+    def test_other_decoder_function(self):
+        def from_upper_hex(text):
+            if text != text.upper():
+                raise TypeError("must be upper case")
+            return None, text.decode("hex")
+        data, num_bytes, num_bits = decoders.decode_fingerprints(
+            ["AB", "ab", None, "ABCD"], from_upper_hex, 2)
+        self.assertEquals(num_bytes.tolist(), [1, -1, -1, 2])
+        self.assertEquals(str(data), "\xab\0\0\0\0\0\xab\xcd")
+
+    def test_iterator_input(self):
+        data, num_bytes, num_bits = decoders.decode_fingerprints(iter(["01", "10"]), "hex", 1)
+        self.assertEquals(str(data), "\x01\x10")
+
+    def test_empty(self):
+        data, num_bytes, num_bits = decoders.decode_fingerprints([], "cactvs", 111)
+        self.assertEquals((len(data), len(num_bytes), len(num_bits)), (0, 0, 0))
+
+    def test_bad_arguments(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown decoder name"):
+            decoders.decode_fingerprints(["00"], "decoder", 1)
+        with self.assertRaisesRegexp(ValueError, "storage_size must not be negative"):
+            decoders.decode_fingerprints(["00"], "hex", -1)
+        with self.assertRaisesRegexp(TypeError, "strings or None"):
+            decoders.decode_fingerprints([1], "hex", 1)
+
+
+class TestDecoders(unittest2.TestCase):
+    def test_binary_lengths(self):
+        # The C code handles 8 characters at a time, then the rest
+        for n in range(20):
+            text = "1" * n
+            self.assertEquals(decoders.from_binary_lsb(text),
+                              (n, ("\xff" * (n // 8)) + ((n % 8) and chr((1 << (n % 8)) - 1) or "")))
+            self.assertEquals(decoders.from_binary_msb(text)[1],
+                              decoders.from_binary_lsb(text)[1] or "\0")
+
+    def test_errors_are_unchanged(self):
+        for decoder, text, msg in (
+                (decoders.from_binary_lsb, "012", "Not a binary string"),
+                (decoders.from_binary_msb, "012", "Not a binary string"),
+                (decoders.from_hex, "abc", "Odd-length string"),
+                (decoders.from_hex, "ax", "Non-hexadecimal digit found"),
+                (decoders.from_base64, "S", "Incorrect padding"),
+                (decoders.from_cactvs, "SGk=", "hard-coded for 881 bit CACTVS")):
+            with self.assertRaisesRegexp(TypeError, msg):
+                decoder(text)
+        with self.assertRaisesRegexp(ValueError, "wrong length"):
+            decoders.from_daylight("I5Z2")
+
+    def test_daylight_empty_string(self):
+        self.assertEquals(decoders.from_daylight("3"), (None, ""))
+
+
+if __name__ == "__main__":
+    unittest2.main()
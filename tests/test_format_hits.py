@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+import unittest2
+import os
+import shutil
+import tempfile
+
+import chemfp
+from chemfp import search
+from chemfp.arena import FingerprintArena
+
+import support
+
+CHEBI_TARGETS = support.fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = support.fullpath("chebi_queries.fps.gz")
+
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+
+
+def slow_format(results, query_ids, num_digits):
+    hit_formatter = "\t%s\t%." + str(num_digits) + "f"
+    lines = []
+    for query_id, hits in zip(query_ids, results.iter_ids_and_scores()):
+        lines.append("%d\t%s" % (len(hits), query_id))
+        for hit in hits:
+            lines.append(hit_formatter % hit)
+        lines.append("\n")
+    return "".join(lines)
+
+def _list_id_arena(arena):
+    # The same arena, but with the ids in a list instead of an IdStore
+    return FingerprintArena(arena.metadata, arena.alignment,
+                            arena.start_padding, arena.end_padding,
+                            arena.storage_size, arena.arena,
+                            arena.popcount_indices, list(arena.ids),
+                            arena.start, arena.end)
+
+
+class TestFormatHits(unittest2.TestCase):
+    def _check(self, results, query_ids, num_digits=3):
+        self.assertEquals(search.format_hits(results, query_ids, num_digits),
+                          slow_format(results, query_ids, num_digits))
+
+    def test_threshold(self):
+        results = search.threshold_tanimoto_search(queries, targets, 0.4)
+        for num_digits in (0, 3, 5, 12):
+            self._check(results, queries.ids, num_digits)
+
+    def test_knearest(self):
+        results = search.knearest_tanimoto_search(queries, targets, 5, 0.0)
+        self._check(results, queries.ids)
+
+    def test_no_hits(self):
+        results = search.threshold_tanimoto_search(queries, targets, 1.0)
+        self._check(results, queries.ids)
+        results = search.SearchResults(0, targets.ids)
+        self.assertEquals(search.format_hits(results, [], 3), "")
+
+    def test_range(self):
+        results = search.threshold_tanimoto_search(queries, targets, 0.5)
+        text = search.format_hits(results, queries.ids[10:20], 3, 10, 20)
+        self.assertEquals(text, "".join(slow_format(results, queries.ids, 3).splitlines(True)[10:20]))
+
+    def test_target_subarena(self):
+        subarena = targets[100:900]
+        results = search.threshold_tanimoto_search(queries, subarena, 0.3)
+        self._check(results, queries.ids)
+
+    def test_list_ids(self):
+        list_targets = _list_id_arena(targets)
+        results = search.threshold_tanimoto_search(queries, list_targets, 0.4)
+        self.assertEquals(search.format_hits(results, queries.ids, 3),
+                          search.format_hits(search.threshold_tanimoto_search(queries, targets, 0.4),
+                                             queries.ids, 3))
+        self._check(results, queries.ids)
+
+    def test_fpb_ids(self):
+        dirname = tempfile.mkdtemp(prefix="test_format_hits")
+        try:
+            filename = os.path.join(dirname, "targets.fpb")
+            targets.save(filename)
+            fpb_targets = chemfp.open(filename)
+            results = search.knearest_tanimoto_search(queries, fpb_targets, 3, 0.0)
+            self._check(results, queries.ids)
+            del fpb_targets, results
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_wrong_number_of_query_ids(self):
+        results = search.threshold_tanimoto_search(queries, targets, 0.4)
+        for target_ids in (targets.ids, list(targets.ids)):
+            results.target_ids = target_ids
+            with self.assertRaisesRegexp(ValueError, "must have one query id for each result row"):
+                search.format_hits(results, queries.ids[:-1], 3)
+
+    def test_bad_query_id(self):
+        results = search.threshold_tanimoto_search(queries[:2], targets, 0.4)
+        with self.assertRaisesRegexp(TypeError, "query ids must be strings"):
+            search.format_hits(results, ["a", 2], 3)
+
+    def test_index_not_in_ids(self):
+        results = search.threshold_tanimoto_search(queries, targets, 0.4)
+        results.target_ids = targets.ids[:10]
+        with self.assertRaisesRegexp(ValueError, "a hit index is not in the target id table"):
+            search.format_hits(results, queries.ids, 3)
+
+    def test_no_target_ids(self):
+        results = search.SearchResults(1)
+        with self.assertRaisesRegexp(TypeError, "target_ids are not available"):
+            search.format_hits(results, ["a"], 3)
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,246 @@
+from __future__ import absolute_import, with_statement
+import unittest2
+import os
+import shutil
+import tempfile
+
+import chemfp
+from chemfp import io, readers, fps_search, fpsidx
+from chemfp.commandline import fpsindex
+
+from support import fullpath
+
+CHEBI_TARGETS = fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = fullpath("chebi_queries.fps.gz")
+
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+target_id_fps = list(readers.open_fps(CHEBI_TARGETS))
+# A single arena, with few enough queries that the threshold search
+# results for a block fit into one call
+queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+queries = chemfp.load_fingerprints(list(queries)[:30], queries.metadata, reorder=False)
+
+
+class TestIndex(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix="test_fpsidx")
+        self.filename = os.path.join(self.dirname, "chebi.fps")
+        shutil.copy(CHEBI_TARGETS, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_build_index(self):
+        index = fpsidx.build_index(self.filename, 300)
+        self.assertEquals(index.num_records, 2000)
+        self.assertEquals([block[2] for block in index.blocks], [300]*6 + [200])
+        self.assertEquals(index.fps_size, os.path.getsize(self.filename))
+        with open(self.filename, "rb") as infile:
+            lines = infile.readlines()
+        for block_num, (offset, lineno, num_records, min_popcount, max_popcount, id_hash) in \
+                enumerate(index.blocks):
+            self.assertEquals(lines[lineno-1], target_id_fps[block_num*300][1].encode("hex") + "\t" +
+                              target_id_fps[block_num*300][0] + "\n")
+            self.assertEquals(sum(len(line) for line in lines[:lineno-1]), offset)
+            popcounts = [chemfp.bitops.byte_popcount(fp) for (id, fp) in
+                         target_id_fps[block_num*300:block_num*300+num_records]]
+            self.assertEquals((min(popcounts), max(popcounts)), (min_popcount, max_popcount))
+
+    def test_save_and_read(self):
+        index = fpsidx.build_index(self.filename, 128)
+        index.save(fpsidx.get_index_filename(self.filename))
+        self.assertEquals(fpsidx.read_index(self.filename + ".fpsidx"), index)
+
+    def test_bad_index_file(self):
+        index_filename = fpsidx.get_index_filename(self.filename)
+        with open(index_filename, "w") as outfile:
+            outfile.write("#FPS1\n")
+        with self.assertRaisesRegexp(fpsidx.FPSIndexFormatError, "does not start with the FPSIDX1 magic"):
+            fpsidx.read_index(index_filename)
+        with open(index_filename, "w") as outfile:
+            outfile.write("#FPSIDX1\n#records_per_block=10\n#fps_size=100\n"
+                          "#fps_mtime=1234.5\n#fps_hash=0000abcd\n#num_records=20\n"
+                          "10\t7\t10\t1\t5\t00000000\n")
+        with self.assertRaisesRegexp(fpsidx.FPSIndexFormatError, "incorrect number of records"):
+            fpsidx.read_index(index_filename)
+
+    def test_write_fps1_output(self):
+        io.write_fps1_output(targets, self.filename, index=True, records_per_block=64)
+        index = fpsidx.read_index(fpsidx.get_index_filename(self.filename))
+        self.assertEquals(index, fpsidx.build_index(self.filename, 64))
+        self.assertEquals(list(readers.open_fps(self.filename)), list(targets))
+
+    def test_write_fps1_output_needs_a_filename(self):
+        with self.assertRaisesRegexp(ValueError, "uncompressed FPS file name"):
+            io.write_fps1_output(targets, self.filename + ".gz", index=True)
+
+    def test_open_uses_the_index(self):
+        self.assertIs(chemfp.open(self.filename).index, None)
+        fpsidx.build_index(self.filename).save(fpsidx.get_index_filename(self.filename))
+        self.assertEquals(chemfp.open(self.filename).index.num_records, 2000)
+        self.assertIs(readers.open_fps(self.filename, index=False).index, None)
+
+    def test_stale_index_is_ignored(self):
+        fpsidx.build_index(self.filename).save(fpsidx.get_index_filename(self.filename))
+        with open(self.filename, "a") as outfile:
+            outfile.write("00" * 21 + "\tnew\n")
+        self.assertIs(chemfp.open(self.filename).index, None)
+
+    def test_same_size_rewrite_is_ignored(self):
+        # Use a whole number of seconds so utime() can restore it exactly
+        os.utime(self.filename, (1000000000, 1000000000))
+        fpsidx.build_index(self.filename).save(fpsidx.get_index_filename(self.filename))
+        self.assertEquals(chemfp.open(self.filename).index.num_records, 2000)
+        with open(self.filename, "rb") as infile:
+            text = infile.read()
+        # Same size, and the same modification time
+        with open(self.filename, "wb") as outfile:
+            outfile.write(text.replace("#type=", "#TYPE=", 1))
+        os.utime(self.filename, (1000000000, 1000000000))
+        self.assertIs(chemfp.open(self.filename).index, None)
+        # Same contents, but a new modification time
+        with open(self.filename, "wb") as outfile:
+            outfile.write(text)
+        os.utime(self.filename, (1000000010, 1000000010))
+        self.assertIs(chemfp.open(self.filename).index, None)
+        os.utime(self.filename, (1000000000, 1000000000))
+        self.assertEquals(chemfp.open(self.filename).index.num_records, 2000)
+
+    def test_corrupt_index_is_ignored(self):
+        index_filename = fpsidx.get_index_filename(self.filename)
+        fpsidx.build_index(self.filename).save(index_filename)
+        with open(index_filename, "rb") as infile:
+            text = infile.read()
+        expected = list(readers.open_fps(self.filename, index=False))
+        # Empty, truncated and garbage sidecars
+        for bad_text in ("", text[:len(text)//2], "\x00\xff garbage\n"):
+            with open(index_filename, "wb") as outfile:
+                outfile.write(bad_text)
+            self.assertIs(chemfp.open(self.filename).index, None)
+            self.assertEquals(list(chemfp.open(self.filename)), expected)
+            self.assertEquals(len(chemfp.load_fingerprints(self.filename)), 2000)
+
+    def test_save_replaces_the_old_index(self):
+        index_filename = fpsidx.get_index_filename(self.filename)
+        with open(index_filename, "wb") as outfile:
+            outfile.write("old index" * 1000)
+        index = fpsidx.build_index(self.filename, 500)
+        index.save(index_filename)
+        self.assertEquals(fpsidx.read_index(index_filename), index)
+        # No temporary files are left behind
+        self.assertEquals(sorted(os.listdir(self.dirname)),
+                          sorted([os.path.basename(self.filename),
+                                  os.path.basename(index_filename)]))
+
+    def test_write_fps1_output_removes_an_old_index(self):
+        fpsidx.build_index(self.filename).save(fpsidx.get_index_filename(self.filename))
+        io.write_fps1_output(targets, self.filename)
+        self.assertFalse(os.path.exists(fpsidx.get_index_filename(self.filename)))
+
+
+class TestIndexedReader(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix="test_fpsidx")
+        # Targets sorted by popcount, which is where skipping works best
+        self.filename = os.path.join(self.dirname, "chebi.fps")
+        io.write_fps1_output(targets, self.filename, index=True, records_per_block=100)
+        self.id_fps = list(targets)
+        self._num_threads = chemfp.get_num_threads()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+        chemfp.set_num_threads(self._num_threads)
+
+    def test_iter_records(self):
+        reader = chemfp.open(self.filename)
+        for start, end in ((0, None), (0, 1), (99, 101), (150, 420), (1999, 2000),
+                           (-5, None), (500, 100), (1990, 3000)):
+            self.assertEquals(list(reader.iter_records(start, end)), self.id_fps[start:end])
+        # These don't use the forward iteration
+        self.assertEquals(list(reader), self.id_fps)
+
+    def test_iter_records_without_an_index(self):
+        reader = readers.open_fps(self.filename, index=False)
+        self.assertEquals(list(reader.iter_records(150, 420)), self.id_fps[150:420])
+
+    def test_iter_arenas(self):
+        reader = chemfp.open(self.filename)
+        arenas = list(reader.iter_arenas(30, 1000, 1095))
+        self.assertEquals([len(arena) for arena in arenas], [30, 30, 30, 5])
+        self.assertEquals([id_fp for arena in arenas for id_fp in arena], self.id_fps[1000:1095])
+
+    def test_chunk_ranges(self):
+        reader = chemfp.open(self.filename)
+        ranges = reader.index.get_chunk_ranges(3)
+        self.assertEquals(ranges, [(0, 600), (600, 1300), (1300, 2000)])
+        self.assertEquals([id_fp for (start, end) in ranges
+                               for id_fp in reader.iter_records(start, end)], self.id_fps)
+        self.assertEquals(len(reader.index.get_chunk_ranges(100)), 20)
+
+    def test_skips_blocks(self):
+        reader = chemfp.open(self.filename)
+        query = chemfp.load_fingerprints([self.id_fps[1500]], targets.metadata)
+        self.assertLess(len(list(fps_search._iter_target_blocks(reader, query, 0.8))), 10)
+        reader = chemfp.open(self.filename)
+        self.assertEquals(len(list(fps_search._iter_target_blocks(reader, query, 0.0))), 20)
+
+    def _search(self, index):
+        results = []
+        for threshold in (0.0, 0.3, 0.7, 0.95, 1.0):
+            results.append(fps_search.count_tanimoto_hits_arena(
+                queries, readers.open_fps(self.filename, index=index), threshold))
+            results.append([list(result) for result in fps_search.threshold_tanimoto_search_arena(
+                queries, readers.open_fps(self.filename, index=index), threshold)])
+            results.append([list(result) for result in fps_search.knearest_tanimoto_search(
+                queries, readers.open_fps(self.filename, index=index), 5, threshold)])
+        return results
+
+    def test_same_search_results(self):
+        for num_threads in (1, chemfp.get_max_threads()):
+            chemfp.set_num_threads(num_threads)
+            self.assertEquals(self._search(None), self._search(False))
+
+    def test_search_error_location(self):
+        os.utime(self.filename, (1000000000, 1000000000))
+        fpsidx.build_index(self.filename, 100).save(fpsidx.get_index_filename(self.filename))
+        with open(self.filename, "rb") as infile:
+            lines = infile.readlines()
+        # Keep the same file size and time, and don't change the
+        # first or last block, so the index is still used
+        lines[1000] = "z" + lines[1000][1:]
+        with open(self.filename, "wb") as outfile:
+            outfile.writelines(lines)
+        os.utime(self.filename, (1000000000, 1000000000))
+        query = chemfp.load_fingerprints([self.id_fps[0]], targets.metadata)
+        for index in (None, False):
+            reader = readers.open_fps(self.filename, index=index)
+            self.assertEquals(reader.index is None, index is False)
+            with self.assertRaisesRegexp(fps_search.FPSFormatError, "at line 1001 of"):
+                fps_search.count_tanimoto_hits_arena(query, reader, 0.0)
+
+
+class TestFPSIndexCommand(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix="test_fpsidx")
+        self.filename = os.path.join(self.dirname, "chebi.fps")
+        shutil.copy(CHEBI_TARGETS, self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_build_and_check(self):
+        fpsindex.main(["--records-per-block", "500", self.filename])
+        index = fpsidx.read_index(fpsidx.get_index_filename(self.filename))
+        self.assertEquals(index, fpsidx.build_index(self.filename, 500))
+        fpsindex.main(["--check", self.filename])
+
+    def test_check_out_of_date(self):
+        fpsindex.main([self.filename])
+        with open(self.filename, "a") as outfile:
+            outfile.write("00" * 21 + "\tnew\n")
+        with self.assertRaises(SystemExit):
+            fpsindex.main(["--check", self.filename])
+
+
+if __name__ == "__main__":
+    unittest2.main()
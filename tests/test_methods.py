@@ -20,7 +20,8 @@ available_methods = chemfp.bitops.get_methods()
 alignment_methods = chemfp.bitops.get_alignment_methods()
 
 
-all_methods = dict.fromkeys("LUT8-1 LUT8-4 LUT16-4 Lauradoux POPCNT Gillies ssse3".split())
+all_methods = dict.fromkeys(
+    "LUT8-1 LUT8-4 LUT16-4 Lauradoux POPCNT Gillies ssse3 avx2 avx512-vpopcnt".split())
 
 class TestMethods(unittest2.TestCase):
     def test_no_duplicates(self):
@@ -152,6 +153,15 @@ class TestAlign8SmallMethods(unittest2.TestCase):
     def test_popcnt(self):
         self._doit("POPCNT")
 
+    @unittest2.skipIf("avx2" not in available_methods, "CPU does not implement AVX2")
+    def test_avx2(self):
+        self._doit("avx2")
+
+    @unittest2.skipIf("avx512-vpopcnt" not in available_methods,
+                      "CPU does not implement AVX-512 VPOPCNTDQ")
+    def test_avx512(self):
+        self._doit("avx512-vpopcnt")
+
 class TestAlign8LargeMethods(unittest2.TestCase):
     def setUp(self):
         self.large_method = get_alignment_method("align8-large")
@@ -206,7 +216,122 @@ class TestAlign8LargeMethods(unittest2.TestCase):
     @unittest2.skipIf("POPCNT" not in available_methods, "CPU does not implement POPCNT")
     def test_popcnt(self):
         self._doit("POPCNT")
-        
+
+    @unittest2.skipIf("avx2" not in available_methods, "CPU does not implement AVX2")
+    def test_avx2(self):
+        self._doit("avx2")
+
+    @unittest2.skipIf("avx512-vpopcnt" not in available_methods,
+                      "CPU does not implement AVX-512 VPOPCNTDQ")
+    def test_avx512(self):
+        self._doit("avx512-vpopcnt")
+
+
+class TestVectorMethods(unittest2.TestCase):
+    # The AVX methods have separate code paths for the full vectors,
+    # 512 byte Harley-Seal blocks, and the words at the end
+    def setUp(self):
+        self._alignment_methods = chemfp.bitops.get_alignment_methods()
+    def tearDown(self):
+        for k,v in self._alignment_methods.items():
+            set_alignment_method(k, v)
+
+    def _doit(self, method):
+        from chemfp import bench, search
+        for num_bits in (64, 200, 512, 1000, 2048, 4096, 4200, 9000):
+            metadata = chemfp.Metadata(num_bits=num_bits)
+            fps = list(bench.generate_fingerprints(50, num_bits, density=0.4, seed=num_bits))
+            arena = chemfp.load_fingerprints(fps, metadata, alignment=8)
+            results = []
+            for m in ("LUT8-1", method):
+                set_alignment_method("align8-small", m)
+                set_alignment_method("align8-large", m)
+                results.append(list(search.count_tanimoto_hits_symmetric(arena, 0.25)))
+            self.assertEquals(results[0], results[1], num_bits)
+
+    @unittest2.skipIf("avx2" not in available_methods, "CPU does not implement AVX2")
+    def test_avx2(self):
+        self._doit("avx2")
+
+    @unittest2.skipIf("avx512-vpopcnt" not in available_methods,
+                      "CPU does not implement AVX-512 VPOPCNTDQ")
+    def test_avx512(self):
+        self._doit("avx512-vpopcnt")
+
+    @unittest2.skipIf("avx2" not in available_methods, "CPU does not implement AVX2")
+    def test_environment_variable(self):
+        chemfp.bitops.use_environment_variables({"CHEMFP-ALIGN8-LARGE": "avx2"})
+        self.assertEquals(get_alignment_method("align8-large"), "avx2")
+
+
+class TestFixedKernels(unittest2.TestCase):
+    # The 166, 881, 1024 and 2048 bit Tanimoto searches have their own
+    # code, used with the POPCNT, avx2 and avx512-vpopcnt methods.
+    def setUp(self):
+        self._alignment_methods = chemfp.bitops.get_alignment_methods()
+        self._num_threads = chemfp.get_num_threads()
+    def tearDown(self):
+        for k,v in self._alignment_methods.items():
+            set_alignment_method(k, v)
+        chemfp.bitops.set_option("fixed-kernels", 1)
+        chemfp.set_num_threads(self._num_threads)
+
+    def _search(self, queries, targets):
+        from chemfp import search
+        results = []
+        for threshold in (0.0, 0.35, 1.0):
+            results.append(list(search.count_tanimoto_hits(queries, targets, threshold)))
+            results.append([sorted(row.get_ids_and_scores()) for row in
+                                search.threshold_tanimoto_search(queries, targets, threshold)])
+        for (k, threshold) in ((1, 0.0), (7, 0.0), (3, 0.5)):
+            results.append([row.get_ids_and_scores() for row in
+                                search.knearest_tanimoto_search(queries, targets, k, threshold)])
+        return results
+
+    def _doit(self, method):
+        from chemfp import bench
+        for num_bits in (166, 881, 1024, 2048):
+            metadata = chemfp.Metadata(num_bits=num_bits)
+            fps = list(bench.generate_fingerprints(200, num_bits, seed=num_bits))
+            query_fps = fps[:10] + [("empty", "\0" * ((num_bits+7)//8))]
+            for alignment in (8, 64):
+                targets = chemfp.load_fingerprints(fps, metadata, alignment=alignment)
+                queries = chemfp.load_fingerprints(query_fps, metadata, alignment=alignment)
+                for num_threads in (1, 2):
+                    chemfp.set_num_threads(num_threads)
+                    for (q, t) in ((queries, targets), (queries[2:6], targets[30:150])):
+                        set_alignment_method("align8-small", "LUT8-1")
+                        set_alignment_method("align8-large", "LUT8-1")
+                        expected = self._search(q, t)
+                        set_alignment_method("align8-small", method)
+                        set_alignment_method("align8-large", method)
+                        self.assertEquals(self._search(q, t), expected, (num_bits, alignment))
+
+    @unittest2.skipIf("POPCNT" not in available_methods, "CPU does not implement POPCNT")
+    def test_popcnt(self):
+        self._doit("POPCNT")
+
+    @unittest2.skipIf("avx2" not in available_methods, "CPU does not implement AVX2")
+    def test_avx2(self):
+        self._doit("avx2")
+
+    @unittest2.skipIf("avx512-vpopcnt" not in available_methods,
+                      "CPU does not implement AVX-512 VPOPCNTDQ")
+    def test_avx512(self):
+        self._doit("avx512-vpopcnt")
+
+    def test_option(self):
+        self.assertIn("fixed-kernels", chemfp.bitops.get_options())
+        self.assertEquals(chemfp.bitops.get_option("fixed-kernels"), 1)
+        chemfp.bitops.set_option("fixed-kernels", 0)
+        self.assertEquals(chemfp.bitops.get_option("fixed-kernels"), 0)
+        with self.assertRaises(ValueError):
+            chemfp.bitops.set_option("fixed-kernels", 2)
+
+    def test_environment_variable(self):
+        chemfp.bitops.use_environment_variables({"CHEMFP-FIXED-KERNELS": "0"})
+        self.assertEquals(chemfp.bitops.get_option("fixed-kernels"), 0)
+
 
 class TestSelectFastestMethod(unittest2.TestCase):
     def setUp(self):
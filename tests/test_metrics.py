@@ -0,0 +1,189 @@
+from __future__ import absolute_import
+import unittest2
+import itertools
+
+import chemfp
+from chemfp import search, fps_search, metrics, bitops
+from chemfp.commandline import simsearch
+
+import support
+
+CHEBI_TARGETS = support.fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = support.fullpath("chebi_queries.fps.gz")
+SIMPLE_FPS = support.fullpath("simple.fps")
+
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+unordered_targets = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+_query_reader = chemfp.open(CHEBI_QUERIES)
+queries = chemfp.load_fingerprints(itertools.islice(_query_reader, 20), _query_reader.metadata)
+num_bits = targets.metadata.num_bits
+
+METRICS = [metrics.Metric("tversky", 0.9, 0.1),
+           metrics.Metric("tversky", 0.3, 1.7),
+           metrics.Metric("dice"),
+           metrics.Metric("cosine"),
+           metrics.Metric("hamming"),
+           metrics.Metric("euclidean"),
+           metrics.Metric("contains")]
+
+def slow_scores(metric, query_fp, arena):
+    A = bitops.byte_popcount(query_fp)
+    return [(i, metric.score(num_bits, A, bitops.byte_popcount(target_fp),
+                             bitops.byte_intersect_popcount(query_fp, target_fp)))
+                for (i, (id, target_fp)) in enumerate(arena)]
+
+def slow_threshold(metric, query_fp, arena, threshold):
+    return sorted((i, score) for (i, score) in slow_scores(metric, query_fp, arena)
+                      if score >= threshold)
+
+def slow_knearest_scores(metric, query_fp, arena, k, threshold):
+    scores = [score for (i, score) in slow_scores(metric, query_fp, arena) if score >= threshold]
+    scores.sort(reverse=True)
+    return scores[:k]
+
+
+class TestMetric(unittest2.TestCase):
+    def test_names(self):
+        for name in metrics.METRIC_NAMES:
+            self.assertEquals(metrics.get_metric(name).name, name)
+        self.assertIs(metrics.get_metric(None), metrics.TANIMOTO)
+        self.assertTrue(metrics.get_metric("tanimoto").is_tanimoto)
+        self.assertFalse(metrics.get_metric("dice").is_tanimoto)
+
+    def test_description(self):
+        self.assertEquals(str(metrics.get_metric("tversky", 0.5, 0.25)),
+                          "Tversky alpha=0.5 beta=0.25")
+        self.assertEquals(str(metrics.get_metric("dice")), "Dice")
+
+    def test_bad_name(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown metric 'jaccard'"):
+            metrics.get_metric("jaccard")
+
+    def test_bad_tversky(self):
+        with self.assertRaisesRegexp(ValueError, "non-negative"):
+            metrics.get_metric("tversky", -1.0, 1.0)
+
+    def test_scores(self):
+        dice = metrics.get_metric("dice")
+        self.assertEquals(dice.score(32, 3, 5, 2), 0.5)
+        self.assertEquals(dice.score(32, 0, 0, 0), 0.0)
+        self.assertEquals(metrics.get_metric("hamming").score(32, 3, 5, 2), 0.875)
+        self.assertEquals(metrics.get_metric("contains").score(32, 3, 5, 3), 1.0)
+        self.assertEquals(metrics.get_metric("contains").score(32, 3, 5, 2), 0.0)
+        # Tversky with alpha = beta = 1 is Tanimoto
+        self.assertEquals(metrics.get_metric("tversky").score(32, 3, 5, 2),
+                          metrics.get_metric("tanimoto").score(32, 3, 5, 2))
+
+
+class TestArenaSearch(unittest2.TestCase):
+    def _test_threshold(self, arena):
+        for metric in METRICS:
+            for threshold in (0.0, 0.5, 0.8, 1.0):
+                counts = search.count_hits(queries, arena, threshold, metric)
+                results = search.threshold_search(queries, arena, threshold, metric)
+                for i, (query_id, query_fp) in enumerate(queries):
+                    expected = slow_threshold(metric, query_fp, arena, threshold)
+                    self.assertEquals(sorted(results[i].get_indices_and_scores()), expected)
+                    self.assertEquals(counts[i], len(expected))
+
+    def test_threshold(self):
+        self._test_threshold(targets)
+
+    def test_threshold_without_popcount_indices(self):
+        self._test_threshold(unordered_targets)
+
+    def _test_knearest(self, arena):
+        for metric in METRICS:
+            for (k, threshold) in ((1, 0.0), (5, 0.0), (20, 0.6)):
+                results = search.knearest_search(queries, arena, k, threshold, metric)
+                for i, (query_id, query_fp) in enumerate(queries):
+                    self.assertEquals(list(results[i].get_scores()),
+                                      slow_knearest_scores(metric, query_fp, arena, k, threshold))
+
+    def test_knearest(self):
+        self._test_knearest(targets)
+
+    def test_knearest_without_popcount_indices(self):
+        self._test_knearest(unordered_targets)
+
+    def test_fp_search(self):
+        query_id, query_fp = queries[0]
+        for metric in METRICS:
+            expected = slow_threshold(metric, query_fp, targets, 0.7)
+            self.assertEquals(search.count_hits_fp(query_fp, targets, 0.7, metric), len(expected))
+            result = search.threshold_search_fp(query_fp, targets, 0.7, metric)
+            self.assertEquals(sorted(result.get_indices_and_scores()), expected)
+            result = search.knearest_search_fp(query_fp, targets, 3, 0.0, metric)
+            self.assertEquals(list(result.get_scores()),
+                              slow_knearest_scores(metric, query_fp, targets, 3, 0.0))
+
+    def test_subarena(self):
+        subarena = targets[100:300]
+        subarena_ids = set(subarena.arena_ids)
+        metric = metrics.get_metric("cosine")
+        results = search.threshold_search(queries, subarena, 0.8, metric)
+        expected = search.threshold_search(queries, targets, 0.8, metric)
+        for i in xrange(len(queries)):
+            self.assertEquals(sorted(results[i].get_ids_and_scores()),
+                              sorted((id, score) for (id, score) in expected[i].get_ids_and_scores()
+                                         if id in subarena_ids))
+
+    def test_tanimoto_uses_the_tanimoto_search(self):
+        results = search.threshold_search(queries, targets, 0.7)
+        expected = search.threshold_tanimoto_search(queries, targets, 0.7)
+        for i in xrange(len(queries)):
+            self.assertEquals(sorted(results[i]), sorted(expected[i]))
+
+
+class TestFPSSearch(unittest2.TestCase):
+    def test_count_and_threshold(self):
+        for metric in METRICS:
+            counts = fps_search.count_hits_arena(queries, chemfp.open(CHEBI_TARGETS),
+                                                 0.7, metric)
+            self.assertEquals(counts, list(search.count_hits(queries, targets, 0.7, metric)))
+            results = fps_search.threshold_search_arena(queries, chemfp.open(CHEBI_TARGETS),
+                                                        0.7, metric)
+            expected = search.threshold_search(queries, targets, 0.7, metric)
+            for i in xrange(len(queries)):
+                self.assertEquals(sorted(results[i]), sorted(expected[i].get_ids_and_scores()))
+
+    def test_knearest(self):
+        for metric in METRICS:
+            results = fps_search.knearest_search(queries, chemfp.open(CHEBI_TARGETS),
+                                                 5, 0.0, metric)
+            expected = search.knearest_search(queries, targets, 5, 0.0, metric)
+            for i in xrange(len(queries)):
+                self.assertEquals(results[i].get_scores(), list(expected[i].get_scores()))
+
+
+class SimsearchRunner(support.Runner):
+    def verify_result(self, result):
+        assert result[0] in ("#Simsearch/1", "#Count/1"), result[0]
+
+runner = SimsearchRunner(simsearch.main)
+
+class TestSimsearch(unittest2.TestCase):
+    def test_dice(self):
+        lines = runner.run("--hex-query deadbeef -t 0.5 --metric dice", SIMPLE_FPS)
+        self.assertIn("#type=Dice k=all threshold=0.5", lines)
+        fields = lines[-1].split("\t")
+        hits = sorted(zip(fields[2::2], fields[3::2]))
+        self.assertEquals(hits, [("DEADdead", "0.913"), ("Deaf Beef", "0.980"),
+                                 ("deadbeef", "1.000")])
+
+    def test_tversky(self):
+        lines = runner.run("--hex-query deadbeef -k 2 --metric tversky --alpha 1 --beta 0",
+                           SIMPLE_FPS)
+        self.assertIn("#type=Tversky alpha=1.0 beta=0.0 k=2 threshold=0.0", lines)
+
+    def test_contains_count(self):
+        lines = runner.run("--hex-query 00000001 -c -t 1.0 --metric contains", SIMPLE_FPS)
+        self.assertIn("#type=Count contains threshold=1.0", lines)
+
+    def test_alpha_requires_tversky(self):
+        with self.assertRaises(SystemExit):
+            runner.run("--hex-query deadbeef --metric dice --alpha 0.5", SIMPLE_FPS)
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,176 @@
+from __future__ import absolute_import
+import unittest2
+import os
+import shutil
+import tempfile
+
+try:
+    import numpy
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+try:
+    from scipy import sparse
+    has_scipy = True
+except ImportError:
+    has_scipy = False
+
+import chemfp
+from chemfp import search
+
+import support
+
+CHEBI_TARGETS = support.fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = support.fullpath("chebi_queries.fps.gz")
+
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+
+
+class TestArenaViews(unittest2.TestCase):
+    def _check_fingerprints(self, arena):
+        fps = arena.as_numpy()
+        self.assertEquals(fps.shape, (len(arena), arena.storage_size))
+        self.assertEquals(fps.dtype, numpy.uint8)
+        num_bytes = arena.metadata.num_bytes
+        for i in (0, 1, len(arena)//2, len(arena)-1):
+            self.assertEquals(fps[i, :num_bytes].tostring(), arena[i][1])
+            self.assertFalse(fps[i, num_bytes:].any())
+
+    def test_uint8(self):
+        self._check_fingerprints(targets)
+        self._check_fingerprints(queries)
+
+    def test_subarena(self):
+        self._check_fingerprints(targets[100:250])
+
+    def test_is_a_view(self):
+        fps = targets.as_numpy()
+        self.assertFalse(fps.flags.writeable)
+        self.assertFalse(fps.flags.owndata)
+
+    def test_uint64(self):
+        fps = targets.as_numpy("uint64")
+        self.assertEquals(fps.shape, (len(targets), targets.storage_size // 8))
+        self.assertEquals(fps.view(numpy.uint8).tostring(), targets.as_numpy().tostring())
+
+    def test_uint64_needs_multiple_of_8(self):
+        arena = chemfp.load_fingerprints([("a", "\1\2\3\4")], chemfp.Metadata(num_bits=32),
+                                         alignment=4)
+        self.assertEquals(arena.as_numpy().tolist(), [[1, 2, 3, 4]])
+        with self.assertRaisesRegexp(ValueError, "storage size of 4 bytes is not a multiple of 8"):
+            arena.as_numpy("uint64")
+
+    def test_bad_dtype(self):
+        with self.assertRaisesRegexp(ValueError, "dtype must be 'uint8' or 'uint64'"):
+            targets.as_numpy("int32")
+
+    def test_empty(self):
+        self.assertEquals(targets[5:5].as_numpy().shape, (0, targets.storage_size))
+
+    def test_fpb(self):
+        dirname = tempfile.mkdtemp(prefix="test_numpy")
+        try:
+            filename = os.path.join(dirname, "targets.fpb")
+            targets.save(filename)
+            fpb_targets = chemfp.open(filename)
+            self.assertEquals(fpb_targets.as_numpy()[:, :targets.metadata.num_bytes].tolist(),
+                              targets.as_numpy()[:, :targets.metadata.num_bytes].tolist())
+            del fpb_targets
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_popcount_indices(self):
+        indices = targets.popcount_indices_as_numpy()
+        self.assertEquals(len(indices), targets.num_bits + 2)
+        fps = targets.as_numpy()
+        popcounts = numpy.unpackbits(fps, axis=1).sum(axis=1)
+        for popcount in (0, 10, 50):
+            self.assertTrue((popcounts[indices[popcount]:indices[popcount+1]] == popcount).all())
+
+    def test_no_popcount_indices(self):
+        self.assertIs(queries.popcount_indices_as_numpy(), None)
+
+TestArenaViews = unittest2.skipUnless(has_numpy, "NumPy not available")(TestArenaViews)
+
+
+class TestRowViews(unittest2.TestCase):
+    def setUp(self):
+        self.results = search.threshold_tanimoto_search(queries, targets, 0.4)
+
+    def test_indices_and_scores(self):
+        for row in self.results:
+            self.assertEquals(row.get_indices_array().tolist(), list(row.get_indices()))
+            self.assertEquals(row.get_scores_array().tolist(), list(row.get_scores()))
+            self.assertEquals(row.get_indices_array().dtype, numpy.intc)
+
+    def test_empty_row(self):
+        results = search.SearchResults(2)
+        self.assertEquals(results[0].get_indices_array().tolist(), [])
+        self.assertEquals(results[1].get_scores_array().tolist(), [])
+
+    def test_is_a_view(self):
+        row = self.results[3]
+        scores = row.get_scores_array()
+        self.assertFalse(scores.flags.writeable)
+        row.reorder("increasing-score")
+        self.assertEquals(scores.tolist(), sorted(row.get_scores()))
+
+    def test_cannot_change_hits_with_views(self):
+        results = self.results
+        indices = results[3].get_indices_array()
+        with self.assertRaisesRegexp(BufferError, "exported row arrays"):
+            results.clear_all()
+        with self.assertRaisesRegexp(BufferError, "exported row arrays"):
+            results[0].clear()
+        with self.assertRaisesRegexp(BufferError, "exported row arrays"):
+            search.partial_threshold_tanimoto_search_symmetric(results, targets[:len(results)], 0.5)
+        # Read-only operations are fine
+        self.assertEquals(results[3].get_indices(), search.threshold_tanimoto_search(
+            queries, targets, 0.4)[3].get_indices())
+        del indices
+        results.clear_all()
+        self.assertEquals(len(results[3]), 0)
+
+TestRowViews = unittest2.skipUnless(has_numpy, "NumPy not available")(TestRowViews)
+
+
+class TestCSR(unittest2.TestCase):
+    def _check(self, results, matrix):
+        self.assertEquals(matrix.shape, (len(results), len(targets)))
+        self.assertEquals(matrix.nnz, sum(len(row) for row in results))
+        for i, row in enumerate(results):
+            self.assertEquals(matrix[i].indices.tolist(), list(row.get_indices()))
+            self.assertEquals(matrix[i].data.tolist(), list(row.get_scores()))
+
+    def test_threshold(self):
+        results = search.threshold_tanimoto_search(queries, targets, 0.4)
+        self._check(results, results.to_csr())
+
+    def test_knearest(self):
+        results = search.knearest_tanimoto_search(queries, targets, 5, 0.0)
+        self._check(results, results.to_csr())
+
+    def test_no_hits(self):
+        results = search.threshold_tanimoto_search(queries, targets, 1.0)
+        matrix = results.to_csr()
+        self._check(results, matrix)
+        self.assertEquals(search.SearchResults(0).to_csr(5).shape, (0, 5))
+
+    def test_num_columns(self):
+        results = search.SearchResults(2)
+        results._add_hit(1, 7, 0.5)
+        matrix = results.to_csr(10)
+        self.assertEquals(matrix.shape, (2, 10))
+        self.assertEquals(matrix.toarray()[1].tolist(), [0.0]*7 + [0.5, 0.0, 0.0])
+
+    def test_needs_num_columns(self):
+        with self.assertRaisesRegexp(TypeError, "num_columns must be given"):
+            search.SearchResults(2).to_csr()
+
+TestCSR = unittest2.skipUnless(has_scipy, "SciPy not available")(TestCSR)
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -161,5 +161,10 @@ class TestMACCS(unittest2.TestCase):
 
 TestMACCS = unittest2.skipIf(skip_openbabel, "OpenBabel not installed")(TestMACCS)
 
+class TestJobs(support.TestJobs, unittest2.TestCase):
+    _runner = runner
+
+TestJobs = unittest2.skipIf(skip_openbabel, "OpenBabel not installed")(TestJobs)
+
 if __name__ == "__main__":
     unittest2.main()
@@ -381,6 +381,11 @@ class TestHeaderOutput(unittest2.TestCase):
         self.assertEquals(result, "#type=OpenEye-MACCS166/1")
     
 TestHeaderOutput = unittest2.skipIf(skip_oechem, "OEChem not installed")(TestHeaderOutput)
-        
+
+class TestJobs(support.TestJobs, unittest2.TestCase):
+    _runner = runner
+
+TestJobs = unittest2.skipIf(skip_oechem, "OEChem not installed")(TestJobs)
+
 if __name__ == "__main__":
     unittest2.main()
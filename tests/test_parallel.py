@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+import unittest2
+import gzip
+from cStringIO import StringIO
+
+from chemfp.commandline import parallel
+
+import support
+
+
+class TestChunkFormat(unittest2.TestCase):
+    def test_formats(self):
+        self.assertEquals(parallel.get_chunk_format("abc.smi", None), ("smi", ""))
+        self.assertEquals(parallel.get_chunk_format("abc.sdf.gz", None), ("sdf", ".gz"))
+        self.assertEquals(parallel.get_chunk_format(None, None), ("smi", ""))
+        self.assertEquals(parallel.get_chunk_format(None, "can"), ("can", ""))
+        self.assertEquals(parallel.get_chunk_format("abc.dat", "mol.gz"), ("mol", ".gz"))
+
+    def test_unsupported_format(self):
+        with self.assertRaisesRegexp(ValueError, "--jobs only supports SMILES and SD files, not 'mol2'"):
+            parallel.get_chunk_format("abc.mol2", None)
+
+
+class TestLineChunks(unittest2.TestCase):
+    def test_chunks(self):
+        lines = ["C%d %d\n" % (i, i) for i in range(10)]
+        chunks = list(parallel.iter_line_chunks(StringIO("".join(lines)), 4))
+        self.assertEquals(chunks, [(4, "".join(lines[:4])), (4, "".join(lines[4:8])),
+                                   (2, "".join(lines[8:]))])
+
+    def test_exact_multiple(self):
+        chunks = list(parallel.iter_line_chunks(StringIO("C 1\nO 2\n"), 2))
+        self.assertEquals(chunks, [(2, "C 1\nO 2\n")])
+
+    def test_no_final_newline(self):
+        chunks = list(parallel.iter_line_chunks(StringIO("C 1\nO 2"), 5))
+        self.assertEquals(chunks, [(2, "C 1\nO 2")])
+
+    def test_empty(self):
+        self.assertEquals(list(parallel.iter_line_chunks(StringIO(""), 5)), [])
+
+
+class TestSDFChunks(unittest2.TestCase):
+    def _check_pubchem(self, infile):
+        text = open(support.PUBCHEM_SDF).read()
+        chunks = list(parallel.iter_sdf_chunks(infile, 4))
+        self.assertEquals([n for (n, chunk) in chunks], [4, 4, 4, 4, 3])
+        self.assertEquals("".join(chunk for (n, chunk) in chunks), text)
+        for n, chunk in chunks:
+            self.assertEquals(chunk.count("\n$$$$"), n)
+            self.assertTrue(chunk.endswith("$$$$\n"))
+
+    def test_pubchem(self):
+        self._check_pubchem(open(support.PUBCHEM_SDF))
+
+    def test_pubchem_gz(self):
+        self._check_pubchem(gzip.open(support.PUBCHEM_SDF_GZ))
+
+    def test_incomplete_last_record(self):
+        text = "a\n\n\n  0  0\nM  END\n$$$$\nb\n\n\n  0  0\nM  END\n"
+        self.assertEquals(list(parallel.iter_sdf_chunks(StringIO(text), 1)),
+                          [(1, text[:text.index("b")]), (1, text[text.index("b"):])])
+
+    def test_trailing_blank_lines(self):
+        text = "a\n\n\n  0  0\nM  END\n$$$$\n"
+        self.assertEquals(list(parallel.iter_sdf_chunks(StringIO(text + "\n\n"), 10)),
+                          [(1, text + "\n\n")])
+        self.assertEquals(list(parallel.iter_sdf_chunks(StringIO(""), 10)), [])
+
+class TestLocations(unittest2.TestCase):
+    def test_fix_locations(self):
+        self.assertEquals(
+            parallel._fix_locations("Cannot parse the SMILES 'Q' at line 3 of /tmp/chemfp_x.smi",
+                                    "/tmp/chemfp_x.smi", "input.smi", 1001, 1001),
+            "Cannot parse the SMILES 'Q' at line 1003 of input.smi")
+        self.assertEquals(
+            parallel._fix_locations("Missing title for record #2 at line 40 of '/tmp/chemfp_x.sdf'",
+                                    "/tmp/chemfp_x.sdf", "input.sdf", 150, 5),
+            "Missing title for record #6 at line 189 of 'input.sdf'")
+
+    def test_first_block(self):
+        self.assertEquals(
+            parallel._fix_locations("Missing title for record #3 at line 7", "x", "y", 1, 1),
+            "Missing title for record #3 at line 7")
+
+    def test_chunk_task_locations(self):
+        tasks = list(parallel._iter_chunk_tasks([support.PUBCHEM_SDF], None, 4))
+        self.assertEquals([task[4] for task in tasks], [1, 5, 9, 13, 17])
+        lines = open(support.PUBCHEM_SDF).readlines()
+        for (format_name, text, source_name, first_lineno, first_record) in tasks:
+            self.assertEquals(format_name, "sdf")
+            self.assertEquals(source_name, support.PUBCHEM_SDF)
+            self.assertEquals(text.splitlines(True)[0], lines[first_lineno-1])
+        self.assertEquals(tasks[-1][3] + tasks[-1][1].count("\n") - 1, len(lines))
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -267,5 +267,10 @@ class TestIO(unittest2.TestCase, support.TestIdAndErrors):
 
 TestIO = unittest2.skipIf(skip_rdkit, "RDKit not installed")(TestIO)
 
+class TestJobs(support.TestJobs, unittest2.TestCase):
+    _runner = runner
+
+TestJobs = unittest2.skipIf(skip_rdkit, "RDKit not installed")(TestJobs)
+
 if __name__ == "__main__":
     unittest2.main()
@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+import unittest2
+
+try:
+    import numpy
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+try:
+    from scipy import sparse
+    has_scipy = True
+except ImportError:
+    has_scipy = False
+
+import _chemfp
+import chemfp
+from chemfp import search
+
+import support
+
+CHEBI_TARGETS = support.fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = support.fullpath("chebi_queries.fps.gz")
+
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+
+# The largest difference between a stored score and the real score
+TOLERANCES = {"double": 0.0, "float": 1e-7, "uint16": 0.5/65535 + 1e-12}
+
+
+class TestSearchResults(unittest2.TestCase):
+    def test_default(self):
+        self.assertEquals(search.SearchResults(3).score_type, "double")
+
+    def test_score_types(self):
+        for score_type in ("double", "float", "uint16"):
+            results = search.SearchResults(2, score_type=score_type)
+            self.assertEquals(results.score_type, score_type)
+            for i, score in enumerate((0.0, 0.1, 1/3.0, 0.5, 0.999, 1.0)):
+                results._add_hit(1, i, score)
+            self.assertEquals(list(results[1].get_indices()), range(6))
+            for expected, score in zip((0.0, 0.1, 1/3.0, 0.5, 0.999, 1.0), results[1].get_scores()):
+                self.assertLessEqual(abs(expected - score), TOLERANCES[score_type])
+            self.assertEquals(len(results[0]), 0)
+            self.assertEquals(results[0].get_scores(), ())
+
+    def test_uint16_clips_to_the_unit_interval(self):
+        results = search.SearchResults(1, score_type="uint16")
+        results._add_hit(0, 0, -0.5)
+        results._add_hit(0, 1, 1.5)
+        self.assertEquals(list(results[0].get_scores()), [0.0, 1.0])
+
+    def test_bad_score_type(self):
+        with self.assertRaisesRegexp(ValueError, "score_type must be 'double', 'float', or 'uint16', not 'int8'"):
+            search.SearchResults(2, score_type="int8")
+
+    def test_many_hits(self):
+        # Grow through both parts of the growth policy
+        for score_type in ("double", "float", "uint16"):
+            results = search.SearchResults(1, score_type=score_type)
+            for i in range(5000):
+                results._add_hit(0, i, (i % 100) / 100.0)
+            self.assertEquals(list(results[0].get_indices()), range(5000))
+            self.assertEquals([int(round(score*100)) for score in results[0].get_scores()],
+                              [i % 100 for i in range(5000)])
+
+    def test_trim(self):
+        for score_type in ("double", "float", "uint16"):
+            results = search.SearchResults(3, score_type=score_type)
+            for i in range(101):
+                results._add_hit(0, i, i / 200.0)
+            results._add_hit(1, 5, 1.0)
+            results.trim()
+            self.assertEquals(list(results[0].get_indices()), range(101))
+            self.assertEquals([int(round(score*200)) for score in results[0].get_scores()],
+                              range(101))
+            self.assertEquals(results[1].get_indices_and_scores(), [(5, 1.0)])
+            self.assertEquals(len(results[2]), 0)
+            results._add_hit(0, 200, 0.5)
+            self.assertEquals(len(results[0]), 102)
+
+    def test_reorder(self):
+        for score_type in ("float", "uint16"):
+            results = search.SearchResults(1, score_type=score_type)
+            for i, score in enumerate((0.25, 0.75, 0.5, 1.0)):
+                results._add_hit(0, i, score)
+            scores = dict(results[0].get_indices_and_scores())
+            results.reorder_all("decreasing-score")
+            self.assertEquals(results[0].get_indices_and_scores(),
+                              [(i, scores[i]) for i in (3, 1, 2, 0)])
+            results[0].reorder("increasing-index")
+            self.assertEquals(results[0].get_indices_and_scores(),
+                              [(i, scores[i]) for i in (0, 1, 2, 3)])
+
+
+class TestSearches(unittest2.TestCase):
+    def _check(self, expected, results, score_type):
+        self.assertEquals(results.score_type, score_type)
+        self.assertEquals([list(row.get_indices()) for row in results],
+                          [list(row.get_indices()) for row in expected])
+        tolerance = TOLERANCES[score_type]
+        for expected_row, row in zip(expected, results):
+            for expected_score, score in zip(expected_row.get_scores(), row.get_scores()):
+                self.assertLessEqual(abs(expected_score - score), tolerance)
+
+    def test_threshold_tanimoto(self):
+        expected = search.threshold_tanimoto_search(queries, targets, 0.4)
+        for score_type in ("float", "uint16"):
+            self._check(expected, search.threshold_tanimoto_search(queries, targets, 0.4, score_type),
+                        score_type)
+
+    def test_threshold_metric(self):
+        expected = search.threshold_search(queries, targets, 0.5, "dice")
+        for score_type in ("float", "uint16"):
+            self._check(expected, search.threshold_search(queries, targets, 0.5, "dice", score_type),
+                        score_type)
+
+    def test_symmetric(self):
+        expected = search.threshold_tanimoto_search_symmetric(targets, 0.6)
+        for score_type in ("float", "uint16"):
+            self._check(expected, search.threshold_tanimoto_search_symmetric(
+                targets, 0.6, score_type=score_type), score_type)
+
+    def test_uint16_keeps_the_tanimoto_order(self):
+        # MACCS keys have 166 bits, so every Tanimoto score has its own uint16 value
+        expected = search.threshold_tanimoto_search(queries, targets, 0.3)
+        expected.reorder_all("decreasing-score")
+        results = search.threshold_tanimoto_search(queries, targets, 0.3, "uint16")
+        results.reorder_all("decreasing-score")
+        self.assertEquals([list(row.get_indices()) for row in results],
+                          [list(row.get_indices()) for row in expected])
+
+    def test_format_hits(self):
+        results = search.threshold_tanimoto_search(queries, targets, 0.4, "uint16")
+        lines = search.format_hits(results, queries.ids, 3).splitlines()
+        self.assertEquals(len(lines), len(queries))
+        fields = lines[0].split("\t")
+        self.assertEquals(int(fields[0]), len(results[0]))
+        self.assertEquals(fields[3], "%.3f" % results[0].get_scores()[0])
+
+    def test_knearest_needs_double_scores(self):
+        results = search.SearchResults(len(queries), targets.ids, "float")
+        with self.assertRaisesRegexp(ValueError, "k-nearest searches need SearchResults with 'double' scores"):
+            _chemfp.knearest_results_finalize(results, 0, len(queries))
+
+
+class TestNumPy(unittest2.TestCase):
+    def test_scores_array_dtype(self):
+        for score_type, dtype in (("double", numpy.float64), ("float", numpy.float32),
+                                  ("uint16", numpy.uint16)):
+            results = search.SearchResults(1, score_type=score_type)
+            results._add_hit(0, 3, 0.5)
+            scores = results[0].get_scores_array()
+            self.assertEquals(scores.dtype, dtype)
+            if score_type == "uint16":
+                self.assertEquals(scores.tolist(), [32768])
+            else:
+                self.assertEquals(scores.tolist(), [0.5])
+            self.assertEquals(results[0].get_indices_array().tolist(), [3])
+
+TestNumPy = unittest2.skipUnless(has_numpy, "NumPy not available")(TestNumPy)
+
+
+class TestCSR(unittest2.TestCase):
+    def test_csr(self):
+        expected = search.threshold_tanimoto_search(queries, targets, 0.4).to_csr()
+        for score_type, dtype in (("float", numpy.float32), ("uint16", numpy.float64)):
+            matrix = search.threshold_tanimoto_search(queries, targets, 0.4, score_type).to_csr()
+            self.assertEquals(matrix.dtype, dtype)
+            self.assertEquals(matrix.indices.tolist(), expected.indices.tolist())
+            self.assertEquals(matrix.indptr.tolist(), expected.indptr.tolist())
+            self.assertLessEqual(abs(matrix.data - expected.data).max(), TOLERANCES[score_type])
+
+TestCSR = unittest2.skipUnless(has_scipy, "SciPy not available")(TestCSR)
+
+
+if __name__ == "__main__":
+    unittest2.main()
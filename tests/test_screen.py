@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+import unittest2
+import itertools
+import threading
+
+import chemfp
+from chemfp import screen, search, bitops
+
+import support
+
+CHEBI_TARGETS = support.fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = support.fullpath("chebi_queries.fps.gz")
+
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+unordered_targets = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+_query_reader = chemfp.open(CHEBI_QUERIES)
+queries = chemfp.load_fingerprints(itertools.islice(_query_reader, 50), _query_reader.metadata)
+
+def slow_contains(query_fp, arena):
+    return [arena.start + i for (i, (id, target_fp)) in enumerate(arena)
+                if bitops.byte_contains(query_fp, target_fp)]
+
+def query_fps():
+    for (query_id, query_fp) in queries:
+        yield query_fp
+        # Fewer bits means more hits
+        yield bitops.byte_intersect(query_fp, "\x11" * len(query_fp))
+
+
+class TestScreenIndex(unittest2.TestCase):
+    def _test_contains_fp(self, arena):
+        index = screen.ScreenIndex(arena)
+        self.assertEquals(len(index), len(arena))
+        for query_fp in query_fps():
+            expected = slow_contains(query_fp, arena)
+            self.assertEquals(list(index.contains_fp(query_fp)), expected)
+            self.assertEquals(index.count_contains_fp(query_fp), len(expected))
+
+    def test_contains_fp(self):
+        self._test_contains_fp(targets)
+
+    def test_contains_fp_without_popcount_indices(self):
+        self._test_contains_fp(unordered_targets)
+
+    def test_subarena(self):
+        self._test_contains_fp(targets[100:1000])
+
+    def test_unordered_subarena(self):
+        self._test_contains_fp(unordered_targets[5:700])
+
+    def test_empty_query(self):
+        index = screen.ScreenIndex(targets)
+        empty_fp = "\0" * targets.metadata.num_bytes
+        self.assertEquals(list(index.contains_fp(empty_fp)), range(len(targets)))
+
+    def test_full_query(self):
+        index = screen.ScreenIndex(targets)
+        full_fp = "\xff" * targets.metadata.num_bytes
+        self.assertEquals(index.count_contains_fp(full_fp), 0)
+
+    def test_contains_ids_fp(self):
+        index = screen.ScreenIndex(targets)
+        query_id, query_fp = queries[0]
+        self.assertEquals(index.contains_ids_fp(query_fp),
+                          [targets.ids[i] for i in slow_contains(query_fp, targets)])
+
+    def test_wrong_size(self):
+        index = screen.ScreenIndex(targets)
+        with self.assertRaisesRegexp(ValueError, "query_fp uses 4 bytes"):
+            index.contains_fp("abcd")
+
+    def test_empty_arena(self):
+        index = screen.ScreenIndex(targets[10:10])
+        query_id, query_fp = queries[0]
+        self.assertEquals(list(index.contains_fp(query_fp)), [])
+        results = index.contains_arena(queries)
+        self.assertEquals(len(results), len(queries))
+        self.assertEquals(len(results[0]), 0)
+
+    def test_threads_share_an_index(self):
+        index = screen.ScreenIndex(targets)
+        fps = list(query_fps())
+        expected = [list(index.contains_fp(query_fp)) for query_fp in fps]
+        failures = []
+        def screen_all():
+            for i in range(5):
+                for query_fp, hits in zip(fps, expected):
+                    if list(index.contains_fp(query_fp)) != hits:
+                        failures.append(query_fp)
+        workers = [threading.Thread(target=screen_all) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEquals(failures, [])
+
+
+class TestScreenArena(unittest2.TestCase):
+    def _test_contains_arena(self, arena):
+        index = screen.ScreenIndex(arena)
+        results = index.contains_arena(queries)
+        self.assertEquals(len(results), len(queries))
+        for i, (query_id, query_fp) in enumerate(queries):
+            self.assertEquals(list(results[i].get_indices()), slow_contains(query_fp, arena))
+
+    def test_contains_arena(self):
+        self._test_contains_arena(targets)
+
+    def test_contains_arena_without_popcount_indices(self):
+        self._test_contains_arena(unordered_targets)
+
+    def test_subarena(self):
+        self._test_contains_arena(targets[200:800])
+
+    def test_matches_contains_metric(self):
+        index = screen.ScreenIndex(targets)
+        results = index.contains_arena(queries)
+        expected = search.threshold_search(queries, targets, 1.0, "contains")
+        for i in xrange(len(queries)):
+            self.assertEquals(sorted(results[i].get_ids_and_scores()),
+                              sorted(expected[i].get_ids_and_scores()))
+
+    def test_threads(self):
+        num_threads = chemfp.get_num_threads()
+        try:
+            chemfp.set_num_threads(4)
+            self._test_contains_arena(targets)
+        finally:
+            chemfp.set_num_threads(num_threads)
+
+
+if __name__ == "__main__":
+    unittest2.main()
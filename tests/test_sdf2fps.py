@@ -221,6 +221,35 @@ class TestTitleProcessing(unittest2.TestCase):
         self.assertIn("line 1 of", warning)
         self.assertIn("line 151 of", warning)
 
+class TestDecodeBlocks(unittest2.TestCase):
+    def test_bad_fingerprint_locations(self):
+        warning = run_warning("--binary --fp-tag hex16 --errors report")
+        lines = warning.splitlines()
+        self.assertEquals(len(lines), 2, warning)
+        self.assertIn("Could not binary decode 'hex16' value '0123456789abcdef'", lines[0])
+        self.assertIn("at line 1 of ", lines[0])
+        self.assertIn("title='9425004'", lines[0])
+        self.assertIn("at line 151 of ", lines[1])
+        self.assertIn("title='9425009'", lines[1])
+
+    def test_one_record_per_block(self):
+        expected = run("--hex --fp-tag hex16")
+        old_block_size = sdf2fps._DECODE_BLOCK_SIZE
+        sdf2fps._DECODE_BLOCK_SIZE = 1
+        try:
+            result = run("--hex --fp-tag hex16")
+            warning = run_warning("--hex --fp-tag hex2 --id-tag FAKE_TITLE --errors report")
+        finally:
+            sdf2fps._DECODE_BLOCK_SIZE = old_block_size
+        self.assertEquals(result[1:], expected[1:]) # skip the date
+        self.assertIn("line 151 of ", warning)
+
+    def test_first_fingerprint_larger_than_its_text(self):
+        # The first block is decoded with a storage size based on the
+        # text length, so this fingerprint must be decoded again
+        result = run_fps("--decoder chemfp.decoders.from_on_bit_positions --fp-tag binary3", 2)
+        self.assertEquals(result[0], "02" + "00"*127 + "\t9425004")
+
 class TestShortcuts(unittest2.TestCase):
     def test_pubchem(self):
         result = run("--pubchem")
@@ -1,5 +1,6 @@
 from __future__ import with_statement
 import sys
+import mmap
 import unittest2
 from cStringIO import StringIO as SIO
 
@@ -14,6 +15,7 @@ assert len(after - before) == 4, ("wrong import * count", after-before)
 
 # Needed for access to the experimental FileLocation
 from chemfp import sdf_reader
+import _chemfp
 
 TRYPTOPHAN_SDF = support.fullpath("tryptophan.sdf")
 PUBCHEM_SDF = support.fullpath("pubchem.sdf")
@@ -287,5 +289,74 @@ class TestReadTitleAndTag(unittest2.TestCase):
             self.assertRaises(TypeError, iter_title_and_tag([], tag))
 
 
+class TestSplitRecords(unittest2.TestCase):
+    def test_split(self):
+        text = open(PUBCHEM_SDF).read()
+        records, bad_records, end = _chemfp.sdf_split_records(text + "partial")
+        self.assertEquals(len(records), 19)
+        self.assertEquals("".join(records), text)
+        self.assertEquals(bad_records, [])
+        self.assertEquals(end, len(text))
+
+    def test_bad_record(self):
+        bad = tryptophan.replace("V2000", "V4000")
+        records, bad_records, end = _chemfp.sdf_split_records(tryptophan + bad + tryptophan)
+        self.assertEquals(records, [tryptophan, None, tryptophan])
+        self.assertEquals(bad_records, [bad[:-6]])
+        self.assertEquals(end, len(tryptophan)*3)
+
+    def test_count_fields(self):
+        # The atom and bond counts are followed by 28 spaces or digits and the version
+        template = "title\nprog\ncomment\n%s" + "  0"*9 + " V2000\n"
+        for counts in ("  1  2", " 12 34", "123456", "12 34 ", "1 2 ", " 1  2 ", "1 34 "):
+            record = template % (counts,)
+            self.assertEquals(_chemfp.sdf_split_records(record + "$$$$\n")[0],
+                              [record + "$$$$\n"], repr(counts))
+        for counts in ("  1 a2", "1234  ", "    12", "1 2"):
+            record = template % (counts,)
+            self.assertEquals(_chemfp.sdf_split_records(record + "$$$$\n")[0], [None], repr(counts))
+
+    def test_mmap(self):
+        with open(PUBCHEM_SDF, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                records, bad_records, end = _chemfp.sdf_split_records(mm)
+                self.assertEquals(len(records), 19)
+                # Continue from part way through the file
+                records2, bad_records, end2 = _chemfp.sdf_split_records(mm, len(records[0]), end)
+                self.assertEquals(records2, records[1:])
+                self.assertEquals(end2, end)
+                self.assertEquals(_chemfp.sdf_get_values(mm, ("<PUBCHEM_CACTVS_XLOGP>",), 1),
+                                  ("9425004", "2.8"))
+            finally:
+                mm.close()
+
+    def test_bad_range(self):
+        for start, end in ((-1, 5), (5, 4), (0, 100)):
+            with self.assertRaisesRegexp(ValueError, "valid range"):
+                _chemfp.sdf_split_records("x" * 10, start, end)
+
+class TestGetValues(unittest2.TestCase):
+    def test_values(self):
+        record = open(PUBCHEM_SDF).read().split("$$$$\n")[6] + "$$$$\n"
+        self.assertEquals(_chemfp.sdf_get_values(
+            record, ("<PUBCHEM_COMPOUND_CID>", "<PUBCHEM_CACTVS_XLOGP>", "<PUBCHEM_CACTVS_HBOND_DONOR>"), 1),
+                          ("9425030", "9425030", None, "4"))
+        self.assertEquals(_chemfp.sdf_get_values(record, [], 0), ())
+
+    def test_tag_at_end_of_data(self):
+        self.assertEquals(_chemfp.sdf_get_values("title\n> <A>", ("<A>",), 1), ("title", ""))
+        self.assertEquals(_chemfp.sdf_get_values("  title \n> <A>\n", ("<A>",), 1), ("title", ""))
+        self.assertEquals(_chemfp.sdf_get_values("title\n> <A>\nvalue", ("<A>",), 0), ("value",))
+
+    def test_tag_must_be_on_a_header_line(self):
+        record = "title\n<A>\n> <B>\n<A>\n> <A>\nyes\n\n$$$$\n"
+        self.assertEquals(_chemfp.sdf_get_values(record, ("<A>", "<B>"), 0), ("yes", "<A>"))
+
+    def test_bad_tag_substrs(self):
+        with self.assertRaisesRegexp(TypeError, "tag_substrs must be strings"):
+            _chemfp.sdf_get_values("title\n", (1,), 0)
+
+
 if __name__ == "__main__":
     unittest2.main()
@@ -130,6 +130,19 @@ class TestBasicAPI(TestCase):
         self.assertListEquals(results[0], [])
         self.assertListEquals(results[1], [])
 
+    def test_add_after_clear(self):
+        results = SearchResults(2)
+        for i in range(10):
+            results._add_hit(0, i, 0.5)
+        results._add_hit(1, 3, 0.25)
+        results.clear_all()
+        results._add_hit(0, 4, 0.75)
+        results._add_hit(0, 5, 0.25)
+        results[1].clear()
+        results._add_hit(1, 6, 1.0)
+        self.assertListEquals(results[0], [(4, 0.75), (5, 0.25)])
+        self.assertListEquals(results[1], [(6, 1.0)])
+
 
 
 class TestIterAPI(TestCase):
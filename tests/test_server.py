@@ -0,0 +1,271 @@
+from __future__ import absolute_import, with_statement
+import unittest2
+import sys
+import threading
+import Queue
+from cStringIO import StringIO
+
+import chemfp
+from chemfp import search, server, metrics
+from chemfp.commandline import simsearch, serve
+
+from support import fullpath
+
+CHEBI_TARGETS = fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = fullpath("chebi_queries.fps.gz")
+SIMPLE_FPS = fullpath("simple.fps")
+
+_targets = None
+_queries = None
+def _get_arenas():
+    global _targets, _queries
+    if _targets is None:
+        _targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        _queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+    return _queries, _targets
+
+
+class ServerTestCase(unittest2.TestCase):
+    max_wait = 0.001
+
+    def setUp(self):
+        self.queries, self.targets = _get_arenas()
+        self.server = server.SearchServer(
+            [("chebi", self.targets), ("simple", chemfp.load_fingerprints(SIMPLE_FPS))],
+            max_wait=self.max_wait)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = server.SearchClient(self.server.url)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+class TestSearches(ServerTestCase):
+    def test_targets(self):
+        targets = self.client.get_targets()
+        self.assertEquals([info["name"] for info in targets], ["chebi", "simple"])
+        self.assertEquals(targets[0]["num_fingerprints"], len(self.targets))
+        self.assertEquals(targets[0]["num_bits"], self.targets.metadata.num_bits)
+        self.assertEquals(targets[1]["num_bits"], 32)
+
+    def test_count(self):
+        results, timings = self.client.search("count", list(self.queries), threshold=0.4,
+                                              targets="chebi")
+        self.assertEquals(results,
+                          zip(self.queries.ids, search.count_tanimoto_hits(self.queries,
+                                                                           self.targets, 0.4)))
+        self.assertEquals(sorted(timings), ["queue", "search", "total"])
+
+    def test_threshold(self):
+        results, timings = self.client.search("threshold", list(self.queries), threshold=0.4,
+                                              targets="chebi")
+        expected = search.threshold_tanimoto_search(self.queries, self.targets, 0.4)
+        self.assertEquals([query_id for (query_id, hits) in results], list(self.queries.ids))
+        self.assertEquals([sorted(hits) for (query_id, hits) in results],
+                          [sorted(row.get_ids_and_scores()) for row in expected])
+
+    def test_knearest(self):
+        results, timings = self.client.search("knearest", list(self.queries), k=5, threshold=0.2,
+                                              targets="chebi")
+        expected = search.knearest_tanimoto_search(self.queries, self.targets, 5, 0.2)
+        self.assertEquals([hits for (query_id, hits) in results],
+                          [row.get_ids_and_scores() for row in expected])
+
+    def test_metric(self):
+        metric = metrics.get_metric("tversky", 0.8, 0.2)
+        results, timings = self.client.search("count", list(self.queries), threshold=0.5,
+                                              metric=metric, targets="chebi")
+        self.assertEquals([count for (query_id, count) in results],
+                          list(search.count_hits(self.queries, self.targets, 0.5, metric)))
+
+    def test_statistics(self):
+        self.client.search("count", list(self.queries)[:3], targets="chebi")
+        self.client.search("count", list(self.queries)[:2], targets="chebi")
+        stats = self.client.get_statistics()
+        self.assertEquals(stats["num_requests"], 2)
+        self.assertEquals(stats["num_queries"], 5)
+        self.assertEquals(stats["num_errors"], 0)
+        for name in ("queue", "search", "total"):
+            latency = stats["latency"][name]
+            self.assertLessEqual(latency["p50"], latency["max"])
+
+    def test_errors(self):
+        query_fp = self.queries[0][1]
+        for (kwargs, message) in (
+            (dict(targets="spam"), "Unknown targets u'spam'"),
+            (dict(), "Must specify 'targets'; the server has 2 target arenas"),
+            (dict(targets="simple"), "query #1 has 21 bytes but the targets have 4"),
+            (dict(targets="chebi", threshold=1.5), "'threshold' must be at most 1.0"),
+            (dict(targets="chebi", k=-1), "'k' must be a non-negative integer"),
+            ):
+            with self.assertRaisesRegexp(server.ServerError, message):
+                self.client.search("knearest", [("Q", query_fp)], **kwargs)
+        self.assertEquals(self.client.get_statistics()["num_errors"], 5)
+
+    def test_ids_which_are_not_utf8(self):
+        arena = chemfp.load_fingerprints([("caf\xe9", "\x01\x02\x03\x04"),
+                                          ("plain", "\x01\x02\x03\x05")],
+                                         chemfp.Metadata(num_bits=32))
+        latin1_server = server.SearchServer([("latin1", arena)], max_wait=self.max_wait)
+        thread = threading.Thread(target=latin1_server.serve_forever)
+        thread.start()
+        try:
+            client = server.SearchClient(latin1_server.url)
+            results, timings = client.search("knearest", [("q", "\x01\x02\x03\x04")],
+                                             k=2, threshold=0.0)
+        finally:
+            latin1_server.shutdown()
+            thread.join()
+        # The Latin-1 id comes back UTF-8 encoded
+        self.assertEquals(sorted(target_id for (target_id, score) in results[0][1]),
+                          ["caf\xc3\xa9", "plain"])
+
+    def test_bad_url(self):
+        with self.assertRaisesRegexp(server.ServerError, "Cannot connect"):
+            server.SearchClient("http://127.0.0.1:1").get_targets()
+
+
+class TestBatching(ServerTestCase):
+    # Wait long enough that all of the concurrent requests get merged
+    max_wait = 0.5
+
+    def test_concurrent_requests(self):
+        queries = list(self.queries)[:20]
+        responses = [None] * len(queries)
+        def run(i):
+            responses[i] = self.client.search("knearest", [queries[i]], k=3, threshold=0.0,
+                                              targets="chebi")
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(queries))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = search.knearest_tanimoto_search(self.queries[:20], self.targets, 3, 0.0)
+        self.assertEquals([results for (results, timings) in responses],
+                          [[(query_id, row.get_ids_and_scores())]
+                               for (query_id, row) in zip(self.queries.ids[:20], expected)])
+        stats = self.client.get_statistics()
+        self.assertEquals(stats["num_requests"], 20)
+        self.assertLess(stats["num_batches"], 20)
+        self.assertGreater(stats["queries_per_search"], 1.0)
+
+    def test_different_parameters_are_not_merged(self):
+        query = list(self.queries)[:1]
+        responses = []
+        def run(k):
+            responses.append((k, self.client.search("knearest", query, k=k, threshold=0.0,
+                                                    targets="chebi")[0]))
+        threads = [threading.Thread(target=run, args=(k,)) for k in (1, 2, 3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for k, results in responses:
+            self.assertEquals(len(results[0][1]), k)
+
+class _FakeRequest(object):
+    def __init__(self, num_queries):
+        self.query_fps = ["\0"] * num_queries
+
+class TestBatchSize(unittest2.TestCase):
+    def _get_batcher(self, max_batch_size):
+        # Don't start the search thread; call _get_batch() directly
+        batcher = server._Batcher.__new__(server._Batcher)
+        batcher.max_batch_size = max_batch_size
+        batcher.max_wait = 0.0
+        batcher._queue = Queue.Queue()
+        batcher._held_request = None
+        return batcher
+
+    def _get_batch_sizes(self, batcher):
+        batch = batcher._get_batch()
+        if batch is None:
+            return None
+        return [len(request.query_fps) for request in batch]
+
+    def test_batch_size_limit(self):
+        batcher = self._get_batcher(5)
+        for n in (2, 2, 3, 1, 6, None):
+            if n is None:
+                batcher.submit(None)
+            else:
+                batcher.submit(_FakeRequest(n))
+        self.assertEquals(self._get_batch_sizes(batcher), [2, 2])
+        self.assertEquals(self._get_batch_sizes(batcher), [3, 1])
+        # A request larger than the limit is searched on its own
+        self.assertEquals(self._get_batch_sizes(batcher), [6])
+        self.assertEquals(self._get_batch_sizes(batcher), None)
+
+
+def run_simsearch(cmdline):
+    real_stdout = sys.stdout
+    sys.stdout = stdout = StringIO()
+    try:
+        simsearch.main(cmdline)
+    finally:
+        sys.stdout = real_stdout
+    return stdout.getvalue().splitlines()
+
+class TestSimsearchClient(ServerTestCase):
+    def _check(self, options):
+        local = run_simsearch(options + ["--memory", CHEBI_TARGETS])
+        remote = run_simsearch(options + ["--server", self.server.url, "chebi"])
+        # Everything except the "#targets" header line is the same
+        self.assertEquals([line for line in local if not line.startswith("#targets=")],
+                          [line for line in remote if not line.startswith("#targets=")])
+        self.assertIn("#targets=chebi", remote)
+
+    def test_knearest(self):
+        self._check(["-k", "5", "--threshold", "0.2", "-q", CHEBI_QUERIES])
+
+    def test_count(self):
+        self._check(["--count", "--threshold", "0.4", "-q", CHEBI_QUERIES])
+
+    def test_hex_query(self):
+        self._check(["--hex-query", self.queries[0][1].encode("hex"), "-k", "3"])
+
+    def test_batch_size(self):
+        self._check(["-k", "3", "--batch-size", "7", "-q", CHEBI_QUERIES])
+
+    def test_needs_target_name(self):
+        with self.assertRaisesRegexp(SystemExit, "2"):
+            run_simsearch(["--server", self.server.url, "--hex-query", "00"])
+
+    def test_needs_target_filename(self):
+        with self.assertRaisesRegexp(SystemExit, "2"):
+            run_simsearch(["--hex-query", "00"])
+
+
+class TestServeOptions(unittest2.TestCase):
+    def test_target_names(self):
+        args = serve.parser.parse_args(["a/b/chebi.fps.gz", "x=y.fps", "c.fpb"])
+        self.assertEquals(args.targets, [("chebi", "a/b/chebi.fps.gz"), ("x", "y.fps"),
+                                         ("c", "c.fpb")])
+
+    def test_duplicate_names(self):
+        with self.assertRaisesRegexp(SystemExit, "2"):
+            serve.main(["-q", "a/chebi.fps", "b/chebi.fps"])
+
+    def test_bad_options(self):
+        for args in (["--max-batch-size", "0", "x.fps"],
+                     ["--max-wait", "-1", "x.fps"],
+                     ["--port", "70000", "x.fps"]):
+            with self.assertRaisesRegexp(SystemExit, "2"):
+                serve.main(args)
+
+
+class TestServerArguments(unittest2.TestCase):
+    def test_no_targets(self):
+        with self.assertRaisesRegexp(ValueError, "must have at least one target arena"):
+            server.SearchServer([])
+
+    def test_duplicate_name(self):
+        arena = chemfp.load_fingerprints(SIMPLE_FPS)
+        with self.assertRaisesRegexp(ValueError, "Duplicate target name 'x'"):
+            server.SearchServer([("x", arena), ("x", arena)])
+
+
+if __name__ == "__main__":
+    unittest2.main()
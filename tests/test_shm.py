@@ -0,0 +1,92 @@
+from __future__ import absolute_import, with_statement
+import unittest2
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+import chemfp
+from chemfp import shm, search
+
+from support import fullpath
+
+CHEBI_TARGETS = fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = fullpath("chebi_queries.fps.gz")
+
+class TestSharedArena(unittest2.TestCase):
+    def setUp(self):
+        self.old_shm_dir = os.environ.get("CHEMFP_SHM_DIR")
+        self.dirname = tempfile.mkdtemp(prefix="test_shm")
+        os.environ["CHEMFP_SHM_DIR"] = self.dirname
+
+    def tearDown(self):
+        if self.old_shm_dir is None:
+            os.environ.pop("CHEMFP_SHM_DIR", None)
+        else:
+            os.environ["CHEMFP_SHM_DIR"] = self.old_shm_dir
+        shutil.rmtree(self.dirname)
+
+    def test_publish_and_attach(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        shm.publish_arena(targets, "chebi")
+        attached = shm.attach_arena("chebi")
+        self.assertEquals(attached.ids, targets.ids)
+        self.assertEquals(list(attached), list(targets))
+        self.assertEquals(attached.metadata.type, targets.metadata.type)
+
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES)
+        expected = search.knearest_tanimoto_search(queries, targets, k=5, threshold=0.3)
+        found = search.knearest_tanimoto_search(queries, attached, k=5, threshold=0.3)
+        self.assertEquals(list(found.iter_ids_and_scores()),
+                          list(expected.iter_ids_and_scores()))
+
+    def test_attach_from_other_process(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        shm.publish_arena(targets, "chebi")
+        code = ("from chemfp import shm; arena = shm.attach_arena('chebi'); "
+                "print len(arena), arena.ids[0]")
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        p = subprocess.Popen([sys.executable, "-c", code], env=env,
+                             stdout=subprocess.PIPE)
+        output = p.communicate()[0]
+        self.assertEquals(output.split(), ["2000", targets.ids[0]])
+
+    def test_unpublish(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        shm.publish_arena(targets, "chebi")
+        attached = shm.attach_arena("chebi")
+        shm.unpublish_arena("chebi")
+        # Still usable after the name is removed
+        self.assertEquals(attached[0], targets[0])
+        with self.assertRaisesRegexp(KeyError, "No shared arena named 'chebi'"):
+            shm.attach_arena("chebi")
+        with self.assertRaisesRegexp(KeyError, "No shared arena named 'chebi'"):
+            shm.unpublish_arena("chebi")
+
+    def test_bad_name(self):
+        targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        with self.assertRaisesRegexp(ValueError, "shared arena name"):
+            shm.publish_arena(targets, "../chebi")
+        with self.assertRaisesRegexp(ValueError, "shared arena name"):
+            shm.attach_arena("")
+
+    def test_shm_directory(self):
+        self.assertEquals(shm.get_shm_directory(), self.dirname)
+        del os.environ["CHEMFP_SHM_DIR"]
+        old_default = shm._DEFAULT_SHM_DIR
+        shm._DEFAULT_SHM_DIR = self.dirname
+        try:
+            self.assertEquals(shm.get_shm_directory(), self.dirname)
+            # Don't silently fall back to a disk-backed directory
+            shm._DEFAULT_SHM_DIR = os.path.join(self.dirname, "missing")
+            with self.assertRaisesRegexp(IOError, "set CHEMFP_SHM_DIR"):
+                shm.get_shm_directory()
+            with self.assertRaisesRegexp(IOError, "set CHEMFP_SHM_DIR"):
+                shm.attach_arena("chebi")
+        finally:
+            shm._DEFAULT_SHM_DIR = old_default
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+import unittest2
+
+import chemfp
+from chemfp import search, metrics
+
+import support
+
+CHEBI_TARGETS = support.fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = support.fullpath("chebi_queries.fps.gz")
+
+targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+
+CHUNK_SIZES = (1, 7, 100, len(queries), len(queries) + 5)
+
+def _expected(results, query_arena):
+    return zip(query_arena.arena_ids, results.iter_ids_and_scores())
+
+
+class TestTanimoto(unittest2.TestCase):
+    def test_threshold(self):
+        expected = _expected(search.threshold_tanimoto_search(queries, targets, 0.4), queries)
+        for chunk_size in CHUNK_SIZES:
+            self.assertEquals(list(search.iter_threshold_tanimoto_search(
+                queries, targets, 0.4, chunk_size)), expected)
+
+    def test_knearest(self):
+        expected = _expected(search.knearest_tanimoto_search(queries, targets, 5, 0.2), queries)
+        for chunk_size in CHUNK_SIZES:
+            self.assertEquals(list(search.iter_knearest_tanimoto_search(
+                queries, targets, 5, 0.2, chunk_size)), expected)
+
+    def test_knearest_index(self):
+        indexed_targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        indexed_targets.build_knearest_index()
+        stats = search.KNearestStatistics()
+        expected = _expected(search.knearest_tanimoto_search(queries, targets, 3, 0.0), queries)
+        self.assertEquals(list(search.iter_knearest_tanimoto_search(
+            queries, indexed_targets, 3, 0.0, 10, stats)), expected)
+        self.assertEquals(stats.num_queries, len(queries))
+
+    def test_subarenas(self):
+        query_subarena = queries[5:38]
+        target_subarena = targets[100:1500]
+        expected = _expected(search.threshold_tanimoto_search(
+            query_subarena, target_subarena, 0.3), query_subarena)
+        self.assertEquals(list(search.iter_threshold_tanimoto_search(
+            query_subarena, target_subarena, 0.3, 4)), expected)
+        expected = _expected(search.knearest_tanimoto_search(
+            query_subarena, target_subarena, 4, 0.0), query_subarena)
+        self.assertEquals(list(search.iter_knearest_tanimoto_search(
+            query_subarena, target_subarena, 4, 0.0, 4)), expected)
+
+    def test_empty_queries(self):
+        self.assertEquals(list(search.iter_threshold_tanimoto_search(queries[:0], targets, 0.4)), [])
+
+    def test_results_are_yielded_per_chunk(self):
+        it = search.iter_threshold_tanimoto_search(queries, targets, 0.4, 3)
+        self.assertEquals(it.next()[0], queries.ids[0])
+
+    def test_errors_are_immediate(self):
+        with self.assertRaisesRegexp(ValueError, "chunk_size must be positive"):
+            search.iter_threshold_tanimoto_search(queries, targets, 0.4, 0)
+        with self.assertRaisesRegexp(ValueError, "k must be non-negative"):
+            search.iter_knearest_tanimoto_search(queries, targets, -1, 0.4)
+        other = chemfp.load_fingerprints([("a", "\0\0")], chemfp.Metadata(num_bits=16))
+        with self.assertRaisesRegexp(ValueError, "query_arena has 16 bits"):
+            search.iter_threshold_tanimoto_search(other, targets, 0.4)
+
+
+class TestMetrics(unittest2.TestCase):
+    def test_threshold(self):
+        for metric in (None, "dice", metrics.Metric("tversky", 0.9, 0.1), "hamming"):
+            expected = _expected(search.threshold_search(queries, targets, 0.6, metric), queries)
+            self.assertEquals(list(search.iter_threshold_search(queries, targets, 0.6, metric, 9)),
+                              expected)
+
+    def test_knearest(self):
+        for metric in (None, "cosine", metrics.Metric("tversky", 0.3, 1.7)):
+            expected = _expected(search.knearest_search(queries, targets, 3, 0.1, metric), queries)
+            self.assertEquals(list(search.iter_knearest_search(queries, targets, 3, 0.1, metric, 9)),
+                              expected)
+
+
+class TestArenaMethods(unittest2.TestCase):
+    # The id-based arena searches stream 'arena_size' queries at a time
+    def test_query_arena(self):
+        expected = _expected(search.threshold_tanimoto_search(queries, targets, 0.4), queries)
+        self.assertEquals(list(targets.id_threshold_tanimoto_search(queries, 0.4, arena_size=6)),
+                          expected)
+        expected = _expected(search.knearest_search(queries, targets, 2, 0.0, "dice"), queries)
+        self.assertEquals(list(targets.id_knearest_search(queries, 2, 0.0, "dice", arena_size=6)),
+                          expected)
+
+    def test_query_reader(self):
+        expected = _expected(search.knearest_tanimoto_search(queries, targets, 3, 0.0), queries)
+        self.assertEquals(list(targets.id_knearest_tanimoto_search(chemfp.open(CHEBI_QUERIES),
+                                                                   3, 0.0, arena_size=6)),
+                          expected)
+
+
+if __name__ == "__main__":
+    unittest2.main()
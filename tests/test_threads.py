@@ -0,0 +1,243 @@
+from __future__ import absolute_import, with_statement
+import unittest2
+import os
+import random
+import threading
+import time
+
+import chemfp
+import _chemfp
+from chemfp import bitops, search
+
+from support import fullpath
+
+CHEBI_TARGETS = fullpath("chebi_rdmaccs.fps")
+CHEBI_QUERIES = fullpath("chebi_queries.fps.gz")
+
+
+def _random_arena(num_fingerprints, num_bytes, seed):
+    rng = random.Random(seed)
+    fps = [("ID%d" % i, ("%0*x" % (num_bytes*2, rng.getrandbits(num_bytes*8))).decode("hex"))
+               for i in xrange(num_fingerprints)]
+    return chemfp.load_fingerprints(fps, chemfp.Metadata(num_bits=num_bytes*8))
+
+_big_arenas = None
+def _get_big_arenas():
+    # Big enough that one search takes a noticeable amount of time
+    global _big_arenas
+    if _big_arenas is None:
+        _big_arenas = (_random_arena(400, 128, 1), _random_arena(40000, 128, 2))
+    return _big_arenas
+
+def _run_threads(num_threads, f):
+    results = [None] * num_threads
+    errors = []
+    def run(i):
+        try:
+            results[i] = f()
+        except Exception, err:
+            errors.append(err)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class TestConcurrentSearches(unittest2.TestCase):
+    # Several Python threads search the same arenas at once. The
+    # results must be the same as when the searches are done one at a
+    # time.
+    def setUp(self):
+        self._num_threads = chemfp.get_num_threads()
+        self.targets = chemfp.load_fingerprints(CHEBI_TARGETS)
+        self.queries = chemfp.load_fingerprints(CHEBI_QUERIES, reorder=False)
+    def tearDown(self):
+        chemfp.set_num_threads(self._num_threads)
+
+    def _searches(self):
+        queries, targets = self.queries, self.targets
+        return [
+            list(search.count_tanimoto_hits(queries, targets, 0.4)),
+            [result.get_ids_and_scores() for result in
+                 search.threshold_tanimoto_search(queries, targets, 0.4)],
+            [result.get_ids_and_scores() for result in
+                 search.knearest_tanimoto_search(queries, targets, 5, 0.2)],
+            list(search.count_tanimoto_hits_symmetric(targets, 0.6)),
+            [result.get_indices_and_scores() for result in
+                 search.threshold_tanimoto_search_symmetric(targets, 0.6)],
+            ]
+
+    def _check(self):
+        expected = self._searches()
+        for results in _run_threads(8, self._searches):
+            self.assertEquals(results, expected)
+
+    def test_single_threaded_searches(self):
+        chemfp.set_num_threads(1)
+        self._check()
+
+    def test_openmp_searches(self):
+        chemfp.set_num_threads(chemfp.get_max_threads())
+        self._check()
+
+    def test_different_arenas(self):
+        chemfp.set_num_threads(1)
+        slices = [(0, 100), (50, 700), (600, 2000), (0, len(self.targets))]
+        def search_slice(start, end):
+            return [result.get_ids_and_scores() for result in
+                        search.threshold_tanimoto_search(self.queries, self.targets[start:end], 0.3)]
+        expected = [search_slice(start, end) for (start, end) in slices]
+        results = [None] * len(slices)
+        def run(i):
+            results[i] = search_slice(*slices[i])
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(slices))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(results, expected)
+
+    def test_concurrent_loads(self):
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS)
+        for arena in _run_threads(4, lambda: chemfp.load_fingerprints(CHEBI_TARGETS)):
+            self.assertEquals(list(arena), list(expected))
+            self.assertEquals(arena.popcount_indices, expected.popcount_indices)
+
+    def test_set_num_threads_in_other_threads(self):
+        # The number of threads is a global setting, not a per-thread one
+        chemfp.set_num_threads(1)
+        self.assertEquals(_run_threads(3, chemfp.get_num_threads), [1, 1, 1])
+
+
+class TestGILReleased(unittest2.TestCase):
+    def setUp(self):
+        self._num_threads = chemfp.get_num_threads()
+        chemfp.set_num_threads(1)
+        self.queries, self.targets = _get_big_arenas()
+    def tearDown(self):
+        chemfp.set_num_threads(self._num_threads)
+
+    def _count(self):
+        return search.count_tanimoto_hits(self.queries, self.targets, 0.35)
+
+    def test_main_thread_runs_during_search(self):
+        t1 = time.time()
+        expected = list(self._count())
+        search_time = time.time() - t1
+        if search_time < 0.05:
+            raise unittest2.SkipTest("search is too fast to time")
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(list(self._count())))
+        # If the search holds the GIL then the main thread stops for
+        # the entire search. Otherwise it gets its usual time slices.
+        prev_time = time.time()
+        max_gap = 0.0
+        thread.start()
+        while thread.is_alive():
+            now = time.time()
+            max_gap = max(max_gap, now - prev_time)
+            prev_time = now
+        thread.join()
+        self.assertEquals(results, [expected])
+        self.assertLess(max_gap, search_time / 2, (max_gap, search_time))
+
+    def test_results_in_use(self):
+        queries, targets = self.queries, self.targets
+        results = search.SearchResults(len(queries), targets.ids)
+        other_results = search.SearchResults(len(queries), targets.ids)
+        def threshold_search(results):
+            return _chemfp.threshold_tanimoto_arena(
+                0.4, targets.num_bits,
+                queries.start_padding, queries.end_padding,
+                queries.storage_size, queries.arena, queries.start, queries.end,
+                targets.start_padding, targets.end_padding,
+                targets.storage_size, targets.arena, targets.start, targets.end,
+                targets.popcount_indices,
+                results, 0)
+
+        errors = []
+        thread = threading.Thread(target=threshold_search, args=(results,))
+        thread.start()
+        while thread.is_alive():
+            # The rows can't be used while the search adds to them
+            try:
+                len(results[0])
+            except RuntimeError, err:
+                self.assertEquals(str(err), "SearchResults is in use by another thread")
+                errors.append(err)
+            # Other results are not affected
+            self.assertEquals(len(other_results[0]), 0)
+        thread.join()
+        if not errors:
+            raise unittest2.SkipTest("search finished before the main thread could run")
+
+        self.assertEquals(threshold_search(other_results), 0)
+        results.reorder_all("increasing-index")
+        other_results.reorder_all("increasing-index")
+        self.assertEquals([result.get_ids_and_scores() for result in results],
+                          [result.get_ids_and_scores() for result in other_results])
+
+    def test_search_into_results_in_use(self):
+        queries, targets = self.queries, self.targets
+        results = search.SearchResults(len(queries), targets.ids)
+        def threshold_search():
+            return _chemfp.threshold_tanimoto_arena(
+                0.4, targets.num_bits,
+                queries.start_padding, queries.end_padding,
+                queries.storage_size, queries.arena, queries.start, queries.end,
+                targets.start_padding, targets.end_padding,
+                targets.storage_size, targets.arena, targets.start, targets.end,
+                targets.popcount_indices,
+                results, 0)
+        errors = []
+        def run():
+            try:
+                threshold_search()
+            except RuntimeError, err:
+                errors.append(err)
+        # Only one of two searches into the same results can run at a time
+        threads = [threading.Thread(target=run) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not errors:
+            raise unittest2.SkipTest("the searches didn't overlap")
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(str(errors[0]), "SearchResults is in use by another thread")
+        expected = search.threshold_tanimoto_search(queries, targets, 0.4)
+        expected.reorder_all("increasing-index")
+        results.reorder_all("increasing-index")
+        self.assertEquals([result.get_ids_and_scores() for result in results],
+                          [result.get_ids_and_scores() for result in expected])
+
+
+class TestLargeFingerprintOperations(unittest2.TestCase):
+    # The bitops functions release the GIL for large fingerprints.
+    # Check both sides of the size cutoff.
+    def test_sizes(self):
+        for size in (16, 2047, 2048, 10000):
+            fp1 = os.urandom(size)
+            fp2 = os.urandom(size)
+            popcount = sum(bin(ord(c)).count("1") for c in fp1)
+            intersect = sum(bin(ord(c1) & ord(c2)).count("1") for (c1, c2) in zip(fp1, fp2))
+            union = sum(bin(ord(c1) | ord(c2)).count("1") for (c1, c2) in zip(fp1, fp2))
+            self.assertEquals(bitops.byte_popcount(fp1), popcount)
+            self.assertEquals(bitops.byte_intersect_popcount(fp1, fp2), intersect)
+            self.assertEquals(bitops.byte_tanimoto(fp1, fp2), float(intersect) / union)
+            self.assertEquals(bitops.hex_popcount(fp1.encode("hex")), popcount)
+            self.assertEquals(bitops.hex_intersect_popcount(fp1.encode("hex"), fp2.encode("hex")),
+                              intersect)
+            self.assertEquals(bitops.hex_tanimoto(fp1.encode("hex"), fp2.encode("hex")),
+                              float(intersect) / union)
+            self.assertEquals(bitops.hex_isvalid(fp1.encode("hex")), 1)
+            self.assertEquals(bitops.byte_contains(fp1, fp1), 1)
+
+
+if __name__ == "__main__":
+    unittest2.main()